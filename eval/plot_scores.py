@@ -5,23 +5,31 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+from registry import Registry
 
-if __name__ == '__main__':
 
-	scores_dir = 'scores'
-	
-	# Load scores for test all, wb, and nwb sets
-	test_all_scores = pd.read_csv(f'{scores_dir}/test_all_scores.csv')
-	test_wb_scores = pd.read_csv(f'{scores_dir}/test_wb_scores.csv')
-	test_nwb_scores = pd.read_csv(f'{scores_dir}/test_nwb_scores.csv')
+if __name__ == '__main__':
 
-	# Add 'eval_set' column
-	test_all_scores['eval_set'] = 'All'
-	test_wb_scores['eval_set'] = 'White British'
-	test_nwb_scores['eval_set'] = 'Not White British'
+	registry_file = 'scores/registry.sqlite'
+	phenos = None
+	model_types = None
+
+	# Load scores for test all, wb, and nwb sets from the run registry
+	registry = Registry(registry_file)
+	eval_sets = {
+		'test': 'All',
+		'test_wb': 'White British',
+		'test_nwb': 'Not White British',
+	}
+	split_scores = []
+	for split, eval_set in eval_sets.items():
+		scores_df = registry.scores(split, phenos=phenos, model_types=model_types)
+		scores_df['eval_set'] = eval_set
+		split_scores.append(scores_df)
+	registry.close()
 
 	# Concatenate
-	all_scores = pd.concat([test_all_scores, test_wb_scores, test_nwb_scores])
+	all_scores = pd.concat(split_scores)
 
 	# Plot
 	all_scores['white_british'] = all_scores['white_british'].astype(str).replace({'True': 'True', 'False': 'False'})
@@ -0,0 +1,605 @@
+"""SQLite registry of model runs, their scores and runtimes.
+
+Runs are discovered by listing each output root in OUTPUT_ROOTS once
+(recursively, for scores.json and runtime.json files) and every GWAS
+runtime.json under GWAS_ROOT. A folder whose launch reused an earlier
+analysis's outputs has these files listed in its reuse pointer file
+instead (see rap_utils/reuse.py), which is followed as dx_resolve does.
+A run is a folder directly in an output root holding a scores.json,
+named as the launchers name them:
+
+	prsice:	{pheno}[_wb][_dev]
+	basil:	{pheno}[_wb][_dev]_{model_type}
+	automl:	{pheno}[_wb]_{data_version}_{model_config}
+
+Ingest is incremental: a run is only downloaded and stored if it is new
+or its scores.json or runtime.json file ID has changed since it was last
+ingested. A folder with more than one file of either name is skipped.
+Each run stores its model type, class and description, the training
+population, the data version, the model config (with the config JSON
+from prs_aml/docker/model_configs for AutoML runs), its runtime and
+every metric of every split of its scores.json.
+
+scores() returns one split's scores in the layout of the scores/*.csv
+tables, filtered on indexed columns, with the GWAS runtime added to the
+runtime of models that use GWAS summary statistics.
+
+Run as a script to ingest new runs:
+
+	python registry.py ingest --db scores/registry.sqlite
+"""
+
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+EVAL_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(EVAL_DIR, '..', 'ukb_rap_workflows'))
+from rap_utils.dx_resolve import REUSE_POINTER_FILE, AmbiguousPathError
+from rap_utils.local_dx import get_dxpy
+
+
+OUTPUT_ROOTS = {
+	'prsice': '/rdevito/nonlin_prs/sum_stats_prs/PRSice2/prsice2_output',
+	'basil': '/rdevito/nonlin_prs/batch_iterative_prs/output',
+	'automl': '/rdevito/nonlin_prs/automl_prs/output',
+}
+GWAS_ROOT = '/rdevito/nonlin_prs/gwas/gwas_output'
+DEFAULT_DB = os.path.join(EVAL_DIR, 'scores', 'registry.sqlite')
+DEFAULT_CACHE_DIR = os.path.join(EVAL_DIR, 'tmp', 'json_cache')
+PHENO_METADATA_FILE = os.path.join(EVAL_DIR, '..', 'data', 'pheno_metadata.json')
+MODEL_CONFIG_DIR = os.path.join(
+	EVAL_DIR, '..', 'ukb_rap_workflows', 'prs_aml', 'docker', 'model_configs'
+)
+
+# Descriptions differing from the model config name
+MODEL_DESCS = {
+	'prsice': 'PRSice-2',
+	'automl_max35000_v2_npart_elastic_net_v0h24': 'n-part elastic net v0h24',
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+	run_dir TEXT PRIMARY KEY,
+	model_type TEXT NOT NULL,
+	model_class TEXT NOT NULL,
+	model_desc TEXT NOT NULL,
+	pheno TEXT NOT NULL,
+	white_british INTEGER NOT NULL,
+	dev INTEGER NOT NULL,
+	data_version TEXT,
+	model_config TEXT,
+	model_config_json TEXT,
+	uses_gwas INTEGER NOT NULL,
+	runtime_seconds REAL,
+	scores_file_id TEXT NOT NULL,
+	runtime_file_id TEXT,
+	ingested_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_pheno ON runs (pheno, white_british, dev);
+CREATE INDEX IF NOT EXISTS runs_model_type ON runs (model_type);
+CREATE INDEX IF NOT EXISTS runs_model_class ON runs (model_class);
+
+CREATE TABLE IF NOT EXISTS scores (
+	split TEXT NOT NULL,
+	run_dir TEXT NOT NULL REFERENCES runs (run_dir) ON DELETE CASCADE,
+	metric TEXT NOT NULL,
+	metric_order INTEGER NOT NULL,
+	value REAL,
+	PRIMARY KEY (split, run_dir, metric)
+);
+
+CREATE TABLE IF NOT EXISTS gwas_runs (
+	run_dir TEXT PRIMARY KEY,
+	pheno TEXT NOT NULL,
+	white_british INTEGER NOT NULL,
+	dev INTEGER NOT NULL,
+	runtime_seconds REAL,
+	runtime_file_id TEXT NOT NULL,
+	ingested_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS gwas_runs_pheno ON gwas_runs (pheno, white_british, dev);
+"""
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument("command", choices=['ingest'])
+	parser.add_argument("--db", default=DEFAULT_DB)
+	parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+	parser.add_argument("--n-workers", type=int, default=16)
+
+	return parser.parse_args()
+
+
+def download_json(dx, file_id, cache_dir):
+	"""Load a JSON file from storage, downloading it at most once.
+
+	Files are cached as {cache_dir}/{file_id}.json. File IDs are
+	immutable, so a cached file never goes stale. Downloads go to a
+	unique temp file that is renamed into place, so concurrent downloads
+	never read partial files.
+	"""
+	cache_fname = os.path.join(cache_dir, f'{file_id}.json')
+
+	if not os.path.exists(cache_fname):
+		fd, temp_fname = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+		os.close(fd)
+		try:
+			dx.download_dxfile(file_id, temp_fname)
+			os.replace(temp_fname, cache_fname)
+		finally:
+			if os.path.exists(temp_fname):
+				os.remove(temp_fname)
+
+	with open(cache_fname, 'r') as f:
+		return json.load(f)
+
+
+def list_json_files(dx, root, names):
+	"""Dict of folder -> {file name: [file IDs]} under root, in one query."""
+	name_re = '^(' + '|'.join(re.escape(n) for n in names) + ')$'
+	folders = defaultdict(lambda: defaultdict(list))
+	for obj in dx.find_data_objects(
+		classname='file',
+		folder=root,
+		recurse=True,
+		name=name_re,
+		name_mode='regexp',
+		project=dx.PROJECT_CONTEXT_ID,
+		describe={'fields': {'name': True, 'folder': True}}
+	):
+		desc = obj['describe']
+		folders[desc['folder']][desc['name']].append(obj['id'])
+	return folders
+
+
+def follow_reuse_pointers(dx, folders, names, cache_dir, n_workers=16):
+	"""Add files a folder's reuse pointer lists to a list_json_files() listing.
+
+	As in dx_resolve, a listed file of the same name in the folder takes
+	precedence, and a folder with more than one pointer is left as is.
+
+	Args:
+		dx: dxpy module or stand-in.
+		folders: Dict of folder -> {file name: [file IDs]}, updated in place.
+		names: File names to take from the pointers.
+		cache_dir: Local directory of downloaded JSON files.
+		n_workers: Number of concurrent downloads.
+	"""
+	pointer_folders = [
+		folder for folder, files in folders.items()
+		if len(files.get(REUSE_POINTER_FILE, [])) == 1
+	]
+	with ThreadPoolExecutor(max_workers=n_workers) as executor:
+		pointers = executor.map(
+			lambda folder: download_json(
+				dx, folders[folder][REUSE_POINTER_FILE][0], cache_dir
+			),
+			pointer_folders
+		)
+		for folder, pointer in zip(pointer_folders, pointers):
+			for name, file_id in pointer['files'].items():
+				if name in names and name not in folders[folder]:
+					folders[folder][name] = [file_id]
+
+
+def split_population(name, phenos):
+	"""(pheno, white_british, dev, rest) of a run folder name, or None.
+
+	rest is what follows the phenotype and population suffixes, without
+	its leading underscore.
+	"""
+	matches = [p for p in phenos if name == p or name.startswith(p + '_')]
+	if not matches:
+		return None
+	pheno = max(matches, key=len)
+	rest = name[len(pheno):]
+
+	flags = {}
+	for flag in ['wb', 'dev']:
+		flags[flag] = rest == f'_{flag}' or rest.startswith(f'_{flag}_')
+		if flags[flag]:
+			rest = rest[len(flag) + 1:]
+
+	return pheno, flags['wb'], flags['dev'], rest.lstrip('_')
+
+
+def automl_model_class(model_config, config):
+	"""'AutoML linear' or 'AutoML non-linear' from a model config."""
+	model_name = config['model_type'] if config else model_config
+	if 'elastic_net' in model_name or 'lasso' in model_name or 'ridge' in model_name:
+		return 'AutoML linear'
+	return 'AutoML non-linear'
+
+
+def parse_run_dir(kind, name, phenos, model_configs):
+	"""Metadata of a run from its output root kind and folder name.
+
+	Returns None if the folder name does not match the kind's pattern.
+
+	Args:
+		kind: Key of OUTPUT_ROOTS.
+		name: Run folder name.
+		phenos: Known phenotype names.
+		model_configs: Dict of AutoML model config name -> config dict.
+	"""
+	parsed = split_population(name, phenos)
+	if parsed is None:
+		return None
+	pheno, white_british, dev, rest = parsed
+
+	run = {
+		'pheno': pheno,
+		'white_british': white_british,
+		'dev': dev,
+		'data_version': None,
+		'model_config': None,
+		'model_config_json': None,
+		'uses_gwas': kind != 'basil',
+	}
+
+	if kind == 'prsice':
+		if rest:
+			return None
+		run.update(
+			model_type='prsice',
+			model_class='C+T',
+			model_desc=MODEL_DESCS['prsice']
+		)
+	elif kind == 'basil':
+		if not rest:
+			return None
+		run.update(
+			model_type=f'basil_{rest}',
+			model_class='Iterative screening',
+			model_desc=f'BASIL {rest.replace("_", " ").capitalize()}',
+			model_config=rest
+		)
+	elif kind == 'automl':
+		if not rest:
+			return None
+
+		# Longest known config the name ends with, else max{N}_v{M}_{config}
+		known = [c for c in model_configs if rest.endswith(f'_{c}')]
+		if known:
+			model_config = max(known, key=len)
+			data_version = rest[:-len(model_config) - 1]
+		else:
+			match = re.match(r'^(max\d+_v\d+)_(.+)$', rest)
+			data_version, model_config = match.groups() if match else (None, rest)
+
+		config = model_configs.get(model_config)
+		model_type = f'automl_{rest}'
+		run.update(
+			model_type=model_type,
+			model_class=automl_model_class(model_config, config),
+			model_desc=MODEL_DESCS.get(model_type, model_config),
+			data_version=data_version,
+			model_config=model_config,
+			model_config_json=json.dumps(config) if config else None
+		)
+	else:
+		raise ValueError(f'Unknown output root kind: {kind}')
+
+	return run
+
+
+def load_model_configs(model_config_dir=MODEL_CONFIG_DIR):
+	"""Dict of AutoML model config name -> config dict."""
+	configs = {}
+	if os.path.isdir(model_config_dir):
+		for fname in sorted(os.listdir(model_config_dir)):
+			if fname.endswith('.json'):
+				with open(os.path.join(model_config_dir, fname)) as f:
+					configs[fname[:-len('.json')]] = json.load(f)
+	return configs
+
+
+def _single_id(files, name):
+	"""File ID of name in a folder listing, or None if missing.
+
+	Raises AmbiguousPathError if the listing has more than one.
+	"""
+	ids = files.get(name, [])
+	if len(ids) > 1:
+		raise AmbiguousPathError(f'{len(ids)} files named {name}')
+	return ids[0] if ids else None
+
+
+class Registry:
+	"""SQLite registry of runs.
+
+	Args:
+		db_file: SQLite database file, created if it does not exist.
+	"""
+
+	def __init__(self, db_file=DEFAULT_DB):
+		os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+		self.conn = sqlite3.connect(db_file)
+		self.conn.execute('PRAGMA foreign_keys = ON')
+		self.conn.executescript(SCHEMA)
+
+	def close(self):
+		self.conn.close()
+
+	def _ingested_ids(self, table, id_cols):
+		"""Dict of run_dir -> tuple of file IDs of ingested runs."""
+		rows = self.conn.execute(
+			f'SELECT run_dir, {", ".join(id_cols)} FROM {table}'
+		)
+		return {row[0]: tuple(row[1:]) for row in rows}
+
+	def ingest(
+		self,
+		dx=None,
+		output_roots=OUTPUT_ROOTS,
+		gwas_root=GWAS_ROOT,
+		phenos=None,
+		model_configs=None,
+		cache_dir=DEFAULT_CACHE_DIR,
+		n_workers=16
+	):
+		"""Ingest new and changed runs. Returns the number ingested.
+
+		Args:
+			dx: dxpy module or stand-in. Default: local_dx.get_dxpy().
+			output_roots: Dict of kind -> output root folder.
+			gwas_root: Output root of GWAS runs.
+			phenos: Phenotype names. Default: those in pheno_metadata.json.
+			model_configs: Dict of AutoML model config name -> config.
+				Default: configs in prs_aml/docker/model_configs.
+			cache_dir: Local directory of downloaded JSON files.
+			n_workers: Number of concurrent listings and downloads.
+		"""
+		dx = dx if dx is not None else get_dxpy()
+		if phenos is None:
+			with open(PHENO_METADATA_FILE) as f:
+				phenos = list(json.load(f))
+		if model_configs is None:
+			model_configs = load_model_configs()
+		os.makedirs(cache_dir, exist_ok=True)
+
+		# List every root once, concurrently
+		run_files = ['scores.json', 'runtime.json']
+		roots = dict(output_roots, gwas=gwas_root)
+		with ThreadPoolExecutor(max_workers=n_workers) as executor:
+			listings = dict(zip(roots, executor.map(
+				lambda root: list_json_files(dx, root, run_files + [REUSE_POINTER_FILE]),
+				roots.values()
+			)))
+		for folders in listings.values():
+			follow_reuse_pointers(dx, folders, run_files, cache_dir, n_workers)
+
+		# Runs that are new or whose files changed
+		ingested_runs = self._ingested_ids('runs', ['scores_file_id', 'runtime_file_id'])
+		ingested_gwas = self._ingested_ids('gwas_runs', ['runtime_file_id'])
+		new_runs = []
+		new_gwas = []
+
+		for kind, folders in listings.items():
+			root = roots[kind].rstrip('/')
+			for folder, files in folders.items():
+				parent, name = folder.rstrip('/').rsplit('/', 1)
+				if parent != root:
+					continue
+
+				try:
+					scores_id = _single_id(files, 'scores.json')
+					runtime_id = _single_id(files, 'runtime.json')
+				except AmbiguousPathError as e:
+					# Which file is current is unknown, so neither is used
+					print(f'Skipping {folder}: {e}', flush=True)
+					continue
+
+				if kind == 'gwas':
+					match = re.match(r'^(.+)_glm(_wb)?(_dev)?$', name)
+					if runtime_id is None or match is None:
+						continue
+					if ingested_gwas.get(folder) == (runtime_id,):
+						continue
+					new_gwas.append({
+						'run_dir': folder,
+						'pheno': match.group(1),
+						'white_british': match.group(2) is not None,
+						'dev': match.group(3) is not None,
+						'runtime_file_id': runtime_id,
+					})
+					continue
+
+				if scores_id is None:
+					continue
+				if ingested_runs.get(folder) == (scores_id, runtime_id):
+					continue
+
+				run = parse_run_dir(kind, name, phenos, model_configs)
+				if run is None:
+					print(f'Skipping {folder}: unrecognized run name', flush=True)
+					continue
+				run.update(
+					run_dir=folder,
+					scores_file_id=scores_id,
+					runtime_file_id=runtime_id
+				)
+				new_runs.append(run)
+
+		print(
+			f'{len(new_runs)} new or changed runs and {len(new_gwas)} GWAS runs '
+			'to ingest',
+			flush=True
+		)
+
+		# Download only the files of new and changed runs
+		file_ids = [r['scores_file_id'] for r in new_runs]
+		file_ids += [r['runtime_file_id'] for r in new_runs + new_gwas]
+		file_ids = list(dict.fromkeys(f for f in file_ids if f is not None))
+		with ThreadPoolExecutor(max_workers=n_workers) as executor:
+			contents = dict(zip(file_ids, executor.map(
+				lambda file_id: download_json(dx, file_id, cache_dir), file_ids
+			)))
+
+		def runtime_of(file_id):
+			if file_id is None:
+				return None
+			return contents[file_id]['runtime_seconds']
+
+		now = time.time()
+		with self.conn:
+			for run in new_runs:
+				self.conn.execute('DELETE FROM runs WHERE run_dir = ?', (run['run_dir'],))
+				self.conn.execute(
+					'INSERT INTO runs VALUES (:run_dir, :model_type, :model_class, '
+					':model_desc, :pheno, :white_british, :dev, :data_version, '
+					':model_config, :model_config_json, :uses_gwas, '
+					':runtime_seconds, :scores_file_id, :runtime_file_id, '
+					':ingested_at)',
+					dict(
+						run,
+						runtime_seconds=runtime_of(run['runtime_file_id']),
+						ingested_at=now
+					)
+				)
+				self.conn.executemany(
+					'INSERT INTO scores VALUES (?, ?, ?, ?, ?)',
+					[
+						(split, run['run_dir'], metric, i, value)
+						for split, metrics in contents[run['scores_file_id']].items()
+						if isinstance(metrics, dict)
+						for i, (metric, value) in enumerate(metrics.items())
+					]
+				)
+
+			for gwas_run in new_gwas:
+				self.conn.execute(
+					'INSERT OR REPLACE INTO gwas_runs VALUES (:run_dir, :pheno, '
+					':white_british, :dev, :runtime_seconds, :runtime_file_id, '
+					':ingested_at)',
+					dict(
+						gwas_run,
+						runtime_seconds=runtime_of(gwas_run['runtime_file_id']),
+						ingested_at=now
+					)
+				)
+
+		return len(new_runs) + len(new_gwas)
+
+	def has_run(self, model_type, pheno, white_british, dev=False):
+		"""Whether a run of a model type has been ingested."""
+		row = self.conn.execute(
+			'SELECT 1 FROM runs WHERE pheno = ? AND white_british = ? AND dev = ? '
+			'AND model_type = ? LIMIT 1',
+			(pheno, int(white_british), int(dev), model_type)
+		).fetchone()
+		return row is not None
+
+	def scores(
+		self,
+		split,
+		phenos=None,
+		model_types=None,
+		model_classes=None,
+		white_british=None,
+		dev=False
+	):
+		"""DataFrame of one split's scores, one row per run.
+
+		Columns are model_class, model_desc, pheno, white_british, the
+		metrics in scores.json order and runtime_seconds. Rows are
+		ordered by model_types and phenos when given.
+
+		Args:
+			split: Split of scores.json, e.g. 'val' or 'test_wb'.
+			phenos: Phenotypes to include. Default: all.
+			model_types: Model types to include, e.g. 'prsice' or
+				'automl_max35000_v2_lgbm_v0h24'. Default: all.
+			model_classes: Model classes to include. Default: all.
+			white_british: Only runs trained on white British samples if
+				True, or on all samples if False. Default: both.
+			dev: Runs trained on the development subset if True, the full
+				train split if False, or both if None.
+		"""
+		where = ['s.split = ?']
+		params = [split]
+		for col, values in [
+			('r.pheno', phenos),
+			('r.model_type', model_types),
+			('r.model_class', model_classes),
+		]:
+			if values is not None:
+				where.append(f'{col} IN ({", ".join("?" * len(values))})')
+				params += list(values)
+		for col, value in [('r.white_british', white_british), ('r.dev', dev)]:
+			if value is not None:
+				where.append(f'{col} = ?')
+				params.append(int(value))
+
+		long_df = pd.read_sql_query(
+			f"""
+			SELECT
+				r.run_dir, r.model_type, r.model_class, r.model_desc, r.pheno,
+				r.white_british,
+				CASE WHEN r.uses_gwas
+					THEN r.runtime_seconds + g.runtime_seconds
+					ELSE r.runtime_seconds
+				END AS runtime_seconds,
+				s.metric, s.metric_order, s.value
+			FROM scores s
+			JOIN runs r ON r.run_dir = s.run_dir
+			LEFT JOIN gwas_runs g
+				ON g.pheno = r.pheno
+				AND g.white_british = r.white_british
+				AND g.dev = r.dev
+			WHERE {' AND '.join(where)}
+			""",
+			self.conn,
+			params=params
+		)
+
+		run_cols = [
+			'run_dir', 'model_type', 'model_class', 'model_desc', 'pheno',
+			'white_british', 'runtime_seconds'
+		]
+		metrics = (
+			long_df.groupby('metric', sort=False)['metric_order'].min()
+			.sort_values(kind='stable').index.tolist()
+		)
+		scores_df = long_df.pivot(
+			index='run_dir', columns='metric', values='value'
+		)
+		runs_df = long_df[run_cols].drop_duplicates('run_dir').set_index('run_dir')
+		scores_df = runs_df.join(scores_df).reset_index(drop=True)
+		scores_df['white_british'] = scores_df['white_british'].astype(bool)
+
+		# Order rows by the given model types and phenotypes
+		sort_cols = []
+		for col, values in [('model_type', model_types), ('pheno', phenos)]:
+			if values is not None:
+				scores_df[col] = pd.Categorical(scores_df[col], categories=values)
+			sort_cols.append(col)
+		scores_df = scores_df.sort_values(
+			sort_cols + ['white_british'], kind='stable'
+		)
+
+		return scores_df[
+			['model_class', 'model_desc', 'pheno', 'white_british']
+			+ metrics + ['runtime_seconds']
+		].reset_index(drop=True)
+
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	registry = Registry(args.db)
+	n_ingested = registry.ingest(cache_dir=args.cache_dir, n_workers=args.n_workers)
+	print(f'Ingested {n_ingested} runs into {args.db}')
+	registry.close()
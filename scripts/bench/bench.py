@@ -0,0 +1,483 @@
+"""Benchmark pipeline components on synthetic data across a size grid.
+
+For every (n_samples, n_variants) size a dataset is generated with
+synth_data.py, or reused from --data-dir if it was generated before
+with the same seed. Each component is then run on it as a subprocess,
+recording:
+
+* wall_seconds: Elapsed time of the subprocess.
+* peak_rss_mb: Peak resident memory of the subprocess.
+* throughput: Work units per second, where work is predictions scored
+	for score_preds, samples fit for fit_wrapper and genotype calls
+	(samples x variants) for the genotype components.
+
+Components:
+
+* score_preds: score_preds.py on val and test predictions, --no-plots.
+* score_preds_stream: The same with --stream.
+* fit_wrapper: fit_wrapper.py with the synthetic score and covariates.
+* raw_to_parquet: raw_to_parquet.py on a plink2 --export A table.
+* score_bed: score_bed.py scoring the GWAS betas at the p-value
+	thresholds in P_THRESHOLDS, i.e. filtering variants by p-value and
+	scoring them in one pass.
+* geno_store: Building a packed genotype store with geno_store.py.
+* gwas_ols: gwas_ols.py's linear regression GWAS of the phenotype on
+	the covariates and each variant, in the train split.
+
+score_preds, score_preds_stream and fit_wrapper only depend on the
+number of samples, so they are run once per --samples size, on the
+dataset with the fewest --variants.
+
+For each component, log(wall_seconds) and log(peak_rss_mb) are fit by
+least squares as linear in log(n_samples) (and log(n_variants) for
+genotype components), i.e. as power laws c * n_samples^a * n_variants^b.
+Runs, machine details and fits are written to --out as JSON. With
+--baseline, the median wall time of each (component, size) is compared
+to that of an earlier results file.
+
+Input tables are parsed from text on every run: table_cache.py's cache
+is only used with --table-cache, in NONLIN_PRS_CACHE_DIR if set or
+otherwise in table_cache/ under --data-dir.
+
+Args:
+
+* -o, --out: Path of the results JSON. Default: 'bench_results.json'.
+* --samples: Sample sizes. Default: 10000 50000 100000 500000.
+* --variants: Variant counts. Default: 1000 10000 100000.
+* --components: Components to run. Default: all.
+* --repeats: Runs per component and size. Default: 1.
+* --seed: Seed of the synthetic datasets. Default: 0.
+* --data-dir: Directory to generate and cache datasets in.
+	Default: 'bench_data'.
+* --work-dir: Directory for component outputs, deleted after each run
+	unless --keep-outputs. Default: 'bench_work'.
+* --keep-outputs: Flag to keep component outputs.
+* --threads: Threads for multithreaded components. Default: number of
+	CPUs.
+* --max-raw-gb: Largest .raw table to generate, in GB. Larger sizes are
+	skipped for raw_to_parquet. Default: 20.
+* --timeout: Seconds after which a run is killed and recorded as timed
+	out. Default: no limit.
+* --table-cache: Flag to let components use table_cache.py's cache.
+* --baseline: Results JSON of an earlier run to compare against.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PRS_DIR = os.path.join(SCRIPTS_DIR, 'prs')
+GENO_DIR = os.path.join(SCRIPTS_DIR, 'geno')
+
+sys.path.insert(0, GENO_DIR)
+from bed_io import read_bim
+from synth_data import generate, make_samples, write_raw
+
+
+PHENO_NAME = 'synthetic_pheno'
+
+# Ranges for score_bed --q-score-range, as in PRSice-2 thresholding
+P_THRESHOLDS = [5e-8, 1e-5, 1e-3, 0.05, 0.1, 0.5, 1.0]
+
+# Components whose cost depends only on the number of samples
+SAMPLE_COMPONENTS = ['score_preds', 'score_preds_stream', 'fit_wrapper']
+GENO_COMPONENTS = ['raw_to_parquet', 'score_bed', 'geno_store', 'gwas_ols']
+COMPONENTS = SAMPLE_COMPONENTS + GENO_COMPONENTS
+
+# Approximate .raw table bytes per genotype call (value and separator)
+RAW_BYTES_PER_CALL = 2
+
+# Memory per sample block when writing a .raw table
+RAW_BLOCK_MB = 256
+
+# Runs a command and writes the peak RSS of its process tree in KB to
+# the file given as the first argument
+RUSAGE_WRAPPER = '''
+import resource, subprocess, sys
+returncode = subprocess.call(sys.argv[2:])
+with open(sys.argv[1], 'w') as f:
+	f.write(str(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+sys.exit(returncode)
+'''
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument("-o", "--out", default='bench_results.json')
+	parser.add_argument(
+		"--samples", type=int, nargs='+', default=[10_000, 50_000, 100_000, 500_000]
+	)
+	parser.add_argument(
+		"--variants", type=int, nargs='+', default=[1_000, 10_000, 100_000]
+	)
+	parser.add_argument(
+		"--components", nargs='+', choices=COMPONENTS, default=COMPONENTS
+	)
+	parser.add_argument("--repeats", type=int, default=1)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--data-dir", default='bench_data')
+	parser.add_argument("--work-dir", default='bench_work')
+	parser.add_argument("--keep-outputs", action='store_true')
+	parser.add_argument("--threads", type=int, default=os.cpu_count())
+	parser.add_argument("--max-raw-gb", type=float, default=20)
+	parser.add_argument("--timeout", type=float)
+	parser.add_argument("--table-cache", action='store_true')
+	parser.add_argument("--baseline")
+
+	return parser.parse_args()
+
+
+def dataset(data_dir, n_samples, n_variants, seed, raw=False):
+	"""Directory of a synthetic dataset, generating it if needed.
+
+	A dataset is reused if its synth_meta.json exists. If raw is True
+	and it has no .raw table, one is written from its .bed file.
+	"""
+	out_dir = os.path.join(data_dir, f'n{n_samples}_m{n_variants}_s{seed}')
+	meta_file = os.path.join(out_dir, 'synth_meta.json')
+	if not os.path.exists(meta_file):
+		print(f'Generating {n_samples} x {n_variants} dataset', flush=True)
+		generate(
+			out_dir, n_samples, n_variants, seed=seed, pheno_name=PHENO_NAME, raw=raw
+		)
+		return out_dir
+
+	with open(meta_file) as f:
+		meta = json.load(f)
+	if raw and not meta['raw']:
+		print(f'Writing .raw table of {n_samples} x {n_variants} dataset', flush=True)
+		bfile = os.path.join(out_dir, 'geno')
+		write_raw(
+			f'{bfile}.raw', f'{bfile}.bed', read_bim(f'{bfile}.bim'),
+			make_samples(n_samples), RAW_BLOCK_MB
+		)
+		meta['raw'] = True
+		with open(meta_file, 'w') as f:
+			json.dump(meta, f, indent=4)
+	return out_dir
+
+
+def component_command(component, data, out_dir, threads):
+	"""Command line running component on dataset directory data."""
+	python = [sys.executable]
+	if component in ['score_preds', 'score_preds_stream']:
+		cmd = python + [
+			os.path.join(PRS_DIR, 'score_preds.py'),
+			'-v', f'{data}/val_preds.csv',
+			'-t', f'{data}/test_preds.csv',
+			'-p', f'{data}/{PHENO_NAME}.pheno',
+			'--wb', f'{data}/wb.txt',
+			'-o', out_dir,
+			'--no-plots',
+		]
+		if component == 'score_preds_stream':
+			cmd += ['--stream', '--pheno-index', os.path.join(out_dir, 'pheno_index')]
+		return cmd
+	if component == 'fit_wrapper':
+		return python + [
+			os.path.join(PRS_DIR, 'fit_wrapper.py'),
+			'-p', f'{data}/{PHENO_NAME}.pheno',
+			'-c', f'{data}/covariates.tsv',
+			'-s', f'{data}/prs.sscore',
+			'-v', f'{data}/val_all.txt',
+			'-t', f'{data}/test_all.txt',
+			'-o', out_dir,
+		]
+	if component == 'raw_to_parquet':
+		return python + [
+			os.path.join(GENO_DIR, 'raw_to_parquet.py'),
+			'-r', f'{data}/geno.raw',
+			'-o', os.path.join(out_dir, 'geno.parquet'),
+			'--threads', str(threads),
+		]
+	if component == 'score_bed':
+		return python + [
+			os.path.join(GENO_DIR, 'score_bed.py'),
+			'--bfile', f'{data}/geno',
+			'--score', f'{data}/gwas_plink2.{PHENO_NAME}.glm.linear',
+			'--q-score-range', os.path.join(out_dir, 'range_list'),
+			'--out', os.path.join(out_dir, 'prs'),
+			'--threads', str(threads),
+		]
+	if component == 'geno_store':
+		return python + [
+			os.path.join(GENO_DIR, 'geno_store.py'),
+			'--bfile', f'{data}/geno',
+			'-o', os.path.join(out_dir, 'store'),
+		]
+	if component == 'gwas_ols':
+		return python + [
+			os.path.join(GENO_DIR, 'gwas_ols.py'),
+			'--bfile', f'{data}/geno',
+			'--pheno', f'{data}/{PHENO_NAME}.pheno',
+			'--covar', f'{data}/covariates.tsv',
+			'--keep', f'{data}/train_all.txt',
+			'--out', os.path.join(out_dir, 'gwas'),
+			'--threads', str(threads),
+		]
+	raise ValueError(f'Unknown component {component}')
+
+
+def write_range_list(range_file):
+	"""Write a score_bed --q-score-range file of P_THRESHOLDS."""
+	with open(range_file, 'w') as f:
+		for threshold in P_THRESHOLDS:
+			f.write(f'{threshold:g} 0 {threshold:g}\n')
+
+
+def measure(cmd, log_file, env, timeout=None):
+	"""Run cmd and return (returncode, wall_seconds, peak_rss_mb).
+
+	cmd is run by RUSAGE_WRAPPER, a small Python process that records its
+	children's peak RSS. Measuring from this process instead would count
+	its own memory, which a forked child starts with. returncode is None
+	if the run was killed after timeout seconds.
+	"""
+	rss_file = f'{log_file}.maxrss'
+	with open(log_file, 'w') as log:
+		start = time.perf_counter()
+		proc = subprocess.Popen(
+			[sys.executable, '-c', RUSAGE_WRAPPER, rss_file] + cmd,
+			stdout=log,
+			stderr=subprocess.STDOUT,
+			env=env,
+			start_new_session=True
+		)
+		try:
+			returncode = proc.wait(timeout=timeout)
+		except subprocess.TimeoutExpired:
+			os.killpg(proc.pid, signal.SIGKILL)
+			proc.wait()
+			returncode = None
+		wall_seconds = time.perf_counter() - start
+
+	peak_rss_mb = None
+	if os.path.exists(rss_file):
+		with open(rss_file) as f:
+			peak_rss_mb = int(f.read()) / 1024
+		os.remove(rss_file)
+	return returncode, wall_seconds, peak_rss_mb
+
+
+def work_units(component, meta):
+	"""Units of work for component on a dataset, for throughput."""
+	if component in ['score_preds', 'score_preds_stream']:
+		return meta['split_sizes']['val'] + meta['split_sizes']['test']
+	if component == 'fit_wrapper':
+		return meta['n_samples']
+	return meta['n_samples'] * meta['n_variants']
+
+
+def fit_power_law(runs, value_key, use_variants):
+	"""Least squares fit of log(value) on log sizes.
+
+	Returns a dict of the fitted coefficient, exponents and R^2 in log
+	space, or None if there are not enough distinct sizes.
+
+	Args:
+		runs: Successful runs of one component.
+		value_key: Run key to fit, e.g. 'wall_seconds'.
+		use_variants: Whether to include log(n_variants) as a predictor.
+	"""
+	sizes = {}
+	for run in runs:
+		key = (run['n_samples'], run['n_variants'])
+		sizes.setdefault(key, []).append(run[value_key])
+	if len(sizes) < 2 + use_variants:
+		return None
+
+	keys = sorted(sizes)
+	X = [np.ones(len(keys)), np.log([k[0] for k in keys])]
+	if use_variants:
+		X.append(np.log([k[1] for k in keys]))
+	X = np.column_stack(X)
+	y = np.log([max(np.median(sizes[k]), 1e-9) for k in keys])
+
+	coefs = np.linalg.lstsq(X, y, rcond=None)[0]
+	resid = y - X @ coefs
+	ss_tot = ((y - y.mean()) ** 2).sum()
+	fit = {
+		'coef': float(np.exp(coefs[0])),
+		'samples_exponent': float(coefs[1]),
+		'r2': float(1 - (resid ** 2).sum() / ss_tot) if ss_tot > 0 else 1.0,
+		'n_sizes': len(keys),
+	}
+	if use_variants:
+		fit['variants_exponent'] = float(coefs[2])
+	return fit
+
+
+def fit_scaling(runs):
+	"""Power law fits of wall time and peak RSS for every component."""
+	fits = {}
+	for component in COMPONENTS:
+		ok_runs = [
+			r for r in runs
+			if r['component'] == component and r['status'] == 'ok'
+		]
+		if not ok_runs:
+			continue
+		use_variants = component in GENO_COMPONENTS
+		fits[component] = {
+			key: fit_power_law(ok_runs, key, use_variants)
+			for key in ['wall_seconds', 'peak_rss_mb']
+		}
+	return fits
+
+
+def median_wall_times(runs):
+	"""Median wall seconds of successful runs by (component, size)."""
+	times = {}
+	for run in runs:
+		if run['status'] == 'ok':
+			key = (run['component'], run['n_samples'], run['n_variants'])
+			times.setdefault(key, []).append(run['wall_seconds'])
+	return {key: float(np.median(t)) for key, t in times.items()}
+
+
+def compare_to_baseline(runs, baseline_file):
+	"""Ratios of median wall time to a baseline results file's.
+
+	Returns a list of dicts, one per (component, size) in both.
+	"""
+	with open(baseline_file) as f:
+		baseline = median_wall_times(json.load(f)['runs'])
+
+	comparisons = []
+	for key, seconds in sorted(median_wall_times(runs).items(), key=str):
+		if key in baseline:
+			component, n_samples, n_variants = key
+			comparisons.append({
+				'component': component,
+				'n_samples': n_samples,
+				'n_variants': n_variants,
+				'baseline_seconds': baseline[key],
+				'wall_seconds': seconds,
+				'speedup': baseline[key] / seconds,
+			})
+	return comparisons
+
+
+def machine_info():
+	return {
+		'platform': platform.platform(),
+		'processor': platform.processor(),
+		'cpu_count': os.cpu_count(),
+		'python': platform.python_version(),
+		'numpy': np.__version__,
+	}
+
+
+def run_benchmarks(args):
+	"""Run every component over the size grid and return the runs."""
+	env = dict(os.environ)
+	if not args.table_cache:
+		env['NONLIN_PRS_CACHE_DIR'] = ''
+	elif not env.get('NONLIN_PRS_CACHE_DIR'):
+		env['NONLIN_PRS_CACHE_DIR'] = os.path.abspath(
+			os.path.join(args.data_dir, 'table_cache')
+		)
+
+	tasks = []
+	for n_samples in args.samples:
+		for component in SAMPLE_COMPONENTS:
+			if component in args.components:
+				tasks.append((component, n_samples, min(args.variants)))
+		for n_variants in args.variants:
+			for component in GENO_COMPONENTS:
+				if component in args.components:
+					tasks.append((component, n_samples, n_variants))
+
+	runs = []
+	for component, n_samples, n_variants in tasks:
+		run = {
+			'component': component,
+			'n_samples': n_samples,
+			'n_variants': None if component in SAMPLE_COMPONENTS else n_variants,
+		}
+
+		needs_raw = component == 'raw_to_parquet'
+		raw_gb = n_samples * n_variants * RAW_BYTES_PER_CALL / 1e9
+		if needs_raw and raw_gb > args.max_raw_gb:
+			print(f'Skipping {component} {n_samples} x {n_variants}: '
+				f'.raw table would be {raw_gb:.0f} GB', flush=True)
+			runs.append({**run, 'status': 'skipped'})
+			continue
+
+		data = dataset(args.data_dir, n_samples, n_variants, args.seed, raw=needs_raw)
+		with open(os.path.join(data, 'synth_meta.json')) as f:
+			meta = json.load(f)
+
+		for repeat in range(args.repeats):
+			out_dir = os.path.join(
+				args.work_dir, component, f'n{n_samples}_m{n_variants}_r{repeat}'
+			)
+			os.makedirs(out_dir, exist_ok=True)
+			if component == 'score_bed':
+				write_range_list(os.path.join(out_dir, 'range_list'))
+
+			cmd = component_command(component, data, out_dir, args.threads)
+			returncode, wall_seconds, peak_rss_mb = measure(
+				cmd, os.path.join(out_dir, 'bench.log'), env, args.timeout
+			)
+
+			if returncode is None:
+				status = 'timeout'
+			elif returncode != 0:
+				status = 'failed'
+			else:
+				status = 'ok'
+			runs.append({
+				**run,
+				'repeat': repeat,
+				'status': status,
+				'wall_seconds': wall_seconds,
+				'peak_rss_mb': peak_rss_mb,
+				'throughput': work_units(component, meta) / wall_seconds,
+			})
+			print(
+				f'{component} {n_samples} x {n_variants} #{repeat}: {status}, '
+				f'{wall_seconds:.2f}s, {peak_rss_mb or 0:.0f} MB',
+				flush=True
+			)
+
+			if status == 'ok' and not args.keep_outputs:
+				shutil.rmtree(out_dir)
+
+	return runs
+
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	runs = run_benchmarks(args)
+	results = {
+		'machine': machine_info(),
+		'seed': args.seed,
+		'threads': args.threads,
+		'table_cache': args.table_cache,
+		'runs': runs,
+		'fits': fit_scaling(runs),
+	}
+	if args.baseline is not None:
+		results['baseline'] = args.baseline
+		results['comparisons'] = compare_to_baseline(runs, args.baseline)
+		for c in results['comparisons']:
+			print(
+				f"{c['component']} {c['n_samples']} x {c['n_variants']}: "
+				f"{c['baseline_seconds']:.2f}s -> {c['wall_seconds']:.2f}s "
+				f"({c['speedup']:.2f}x)"
+			)
+
+	with open(args.out, 'w') as f:
+		json.dump(results, f, indent=4)
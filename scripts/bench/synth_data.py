@@ -0,0 +1,502 @@
+"""Generate a synthetic UKB-like dataset for benchmarks.
+
+Genotypes are drawn under Hardy-Weinberg equilibrium with minor allele
+frequencies uniform on [--min-maf, 0.5]. The phenotype is an additive
+genetic value from --n-causal variants with standardized effects
+explaining --h2 of its variance, plus covariate effects and Gaussian
+noise. Each variant's genotypes come from a generator seeded by --seed
+and the variant index, so a dataset depends only on its options and not
+on --block-mb.
+
+Files written to --out-dir, in the formats the pipeline reads:
+
+* geno.bed/.bim/.fam: Hard-call genotypes, counting the A1 allele.
+	With --pgen, also geno.pgen/.pvar/.psam (requires pgenlib).
+* {pheno_name}.pheno: IID and phenotype columns.
+* covariates.tsv: IID, sex, age and --n-pcs principal components.
+* {split}_all.txt and {split}_wb.txt for train, val and test, and
+	wb.txt: Sample IDs, one per line. A --wb-frac fraction of samples
+	is 'white British'.
+* gwas_plink2.{pheno_name}.glm.linear: Marginal association of each
+	variant with the phenotype in train_all samples, without covariates,
+	in plink2 --glm column layout.
+* prs.sscore: IID and SCORE1_AVG, the genetic value plus noise so that
+	it explains --prs-r2 of the genetic variance, like a PRSice-2 score.
+* val_preds.csv, test_preds.csv: IID and pred, the same score on the
+	phenotype scale, like a model's predictions.
+* geno.raw: With --raw, a plink2 --export A table of the genotypes
+	(this is n_samples x n_variants text, so keep it small).
+* true_effects.tsv: ID, A1 and standardized BETA of causal variants.
+* synth_meta.json: Options and dimensions of the dataset.
+
+Args:
+
+* -o, --out-dir: Output directory.
+* -n, --n-samples: Number of samples.
+* -m, --n-variants: Number of variants.
+* --seed: Random seed. Default: 0.
+* --n-causal: Number of causal variants. Default: 1000 or --n-variants
+	if smaller.
+* --h2: Heritability, the variance explained by genotypes. Default: 0.5.
+* --prs-r2: Squared correlation of the score with the genetic value.
+	Default: 0.5.
+* --min-maf: Minimum minor allele frequency. Default: 0.01.
+* --missing-rate: Fraction of missing genotype calls. Default: 0.
+* --n-pcs: Number of principal component covariates. Default: 10.
+* --wb-frac: Fraction of white British samples. Default: 0.8.
+* --split-fracs: Train, val and test fractions. Default: 0.7 0.15 0.15.
+* --pheno-name: Phenotype name. Default: 'synthetic_pheno'.
+* --pgen: Flag to also write .pgen/.pvar/.psam files.
+* --raw: Flag to also write geno.raw.
+* --block-mb: Approximate memory per genotype block in MB. Default: 256.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+sys.path.insert(
+	0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'geno')
+)
+from bed_io import (
+	BED_MAGIC, MISSING, VARIANT_COLS, BedReader, decode_bed_bytes,
+	encode_bed_bytes, pgenlib
+)
+
+
+# Chromosome lengths in Mb, to place variants like a genotyping array
+CHROM_LENGTHS_MB = [
+	249, 243, 198, 191, 182, 171, 159, 145, 138, 134, 135,
+	133, 114, 107, 102, 90, 83, 80, 59, 64, 47, 51
+]
+
+ALLELES = np.array(['A', 'C', 'G', 'T'])
+
+RAW_SEP = ord('\t')
+RAW_NEWLINE = ord('\n')
+
+# First character of each .raw genotype token, indexed by count + 1
+RAW_FIRST_CHAR = np.array([ord('N'), ord('0'), ord('1'), ord('2')], dtype=np.uint8)
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument("-o", "--out-dir", required=True)
+	parser.add_argument("-n", "--n-samples", type=int, required=True)
+	parser.add_argument("-m", "--n-variants", type=int, required=True)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--n-causal", type=int, default=1000)
+	parser.add_argument("--h2", type=float, default=0.5)
+	parser.add_argument("--prs-r2", type=float, default=0.5)
+	parser.add_argument("--min-maf", type=float, default=0.01)
+	parser.add_argument("--missing-rate", type=float, default=0.0)
+	parser.add_argument("--n-pcs", type=int, default=10)
+	parser.add_argument("--wb-frac", type=float, default=0.8)
+	parser.add_argument(
+		"--split-fracs", type=float, nargs=3, default=[0.7, 0.15, 0.15]
+	)
+	parser.add_argument("--pheno-name", default='synthetic_pheno')
+	parser.add_argument("--pgen", action='store_true')
+	parser.add_argument("--raw", action='store_true')
+	parser.add_argument("--block-mb", type=float, default=256)
+
+	return parser.parse_args()
+
+
+def make_samples(n_samples):
+	"""DataFrame of FID and IID for UKB-like 7 digit sample IDs."""
+	iids = (1_000_000 + np.arange(n_samples)).astype(str)
+	return pd.DataFrame({'FID': iids, 'IID': iids})
+
+
+def make_variants(n_variants, rng):
+	"""DataFrame with VARIANT_COLS columns spread over the autosomes."""
+	lengths = np.array(CHROM_LENGTHS_MB, dtype=float)
+	n_per_chrom = np.floor(n_variants * lengths / lengths.sum()).astype(int)
+	n_per_chrom[:n_variants - n_per_chrom.sum()] += 1
+
+	chroms = np.repeat(np.arange(1, len(lengths) + 1), n_per_chrom)
+	positions = np.concatenate([
+		np.sort(rng.choice(int(length * 1e6), size=n, replace=False)) + 1
+		for length, n in zip(lengths, n_per_chrom)
+	])
+
+	a1_idx = rng.integers(0, 4, size=n_variants)
+	a2_idx = (a1_idx + rng.integers(1, 4, size=n_variants)) % 4
+	return pd.DataFrame({
+		'CHROM': chroms.astype(str),
+		'ID': [f'rs{i + 1}' for i in range(n_variants)],
+		'CM': 0,
+		'POS': positions,
+		'A1': ALLELES[a1_idx],
+		'A2': ALLELES[a2_idx],
+	})
+
+
+def simulate_genotypes(seed, start, freqs, n_samples, missing_rate):
+	"""int8 (variants x samples) counts of A1 for variants start onward.
+
+	Variant j's genotypes are drawn from a generator seeded with
+	(seed, j), so they do not depend on how variants are blocked.
+
+	Args:
+		seed: Dataset seed.
+		start: Index of the first variant.
+		freqs: A1 frequency of each variant in the block.
+		n_samples: Number of samples.
+		missing_rate: Fraction of calls set to MISSING.
+	"""
+	genos = np.empty((len(freqs), n_samples), dtype=np.int8)
+	for i, freq in enumerate(freqs):
+		rng = np.random.default_rng([seed, start + i])
+		u = rng.random(n_samples, dtype=np.float32)
+		hom = freq * freq
+		genos[i] = (u < hom).view(np.int8) + (u < 2 * freq - hom).view(np.int8)
+		if missing_rate > 0:
+			genos[i, rng.random(n_samples, dtype=np.float32) < missing_rate] = MISSING
+	return genos
+
+
+def standardize(genos, freqs):
+	"""Genotypes standardized by their expected mean and SD, 0 if missing."""
+	freqs = freqs[:, None]
+	std = (genos - 2 * freqs) / np.sqrt(2 * freqs * (1 - freqs))
+	return np.where(genos == MISSING, 0.0, std)
+
+
+def marginal_sumstats(genos, y):
+	"""Per-variant OLS of y on genotype over non-missing calls.
+
+	Returns (obs_ct, beta, se, t_stat, p) arrays.
+
+	Args:
+		genos: int8 (variants x samples) genotypes.
+		y: Phenotype of each sample.
+	"""
+	valid = genos != MISSING
+	x = np.where(valid, genos, 0).astype(np.float64)
+	n = valid.sum(axis=1)
+	sx = x.sum(axis=1)
+	sy = valid @ y
+	sxx = (x * x).sum(axis=1)
+	sxy = x @ y
+	syy = valid @ (y * y)
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		vx = sxx - sx * sx / n
+		vy = syy - sy * sy / n
+		cxy = sxy - sx * sy / n
+		beta = cxy / vx
+		df = n - 2
+		se = np.sqrt(np.maximum(vy - beta * cxy, 0) / df / vx)
+		t_stat = beta / se
+	p = 2 * stats.t.sf(np.abs(t_stat), df)
+	return n, beta, se, t_stat, p
+
+
+def write_glm_linear(out_file, variants, sumstats):
+	"""Write sumstats in plink2 --glm .glm.linear layout."""
+	obs_ct, beta, se, t_stat, p = sumstats
+	pd.DataFrame({
+		'#CHROM': variants['CHROM'].values,
+		'POS': variants['POS'].values,
+		'ID': variants['ID'].values,
+		'REF': variants['A2'].values,
+		'ALT': variants['A1'].values,
+		'A1': variants['A1'].values,
+		'TEST': 'ADD',
+		'OBS_CT': obs_ct,
+		'BETA': beta,
+		'SE': se,
+		'T_STAT': t_stat,
+		'P': p,
+	}).to_csv(out_file, sep='\t', index=False, na_rep='NA', float_format='%.6g')
+
+
+def raw_rows(genos):
+	"""Encode (samples x variants) genotypes as tab-separated .raw text.
+
+	Returns (buf, row_ends) where buf is a uint8 array of every row's
+	genotype tokens, each ended by a tab or, for the last variant, a
+	newline, and row_ends the end offset of each row in buf.
+	"""
+	n_rows, n_cols = genos.shape
+	flat = genos.ravel()
+	is_missing = flat == MISSING
+	lens = np.where(is_missing, 3, 2)
+	ends = np.cumsum(lens)
+	starts = ends - lens
+
+	buf = np.empty(ends[-1], dtype=np.uint8)
+	buf[starts] = RAW_FIRST_CHAR[flat + 1]
+	buf[starts[is_missing] + 1] = ord('A')
+	buf[ends - 1] = RAW_SEP
+	row_ends = ends[n_cols - 1::n_cols]
+	buf[row_ends - 1] = RAW_NEWLINE
+	return buf, row_ends
+
+
+def write_raw(raw_file, bed_file, variants, samples, block_mb):
+	"""Write a plink2 --export A .raw table from a .bed file.
+
+	Samples are written in blocks, each decoded from the same byte
+	columns of every variant record.
+	"""
+	reader = BedReader(bed_file, len(samples), len(variants))
+	block_samples = max(4, int(block_mb * 2**20 / (16 * len(variants))) // 4 * 4)
+
+	with open(raw_file, 'wb') as f:
+		header = ['FID', 'IID', 'PAT', 'MAT', 'SEX', 'PHENOTYPE'] + [
+			f'{vid}_{a1}' for vid, a1 in zip(variants['ID'], variants['A1'])
+		]
+		f.write(('\t'.join(header) + '\n').encode())
+
+		for start in range(0, len(samples), block_samples):
+			stop = min(start + block_samples, len(samples))
+			packed = reader.packed[:, start // 4:(stop + 3) // 4]
+			genos = decode_bed_bytes(packed, stop - start).T
+			buf, row_ends = raw_rows(genos)
+
+			row_start = 0
+			for (fid, iid), row_end in zip(
+				samples[['FID', 'IID']].values[start:stop], row_ends
+			):
+				f.write(f'{fid}\t{iid}\t0\t0\t0\t-9\t'.encode())
+				f.write(buf[row_start:row_end].tobytes())
+				row_start = row_end
+
+
+def write_pgen(pfile, bed_file, variants, samples, block_variants):
+	"""Write a .pgen/.pvar/.psam fileset with the genotypes of a .bed file.
+
+	The counted allele A1 is written as ALT.
+	"""
+	if pgenlib is None:
+		raise ImportError('pgenlib is required to write .pgen files')
+
+	pd.DataFrame({
+		'#CHROM': variants['CHROM'],
+		'POS': variants['POS'],
+		'ID': variants['ID'],
+		'REF': variants['A2'],
+		'ALT': variants['A1'],
+	}).to_csv(f'{pfile}.pvar', sep='\t', index=False)
+	pd.DataFrame({
+		'#FID': samples['FID'],
+		'IID': samples['IID'],
+		'SEX': 'NA',
+	}).to_csv(f'{pfile}.psam', sep='\t', index=False)
+
+	reader = BedReader(bed_file, len(samples), len(variants))
+	writer = pgenlib.PgenWriter(
+		f'{pfile}.pgen'.encode(), len(samples), len(variants), False
+	)
+	for start in range(0, len(variants), block_variants):
+		genos = reader.read_block(start, min(start + block_variants, len(variants)))
+		genos[genos == MISSING] = -9
+		for row in genos:
+			writer.append_biallelic(np.ascontiguousarray(row))
+	writer.close()
+
+
+def write_split(split_file, iids):
+	with open(split_file, 'w') as f:
+		f.writelines(f'{iid}\n' for iid in iids)
+
+
+def generate(
+	out_dir,
+	n_samples,
+	n_variants,
+	seed=0,
+	n_causal=1000,
+	h2=0.5,
+	prs_r2=0.5,
+	min_maf=0.01,
+	missing_rate=0.0,
+	n_pcs=10,
+	wb_frac=0.8,
+	split_fracs=(0.7, 0.15, 0.15),
+	pheno_name='synthetic_pheno',
+	pgen=False,
+	raw=False,
+	block_mb=256
+):
+	"""Generate a synthetic dataset in out_dir. See module docstring.
+
+	Returns the metadata dict saved to synth_meta.json.
+	"""
+	os.makedirs(out_dir, exist_ok=True)
+	rng = np.random.default_rng(seed)
+	n_causal = min(n_causal, n_variants)
+	block_variants = max(1, int(block_mb * 2**20 / (8 * n_samples)))
+
+	samples = make_samples(n_samples)
+	variants = make_variants(n_variants, rng)
+	mafs = rng.uniform(min_maf, 0.5, size=n_variants)
+	freqs = np.where(rng.random(n_variants) < 0.5, mafs, 1 - mafs)
+
+	causal_idx = np.sort(rng.choice(n_variants, size=n_causal, replace=False))
+	causal_beta = rng.normal(0, np.sqrt(h2 / n_causal), size=n_causal)
+	is_causal = np.zeros(n_variants, dtype=bool)
+	is_causal[causal_idx] = True
+	beta = np.zeros(n_variants)
+	beta[causal_idx] = causal_beta
+
+	# Genotypes and genetic value, in one pass
+	bfile = os.path.join(out_dir, 'geno')
+	variants[VARIANT_COLS].to_csv(
+		f'{bfile}.bim', sep='\t', header=False, index=False
+	)
+	samples.assign(PAT=0, MAT=0, SEX=0, PHENO=-9).to_csv(
+		f'{bfile}.fam', sep='\t', header=False, index=False
+	)
+	genetic_value = np.zeros(n_samples)
+	with open(f'{bfile}.bed', 'wb') as f:
+		f.write(BED_MAGIC)
+		for start in range(0, n_variants, block_variants):
+			stop = min(start + block_variants, n_variants)
+			genos = simulate_genotypes(
+				seed, start, freqs[start:stop], n_samples, missing_rate
+			)
+			f.write(encode_bed_bytes(genos).tobytes())
+
+			block_causal = is_causal[start:stop]
+			if block_causal.any():
+				genetic_value += beta[start:stop][block_causal] @ standardize(
+					genos[block_causal], freqs[start:stop][block_causal]
+				)
+
+	# Covariates and phenotype
+	sex = rng.integers(0, 2, size=n_samples)
+	age = rng.integers(40, 71, size=n_samples)
+	pcs = rng.normal(size=(n_samples, n_pcs))
+	covars = pd.DataFrame({'IID': samples['IID'], 'sex': sex, 'age': age})
+	for i in range(n_pcs):
+		covars[f'pc{i + 1}'] = pcs[:, i]
+	covars.to_csv(os.path.join(out_dir, 'covariates.tsv'), sep='\t', index=False)
+
+	covar_effect = 0.5 * sex + 0.02 * (age - 55) + pcs @ rng.normal(0, 0.05, size=n_pcs)
+	noise = rng.normal(0, np.sqrt(1 - h2), size=n_samples)
+	y = genetic_value + covar_effect + noise
+	pd.DataFrame({'IID': samples['IID'], pheno_name: y}).to_csv(
+		os.path.join(out_dir, f'{pheno_name}.pheno'),
+		sep='\t',
+		index=False,
+		float_format='%.6g'
+	)
+
+	# Splits
+	order = rng.permutation(n_samples)
+	is_wb = rng.random(n_samples) < wb_frac
+	bounds = np.round(np.cumsum(split_fracs) / sum(split_fracs) * n_samples)
+	split_idx = dict(zip(
+		['train', 'val', 'test'],
+		np.split(order, bounds[:-1].astype(int))
+	))
+	iids = samples['IID'].values
+	for split, idx in split_idx.items():
+		idx = np.sort(idx)
+		write_split(os.path.join(out_dir, f'{split}_all.txt'), iids[idx])
+		write_split(os.path.join(out_dir, f'{split}_wb.txt'), iids[idx[is_wb[idx]]])
+	write_split(os.path.join(out_dir, 'wb.txt'), iids[is_wb])
+
+	# GWAS sumstats on train samples
+	train_idx = np.sort(split_idx['train'])
+	reader = BedReader(f'{bfile}.bed', n_samples, n_variants)
+	sumstats = [[] for _ in range(5)]
+	for start in range(0, n_variants, block_variants):
+		genos = reader.read_block(start, min(start + block_variants, n_variants))
+		for col, values in zip(sumstats, marginal_sumstats(genos[:, train_idx], y[train_idx])):
+			col.append(values)
+	write_glm_linear(
+		os.path.join(out_dir, f'gwas_plink2.{pheno_name}.glm.linear'),
+		variants,
+		[np.concatenate(col) for col in sumstats]
+	)
+
+	# Scores and predictions
+	genetic_sd = max(np.std(genetic_value), 1e-12)
+	score = genetic_value + rng.normal(
+		0, genetic_sd * np.sqrt(1 / prs_r2 - 1), size=n_samples
+	)
+	pd.DataFrame({'IID': iids, 'SCORE1_AVG': score}).to_csv(
+		os.path.join(out_dir, 'prs.sscore'), sep='\t', index=False, float_format='%.6g'
+	)
+	for split in ['val', 'test']:
+		idx = np.sort(split_idx[split])
+		pd.DataFrame({
+			'IID': iids[idx],
+			'pred': score[idx] * prs_r2 + np.mean(y),
+		}).to_csv(
+			os.path.join(out_dir, f'{split}_preds.csv'),
+			index=False,
+			float_format='%.6g'
+		)
+
+	pd.DataFrame({
+		'ID': variants['ID'].values[causal_idx],
+		'A1': variants['A1'].values[causal_idx],
+		'BETA': causal_beta,
+	}).to_csv(os.path.join(out_dir, 'true_effects.tsv'), sep='\t', index=False)
+
+	if pgen:
+		write_pgen(bfile, f'{bfile}.bed', variants, samples, block_variants)
+	if raw:
+		write_raw(f'{bfile}.raw', f'{bfile}.bed', variants, samples, block_mb)
+
+	meta = {
+		'n_samples': n_samples,
+		'n_variants': n_variants,
+		'seed': seed,
+		'n_causal': n_causal,
+		'h2': h2,
+		'prs_r2': prs_r2,
+		'min_maf': min_maf,
+		'missing_rate': missing_rate,
+		'n_pcs': n_pcs,
+		'wb_frac': wb_frac,
+		'split_fracs': list(split_fracs),
+		'pheno_name': pheno_name,
+		'pgen': pgen,
+		'raw': raw,
+		'split_sizes': {k: len(v) for k, v in split_idx.items()},
+	}
+	with open(os.path.join(out_dir, 'synth_meta.json'), 'w') as f:
+		json.dump(meta, f, indent=4)
+	return meta
+
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	start_time = time.time()
+	generate(
+		args.out_dir,
+		args.n_samples,
+		args.n_variants,
+		seed=args.seed,
+		n_causal=args.n_causal,
+		h2=args.h2,
+		prs_r2=args.prs_r2,
+		min_maf=args.min_maf,
+		missing_rate=args.missing_rate,
+		n_pcs=args.n_pcs,
+		wb_frac=args.wb_frac,
+		split_fracs=args.split_fracs,
+		pheno_name=args.pheno_name,
+		pgen=args.pgen,
+		raw=args.raw,
+		block_mb=args.block_mb
+	)
+	print(
+		f'Wrote {args.n_samples} samples x {args.n_variants} variants to '
+		f'{args.out_dir} in {time.time() - start_time:.1f}s'
+	)
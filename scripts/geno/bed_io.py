@@ -0,0 +1,286 @@
+"""Read and write PLINK genotype files in variant blocks.
+
+Genotypes are returned as int8 (variants x samples) arrays of counts of
+the counted allele, with MISSING for missing calls. The counted allele
+is column A1 of the variant table, which is
+
+* the fifth .bim column for PLINK 1 .bed files, and
+* the ALT allele for PLINK 2 .pgen files.
+
+.bed files are memory-mapped and decoded with a lookup table from each
+packed byte to its four genotypes. .pgen files are read with pgenlib,
+which is only needed for .pgen input.
+
+In .bed files each sample's genotype is 2 bits, four samples per byte
+starting from the low bits, with variant records padded to whole bytes:
+
+	00: two copies of A1
+	01: missing
+	10: one copy of A1
+	11: zero copies of A1
+"""
+
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+try:
+	import pgenlib
+except ImportError:
+	pgenlib = None
+
+
+MISSING = -1
+
+BED_MAGIC = bytes([0x6c, 0x1b, 0x01])
+
+# Count of A1 for each 2-bit .bed code
+BED_CODE_DOSAGE = np.array([2, MISSING, 1, 0], dtype=np.int8)
+
+# (256, 4) genotypes of the four samples packed in each byte value
+BED_BYTE_LUT = BED_CODE_DOSAGE[
+	(np.arange(256)[:, None] >> (2 * np.arange(4))) & 3
+]
+
+VARIANT_COLS = ['CHROM', 'ID', 'CM', 'POS', 'A1', 'A2']
+
+
+def read_bim(bim_file):
+	"""Load a .bim file as a DataFrame with VARIANT_COLS columns."""
+	return pd.read_csv(
+		bim_file,
+		sep='\s+',
+		header=None,
+		names=VARIANT_COLS,
+		dtype={'CHROM': str, 'ID': str, 'A1': str, 'A2': str}
+	)
+
+
+def read_fam(fam_file):
+	"""Load a .fam file as a DataFrame with FID and IID columns."""
+	return pd.read_csv(
+		fam_file,
+		sep='\s+',
+		header=None,
+		usecols=[0, 1],
+		names=['FID', 'IID'],
+		dtype=str
+	)
+
+
+def read_pvar(pvar_file):
+	"""Load a .pvar file with A1 as ALT and A2 as REF."""
+	with open(pvar_file) as f:
+		n_skip = 0
+		for line in f:
+			if not line.startswith('##'):
+				break
+			n_skip += 1
+
+	pvar = pd.read_csv(
+		pvar_file,
+		sep='\s+',
+		skiprows=n_skip,
+		usecols=['#CHROM', 'POS', 'ID', 'REF', 'ALT'],
+		dtype={'#CHROM': str, 'ID': str, 'REF': str, 'ALT': str}
+	)
+	return pd.DataFrame({
+		'CHROM': pvar['#CHROM'],
+		'ID': pvar['ID'],
+		'CM': 0,
+		'POS': pvar['POS'],
+		'A1': pvar['ALT'],
+		'A2': pvar['REF'],
+	})
+
+
+def read_psam(psam_file):
+	"""Load a .psam file as a DataFrame with FID (if present) and IID."""
+	psam = pd.read_csv(psam_file, sep='\s+', dtype=str)
+	psam = psam.rename(columns={'#FID': 'FID', '#IID': 'IID'})
+	return psam[[c for c in ['FID', 'IID'] if c in psam.columns]]
+
+
+def decode_bed_bytes(packed, n_samples):
+	"""Decode packed .bed records to int8 genotypes.
+
+	Args:
+		packed: (n_variants, bytes_per_variant) uint8 array.
+		n_samples: Number of samples, to drop padding genotypes.
+	"""
+	genos = np.take(BED_BYTE_LUT, packed, axis=0)
+	return genos.reshape(len(packed), -1)[:, :n_samples]
+
+
+def encode_bed_bytes(genos):
+	"""Pack (n_variants, n_samples) int8 genotypes into .bed records."""
+	genos = np.asarray(genos)
+	n_variants, n_samples = genos.shape
+	codes = np.full(genos.shape, 1, dtype=np.uint8)
+	codes[genos == 2] = 0
+	codes[genos == 1] = 2
+	codes[genos == 0] = 3
+
+	n_pad = -n_samples % 4
+	codes = np.pad(codes, ((0, 0), (0, n_pad)), constant_values=0)
+	codes = codes.reshape(n_variants, -1, 4)
+	return (codes << (2 * np.arange(4, dtype=np.uint8))).sum(
+		axis=2, dtype=np.uint8
+	)
+
+
+class BedReader:
+	"""Block reader for a variant-major .bed file.
+
+	Args:
+		bed_file: Path to the .bed file.
+		n_samples: Number of samples, from the .fam file.
+		n_variants: Number of variants, from the .bim file.
+	"""
+
+	def __init__(self, bed_file, n_samples, n_variants):
+		self.n_samples = n_samples
+		self.n_variants = n_variants
+		self.bytes_per_variant = (n_samples + 3) // 4
+
+		with open(bed_file, 'rb') as f:
+			magic = f.read(3)
+		if magic != BED_MAGIC:
+			raise ValueError(f'{bed_file} is not a variant-major .bed file')
+
+		expected_size = 3 + self.bytes_per_variant * n_variants
+		if os.path.getsize(bed_file) != expected_size:
+			raise ValueError(
+				f'{bed_file} has size {os.path.getsize(bed_file)}, expected '
+				f'{expected_size} for {n_variants} variants and {n_samples} '
+				'samples'
+			)
+
+		self.packed = np.memmap(
+			bed_file,
+			dtype=np.uint8,
+			mode='r',
+			offset=3,
+			shape=(n_variants, self.bytes_per_variant)
+		)
+
+	def read_packed(self, start, stop):
+		"""Packed .bed records of variants start to stop."""
+		return self.packed[start:stop]
+
+	def read_block(self, start, stop):
+		"""int8 genotypes of variants start to stop."""
+		return decode_bed_bytes(
+			np.asarray(self.packed[start:stop]), self.n_samples
+		)
+
+	def read_variants(self, variant_idx):
+		"""int8 genotypes of the variants at sorted indices variant_idx."""
+		return decode_bed_bytes(self.packed[variant_idx], self.n_samples)
+
+
+class PgenReader:
+	"""Block reader for a .pgen file using pgenlib.
+
+	Each thread gets its own pgenlib reader, so blocks can be read from
+	a thread pool.
+
+	Args:
+		pgen_file: Path to the .pgen file.
+		n_samples: Number of samples, from the .psam file.
+		n_variants: Number of variants, from the .pvar file.
+	"""
+
+	def __init__(self, pgen_file, n_samples, n_variants):
+		if pgenlib is None:
+			raise ImportError('pgenlib is required to read .pgen files')
+		self.pgen_file = pgen_file
+		self.n_samples = n_samples
+		self.n_variants = n_variants
+		self._local = threading.local()
+
+	def _reader(self):
+		if not hasattr(self._local, 'reader'):
+			self._local.reader = pgenlib.PgenReader(
+				self.pgen_file.encode(),
+				raw_sample_ct=self.n_samples,
+				variant_ct=self.n_variants
+			)
+		return self._local.reader
+
+	def read_block(self, start, stop):
+		"""int8 genotypes of variants start to stop."""
+		genos = np.empty((stop - start, self.n_samples), dtype=np.int8)
+		if stop > start:
+			self._reader().read_range(start, stop, genos)
+		genos[genos < 0] = MISSING
+		return genos
+
+	def read_variants(self, variant_idx):
+		"""int8 genotypes of the variants at sorted indices variant_idx."""
+		genos = np.empty((len(variant_idx), self.n_samples), dtype=np.int8)
+		if len(variant_idx) > 0:
+			self._reader().read_list(
+				np.asarray(variant_idx, dtype=np.uint32), genos
+			)
+		genos[genos < 0] = MISSING
+		return genos
+
+
+def open_genotypes(bfile=None, pfile=None):
+	"""Open a PLINK 1 or PLINK 2 fileset.
+
+	Returns (reader, variants, samples) where reader is a BedReader or
+	PgenReader, variants is a DataFrame with VARIANT_COLS columns and
+	samples is a DataFrame with IID (and FID if known) columns.
+
+	Args:
+		bfile: Prefix of .bed/.bim/.fam files.
+		pfile: Prefix of .pgen/.pvar/.psam files.
+	"""
+	if (bfile is None) == (pfile is None):
+		raise ValueError('Exactly one of bfile and pfile must be given')
+
+	if bfile is not None:
+		variants = read_bim(f'{bfile}.bim')
+		samples = read_fam(f'{bfile}.fam')
+		reader = BedReader(f'{bfile}.bed', len(samples), len(variants))
+	else:
+		variants = read_pvar(f'{pfile}.pvar')
+		samples = read_psam(f'{pfile}.psam')
+		reader = PgenReader(f'{pfile}.pgen', len(samples), len(variants))
+
+	return reader, variants, samples
+
+
+def write_bed(bfile, genos, variants, samples, block_variants=10_000):
+	"""Write a .bed/.bim/.fam fileset.
+
+	Args:
+		bfile: Output prefix.
+		genos: (n_variants, n_samples) int8 counts of A1, MISSING for
+			missing. Can be a memmap or any array supporting row slices.
+		variants: DataFrame with VARIANT_COLS columns.
+		samples: DataFrame with FID and IID columns.
+		block_variants: Variants encoded at a time.
+	"""
+	variants[VARIANT_COLS].to_csv(
+		f'{bfile}.bim', sep='\t', header=False, index=False
+	)
+
+	fam = pd.DataFrame({
+		'FID': samples['FID'] if 'FID' in samples else samples['IID'],
+		'IID': samples['IID'],
+		'PAT': 0,
+		'MAT': 0,
+		'SEX': 0,
+		'PHENO': -9,
+	})
+	fam.to_csv(f'{bfile}.fam', sep='\t', header=False, index=False)
+
+	with open(f'{bfile}.bed', 'wb') as f:
+		f.write(BED_MAGIC)
+		for start in range(0, len(genos), block_variants):
+			f.write(encode_bed_bytes(genos[start:start + block_variants]).tobytes())
@@ -0,0 +1,548 @@
+"""Packed 2-bit genotype store with memory-mapped views.
+
+A store is a directory holding hard-call genotypes packed four per byte
+with the .bed encoding (see bed_io), in two orientations:
+
+* variant_major.bin: (n_variants, ceil(n_samples / 4)) bytes, one row per
+	variant. This is the body of a .bed file.
+* sample_major.bin: (n_samples, ceil(n_variants / 4)) bytes, one row per
+	sample. Optional.
+
+and the variant and sample tables (variants.tsv, samples.tsv) with a
+meta.json of the dimensions. Both orientations are memory-mapped, so
+opening a store reads nothing and selecting variants or samples returns
+a GenoView without copying genotypes. Genotypes are only decoded, to
+int8 counts or float32 dosages, when a view is read, and then from
+whichever orientation needs fewer bytes for the selection: a few
+variants for all samples are read from variant rows, a few samples for
+all variants from sample rows.
+
+At 2 bits per genotype each orientation is 1/32 of the size of a
+float64 matrix (1/16 with both), e.g. 6 GB per orientation for 330k
+samples and 80k variants instead of 196 GB.
+
+Run as a script to build a store from PLINK files:
+
+	python geno_store.py --bfile geno -o geno_store
+
+Args:
+
+* --bfile: Prefix of .bed/.bim/.fam genotype files.
+* --pfile: Prefix of .pgen/.pvar/.psam genotype files. Requires pgenlib.
+	One of --bfile and --pfile is required.
+* -o, --out-dir: Directory to write the store to.
+* --no-sample-major: Flag to only store the variant-major orientation.
+	False when not provided.
+* --block-mb: Approximate memory per block while building in MB.
+	Default: 256.
+"""
+
+import argparse
+import json
+import os
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from bed_io import (
+	BED_BYTE_LUT,
+	BED_CODE_DOSAGE,
+	MISSING,
+	VARIANT_COLS,
+	BedReader,
+	encode_bed_bytes,
+	open_genotypes,
+)
+
+
+STORE_VERSION = 1
+
+VARIANT_MAJOR_FILE = 'variant_major.bin'
+SAMPLE_MAJOR_FILE = 'sample_major.bin'
+
+# float32 dosage of each 2-bit code, NaN for missing
+CODE_FLOAT32 = np.where(
+	BED_CODE_DOSAGE == MISSING, np.nan, BED_CODE_DOSAGE
+).astype(np.float32)
+
+# (256, 4) float32 dosages of the four genotypes packed in each byte value
+BYTE_LUT_FLOAT32 = np.where(
+	BED_BYTE_LUT == MISSING, np.nan, BED_BYTE_LUT
+).astype(np.float32)
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+
+	geno = parser.add_mutually_exclusive_group(required=True)
+	geno.add_argument("--bfile")
+	geno.add_argument("--pfile")
+	parser.add_argument("-o", "--out-dir", required=True)
+	parser.add_argument("--no-sample-major", action='store_true')
+	parser.add_argument("--block-mb", type=float, default=256)
+
+	return parser.parse_args()
+
+
+def packed_width(n):
+	"""Bytes per row holding n packed genotypes."""
+	return (n + 3) // 4
+
+
+def _normalize_sel(sel, n):
+	"""Selection as a step 1 slice or an int64 index array.
+
+	Args:
+		sel: None (everything), a slice, a boolean mask or integer indices.
+		n: Length of the axis selected from.
+	"""
+	if sel is None:
+		return slice(0, n)
+	if isinstance(sel, slice):
+		start, stop, step = sel.indices(n)
+		if step == 1:
+			return slice(start, max(start, stop))
+		return np.arange(start, stop, step)
+
+	sel = np.asarray(sel)
+	if sel.dtype == bool:
+		if len(sel) != n:
+			raise IndexError(f'Boolean selection of length {len(sel)} for {n}')
+		return np.flatnonzero(sel)
+	sel = sel.astype(np.int64)
+	sel[sel < 0] += n
+	if len(sel) and (sel.min() < 0 or sel.max() >= n):
+		raise IndexError(f'Index out of range for axis of length {n}')
+	return sel
+
+
+def _sel_len(sel):
+	if isinstance(sel, slice):
+		return sel.stop - sel.start
+	return len(sel)
+
+
+def _compose_sel(base, sub):
+	"""Selection sub of the entries selected by base, in base's axis."""
+	sub = _normalize_sel(sub, _sel_len(base))
+	if isinstance(base, slice):
+		if isinstance(sub, slice):
+			return slice(base.start + sub.start, base.start + sub.stop)
+		return base.start + sub
+	return base[sub]
+
+
+def decode_packed(packed, cols, n_cols, dtype=np.int8):
+	"""Decode selected columns of packed 2-bit rows.
+
+	Returns (len(packed), n selected) genotypes as int8 counts with
+	MISSING, or float32 dosages with NaN.
+
+	Args:
+		packed: (n_rows, packed_width(n_cols)) uint8 array.
+		cols: Column selection, a slice or index array from _normalize_sel.
+		n_cols: Number of columns packed in each row.
+		dtype: np.int8 or np.float32.
+	"""
+	if np.dtype(dtype) == np.int8:
+		code_lut, byte_lut = BED_CODE_DOSAGE, BED_BYTE_LUT
+	elif np.dtype(dtype) == np.float32:
+		code_lut, byte_lut = CODE_FLOAT32, BYTE_LUT_FLOAT32
+	else:
+		raise ValueError(f'Unsupported dtype {dtype}')
+
+	packed = np.asarray(packed)
+	if len(packed) == 0 or _sel_len(cols) == 0:
+		return np.empty((len(packed), _sel_len(cols)), dtype=dtype)
+
+	if isinstance(cols, slice) and cols.start % 4 == 0:
+		# Whole bytes, decoded four genotypes at a time
+		n_sel = cols.stop - cols.start
+		byte_cols = packed[:, cols.start // 4:packed_width(cols.stop)]
+		genos = np.take(byte_lut, byte_cols, axis=0)
+		return genos.reshape(len(packed), -1)[:, :n_sel]
+
+	if isinstance(cols, slice):
+		cols = np.arange(cols.start, cols.stop)
+	shifts = (2 * (cols & 3)).astype(np.uint8)
+	return code_lut[(packed[:, cols >> 2] >> shifts) & 3]
+
+
+class GenoView:
+	"""Lazy selection of variants and samples from a GenoStore.
+
+	Creating and sub-selecting views copies no genotypes. Reading a view
+	decodes only the selected genotypes.
+
+	Args:
+		store: GenoStore the view selects from.
+		variant_sel: Variant selection (slice or index array).
+		sample_sel: Sample selection (slice or index array).
+	"""
+
+	def __init__(self, store, variant_sel, sample_sel):
+		self.store = store
+		self.variant_sel = variant_sel
+		self.sample_sel = sample_sel
+
+	@property
+	def shape(self):
+		"""(n_variants, n_samples) of the view."""
+		return (_sel_len(self.variant_sel), _sel_len(self.sample_sel))
+
+	@property
+	def variants(self):
+		"""Variant table rows of the view."""
+		return self.store.variants.iloc[self.variant_sel].reset_index(drop=True)
+
+	@property
+	def samples(self):
+		"""Sample table rows of the view."""
+		return self.store.samples.iloc[self.sample_sel].reset_index(drop=True)
+
+	def select(self, variants=None, samples=None):
+		"""View of a subset of this view's variants and samples.
+
+		Args:
+			variants: Selection of the view's variants: None (all), slice,
+				boolean mask or integer indices.
+			samples: Selection of the view's samples, as for variants.
+		"""
+		return GenoView(
+			self.store,
+			_compose_sel(self.variant_sel, variants),
+			_compose_sel(self.sample_sel, samples)
+		)
+
+	def packed_variants(self):
+		"""Packed variant-major rows of the view's variants.
+
+		Covers all samples. A memory-mapped view without copying if the
+		variant selection is a slice.
+		"""
+		return self.store.variant_packed[self.variant_sel]
+
+	def packed_samples(self):
+		"""Packed sample-major rows of the view's samples.
+
+		Covers all variants. A memory-mapped view without copying if the
+		sample selection is a slice.
+		"""
+		if self.store.sample_packed is None:
+			raise ValueError('Store has no sample-major genotypes')
+		return self.store.sample_packed[self.sample_sel]
+
+	def _use_sample_major(self):
+		"""Whether reading sample rows is cheaper than variant rows."""
+		if self.store.sample_packed is None:
+			return False
+		n_variants, n_samples = self.shape
+		variant_bytes = n_variants * self.store.variant_packed.shape[1]
+		sample_bytes = n_samples * self.store.sample_packed.shape[1]
+		return sample_bytes < variant_bytes
+
+	def _decode(self, sample_rows, dtype):
+		if sample_rows:
+			return decode_packed(
+				self.packed_samples(),
+				self.variant_sel,
+				self.store.n_variants,
+				dtype
+			)
+		return decode_packed(
+			self.packed_variants(),
+			self.sample_sel,
+			self.store.n_samples,
+			dtype
+		)
+
+	def genotypes(self, dtype=np.int8, impute=False):
+		"""Decoded (n_variants, n_samples) genotypes of the view.
+
+		Args:
+			dtype: np.int8 for counts of A1 with MISSING for missing calls,
+				or np.float32 for dosages with NaN for missing calls.
+			impute: If True, replace missing float32 dosages with the
+				variant's mean over the view's samples.
+		"""
+		sample_rows = self._use_sample_major()
+		genos = self._decode(sample_rows, dtype)
+		if sample_rows:
+			genos = np.ascontiguousarray(genos.T)
+		if impute:
+			_mean_impute(genos, axis=1, dtype=dtype)
+		return genos
+
+	def sample_genotypes(self, dtype=np.int8, impute=False):
+		"""Decoded (n_samples, n_variants) genotypes of the view.
+
+		The transpose of genotypes, as a C-ordered design matrix with one
+		row per sample.
+
+		Args:
+			dtype: As for genotypes.
+			impute: As for genotypes.
+		"""
+		sample_rows = self._use_sample_major()
+		genos = self._decode(sample_rows, dtype)
+		if not sample_rows:
+			genos = np.ascontiguousarray(genos.T)
+		if impute:
+			_mean_impute(genos, axis=0, dtype=dtype)
+		return genos
+
+
+def _mean_impute(dosages, axis, dtype):
+	"""Replace NaN dosages in place with means along axis."""
+	if np.dtype(dtype) != np.float32:
+		raise ValueError('Only float32 dosages can be imputed')
+	missing = np.isnan(dosages)
+	if not missing.any():
+		return
+	with warnings.catch_warnings():
+		# All-missing variants or samples get 0 below
+		warnings.simplefilter('ignore', RuntimeWarning)
+		means = np.nanmean(dosages, axis=axis, keepdims=True)
+	means = np.nan_to_num(means, nan=0.0)
+	np.copyto(dosages, np.broadcast_to(means, dosages.shape), where=missing)
+
+
+class GenoStore:
+	"""Memory-mapped packed genotypes. Open with GenoStore.open.
+
+	Also a block reader like bed_io.BedReader, so it can be scored with
+	score_bed.score_genotypes.
+
+	Args:
+		store_dir: Directory of the store.
+		variants: DataFrame with VARIANT_COLS columns.
+		samples: DataFrame with IID (and FID if known) columns.
+		variant_packed: (n_variants, packed_width(n_samples)) uint8 memmap.
+		sample_packed: (n_samples, packed_width(n_variants)) uint8 memmap,
+			or None.
+	"""
+
+	def __init__(self, store_dir, variants, samples, variant_packed, sample_packed):
+		self.store_dir = store_dir
+		self.variants = variants
+		self.samples = samples
+		self.variant_packed = variant_packed
+		self.sample_packed = sample_packed
+		self.n_variants = len(variants)
+		self.n_samples = len(samples)
+
+	@property
+	def shape(self):
+		"""(n_variants, n_samples) of the store."""
+		return (self.n_variants, self.n_samples)
+
+	@classmethod
+	def open(cls, store_dir):
+		"""Open a store written by create."""
+		with open(os.path.join(store_dir, 'meta.json')) as f:
+			meta = json.load(f)
+		if meta['version'] != STORE_VERSION:
+			raise ValueError(
+				f'{store_dir} has store version {meta["version"]}, expected '
+				f'{STORE_VERSION}'
+			)
+
+		variants = pd.read_csv(
+			os.path.join(store_dir, 'variants.tsv'),
+			sep='\t',
+			dtype={'CHROM': str, 'ID': str, 'A1': str, 'A2': str}
+		)
+		samples = pd.read_csv(
+			os.path.join(store_dir, 'samples.tsv'), sep='\t', dtype=str
+		)
+		n_variants = meta['n_variants']
+		n_samples = meta['n_samples']
+
+		variant_packed = np.memmap(
+			os.path.join(store_dir, VARIANT_MAJOR_FILE),
+			dtype=np.uint8,
+			mode='r',
+			shape=(n_variants, packed_width(n_samples))
+		)
+		sample_packed = None
+		if meta['sample_major']:
+			sample_packed = np.memmap(
+				os.path.join(store_dir, SAMPLE_MAJOR_FILE),
+				dtype=np.uint8,
+				mode='r',
+				shape=(n_samples, packed_width(n_variants))
+			)
+
+		return cls(store_dir, variants, samples, variant_packed, sample_packed)
+
+	@classmethod
+	def create(
+		cls,
+		store_dir,
+		bfile=None,
+		pfile=None,
+		sample_major=True,
+		block_mb=256
+	):
+		"""Build a store from a PLINK 1 or PLINK 2 fileset and open it.
+
+		Args:
+			store_dir: Directory to write the store to.
+			bfile: Prefix of .bed/.bim/.fam files.
+			pfile: Prefix of .pgen/.pvar/.psam files.
+			sample_major: Whether to also write the sample-major copy.
+			block_mb: Approximate memory per block in MB.
+		"""
+		reader, variants, samples = open_genotypes(bfile, pfile)
+		n_variants, n_samples = len(variants), len(samples)
+		block_bytes = int(block_mb * 2 ** 20)
+		os.makedirs(store_dir, exist_ok=True)
+
+		# Variant-major rows are .bed records, copied or encoded in blocks
+		variant_file = os.path.join(store_dir, VARIANT_MAJOR_FILE)
+		block_variants = max(1, block_bytes // max(1, n_samples))
+		with open(variant_file, 'wb') as f:
+			for start in range(0, n_variants, block_variants):
+				stop = min(start + block_variants, n_variants)
+				if isinstance(reader, BedReader):
+					f.write(np.asarray(reader.read_packed(start, stop)).tobytes())
+				else:
+					f.write(encode_bed_bytes(reader.read_block(start, stop)).tobytes())
+
+		if sample_major:
+			variant_packed = np.memmap(
+				variant_file,
+				dtype=np.uint8,
+				mode='r',
+				shape=(n_variants, packed_width(n_samples))
+			)
+			_write_sample_major(
+				os.path.join(store_dir, SAMPLE_MAJOR_FILE),
+				variant_packed,
+				n_samples,
+				block_bytes
+			)
+			del variant_packed
+
+		variants[VARIANT_COLS].to_csv(
+			os.path.join(store_dir, 'variants.tsv'), sep='\t', index=False
+		)
+		samples.to_csv(
+			os.path.join(store_dir, 'samples.tsv'), sep='\t', index=False
+		)
+
+		# Written last, so a store is only opened once complete
+		with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+			json.dump({
+				'version': STORE_VERSION,
+				'n_variants': n_variants,
+				'n_samples': n_samples,
+				'sample_major': sample_major,
+			}, f)
+
+		return cls.open(store_dir)
+
+	def select(self, variants=None, samples=None):
+		"""View of a subset of variants and samples.
+
+		Args:
+			variants: None (all), slice, boolean mask or integer indices.
+			samples: As for variants.
+		"""
+		return GenoView(
+			self,
+			_normalize_sel(variants, self.n_variants),
+			_normalize_sel(samples, self.n_samples)
+		)
+
+	def variant_index(self, ids):
+		"""Indices of variant IDs, or -1 for IDs not in the store."""
+		positions = pd.Series(
+			np.arange(self.n_variants), index=self.variants['ID'].values
+		)
+		positions = positions[~positions.index.duplicated(keep='first')]
+		idx = positions.reindex(np.asarray(ids, dtype=str)).fillna(-1)
+		return idx.values.astype(np.int64)
+
+	def sample_index(self, iids):
+		"""Indices of sample IIDs, or -1 for IIDs not in the store."""
+		positions = pd.Series(
+			np.arange(self.n_samples), index=self.samples['IID'].values
+		)
+		idx = positions.reindex(np.asarray(iids, dtype=str)).fillna(-1)
+		return idx.values.astype(np.int64)
+
+	def read_block(self, start, stop):
+		"""int8 genotypes of variants start to stop for all samples."""
+		return decode_packed(
+			self.variant_packed[start:stop],
+			slice(0, self.n_samples),
+			self.n_samples
+		)
+
+	def read_variants(self, variant_idx):
+		"""int8 genotypes of the variants at sorted indices variant_idx."""
+		return decode_packed(
+			self.variant_packed[np.asarray(variant_idx)],
+			slice(0, self.n_samples),
+			self.n_samples
+		)
+
+
+def _write_sample_major(sample_file, variant_packed, n_samples, block_bytes):
+	"""Transpose packed variant-major rows into a sample-major file.
+
+	Works on tiles of samples: each tile's columns are read from every
+	variant row, decoded in variant blocks, re-packed along variants and
+	written as whole sample rows, so reads and writes are contiguous runs
+	and memory is a few times block_bytes.
+	"""
+	n_variants = len(variant_packed)
+	row_bytes = packed_width(n_variants)
+
+	# Samples per tile (multiple of 4 so tiles start on byte boundaries)
+	# and variants per decoded block (multiple of 4 for the same reason)
+	tile_samples = max(4, block_bytes // max(1, row_bytes) // 4 * 4)
+	block_variants = max(4, block_bytes // tile_samples // 4 * 4)
+
+	sample_packed = np.memmap(
+		sample_file, dtype=np.uint8, mode='w+', shape=(n_samples, row_bytes)
+	)
+	for s_start in range(0, n_samples, tile_samples):
+		s_stop = min(s_start + tile_samples, n_samples)
+		tile = np.empty((s_stop - s_start, row_bytes), dtype=np.uint8)
+
+		for v_start in range(0, n_variants, block_variants):
+			v_stop = min(v_start + block_variants, n_variants)
+			genos = decode_packed(
+				variant_packed[v_start:v_stop],
+				slice(s_start, s_stop),
+				n_samples
+			)
+			tile[:, v_start // 4:packed_width(v_stop)] = encode_bed_bytes(genos.T)
+
+		sample_packed[s_start:s_stop] = tile
+	sample_packed.flush()
+	del sample_packed
+
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	start_time = time.time()
+
+	store = GenoStore.create(
+		args.out_dir,
+		bfile=args.bfile,
+		pfile=args.pfile,
+		sample_major=not args.no_sample_major,
+		block_mb=args.block_mb
+	)
+
+	print(
+		f'Stored {store.n_variants} variants x {store.n_samples} samples in '
+		f'{args.out_dir} in {time.time() - start_time:.1f} seconds',
+		flush=True
+	)
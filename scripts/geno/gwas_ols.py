@@ -0,0 +1,229 @@
+"""Linear regression GWAS in NumPy, a local stand-in for plink2 --glm.
+
+Each variant's allele count x is tested in the model y ~ C + x, as
+plink2 --glm does with --covar, where C holds the covariates and a
+constant. The covariates are the same for every variant, so they are
+projected out once with a thin QR factorization C = QR:
+
+	y_r = y - Q Q'y
+	x'Mx = |x - mean(x)|^2 - |Q'(x - mean(x))|^2		x'My = x'y_r
+	beta = x'My / x'Mx		SE^2 = (y_r'y_r - beta x'My) / (df x'Mx)
+
+with df = n - rank(C) - 1. Centering x changes neither term, as C has a
+constant, and keeps the subtraction for x'Mx accurate.
+
+Genotypes are read in variant blocks. Each block is decoded, centered,
+and multiplied by [Q, y_r] in one matrix product, so thousands of
+variants cost one BLAS call. Blocks are decoded and multiplied in a
+thread pool.
+
+Missing calls are mean-imputed, as in score_bed.py. plink2 instead
+drops samples with a missing call, so results match plink2's for
+variants without missing calls. Samples with a missing phenotype
+(NA or -9) or covariate are not used, and collinear covariates are
+dropped by pivoting the QR factorization.
+
+Output is {out}.{pheno}.glm.linear with the columns of plink2 --glm
+'hide-covar' (see gwas_stats.write_glm_linear), so filter_vars_by_pval,
+PRSice-2 and plink2 --clump and --score read it unchanged.
+
+Example usage:
+
+	python gwas_ols.py --bfile geno --pheno height.pheno \\
+		--covar covar.tsv --keep train_all.txt --out gwas_plink2
+
+Args:
+
+* --bfile: Prefix of .bed/.bim/.fam genotype files.
+* --pfile: Prefix of .pgen/.pvar/.psam genotype files. Requires pgenlib.
+* --store: Directory of a packed genotype store from geno_store.py.
+	One of --bfile, --pfile and --store is required.
+* --pheno: Phenotype file with an IID column.
+* --pheno-name: Phenotype column of --pheno. Default: its only
+	non-ID column.
+* --covar: Covariate file with an IID column. All other non-ID columns
+	are used as covariates and must be numeric.
+* --keep: File of sample IDs to use, e.g. a train split. Default: all
+	samples with a phenotype and covariates.
+* --out: Output prefix.
+* --threads: Number of threads. Default: number of CPUs.
+* --block-mb: Approximate memory per decoded block in MB. Default: 256.
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import linalg, stats
+
+from bed_io import MISSING, open_genotypes
+from geno_store import GenoStore
+from gwas_stats import load_model_data, read_sample_ids, write_glm_linear
+
+
+# Relative size of R's diagonal below which a covariate is collinear
+RANK_TOL = 1e-10
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+
+	geno = parser.add_mutually_exclusive_group(required=True)
+	geno.add_argument("--bfile")
+	geno.add_argument("--pfile")
+	geno.add_argument("--store")
+	parser.add_argument("--pheno", required=True)
+	parser.add_argument("--pheno-name")
+	parser.add_argument("--covar", required=True)
+	parser.add_argument("--keep")
+	parser.add_argument("--out", required=True)
+	parser.add_argument("--threads", type=int, default=os.cpu_count())
+	parser.add_argument("--block-mb", type=float, default=256)
+
+	return parser.parse_args()
+
+
+def residualize_covariates(covars, y):
+	"""(Q, y_r, rank) of the covariates and residualized phenotype.
+
+	Q is an orthonormal basis of the span of the covariates' columns,
+	found by QR with column pivoting so collinear covariates add nothing.
+
+	Args:
+		covars: (n_samples, n_covars) covariates, with a constant column.
+		y: (n_samples,) phenotype.
+	"""
+	q, r, _ = linalg.qr(covars, mode='economic', pivoting=True)
+	diag = np.abs(np.diag(r))
+	rank = int((diag > RANK_TOL * diag[0]).sum())
+	q = q[:, :rank]
+	return q, y - q @ (q.T @ y), rank
+
+
+def _block_stats(genos, sample_cols, basis):
+	"""(n_called, sum_x, x'x, [x'Q, x'y_r]) of centered genotypes of a block."""
+	if sample_cols is not None:
+		genos = genos[:, sample_cols]
+	missing = genos == MISSING
+	x = genos.astype(np.float64)
+	x[missing] = 0.0
+
+	n_called = genos.shape[1] - missing.sum(1)
+	sum_x = x.sum(1)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		means = np.where(n_called > 0, sum_x / n_called, 0.0)
+
+	# Centered and mean-imputed: missing calls become 0
+	x -= means[:, None]
+	x[missing] = 0.0
+	return n_called, sum_x, np.einsum('ij,ij->i', x, x), x @ basis
+
+
+def ols_gwas(
+	reader,
+	sample_cols,
+	covars,
+	y,
+	n_threads=1,
+	block_variants=1000
+):
+	"""(obs_ct, a1_freq, beta, se, t_stat, p) of y ~ C + x per variant.
+
+	Args:
+		reader: BedReader, PgenReader or GenoStore.
+		sample_cols: Genotype columns of the samples of y and covars, or
+			None if they are all samples in genotype file order.
+		covars: (n_samples, n_covars) covariates, with a constant column.
+		y: (n_samples,) phenotype.
+		n_threads: Number of threads decoding and multiplying blocks.
+		block_variants: Variants per block.
+	"""
+	q, y_r, rank = residualize_covariates(covars, y)
+	basis = np.column_stack([q, y_r])
+	y_my = y_r @ y_r
+	n_samples = len(y)
+	df = n_samples - rank - 1
+
+	n_variants = reader.n_variants
+	n_called = np.empty(n_variants, dtype=np.int64)
+	sum_x = np.empty(n_variants)
+	xx = np.empty(n_variants)
+	xq = np.empty((n_variants, rank + 1))
+
+	def process_block(start):
+		stop = min(start + block_variants, n_variants)
+		n_called[start:stop], sum_x[start:stop], xx[start:stop], xq[start:stop] = \
+			_block_stats(reader.read_block(start, stop), sample_cols, basis)
+
+	starts = range(0, n_variants, block_variants)
+	if n_threads <= 1:
+		for start in starts:
+			process_block(start)
+	else:
+		with ThreadPoolExecutor(max_workers=n_threads) as executor:
+			# Blocks write disjoint rows, so results need no merging
+			for _ in executor.map(process_block, starts):
+				pass
+
+	x_my = xq[:, rank]
+	x_mx = xx - np.einsum('ij,ij->i', xq[:, :rank], xq[:, :rank])
+	with np.errstate(invalid='ignore', divide='ignore'):
+		# Monomorphic variants leave nothing after the covariates
+		x_mx = np.where(x_mx > 1e-8 * np.maximum(xx, 1.0), x_mx, np.nan)
+		beta = x_my / x_mx
+		se = np.sqrt(np.maximum(y_my - beta * x_my, 0.0) / df / x_mx)
+		t_stat = beta / se
+		a1_freq = np.where(n_called > 0, sum_x / n_called / 2, np.nan)
+	p = 2 * stats.t.sf(np.abs(t_stat), df)
+	obs_ct = np.full(n_variants, n_samples)
+	return obs_ct, a1_freq, beta, se, t_stat, p
+
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	start_time = time.time()
+
+	if args.store is not None:
+		reader = GenoStore.open(args.store)
+		variants, samples = reader.variants, reader.samples
+	else:
+		reader, variants, samples = open_genotypes(args.bfile, args.pfile)
+
+	pheno_name, y, covars = load_model_data(args.pheno, args.covar, args.pheno_name)
+
+	# Samples to use, in genotype file order
+	geno_iids = samples['IID'].astype(str).values
+	use = pd.Index(geno_iids).isin(y.index)
+	if args.keep is not None:
+		use &= pd.Index(geno_iids).isin(read_sample_ids(args.keep))
+	sample_cols = np.flatnonzero(use)
+	iids = geno_iids[sample_cols]
+	if len(sample_cols) == len(geno_iids):
+		sample_cols = None
+	print(f'{len(iids)} samples, {len(variants)} variants', flush=True)
+
+	# Size blocks by decoded float64 bytes
+	block_variants = max(
+		1, int(args.block_mb * 2 ** 20 // (8 * reader.n_samples))
+	)
+	results = ols_gwas(
+		reader,
+		sample_cols,
+		covars.loc[iids].values,
+		y.loc[iids].values,
+		n_threads=args.threads,
+		block_variants=block_variants
+	)
+
+	out_file = f'{args.out}.{pheno_name}.glm.linear'
+	write_glm_linear(
+		out_file, variants, results, provisional_ref=args.bfile is not None
+	)
+	print(
+		f'Wrote {out_file} in {time.time() - start_time:.1f} seconds',
+		flush=True
+	)
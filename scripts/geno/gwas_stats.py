@@ -0,0 +1,551 @@
+"""Per-shard GWAS sufficient statistics, summed to run a GWAS on any split.
+
+The GWAS of train_all, train_wb and their _dev subsets all regress the
+same phenotype on the same genotypes and covariates, only over different
+samples. 'compute' reads the genotypes once, in variant blocks, and for
+each disjoint sample shard stores per variant
+
+* xc: sums of x * c over the covariates c, with a constant covariate
+	first, so xc[:, 0] is the sum of x.
+* xx, xy: sums of x^2 and x * y.
+* mc, my: sums of c and y over samples with a missing call, so
+	mc[:, 0] is the number of missing calls.
+
+and per shard the covariate cross products C'C, C'y and y'y. Shards are
+the groups of samples with the same membership of the given split files,
+so every split is a union of shards:
+
+	python gwas_stats.py compute --bfile geno --pheno height.pheno \\
+		--covar covar.tsv --splits train_all.txt train_wb.txt \\
+		train_all_dev.txt train_wb_dev.txt -s height_stats
+
+'gwas' then sums the statistics of the shards in a split, given by name
+or as a --keep file of sample IDs, and solves for every variant at once,
+which takes seconds rather than a pass over the genotypes:
+
+	python gwas_stats.py gwas -s height_stats --split train_wb_dev \\
+		--out gwas_plink2
+
+The model is y ~ C + x, as plink2 --glm with covariates. By the
+Frisch-Waugh-Lovell theorem its x coefficient only needs the shared
+inverse G of C'C:
+
+	x'Mx = x'x - x'C G C'x		x'My = x'y - x'C G C'y
+	beta = x'My / x'Mx			SE^2 = (y'My - beta x'My) / (df x'Mx)
+
+with df = n - rank(C) - 1. Missing calls are mean-imputed with the
+split's mean of the called genotypes, which the stored missing-call
+sums allow without rereading genotypes. plink2 instead drops samples
+with missing calls, so results match plink2's exactly only for
+variants without missing calls. Samples with a missing phenotype
+(NA or -9) or covariate are left out of every shard.
+
+Output is {out}.{pheno}.glm.linear in plink2's layout, see
+write_glm_linear.
+
+Args:
+
+* command: 'compute' or 'gwas'.
+* -s, --stats-dir: Directory of the statistics.
+* --bfile, --pfile, --store: Genotypes as in score_bed.py (compute).
+* --pheno: Phenotype file with an IID column (compute).
+* --pheno-name: Phenotype column of --pheno. Default: its only
+	non-ID column.
+* --covar: Covariate file with an IID column (compute). All other
+	non-ID columns are used as covariates and must be numeric.
+* --splits: Sample ID files of the splits to support (compute). Each is
+	saved under its file name without extension.
+* --split: Name of a split given to compute (gwas).
+* --keep: Sample ID file of the samples to use, which must be a union of
+	shards (gwas). One of --split and --keep is required.
+* --out: Output prefix (gwas).
+* --threads: Number of threads (compute). Default: number of CPUs.
+* --block-mb: Approximate memory per decoded block in MB (compute).
+	Default: 256.
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from bed_io import MISSING, open_genotypes
+from geno_store import GenoStore
+
+
+STATS_VERSION = 1
+
+# Sample ID columns of phenotype and covariate files
+ID_COLS = ['#FID', 'FID', 'IID']
+
+# Phenotype value plink2 treats as missing
+MISSING_PHENO = -9
+
+# Per-variant arrays of a shard
+VARIANT_STATS = ['xc', 'xx', 'xy', 'mc', 'my']
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument("command", choices=['compute', 'gwas'])
+	parser.add_argument("-s", "--stats-dir", required=True)
+	geno = parser.add_mutually_exclusive_group()
+	geno.add_argument("--bfile")
+	geno.add_argument("--pfile")
+	geno.add_argument("--store")
+	parser.add_argument("--pheno")
+	parser.add_argument("--pheno-name")
+	parser.add_argument("--covar")
+	parser.add_argument("--splits", nargs='+')
+	split = parser.add_mutually_exclusive_group()
+	split.add_argument("--split")
+	split.add_argument("--keep")
+	parser.add_argument("--out")
+	parser.add_argument("--threads", type=int, default=os.cpu_count())
+	parser.add_argument("--block-mb", type=float, default=256)
+
+	args = parser.parse_args()
+	if args.command == 'compute':
+		if args.bfile is None and args.pfile is None and args.store is None:
+			parser.error('compute requires one of --bfile, --pfile and --store')
+		if args.pheno is None or args.covar is None or not args.splits:
+			parser.error('compute requires --pheno, --covar and --splits')
+	elif args.out is None or (args.split is None and args.keep is None):
+		parser.error('gwas requires --out and one of --split and --keep')
+	return args
+
+
+def read_sample_ids(id_file):
+	"""IIDs of a split or --keep file with IID or FID IID lines."""
+	iids = []
+	with open(id_file) as f:
+		for line in f:
+			fields = line.split()
+			if not fields or line.startswith('#') or fields[-1] == 'IID':
+				continue
+			iids.append(fields[1] if len(fields) > 1 else fields[0])
+	return np.array(iids, dtype=object)
+
+
+def read_sample_table(table_file):
+	"""Whitespace delimited table with an IID column, indexed by IID."""
+	table = pd.read_csv(table_file, sep=r'\s+', dtype={'IID': str})
+	table = table.rename(columns={'#IID': 'IID'})
+	if 'IID' not in table.columns:
+		raise ValueError(f'{table_file} has no IID column')
+	table = table.drop(columns=[c for c in ID_COLS if c != 'IID' and c in table])
+	return table.set_index('IID')
+
+
+def load_model_data(pheno_file, covar_file, pheno_name=None):
+	"""Phenotype and covariates of samples with neither missing.
+
+	Returns (pheno_name, y, covars) where y is a float64 Series and
+	covars a float64 DataFrame with a CONST column first, both indexed
+	by IID.
+	"""
+	pheno = read_sample_table(pheno_file)
+	if pheno_name is None:
+		if pheno.shape[1] != 1:
+			raise ValueError(
+				f'{pheno_file} has several phenotypes, choose one with --pheno-name'
+			)
+		pheno_name = pheno.columns[0]
+	y = pd.to_numeric(pheno[pheno_name], errors='coerce').replace(MISSING_PHENO, np.nan)
+
+	covars = read_sample_table(covar_file)
+	non_numeric = [
+		c for c in covars.columns if not pd.api.types.is_numeric_dtype(covars[c])
+	]
+	if non_numeric:
+		raise ValueError(f'Non-numeric covariates in {covar_file}: {non_numeric}')
+	covars.insert(0, 'CONST', 1.0)
+
+	data = pd.concat([y.rename('__y__'), covars], axis=1, join='inner').dropna()
+	return pheno_name, data.pop('__y__').astype(float), data.astype(float)
+
+
+def make_shards(split_iids, eligible_iids):
+	"""Disjoint shards of the samples in at least one split.
+
+	Returns a list of (shard name, IIDs, names of the splits holding it),
+	ordered by first appearance in eligible_iids.
+
+	Args:
+		split_iids: Dict of split name -> IIDs.
+		eligible_iids: IIDs that can be used, in genotype file order.
+	"""
+	split_names = list(split_iids)
+	membership = np.column_stack([
+		pd.Index(eligible_iids).isin(split_iids[name]) for name in split_names
+	])
+	# Bit i of a sample's code is set if it is in split i
+	codes = membership.astype(np.int64) @ (1 << np.arange(len(split_names)))
+
+	shards = []
+	for code in pd.unique(codes[codes > 0]):
+		shards.append((
+			f'shard{len(shards)}',
+			np.asarray(eligible_iids)[codes == code],
+			[name for i, name in enumerate(split_names) if code >> i & 1]
+		))
+	return shards
+
+
+def _shard_block_stats(genos, covars, y, shard_cols):
+	"""Per-variant statistics of one shard for a block of genotypes."""
+	block = genos[:, shard_cols]
+	missing = block == MISSING
+	x = block.astype(np.float64)
+	has_missing = missing.any()
+	if has_missing:
+		x[missing] = 0.0
+
+	n_variants = len(genos)
+	block_stats = {
+		'xc': x @ covars,
+		'xx': np.einsum('ij,ij->i', x, x),
+		'xy': x @ y,
+		'mc': np.zeros((n_variants, covars.shape[1])),
+		'my': np.zeros(n_variants),
+	}
+	if has_missing:
+		missing = missing.astype(np.float64)
+		block_stats['mc'] = missing @ covars
+		block_stats['my'] = missing @ y
+	return block_stats
+
+
+def compute_stats(
+	reader,
+	samples,
+	variants,
+	y,
+	covars,
+	split_iids,
+	stats_dir,
+	n_threads=1,
+	block_variants=1000,
+	provisional_ref=False
+):
+	"""Compute and save the statistics of every shard to stats_dir.
+
+	Returns the saved metadata.
+
+	Args:
+		reader: BedReader, PgenReader or GenoStore.
+		samples: Sample table of the genotypes, with an IID column.
+		variants: Variant table of the genotypes.
+		y: Phenotype Series indexed by IID.
+		covars: Covariate DataFrame indexed by IID, CONST first.
+		split_iids: Dict of split name -> IIDs.
+		stats_dir: Output directory.
+		n_threads: Number of threads decoding and summing blocks.
+		block_variants: Variants per block.
+		provisional_ref: Whether the genotypes' REF alleles are
+			provisional, as for .bed input. Saved for the output.
+	"""
+	geno_iids = samples['IID'].astype(str).values
+	eligible = geno_iids[pd.Index(geno_iids).isin(y.index)]
+	shards = make_shards(split_iids, eligible)
+	geno_col = pd.Series(np.arange(len(geno_iids)), index=geno_iids)
+
+	n_variants = len(variants)
+	n_covars = covars.shape[1]
+	os.makedirs(stats_dir, exist_ok=True)
+
+	shard_data = []
+	for name, iids, _ in shards:
+		shard_dir = os.path.join(stats_dir, name)
+		os.makedirs(shard_dir, exist_ok=True)
+		c = covars.loc[iids].values
+		y_s = y.loc[iids].values
+		np.savez(
+			os.path.join(shard_dir, 'model.npz'),
+			n=len(iids),
+			ctc=c.T @ c,
+			cty=c.T @ y_s,
+			yty=y_s @ y_s
+		)
+		pd.Series(iids).to_csv(
+			os.path.join(shard_dir, 'iids.txt'), index=False, header=False
+		)
+		out = {
+			key: np.lib.format.open_memmap(
+				os.path.join(shard_dir, f'{key}.npy'),
+				mode='w+',
+				dtype=np.float64,
+				shape=(n_variants, n_covars) if key in ('xc', 'mc') else (n_variants,)
+			)
+			for key in VARIANT_STATS
+		}
+		shard_data.append((geno_col.loc[iids].values, c, y_s, out))
+
+	def process_block(start):
+		stop = min(start + block_variants, n_variants)
+		genos = reader.read_block(start, stop)
+		for cols, c, y_s, out in shard_data:
+			for key, values in _shard_block_stats(genos, c, y_s, cols).items():
+				out[key][start:stop] = values
+
+	starts = range(0, n_variants, block_variants)
+	if n_threads <= 1:
+		for start in starts:
+			process_block(start)
+	else:
+		with ThreadPoolExecutor(max_workers=n_threads) as executor:
+			# Blocks write disjoint rows, so results need no merging
+			for _ in executor.map(process_block, starts):
+				pass
+
+	for *_, out in shard_data:
+		for values in out.values():
+			values.flush()
+
+	variants.to_csv(os.path.join(stats_dir, 'variants.tsv'), sep='\t', index=False)
+	meta = {
+		'version': STATS_VERSION,
+		'n_variants': n_variants,
+		'pheno_name': y.name,
+		'covar_names': list(covars.columns),
+		'provisional_ref': provisional_ref,
+		'shards': {
+			name: {'n_samples': len(iids), 'splits': splits}
+			for name, iids, splits in shards
+		},
+		'splits': {
+			split: [name for name, _, splits in shards if split in splits]
+			for split in split_iids
+		},
+	}
+	with open(os.path.join(stats_dir, 'meta.json'), 'w') as f:
+		json.dump(meta, f, indent=4)
+	return meta
+
+
+def load_meta(stats_dir):
+	with open(os.path.join(stats_dir, 'meta.json')) as f:
+		meta = json.load(f)
+	if meta['version'] != STATS_VERSION:
+		raise ValueError(
+			f'{stats_dir} has statistics version {meta["version"]}, expected '
+			f'{STATS_VERSION}'
+		)
+	return meta
+
+
+def shards_of_samples(stats_dir, meta, iids):
+	"""Names of the shards whose union is the eligible samples in iids.
+
+	Raises ValueError if iids splits a shard, as its statistics cannot
+	be divided.
+	"""
+	iids = pd.Index(iids)
+	names = []
+	for name in meta['shards']:
+		shard_iids = read_sample_ids(os.path.join(stats_dir, name, 'iids.txt'))
+		n_in = pd.Index(shard_iids).isin(iids).sum()
+		if n_in == len(shard_iids):
+			names.append(name)
+		elif n_in > 0:
+			raise ValueError(
+				f'Samples include {n_in} of the {len(shard_iids)} samples of '
+				f'{name}, so they are not a union of shards. Compute the '
+				'statistics with these samples as a split.'
+			)
+	return names
+
+
+def sum_stats(stats_dir, shard_names, start, stop):
+	"""Summed statistics of shards for variants start to stop."""
+	total = None
+	for name in shard_names:
+		shard_dir = os.path.join(stats_dir, name)
+		with np.load(os.path.join(shard_dir, 'model.npz')) as model:
+			shard = {key: model[key] for key in model.files}
+		for key in VARIANT_STATS:
+			shard[key] = np.load(os.path.join(shard_dir, f'{key}.npy'), mmap_mode='r')[start:stop]
+		if total is None:
+			total = {key: np.array(value, dtype=np.float64) for key, value in shard.items()}
+		else:
+			for key, value in shard.items():
+				total[key] += value
+	return total
+
+
+def solve_stats(total):
+	"""(obs_ct, a1_freq, beta, se, t_stat, p) of y ~ C + x per variant.
+
+	Missing calls are mean-imputed with the mean of the called genotypes.
+
+	Args:
+		total: Summed statistics from sum_stats.
+	"""
+	n = float(total['n'])
+	xc, mc = total['xc'], total['mc']
+	n_called = n - mc[:, 0]
+	with np.errstate(divide='ignore', invalid='ignore'):
+		mean = xc[:, 0] / n_called
+
+	# Sums with missing calls set to the mean
+	fill = np.where(n_called > 0, mean, np.nan)
+	xc = xc + fill[:, None] * mc
+	xx = total['xx'] + fill ** 2 * mc[:, 0]
+	xy = total['xy'] + fill * total['my']
+
+	# Collinear covariates (e.g. constant within a split) are handled by
+	# the pseudo-inverse, which projects onto their span all the same
+	ctc, cty = total['ctc'], total['cty']
+	gram_inv = np.linalg.pinv(ctc, hermitian=True)
+	rank = np.linalg.matrix_rank(ctc, hermitian=True)
+
+	xc_g = xc @ gram_inv
+	x_mx = xx - np.einsum('ij,ij->i', xc_g, xc)
+	x_my = xy - xc_g @ cty
+	y_my = total['yty'] - cty @ gram_inv @ cty
+	df = n - rank - 1
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		# Monomorphic variants leave nothing after the covariates
+		x_mx = np.where(x_mx > 1e-8 * np.maximum(xx, 1.0), x_mx, np.nan)
+		beta = x_my / x_mx
+		se = np.sqrt(np.maximum(y_my - beta * x_my, 0.0) / df / x_mx)
+		t_stat = beta / se
+	p = 2 * stats.t.sf(np.abs(t_stat), df)
+	obs_ct = np.full(len(beta), int(n))
+	return obs_ct, mean / 2, beta, se, t_stat, p
+
+
+def write_glm_linear(out_file, variants, results, provisional_ref=False, append=False):
+	"""Write results in plink2 --glm .glm.linear layout.
+
+	Columns are those of plink2 --glm 'hide-covar': #CHROM, POS, ID,
+	REF, ALT, PROVISIONAL_REF?, A1, OMITTED, A1_FREQ, TEST, OBS_CT, BETA,
+	SE, T_STAT, P and ERRCODE, in the same positions, as the workflows
+	read some by position (e.g. --score {file} 3 7 12). A1 is the counted
+	allele, ALT for .pgen and the fifth .bim column for .bed. Untestable
+	variants have NA results and ERRCODE CONST_ALLELE.
+
+	Args:
+		out_file: Output path.
+		variants: Variant table of the results' variants.
+		results: (obs_ct, a1_freq, beta, se, t_stat, p) arrays.
+		provisional_ref: Whether REF is provisional, as for .bed input.
+		append: If True, append without a header.
+	"""
+	obs_ct, a1_freq, beta, se, t_stat, p = results
+	pd.DataFrame({
+		'#CHROM': variants['CHROM'].values,
+		'POS': variants['POS'].values,
+		'ID': variants['ID'].values,
+		'REF': variants['A2'].values,
+		'ALT': variants['A1'].values,
+		'PROVISIONAL_REF?': 'Y' if provisional_ref else 'N',
+		'A1': variants['A1'].values,
+		'OMITTED': variants['A2'].values,
+		'A1_FREQ': a1_freq,
+		'TEST': 'ADD',
+		'OBS_CT': obs_ct,
+		'BETA': beta,
+		'SE': se,
+		'T_STAT': t_stat,
+		'P': p,
+		'ERRCODE': np.where(np.isfinite(beta), '.', 'CONST_ALLELE'),
+	}).to_csv(
+		out_file,
+		sep='\t',
+		index=False,
+		header=not append,
+		mode='a' if append else 'w',
+		na_rep='NA',
+		float_format='%.6g'
+	)
+
+
+def run_gwas(stats_dir, out_prefix, split=None, keep_file=None, block_variants=100_000):
+	"""Write the GWAS of a split from stored statistics.
+
+	Returns the output path.
+	"""
+	meta = load_meta(stats_dir)
+	if split is not None:
+		if split not in meta['splits']:
+			raise ValueError(
+				f'{stats_dir} has no split {split}, has {", ".join(meta["splits"])}'
+			)
+		shard_names = meta['splits'][split]
+	else:
+		shard_names = shards_of_samples(stats_dir, meta, read_sample_ids(keep_file))
+	if not shard_names:
+		raise ValueError('No samples with statistics were selected')
+	n_samples = sum(meta['shards'][name]['n_samples'] for name in shard_names)
+	print(f'Using {len(shard_names)} shards of {n_samples} samples', flush=True)
+
+	variants = pd.read_csv(
+		os.path.join(stats_dir, 'variants.tsv'),
+		sep='\t',
+		dtype={'CHROM': str, 'ID': str, 'A1': str, 'A2': str}
+	)
+	out_file = f'{out_prefix}.{meta["pheno_name"]}.glm.linear'
+	for start in range(0, meta['n_variants'], block_variants):
+		stop = min(start + block_variants, meta['n_variants'])
+		results = solve_stats(sum_stats(stats_dir, shard_names, start, stop))
+		write_glm_linear(
+			out_file,
+			variants.iloc[start:stop],
+			results,
+			provisional_ref=meta['provisional_ref'],
+			append=start > 0
+		)
+	return out_file
+
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	start_time = time.time()
+
+	if args.command == 'gwas':
+		out_file = run_gwas(args.stats_dir, args.out, args.split, args.keep)
+		print(f'Wrote {out_file} in {time.time() - start_time:.1f} seconds', flush=True)
+	else:
+		if args.store is not None:
+			reader = GenoStore.open(args.store)
+			variants, samples = reader.variants, reader.samples
+		else:
+			reader, variants, samples = open_genotypes(args.bfile, args.pfile)
+
+		pheno_name, y, covars = load_model_data(args.pheno, args.covar, args.pheno_name)
+		split_iids = {
+			os.path.splitext(os.path.basename(split_file))[0]: read_sample_ids(split_file)
+			for split_file in args.splits
+		}
+
+		# Size blocks by decoded float64 bytes
+		block_variants = max(
+			1, int(args.block_mb * 2 ** 20 // (8 * reader.n_samples))
+		)
+		meta = compute_stats(
+			reader,
+			samples,
+			variants,
+			y.rename(pheno_name),
+			covars,
+			split_iids,
+			args.stats_dir,
+			n_threads=args.threads,
+			block_variants=block_variants,
+			provisional_ref=args.bfile is not None
+		)
+		print(
+			f'Saved statistics of {meta["n_variants"]} variants for '
+			f'{len(meta["shards"])} shards of {len(split_iids)} splits to '
+			f'{args.stats_dir} in {time.time() - start_time:.1f} seconds',
+			flush=True
+		)
@@ -0,0 +1,198 @@
+"""Stream a plink2 --export A .raw table into an int8 parquet file.
+
+The .raw file is read in chunks of whole rows, each parsed with Arrow's
+multithreaded CSV reader and written as one parquet row group, so peak
+memory is a few times --chunk-mb whatever the size of the table. The
+input is read front to back exactly once, so it can be a FIFO that
+plink2 is still writing to, in which case no text table is ever stored:
+
+	mkfifo filtered_doseage_table.raw
+	plink2 ... --export A --out filtered_doseage_table &
+	python raw_to_parquet.py -r filtered_doseage_table.raw -o out.parquet
+
+The parquet file has an IID column and one int8 column per variant,
+named as in the .raw header ('{ID}_{counted allele}'), with hard-call
+allele counts. Missing calls are parquet nulls, kept in each column's
+validity bitmap so the column stays int8, and pandas reads them as NaN,
+as it does the 'NA' of a .raw file. prs_aml's fit_automl_prs reads the
+file and knows no sentinel value, so a missing call must not be stored
+as a count. FID, PAT, MAT, SEX and PHENOTYPE are dropped.
+
+If --vars-json is given, it is copied to --out-json with every variant
+ID replaced by its .raw column name, and a --meta-json file is written
+with the table's dimensions and encoding.
+
+Args:
+
+* -r, --raw-file: Path to the .raw file or a FIFO it is written to.
+* -o, --out-file: Path of the output parquet file. Default:
+	'filtered_vars.parquet'.
+* -f, --vars-json: Optional JSON file of variant ID lists, e.g.
+	'filtered_vars_raw.json'.
+* --out-json: Path of the converted --vars-json. Default:
+	'filtered_vars.json'.
+* --meta-json: Path of the table metadata JSON. Default:
+	'filtered_vars_meta.json'.
+* --chunk-mb: Approximate size in MB of text parsed per chunk.
+	Default: 64.
+* --threads: Number of Arrow threads. Default: number of CPUs.
+"""
+
+import argparse
+import io
+import json
+import os
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import csv
+
+
+RAW_SAMPLE_COLS = ['FID', 'IID', 'PAT', 'MAT', 'SEX', 'PHENOTYPE']
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument("-r", "--raw-file", required=True)
+	parser.add_argument("-o", "--out-file", default='filtered_vars.parquet')
+	parser.add_argument("-f", "--vars-json")
+	parser.add_argument("--out-json", default='filtered_vars.json')
+	parser.add_argument("--meta-json", default='filtered_vars_meta.json')
+	parser.add_argument("--chunk-mb", type=float, default=64)
+	parser.add_argument("--threads", type=int, default=os.cpu_count())
+
+	return parser.parse_args()
+
+
+def iter_row_chunks(raw_stream, chunk_bytes):
+	"""Yield chunks of whole lines of about chunk_bytes from a binary stream."""
+	while True:
+		chunk = raw_stream.read(chunk_bytes)
+		if not chunk:
+			return
+		if not chunk.endswith(b'\n'):
+			chunk += raw_stream.readline()
+		yield chunk
+
+
+def parse_chunk(chunk, columns, delimiter, iid_type=None):
+	"""Parse a chunk of .raw rows to an Arrow table of IID and int8 counts.
+
+	Missing calls ('NA') are nulls.
+
+	Args:
+		chunk: Bytes of whole .raw rows, without the header line.
+		columns: .raw header column names.
+		delimiter: Field delimiter.
+		iid_type: Arrow type of the IID column. Inferred if None.
+	"""
+	variant_cols = [c for c in columns if c not in RAW_SAMPLE_COLS]
+	column_types = {c: pa.int8() for c in variant_cols}
+	if iid_type is not None:
+		column_types['IID'] = iid_type
+
+	return csv.read_csv(
+		io.BytesIO(chunk),
+		read_options=csv.ReadOptions(column_names=columns, use_threads=True),
+		parse_options=csv.ParseOptions(delimiter=delimiter),
+		convert_options=csv.ConvertOptions(
+			column_types=column_types,
+			include_columns=['IID'] + variant_cols,
+			null_values=['NA'],
+		)
+	)
+
+
+def raw_to_parquet(raw_file, out_file, chunk_bytes=64 * 2 ** 20):
+	"""Convert a .raw table to parquet one row group per chunk.
+
+	Returns (variant_cols, n_samples).
+
+	Args:
+		raw_file: Path to the .raw file or FIFO.
+		out_file: Path of the output parquet file.
+		chunk_bytes: Approximate bytes of text parsed per chunk.
+	"""
+	with open(raw_file, 'rb') as raw_stream:
+		header = raw_stream.readline().decode().rstrip('\r\n')
+		delimiter = '\t' if '\t' in header else ' '
+		columns = header.split(delimiter)
+		variant_cols = [c for c in columns if c not in RAW_SAMPLE_COLS]
+
+		writer = None
+		n_samples = 0
+		try:
+			for chunk in iter_row_chunks(raw_stream, chunk_bytes):
+				if writer is None:
+					# IID type is inferred once and kept for every row group
+					table = parse_chunk(chunk, columns, delimiter)
+					writer = pq.ParquetWriter(out_file, table.schema)
+				else:
+					table = parse_chunk(
+						chunk, columns, delimiter, writer.schema.field('IID').type
+					)
+
+				writer.write_table(table, row_group_size=len(table))
+				n_samples += len(table)
+				print(f'Converted {n_samples} samples', flush=True)
+		finally:
+			if writer is not None:
+				writer.close()
+
+	if writer is None:
+		raise ValueError(f'{raw_file} has no sample rows')
+
+	return variant_cols, n_samples
+
+
+def map_variant_ids(obj, id_to_col):
+	"""Replace variant IDs in lists nested in a JSON object with column names.
+
+	IDs with no .raw column are dropped.
+	"""
+	if isinstance(obj, dict):
+		return {k: map_variant_ids(v, id_to_col) for k, v in obj.items()}
+	if isinstance(obj, list):
+		if all(isinstance(v, str) for v in obj):
+			return [id_to_col[v] for v in obj if v in id_to_col]
+		return [map_variant_ids(v, id_to_col) for v in obj]
+	return obj
+
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	start_time = time.time()
+
+	pa.set_cpu_count(args.threads)
+	pa.set_io_thread_count(args.threads)
+
+	variant_cols, n_samples = raw_to_parquet(
+		args.raw_file,
+		args.out_file,
+		chunk_bytes=int(args.chunk_mb * 2 ** 20)
+	)
+
+	if args.vars_json is not None:
+		# .raw columns are named '{ID}_{counted allele}'
+		id_to_col = {c.rsplit('_', 1)[0]: c for c in variant_cols}
+		with open(args.vars_json) as f:
+			var_sets = json.load(f)
+		with open(args.out_json, 'w') as f:
+			json.dump(map_variant_ids(var_sets, id_to_col), f, indent=4)
+
+		with open(args.meta_json, 'w') as f:
+			json.dump({
+				'n_samples': n_samples,
+				'n_variants': len(variant_cols),
+				'dtype': 'int8',
+				'missing_value': None,
+			}, f, indent=4)
+
+	print(
+		f'Wrote {n_samples} samples x {len(variant_cols)} variants to '
+		f'{args.out_file} in {time.time() - start_time:.1f} seconds',
+		flush=True
+	)
@@ -1,115 +1,295 @@
 """Fit wrapper model with PRSice-2 scores.
 
+A wrapper model is a linear regression of the phenotype on the
+covariates plus one PRS. Several phenotypes and scores can be given at
+once, in which case a wrapper is fit for every (phenotype, score) pair.
+All pairs trained on the same samples are solved together from one
+pass over the data: the covariate block of the normal equations is
+Cholesky factored once and each score is added through its Schur
+complement.
+
 Args:
-	-p, --pheno-file: Path to phenotype file.
+	-p, --pheno-file: Path to phenotype file. Can be given several.
 	-c, --covar-file: Path to covariate file.
-	-s, --score-file: Path to PRSice-2 score file.
+	-s, --score-file: Path to PRSice-2 score file. Can be given several.
+	--score-cols: Score columns to use from each score file. Default:
+		SCORE1_AVG.
 	-v, --val-iids: Path to validation set IIDs file.
 	-t, --test-iids: Path to test set IIDs file.
-	-o, --out-dir: Path to output directory.
+	-o, --out-dir: Path to output directory. With one phenotype and one
+		score, val_preds.csv and test_preds.csv are saved here. Otherwise
+		they are saved in {out-dir}/{pheno_name}/{score_name}/, where
+		pheno_name is the phenotype column name and score_name is the
+		score column if there is one score file, the score file name
+		without extension if there is one score column, or both joined
+		by '.'. perf_spans.json, with the time and peak memory of each
+		stage (see perf_spans.py), is saved here too.
+	--sample-index: Optional sample index .npz from sample_index.py. If
+		given, the val and test splits are the index's splits named by
+		the -v and -t file names without extension (e.g. 'val_all' for
+		val_all.txt) and the split files are not read.
 """
 
 import argparse
 import os
 
+import numpy as np
 import pandas as pd
-from sklearn.linear_model import LinearRegression
+from scipy import linalg
+
+import perf_spans
+from perf_spans import span
+from sample_index import SampleIndex
+from table_cache import read_table
 
 
 def parse_args():
 	parser = argparse.ArgumentParser()
 
-	parser.add_argument("-p", "--pheno-file", required=True)
+	parser.add_argument("-p", "--pheno-file", required=True, nargs='+')
 	parser.add_argument("-c", "--covar-file", required=True)
-	parser.add_argument("-s", "--score-file", required=True)
+	parser.add_argument("-s", "--score-file", required=True, nargs='+')
+	parser.add_argument("--score-cols", nargs='+', default=['SCORE1_AVG'])
 	parser.add_argument("-v", "--val-iids", required=True)
 	parser.add_argument("-t", "--test-iids", required=True)
 	parser.add_argument("-o", "--out-dir", required=True)
+	parser.add_argument("--sample-index")
 
 	return parser.parse_args()
 
 
+def file_stem(path):
+	"""File name without directory or extension."""
+	return os.path.splitext(os.path.basename(path))[0]
+
+
+def fit_linear_wrappers(covars, scores, phenos):
+	"""Fit y ~ covariates + score for every phenotype and score column.
+
+	The design for each pair is [1, covars, scores[:, j]]. With covariates
+	and scores centered, the normal equations for score j are
+
+		[A    b_j ] [beta ]   [c_l ]
+		[b_j' d_j ] [gamma] = [s_jl]
+
+	with A = C'C shared by every pair. A is Cholesky factored once and
+	gamma and beta for all pairs follow from triangular solves.
+
+	Returns (intercept, beta, gamma) with shapes (n_scores, n_phenos),
+	(n_covars, n_scores, n_phenos) and (n_scores, n_phenos).
+
+	Args:
+		covars: (n_samples, n_covars) covariates.
+		scores: (n_samples, n_scores) scores.
+		phenos: (n_samples, n_phenos) phenotypes.
+	"""
+	covar_mean = covars.mean(0)
+	score_mean = scores.mean(0)
+	pheno_mean = phenos.mean(0)
+
+	# One pass over the samples for all cross products
+	X = np.column_stack([covars - covar_mean, scores - score_mean])
+	gram = X.T @ X
+	xty = X.T @ (phenos - pheno_mean)
+
+	n_covars = covars.shape[1]
+	A = gram[:n_covars, :n_covars]
+	B = gram[:n_covars, n_covars:]
+	d = np.diag(gram)[n_covars:]
+	cy = xty[:n_covars]
+	sy = xty[n_covars:]
+
+	try:
+		L = linalg.cholesky(A, lower=True)
+	except linalg.LinAlgError:
+		return _lstsq_wrappers(covars, scores, phenos)
+
+	W = linalg.solve_triangular(L, B, lower=True)
+	Z = linalg.solve_triangular(L, cy, lower=True)
+	schur = d - (W ** 2).sum(0)
+	if np.any(schur <= np.finfo(float).eps * d):
+		return _lstsq_wrappers(covars, scores, phenos)
+
+	gamma = (sy - W.T @ Z) / schur[:, None]
+
+	# beta_jl solves L' beta = Z_l - W_j gamma_jl
+	rhs = Z[:, None, :] - W[:, :, None] * gamma[None, :, :]
+	beta = linalg.solve_triangular(
+		L.T, rhs.reshape(n_covars, -1), lower=False
+	).reshape(rhs.shape)
+
+	intercept = pheno_mean[None, :] \
+		- np.einsum('k,kjl->jl', covar_mean, beta) \
+		- score_mean[:, None] * gamma
+
+	return intercept, beta, gamma
+
+
+def _lstsq_wrappers(covars, scores, phenos):
+	"""Least squares fallback to fit_linear_wrappers for singular designs."""
+	n_covars = covars.shape[1]
+	n_scores = scores.shape[1]
+	n_phenos = phenos.shape[1]
+
+	intercept = np.empty((n_scores, n_phenos))
+	beta = np.empty((n_covars, n_scores, n_phenos))
+	gamma = np.empty((n_scores, n_phenos))
+
+	for j in range(n_scores):
+		X = np.column_stack([np.ones(len(covars)), covars, scores[:, j]])
+		coef = np.linalg.lstsq(X, phenos, rcond=None)[0]
+		intercept[j] = coef[0]
+		beta[:, j] = coef[1:-1]
+		gamma[j] = coef[-1]
+
+	return intercept, beta, gamma
+
+
 if __name__ == '__main__':
 	args = parse_args()
+	perf_spans.start('fit_wrapper')
 
-	# Load scores
-	scores_df = pd.read_csv(
-		args.score_file,
-		usecols=['IID', 'SCORE1_AVG'],
-		sep='\s+'
-	)
-
-	# Load phenotype
-	pheno_df = pd.read_csv(
-		args.pheno_file,
-		sep='\s+'
-	)
+	# Load sample sets
+	with span('load'):
+		if args.sample_index is not None:
+			index = SampleIndex.load(args.sample_index)
+			val_split = index.split(file_stem(args.val_iids))
+			test_split = index.split(file_stem(args.test_iids))
+		else:
+			index = SampleIndex.from_split_files(
+				{'val': args.val_iids, 'test': args.test_iids}
+			)
+			val_split = index.split('val')
+			test_split = index.split('test')
 
 	# Load covariates
-	covar_df = pd.read_csv(
-		args.covar_file,
-		sep='\s+'
-	)
+	with span('load'):
+		covar_df = read_table(
+			args.covar_file,
+			sep='\s+'
+		)
+	with span('join'):
+		covar_cols = [c for c in list(covar_df.columns) if c != 'IID']
+		covar_iids = covar_df['IID'].astype(str).values
+		covars = index.gather(covar_iids, covar_df[covar_cols].values)
+		in_covar = index.mask(covar_iids)
+	del covar_df
 
-	# Load sample sets
-	val_split = pd.read_csv(
-		args.val_iids,
-		sep='\s+',
-		header=None
-	).values.flatten().tolist()
-
-	test_split = pd.read_csv(
-		args.test_iids,
-		sep='\s+',
-		header=None
-	).values.flatten().tolist()
-
-	# Join data
-	data_df = covar_df.merge(scores_df, on='IID', how='inner')
-	data_df = data_df.merge(pheno_df, on='IID', how='inner')
-
-	# Get phenotype and feature column names
-	pheno_name = [c for c in list(pheno_df.columns) if c != 'IID']
-	assert len(pheno_name) == 1
-	pheno_name = pheno_name[0]
-
-	col_names = list(data_df.columns)
-	feat_cols = [c for c in col_names if c not in ['IID', pheno_name]]
-	label_col = [pheno_name]
-
-	# Get training and test data, then free other memory
-	training_data = data_df[data_df['IID'].isin(val_split)]
-	IID_train = training_data['IID'].values.flatten()	# type: ignore
-	X_train = training_data[feat_cols]
-	y_train = training_data[label_col]
-
-	test_data = data_df[data_df['IID'].isin(test_split)]
-	IID_test = test_data['IID'].values.flatten()	# type: ignore
-	X_test = test_data[feat_cols]
-
-	del data_df, scores_df, pheno_df, covar_df
-
-	# Fit linear regression
-	fit_model = LinearRegression().fit(
-		X_train,
-		y_train
-	)
-
-	# Predict
-	val_preds = fit_model.predict(X_train).flatten()
-	test_preds = fit_model.predict(X_test).flatten()
-
-	# Save predictions
-	pd.DataFrame(
-		{'IID': IID_train, 'pred': val_preds}
-	).to_csv(
-		os.path.join(args.out_dir, 'val_preds.csv'),
-		index=False
-	)
-
-	test_pred_df = pd.DataFrame(
-		{'IID': IID_test, 'pred': test_preds}
-	).to_csv(
-		os.path.join(args.out_dir, 'test_preds.csv'),
-		index=False
-	)
+	# Load scores, gathered into index order
+	score_names = []
+	score_arrays = []
+	score_masks = []
+	for score_file in args.score_file:
+		with span('load'):
+			scores_df = read_table(
+				score_file,
+				usecols=['IID'] + args.score_cols,
+				sep='\s+'
+			)
+		with span('join'):
+			score_iids = scores_df['IID'].astype(str).values
+			in_scores = index.mask(score_iids)
+
+			for score_col in args.score_cols:
+				if len(args.score_file) == 1:
+					score_names.append(score_col)
+				elif len(args.score_cols) == 1:
+					score_names.append(file_stem(score_file))
+				else:
+					score_names.append(f'{file_stem(score_file)}.{score_col}')
+				score_arrays.append(
+					index.gather(score_iids, scores_df[score_col].values)
+				)
+				score_masks.append(in_scores)
+	scores = np.column_stack(score_arrays)
+
+	# Load phenotypes
+	pheno_names = []
+	pheno_arrays = []
+	pheno_masks = []
+	for pheno_file in args.pheno_file:
+		with span('load'):
+			pheno_df = read_table(
+				pheno_file,
+				sep='\s+'
+			)
+		pheno_name = [c for c in list(pheno_df.columns) if c != 'IID']
+		assert len(pheno_name) == 1
+		pheno_name = pheno_name[0]
+
+		with span('join'):
+			pheno_iids = pheno_df['IID'].astype(str).values
+			pheno_names.append(pheno_name)
+			pheno_arrays.append(index.gather(pheno_iids, pheno_df[pheno_name].values))
+			pheno_masks.append(index.mask(pheno_iids))
+	phenos = np.column_stack(pheno_arrays)
+
+	if len(set(pheno_names)) < len(pheno_names):
+		raise ValueError(f'Duplicate phenotype names: {pheno_names}')
+	if len(set(score_names)) < len(score_names):
+		raise ValueError(f'Duplicate score names: {score_names}')
+
+	# Samples must be in the covariate, score and phenotype tables, as with
+	# an inner merge on IID. Pairs with the same samples are fit together.
+	with span('join'):
+		pair_groups = {}
+		for l, pheno_mask in enumerate(pheno_masks):
+			for j, score_mask in enumerate(score_masks):
+				in_data = in_covar & score_mask & pheno_mask
+				group = pair_groups.setdefault(
+					in_data.bits.tobytes(), {'in_data': in_data, 'pairs': []}
+				)
+				group['pairs'].append((l, j))
+
+	single_output = len(pheno_names) == 1 and len(score_names) == 1
+
+	for group in pair_groups.values():
+		in_data = group['in_data']
+		pheno_cols = sorted({l for l, _ in group['pairs']})
+		score_cols = sorted({j for _, j in group['pairs']})
+
+		with span('join'):
+			train_codes = (in_data & val_split).codes()
+			test_codes = (in_data & test_split).codes()
+
+		# Fit linear regressions
+		with span('fit'):
+			intercept, beta, gamma = fit_linear_wrappers(
+				covars[train_codes],
+				scores[np.ix_(train_codes, score_cols)],
+				phenos[np.ix_(train_codes, pheno_cols)]
+			)
+
+		for l, j in group['pairs']:
+			jj = score_cols.index(j)
+			ll = pheno_cols.index(l)
+
+			# Predict
+			with span('predict'):
+				split_preds = {}
+				for split_name, codes in [('val', train_codes), ('test', test_codes)]:
+					split_preds[split_name] = (
+						codes,
+						intercept[jj, ll] + covars[codes] @ beta[:, jj, ll]
+						+ scores[codes, j] * gamma[jj, ll]
+					)
+
+			# Save predictions
+			if single_output:
+				pair_dir = args.out_dir
+			else:
+				pair_dir = os.path.join(
+					args.out_dir, pheno_names[l], score_names[j]
+				)
+				os.makedirs(pair_dir, exist_ok=True)
+
+			with span('write'):
+				for split_name, (codes, preds) in split_preds.items():
+					pd.DataFrame(
+						{'IID': index.iids[codes], 'pred': preds}
+					).to_csv(
+						os.path.join(pair_dir, f'{split_name}_preds.csv'),
+						index=False
+					)
+
+	perf_spans.finish(args.out_dir)
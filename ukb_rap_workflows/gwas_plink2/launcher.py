@@ -5,11 +5,17 @@ Uses PGEN input genotype file.
 Example usage:
 ```
 python launcher.py -p platelet_count_30080 --wb
+python launcher.py -p platelet_count_30080 standing_height_50 --wait
 ```
 
 Required args:
 
-* -p, --pheno-name: Name of the phenotype to use for the GWAS.
+* -p, --pheno-name: Name of the phenotype to use for the GWAS. Several
+	can be given, in which case phenotypes sharing a covariate set are
+	run in one plink2 pass over the genotypes, and each phenotype's
+	output is then moved to its own output directory (see
+	multi_pheno.py). Moving the outputs needs --wait or a later run with
+	--merge-only.
 
 Optional args:
 
@@ -36,12 +42,36 @@ Optional args:
 	the output of the GWAS workflow. Default: 
 	'/rdevito/nonlin_prs/gwas/gwas_output'. Final output directory
 	will be of the form: {output_dir}/{pheno_name}_glm[_wb][_dev]
+* --instance-type: Instance type to use. Default: the smallest adequate
+	instance for the data size, planned with rap_utils.resources, if its
+	coefficients are calibrated, otherwise DEFAULT_INSTANCE.
+* --scatter: Flag to run the GWAS as one workflow per chromosome, each
+	on an instance planned for its own number of variants, and merge the
+	outputs into the same .glm.linear file as an unscattered run. See
+	scatter.py. False when not provided.
+* --shard-variants: With --scatter, split chromosomes into shards of at
+	most this many variants. Default: one shard per chromosome.
+* --wait: With --scatter, wait for the shards to finish and merge them.
+	With several phenotypes, wait for the runs to finish and move the
+	outputs. False when not provided.
+* --merge-only: Flag to only merge the shards of an earlier --scatter
+	run, or move the outputs of an earlier run of several phenotypes,
+	e.g. one launched without --wait. False when not provided.
 """
 
 import argparse
 import json
+import os
+import sys
 
-import dxpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rap_utils import dx_resolve, resources
+from rap_utils.local_dx import get_dxpy
+
+import multi_pheno
+import scatter
+
+dxpy = get_dxpy()
 
 
 WORKFLOW_ID = 'workflow-GgvFP80Jv7BFqBjk7V171335'
@@ -53,7 +83,9 @@ def parse_args():
 	parser.add_argument(
 		'-p', '--pheno-name',
 		required=True,
-		help='Name of the phenotype to use for the GWAS.'
+		nargs='+',
+		help='Name of the phenotype to use for the GWAS. Several phenotypes '
+			 'sharing a covariate set are run in one pass.'
 	)
 	parser.add_argument(
 		'--wb',
@@ -105,7 +137,41 @@ def parse_args():
 			 'of the GWAS workflow. Final output directory will be of the form: '
 			 '{output_dir}/{pheno_name}_glm[_wb][_dev]'
 	)
-	return parser.parse_args()
+	parser.add_argument(
+		'--instance-type',
+		default=None,
+		help='Instance type to use. Default: planned from the data size if '
+			'calibrated, otherwise DEFAULT_INSTANCE.'
+	)
+	parser.add_argument(
+		'--scatter',
+		action='store_true',
+		help='Flag to run the GWAS as one workflow per chromosome and merge '
+			 'the outputs.'
+	)
+	parser.add_argument(
+		'--shard-variants',
+		type=int,
+		default=None,
+		help='With --scatter, split chromosomes into shards of at most this '
+			 'many variants.'
+	)
+	parser.add_argument(
+		'--wait',
+		action='store_true',
+		help='With --scatter or several phenotypes, wait for the runs to '
+			 'finish and merge or move their outputs.'
+	)
+	parser.add_argument(
+		'--merge-only',
+		action='store_true',
+		help='Flag to only merge the shards of an earlier --scatter run, or '
+			 'move the outputs of an earlier run of several phenotypes.'
+	)
+	args = parser.parse_args()
+	if len(args.pheno_name) > 1 and args.scatter:
+		parser.error('--scatter takes a single phenotype')
+	return args
 
 
 def launch_gwas_workflow(
@@ -116,7 +182,8 @@ def launch_gwas_workflow(
 	output_dir,
 	workflow_id=WORKFLOW_ID,
 	instance_type=DEFAULT_INSTANCE,
-	name='gwas_plink2'
+	name='gwas_plink2',
+	region=None
 ):
 	"""Launch the GWAS workflow on the UKB RAP.
 	
@@ -132,65 +199,37 @@ def launch_gwas_workflow(
 		instance_type: Instance type to use for the workflow. Defaults
 			to DEFAULT_INSTANCE constant.
 		name: Name of the job. Defaults to 'gwas_plink2'.
+		region: Optional dict with 'chrom', and optionally 'from_bp'
+			and 'to_bp', restricting the GWAS to that region.
 	"""
 
 	# Get workflow
 	workflow = dxpy.dxworkflow.DXWorkflow(dxid=workflow_id)
 
 	# Get data links for inputs
-	geno_pgen_link = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=geno_file.split('/')[-1] + '.pgen',
-			folder='/'.join(geno_file.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-	geno_psam_link = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=geno_file.split('/')[-1] + '.psam',
-			folder='/'.join(geno_file.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-	geno_pvar_link = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=geno_file.split('/')[-1] + '.pvar',
-			folder='/'.join(geno_file.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-	covar_link = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=covar_file.split('/')[-1],
-			folder='/'.join(covar_file.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-	pheno_link = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=pheno_file.split('/')[-1],
-			folder='/'.join(pheno_file.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-	split_link = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=split_file.split('/')[-1],
-			folder='/'.join(split_file.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
+	links = dx_resolve.get_dxlinks([
+		f'{geno_file}.pgen',
+		f'{geno_file}.psam',
+		f'{geno_file}.pvar',
+		covar_file,
+		pheno_file,
+		split_file
+	])
 
 	# Set up workflow input
 	prefix = 'stage-common.'
 	workflow_input = {
-		f'{prefix}geno_pgen_file': geno_pgen_link,
-		f'{prefix}geno_psam_file': geno_psam_link,
-		f'{prefix}geno_pvar_file': geno_pvar_link,
-		f'{prefix}covar_file': covar_link,
-		f'{prefix}pheno_file': pheno_link,
-		f'{prefix}split_file': split_link
+		f'{prefix}geno_pgen_file': links[f'{geno_file}.pgen'],
+		f'{prefix}geno_psam_file': links[f'{geno_file}.psam'],
+		f'{prefix}geno_pvar_file': links[f'{geno_file}.pvar'],
+		f'{prefix}covar_file': links[covar_file],
+		f'{prefix}pheno_file': links[pheno_file],
+		f'{prefix}split_file': links[split_file]
 	}
+	if region is not None:
+		for key in ['chrom', 'from_bp', 'to_bp']:
+			if region.get(key) is not None:
+				workflow_input[f'{prefix}{key}'] = region[key]
 
 	# Run workflow
 	analysis = workflow.run(
@@ -207,19 +246,21 @@ def launch_gwas_workflow(
 if __name__ == '__main__':
 	# Parse args
 	args = parse_args()
-	print(f'Phenotype: {args.pheno_name}')
+	print(f'Phenotype: {", ".join(args.pheno_name)}')
 	
 	# Open phenotype metadata file
 	with open(args.pheno_metadata_file, 'r') as f:
 		pheno_metadata = json.load(f)
 
-	# Get the covariate set to use
-	if 'covar_set' in pheno_metadata[args.pheno_name]:
-		covar_set = pheno_metadata[args.pheno_name]['covar_set']
-	else:
-		covar_set = args.default_covar_set
+	# Get the covariate set to use for each phenotype
+	covar_sets = {}
+	for pheno_name in args.pheno_name:
+		if 'covar_set' in pheno_metadata[pheno_name]:
+			covar_sets[pheno_name] = pheno_metadata[pheno_name]['covar_set']
+		else:
+			covar_sets[pheno_name] = args.default_covar_set
 
-	print(f'Using covariate set {covar_set}.')
+	print(f'Using covariate set {", ".join(sorted(set(covar_sets.values())))}.')
 
 	# Set genotype file and split file names based on if only using WB
 	if args.wb:
@@ -236,27 +277,143 @@ if __name__ == '__main__':
 	print(f'Genotype file: {geno_fname}')
 	print(f'Split file: {split_fname}')
 
-	# Set the output directory
-	output_dir = f'{args.output_dir}/{args.pheno_name}_glm'
+	# Set the output directories, of the form {pheno}_glm[_wb][_dev]
+	suffix = ''
 	if args.wb:
-		output_dir += '_wb'
+		suffix += '_wb'
 	if args.dev:
-		output_dir += '_dev'
-	print(f'Output directory: {output_dir}')
+		suffix += '_dev'
+	output_dirs = {
+		pheno_name: f'{args.output_dir}/{pheno_name}_glm{suffix}'
+		for pheno_name in args.pheno_name
+	}
+	for output_dir in output_dirs.values():
+		print(f'Output directory: {output_dir}')
 
-	# Launch the GWAS workflow
-	job_name = f'gwas_plink2_{args.pheno_name}'
-	if args.wb:
-		job_name += '_wb'
-	if args.dev:
-		job_name += '_dev'
-
-	print(f'Launching GWAS workflow with name: {job_name}')
-	launch_gwas_workflow(
-		geno_file=f'{args.geno_dir}/{geno_fname}',
-		covar_file=f'{args.covar_dir}/{covar_set}.tsv',
-		pheno_file=f'{args.pheno_dir}/{args.pheno_name}.pheno',
-		split_file=f'{args.splits_dir}/{split_fname}',
-		output_dir=output_dir,
-		name=job_name
-	)
\ No newline at end of file
+	geno_file = f'{args.geno_dir}/{geno_fname}'
+	split_file = f'{args.splits_dir}/{split_fname}'
+	n_samples = resources.count_lines(split_file)
+	n_variants = resources.pgen_dims(geno_file)[1]
+
+	# Used by single phenotype runs
+	pheno_name = args.pheno_name[0]
+	output_dir = output_dirs[pheno_name]
+	covar_set = covar_sets[pheno_name]
+	job_name = f'gwas_plink2_{pheno_name}{suffix}'
+
+	if len(args.pheno_name) > 1:
+		# One run per group of phenotypes sharing a covariate set and split
+		groups = multi_pheno.group_phenos(covar_sets, split_fname)
+		if args.instance_type is not None:
+			instance_type = args.instance_type
+		else:
+			instance_type, _ = resources.plan_instance(
+				'gwas_plink2',
+				n_samples=n_samples,
+				n_variants=n_variants,
+				default=DEFAULT_INSTANCE
+			)
+
+		runs = []
+		analyses = []
+		for (covar_set, _), pheno_names in groups.items():
+			run_dir = multi_pheno.group_dir(args.output_dir, covar_set, split_fname)
+			runs.append((run_dir, pheno_names))
+			if args.merge_only:
+				continue
+
+			pheno_file = multi_pheno.combine_pheno_files(
+				{p: f'{args.pheno_dir}/{p}.pheno' for p in pheno_names}, run_dir
+			)
+
+			job_name = f'gwas_plink2_{run_dir.rsplit("/", 1)[-1]}{suffix}'
+			print(
+				f'Launching GWAS workflow with name: {job_name} for '
+				f'{len(pheno_names)} phenotypes on {instance_type}'
+			)
+			analyses.append(launch_gwas_workflow(
+				geno_file=geno_file,
+				covar_file=f'{args.covar_dir}/{covar_set}.tsv',
+				pheno_file=pheno_file,
+				split_file=split_file,
+				output_dir=run_dir,
+				instance_type=instance_type,
+				name=job_name
+			))
+
+		if args.wait:
+			print(f'Waiting for {len(analyses)} runs to finish', flush=True)
+			for analysis in analyses:
+				analysis.wait_on_done()
+		if args.merge_only or args.wait:
+			for run_dir, pheno_names in runs:
+				multi_pheno.fan_out(
+					run_dir, {p: output_dirs[p] for p in pheno_names}
+				)
+		else:
+			print('Move the outputs when the runs are done by rerunning with --merge-only')
+	elif args.merge_only:
+		scatter.merge_shards(output_dir, pheno_name, n_variants=n_variants)
+	elif not args.scatter:
+		if args.instance_type is not None:
+			instance_type = args.instance_type
+		else:
+			# Plan instance type from data size
+			instance_type, _ = resources.plan_instance(
+				'gwas_plink2', n_samples=n_samples, n_variants=n_variants,
+				default=DEFAULT_INSTANCE
+			)
+		print(f'Instance type: {instance_type}')
+
+		print(f'Launching GWAS workflow with name: {job_name}')
+		launch_gwas_workflow(
+			geno_file=geno_file,
+			covar_file=f'{args.covar_dir}/{covar_set}.tsv',
+			pheno_file=f'{args.pheno_dir}/{pheno_name}.pheno',
+			split_file=split_file,
+			output_dir=output_dir,
+			instance_type=instance_type,
+			name=job_name
+		)
+	else:
+		# Scatter: one workflow per shard, each on an instance planned
+		# for its own number of variants once the shard model is calibrated
+		shards = scatter.make_shards(f'{geno_file}.pvar', args.shard_variants)
+		print(f'Scattering over {len(shards)} shards')
+		for shard in shards:
+			if args.instance_type is not None:
+				shard['instance_type'] = args.instance_type
+			else:
+				shard['instance_type'], _ = resources.plan_instance(
+					'gwas_plink2_shard',
+					n_samples=n_samples,
+					n_variants=shard['n_variants'],
+					default=DEFAULT_INSTANCE,
+					verbose=False
+				)
+		scatter.save_shards(shards, output_dir)
+
+		analyses = []
+		for shard in shards:
+			print(
+				f'Shard {shard["name"]}: {shard["n_variants"]} variants on '
+				f'{shard["instance_type"]}'
+			)
+			analyses.append(launch_gwas_workflow(
+				geno_file=geno_file,
+				covar_file=f'{args.covar_dir}/{covar_set}.tsv',
+				pheno_file=f'{args.pheno_dir}/{pheno_name}.pheno',
+				split_file=split_file,
+				output_dir=scatter.shard_dir(output_dir, shard),
+				instance_type=shard['instance_type'],
+				name=f'{job_name}_{shard["name"]}',
+				region=shard
+			))
+
+		if args.wait:
+			print(f'Waiting for {len(analyses)} shards to finish', flush=True)
+			for analysis in analyses:
+				analysis.wait_on_done()
+			scatter.merge_shards(output_dir, pheno_name, n_variants=n_variants)
+		else:
+			print('Merge the shards when they are done by rerunning with --merge-only')
@@ -0,0 +1,181 @@
+"""Run the plink2 GWAS of several phenotypes in one pass over the genotypes.
+
+plink2 --glm tests every phenotype column of its --pheno file in one read
+of the genotypes, writing gwas_plink2.{pheno}.glm.linear per column.
+Phenotypes are grouped by covariate set and split file, as only these
+must be shared by a run, and each group's phenotype files are combined
+into one multi-column file by combine_pheno_files(). A sample missing
+from a phenotype's file is NA in its column, so plink2 leaves it out of
+that phenotype's GWAS as a separate run would.
+
+A group is run in {output_dir}/multi_pheno/{group name}, and fan_out()
+then moves each phenotype's .glm.linear file into the phenotype's usual
+{pheno}_glm[_wb][_dev] folder, so later launchers find it as if it had
+its own run. Each of these folders also gets a runtime.json whose
+runtime_seconds is the phenotype's equal share of the group's runtime,
+with the group's total as multi_pheno_runtime_seconds. Its other keys
+are the group's, and the run folder keeps the group's own runtime.json,
+which is the one to calibrate resources.py's cost model with.
+"""
+
+import io
+import json
+
+import pandas as pd
+
+from rap_utils import dx_resolve, resources
+from rap_utils.local_dx import get_dxpy
+
+dxpy = get_dxpy()
+
+
+MULTI_DIR = 'multi_pheno'
+RUNTIME_FNAME = 'runtime.json'
+
+# Sample ID columns of a phenotype file
+ID_COLS = ['#FID', 'FID', 'IID']
+
+
+def glm_fname(pheno_name):
+	"""Name of plink2's .glm.linear output for a phenotype."""
+	return f'gwas_plink2.{pheno_name}.glm.linear'
+
+
+def group_phenos(covar_sets, split_fname):
+	"""Dict of (covar_set, split_fname) -> phenotypes sharing them.
+
+	Args:
+		covar_sets: Dict of phenotype -> covariate set name.
+		split_fname: Split file name used for every phenotype.
+	"""
+	groups = {}
+	for pheno_name, covar_set in covar_sets.items():
+		groups.setdefault((covar_set, split_fname), []).append(pheno_name)
+	return groups
+
+
+def group_dir(output_dir, covar_set, split_fname):
+	"""Folder a group's combined GWAS run is saved to."""
+	split_name = split_fname.rsplit('.', 1)[0]
+	return f'{output_dir}/{MULTI_DIR}/{covar_set}_{split_name}'
+
+
+def read_pheno_file(pheno_file, pheno_name):
+	"""DataFrame of a phenotype file's ID columns and its phenotype.
+
+	The phenotype column is renamed to pheno_name, so plink2 names the
+	phenotype's output after it. Values are kept as text so they reach
+	plink2 exactly as in the original file.
+	"""
+	with resources.open_text(pheno_file) as f:
+		pheno_df = pd.read_csv(f, sep=r'\s+', dtype=str, keep_default_na=False)
+
+	value_cols = [c for c in pheno_df.columns if c not in ID_COLS]
+	if 'IID' not in pheno_df.columns or len(value_cols) != 1:
+		raise ValueError(
+			f'{pheno_file} must have an IID column and one phenotype column, '
+			f'has columns {", ".join(pheno_df.columns)}'
+		)
+	pheno_df = pheno_df.rename(columns={'#FID': 'FID', value_cols[0]: pheno_name})
+	if pheno_df['IID'].duplicated().any():
+		raise ValueError(f'{pheno_file} has duplicate IIDs')
+	return pheno_df
+
+
+def combine_pheno_files(pheno_files, out_dir):
+	"""Combine phenotype files into one multi-column file in out_dir.
+
+	Returns the combined file's path in UKB RAP storage.
+
+	Args:
+		pheno_files: Dict of phenotype name -> phenotype file path.
+		out_dir: Folder in UKB RAP storage to save the file to.
+	"""
+	pheno_dfs = [
+		read_pheno_file(pheno_file, pheno_name).set_index('IID')
+		for pheno_name, pheno_file in pheno_files.items()
+	]
+	# Samples missing from a phenotype's file are NA for it
+	combined = pd.concat(
+		[pheno_df[pheno_name] for pheno_df, pheno_name in zip(pheno_dfs, pheno_files)],
+		axis=1,
+		join='outer'
+	).fillna('NA')
+	fids = [pheno_df['FID'] for pheno_df in pheno_dfs if 'FID' in pheno_df]
+	if fids:
+		fid = pd.concat(fids)
+		combined.insert(0, '#FID', fid[~fid.index.duplicated()].reindex(combined.index))
+	combined = combined.reset_index(names='IID')
+	if fids:
+		combined = combined[['#FID', 'IID'] + list(pheno_files)]
+
+	buffer = io.StringIO()
+	combined.to_csv(buffer, sep='\t', index=False)
+	name = f'{out_dir.rsplit("/", 1)[-1]}.pheno'
+	path = f'{out_dir}/{name}'
+	# A file of an earlier run would make the path ambiguous
+	dx_resolve.remove_paths([path])
+	dxpy.upload_string(
+		buffer.getvalue(),
+		project=dxpy.PROJECT_CONTEXT_ID,
+		folder=out_dir,
+		name=name,
+		parents=True
+	)
+	print(f'Combined {len(pheno_files)} phenotypes of {len(combined)} samples into {path}')
+	return path
+
+
+def fan_out(run_dir, pheno_dirs):
+	"""Move each phenotype's output of a combined run to its own folder.
+
+	Returns the group's runtime dict.
+
+	Args:
+		run_dir: Folder of the combined run in UKB RAP storage.
+		pheno_dirs: Dict of phenotype name -> output folder.
+	"""
+	paths = {
+		pheno_name: f'{run_dir}/{glm_fname(pheno_name)}'
+		for pheno_name in pheno_dirs
+	}
+	runtime_path = f'{run_dir}/{RUNTIME_FNAME}'
+	file_ids = dx_resolve.resolve_paths(
+		list(paths.values()) + [runtime_path], refresh=True, missing_ok=True
+	)
+	missing = [path for path, dxid in file_ids.items() if dxid is None]
+	if missing:
+		raise FileNotFoundError(
+			f'{len(missing)} outputs of {run_dir} are missing: {", ".join(missing)}'
+		)
+
+	with dxpy.open_dxfile(file_ids[runtime_path]) as f:
+		runtime = json.load(f)
+
+	project = dxpy.DXProject(dxpy.PROJECT_CONTEXT_ID)
+	share = round(runtime['runtime_seconds'] / len(pheno_dirs), 3)
+	for pheno_name, pheno_dir in pheno_dirs.items():
+		project.new_folder(pheno_dir, parents=True)
+		# Replace the outputs of an earlier run of the phenotype
+		dx_resolve.remove_paths([
+			f'{pheno_dir}/{glm_fname(pheno_name)}', f'{pheno_dir}/{RUNTIME_FNAME}'
+		])
+		dxpy.DXFile(file_ids[paths[pheno_name]]).move(pheno_dir)
+
+		pheno_runtime = dict(
+			runtime,
+			runtime_seconds=share,
+			multi_pheno_runtime_seconds=runtime['runtime_seconds'],
+			multi_pheno_run_dir=run_dir,
+			multi_pheno_phenos=list(pheno_dirs),
+		)
+		dxpy.upload_string(
+			json.dumps(pheno_runtime, indent=4),
+			project=dxpy.PROJECT_CONTEXT_ID,
+			folder=pheno_dir,
+			name=RUNTIME_FNAME
+		)
+		print(f'{pheno_name}: {glm_fname(pheno_name)} moved to {pheno_dir}')
+
+	dx_resolve.get_resolver().invalidate(prefix=run_dir)
+	return runtime
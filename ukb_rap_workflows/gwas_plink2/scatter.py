@@ -0,0 +1,362 @@
+"""Split a plink2 GWAS into shards by genomic region and merge the outputs.
+
+A scattered GWAS runs the gwas_plink2 workflow once per shard, each
+restricted to one chromosome or a base pair range of one chromosome
+(the workflow's chrom, from_bp and to_bp inputs), and merges the shards'
+.glm.linear files into the single file an unscattered run writes.
+
+Shards are made from the .pvar file by make_shards(). Each chromosome is
+one shard, or is split into shards of at most max_variants variants
+when given. Shards never split a base pair position, so every variant
+falls in exactly one shard, and shards are in .pvar order, so
+concatenating the shards' outputs in order gives the unscattered output.
+
+The launcher saves the shards to {output_dir}/shards/shards.json and
+each shard's output to {output_dir}/shards/{shard name}. merge_shards()
+checks that every shard's output has the same header and exactly the
+shard's variants in position order, then writes
+{output_dir}/gwas_plink2.{pheno}.glm.linear and a runtime.json, in place
+of those of an earlier merge or unscattered run, with
+
+* runtime_seconds: Total runtime of the shards, the instance time the
+	GWAS costs, so the score tables read it as for an unscattered run.
+* wall_seconds: Runtime of the slowest shard.
+* cpu_seconds and peak_mem_gb, from the shards' telemetry.
+* shards: Each shard's region, number of variants, instance type,
+	runtime_seconds, peak_mem_gb and seconds per 1000 variants.
+* overhead_seconds, seconds_per_kvariant: Least squares fit of shard
+	runtime to a fixed cost per shard plus a cost per variant, for
+	tuning the shard size.
+"""
+
+import json
+import os
+import tempfile
+
+import numpy as np
+from scipy import optimize
+
+from rap_utils import dx_resolve, resources
+from rap_utils.local_dx import get_dxpy
+
+dxpy = get_dxpy()
+
+
+SHARDS_DIR = 'shards'
+SHARDS_FNAME = 'shards.json'
+RUNTIME_FNAME = 'runtime.json'
+
+
+def glm_fname(pheno_name):
+	"""Name of plink2's .glm.linear output for a phenotype."""
+	return f'gwas_plink2.{pheno_name}.glm.linear'
+
+
+def _shard(chrom, positions):
+	return {
+		'chrom': chrom,
+		'from_bp': positions[0],
+		'to_bp': positions[-1],
+		'n_variants': len(positions),
+	}
+
+
+def _split_chrom(chrom, positions, max_variants):
+	"""Shards of one chromosome with at most max_variants variants.
+
+	A shard is only cut where the position changes, so a shard can
+	exceed max_variants if more variants than that share a position.
+	"""
+	if max_variants is None or len(positions) <= max_variants:
+		return [_shard(chrom, positions)]
+
+	# Split into equal sized shards rather than leave a small last one
+	n_shards = -(-len(positions) // max_variants)
+	target = -(-len(positions) // n_shards)
+
+	shards = []
+	start = 0
+	while start < len(positions):
+		end = min(start + target, len(positions))
+		while end < len(positions) and positions[end] == positions[end - 1]:
+			end += 1
+		shards.append(_shard(chrom, positions[start:end]))
+		start = end
+	return shards
+
+
+def make_shards(pvar_file, max_variants=None):
+	"""List of shards of the variants of a .pvar file, in file order.
+
+	Each shard is a dict with 'name', 'chrom', 'from_bp', 'to_bp' and
+	'n_variants'. Whole-chromosome shards have from_bp and to_bp set to
+	None, so the workflow runs on the chromosome with --chr alone.
+
+	Args:
+		pvar_file: Local or UKB RAP path of the .pvar file.
+		max_variants: Maximum variants per shard, or None for one shard
+			per chromosome.
+	"""
+	chroms = []
+	positions = {}
+	chrom_col, pos_col = 0, 1
+	with resources.open_text(pvar_file) as f:
+		for line in f:
+			if line.startswith('##'):
+				continue
+			fields = line.split()
+			if line.startswith('#'):
+				chrom_col = fields.index('#CHROM')
+				pos_col = fields.index('POS')
+				continue
+			chrom, pos = fields[chrom_col], int(fields[pos_col])
+			if not chroms or chrom != chroms[-1]:
+				if chrom in positions:
+					raise ValueError(
+						f'{pvar_file} is not sorted: chromosome {chrom} is not contiguous'
+					)
+				chroms.append(chrom)
+				positions[chrom] = []
+			elif pos < positions[chrom][-1]:
+				raise ValueError(
+					f'{pvar_file} is not sorted: position {pos} of chromosome '
+					f'{chrom} follows {positions[chrom][-1]}'
+				)
+			positions[chrom].append(pos)
+
+	shards = []
+	for chrom in chroms:
+		chrom_shards = _split_chrom(chrom, positions[chrom], max_variants)
+		for i, shard in enumerate(chrom_shards):
+			if len(chrom_shards) == 1:
+				shard['name'] = f'chr{chrom}'
+				shard['from_bp'] = shard['to_bp'] = None
+			else:
+				shard['name'] = f'chr{chrom}_{i + 1:03d}'
+			shards.append(shard)
+	return shards
+
+
+def shard_dir(output_dir, shard):
+	"""Output directory of a shard."""
+	return f'{output_dir}/{SHARDS_DIR}/{shard["name"]}'
+
+
+def save_shards(shards, output_dir):
+	"""Upload the shard list to {output_dir}/shards/shards.json."""
+	dx_resolve.remove_paths([f'{output_dir}/{SHARDS_DIR}/{SHARDS_FNAME}'])
+	dxpy.upload_string(
+		json.dumps(shards, indent=4),
+		project=dxpy.PROJECT_CONTEXT_ID,
+		folder=f'{output_dir}/{SHARDS_DIR}',
+		name=SHARDS_FNAME,
+		parents=True
+	)
+
+
+def load_shards(output_dir):
+	"""Shard list saved by save_shards()."""
+	with resources.open_text(f'{output_dir}/{SHARDS_DIR}/{SHARDS_FNAME}') as f:
+		return json.load(f)
+
+
+def _merge_glm_files(shards, shard_files, out_file):
+	"""Check the shards' .glm.linear files and concatenate them to out_file.
+
+	Returns the number of variants written.
+	"""
+	header = None
+	n_written = 0
+	with open(out_file, 'w') as out:
+		for shard, shard_file in zip(shards, shard_files):
+			with open(shard_file) as f:
+				shard_header = f.readline()
+				if header is None:
+					header = shard_header
+					out.write(header)
+					columns = header.lstrip('#').split()
+					chrom_col = columns.index('CHROM')
+					pos_col = columns.index('POS')
+				elif shard_header != header:
+					raise ValueError(
+						f'Header of shard {shard["name"]} differs from the first '
+						f'shard\'s: {shard_header.strip()}'
+					)
+
+				n_rows = 0
+				last_pos = -1
+				for line in f:
+					fields = line.split('\t', pos_col + 1)
+					chrom, pos = fields[chrom_col], int(fields[pos_col])
+					if chrom != shard['chrom'] or pos < last_pos or (
+						shard['from_bp'] is not None
+						and not shard['from_bp'] <= pos <= shard['to_bp']
+					):
+						raise ValueError(
+							f'Variant at {chrom}:{pos} of shard {shard["name"]} is '
+							f'out of order or outside the shard'
+						)
+					last_pos = pos
+					out.write(line)
+					n_rows += 1
+
+			if n_rows != shard['n_variants']:
+				raise ValueError(
+					f'Shard {shard["name"]} has {n_rows} variants, expected '
+					f'{shard["n_variants"]}'
+				)
+			n_written += n_rows
+	return n_written
+
+
+def fit_shard_cost(n_variants, runtime_seconds):
+	"""(overhead_seconds, seconds_per_kvariant) of shard runtimes.
+
+	Non-negative least squares fit of runtime = overhead + per-variant
+	cost, or None if the shards are too few or too alike in size to fit.
+	"""
+	n_variants = np.asarray(n_variants, dtype=float)
+	if len(n_variants) < 3 or np.ptp(n_variants) == 0:
+		return None
+	x = np.column_stack([np.ones(len(n_variants)), n_variants / 1000])
+	coef, _ = optimize.nnls(x, np.asarray(runtime_seconds, dtype=float))
+	return float(coef[0]), float(coef[1])
+
+
+def summarize_runtimes(shards, runtimes):
+	"""runtime.json dict of a scattered GWAS from its shards' runtimes."""
+	shard_records = []
+	for shard, runtime in zip(shards, runtimes):
+		shard_records.append({
+			'name': shard['name'],
+			'chrom': shard['chrom'],
+			'from_bp': shard['from_bp'],
+			'to_bp': shard['to_bp'],
+			'n_variants': shard['n_variants'],
+			'instance_type': shard.get('instance_type'),
+			'runtime_seconds': runtime['runtime_seconds'],
+			'peak_mem_gb': runtime.get('peak_mem_gb'),
+			'seconds_per_kvariant': round(
+				1000 * runtime['runtime_seconds'] / shard['n_variants'], 4
+			),
+		})
+
+	shard_seconds = [r['runtime_seconds'] for r in shard_records]
+	peak_mems = [r['peak_mem_gb'] for r in shard_records if r['peak_mem_gb'] is not None]
+	summary = {
+		'runtime_seconds': round(sum(shard_seconds), 3),
+		'wall_seconds': max(shard_seconds),
+		'cpu_seconds': round(sum(r.get('cpu_seconds', 0.0) for r in runtimes), 3),
+		'peak_mem_gb': max(peak_mems, default=None),
+		'n_shards': len(shards),
+		'n_variants': sum(s['n_variants'] for s in shards),
+	}
+	fit = fit_shard_cost([s['n_variants'] for s in shards], shard_seconds)
+	if fit is not None:
+		summary['overhead_seconds'] = round(fit[0], 3)
+		summary['seconds_per_kvariant'] = round(fit[1], 4)
+	summary['shards'] = shard_records
+	return summary
+
+
+def print_runtimes(summary):
+	"""Print the per-shard runtimes of a summarize_runtimes() dict."""
+	print(f'{"shard":<16} {"variants":>10} {"seconds":>10} {"s/kvar":>8} {"peak GB":>8}  instance')
+	for r in summary['shards']:
+		peak = '' if r['peak_mem_gb'] is None else f'{r["peak_mem_gb"]:.2f}'
+		print(
+			f'{r["name"]:<16} {r["n_variants"]:>10} {r["runtime_seconds"]:>10.1f} '
+			f'{r["seconds_per_kvariant"]:>8.3f} {peak:>8}  {r["instance_type"] or ""}'
+		)
+	mean_seconds = summary['runtime_seconds'] / summary['n_shards']
+	print(
+		f'{summary["n_shards"]} shards: {summary["runtime_seconds"]:.1f} s total, '
+		f'{summary["wall_seconds"]:.1f} s slowest shard '
+		f'({summary["wall_seconds"] / mean_seconds:.2f}x the mean)'
+	)
+	if 'overhead_seconds' in summary:
+		print(
+			f'Fit: {summary["overhead_seconds"]:.1f} s per shard + '
+			f'{summary["seconds_per_kvariant"]:.3f} s per 1000 variants'
+		)
+
+
+def merge_shards(output_dir, pheno_name, n_variants=None):
+	"""Merge the shard outputs of a scattered GWAS into output_dir.
+
+	Returns the runtime summary, as saved to {output_dir}/runtime.json.
+
+	Args:
+		output_dir: GWAS output directory in UKB RAP storage, holding
+			the shards/ directory written by the launcher.
+		pheno_name: Phenotype name of the GWAS.
+		n_variants: If given, the number of variants the merged file
+			must have, e.g. of the whole .pgen.
+	"""
+	shards = load_shards(output_dir)
+	expected = sum(s['n_variants'] for s in shards)
+	if n_variants is not None and n_variants != expected:
+		raise ValueError(
+			f'Shards cover {expected} variants, but the genotype file has {n_variants}'
+		)
+
+	# List the shard folders again, as their outputs are new
+	paths = []
+	for shard in shards:
+		paths += [
+			f'{shard_dir(output_dir, shard)}/{glm_fname(pheno_name)}',
+			f'{shard_dir(output_dir, shard)}/{RUNTIME_FNAME}',
+		]
+	file_ids = dx_resolve.resolve_paths(paths, refresh=True, missing_ok=True)
+	missing = [path for path, dxid in file_ids.items() if dxid is None]
+	if missing:
+		raise FileNotFoundError(
+			f'{len(missing)} shard outputs are missing, e.g. {missing[0]}'
+		)
+
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		shard_files = []
+		runtimes = []
+		for i, shard in enumerate(shards):
+			shard_file = os.path.join(tmp_dir, f'{i}.glm.linear')
+			dxpy.download_dxfile(
+				file_ids[f'{shard_dir(output_dir, shard)}/{glm_fname(pheno_name)}'],
+				shard_file
+			)
+			shard_files.append(shard_file)
+			with dxpy.open_dxfile(
+				file_ids[f'{shard_dir(output_dir, shard)}/{RUNTIME_FNAME}']
+			) as f:
+				runtimes.append(json.load(f))
+
+		merged_file = os.path.join(tmp_dir, glm_fname(pheno_name))
+		n_merged = _merge_glm_files(shards, shard_files, merged_file)
+		print(f'Merged {n_merged} variants of {len(shards)} shards')
+
+		# Replace the outputs of an earlier merge or unscattered run
+		n_removed = dx_resolve.remove_paths([
+			f'{output_dir}/{glm_fname(pheno_name)}',
+			f'{output_dir}/{RUNTIME_FNAME}',
+		])
+		if n_removed:
+			print(f'Removed {n_removed} earlier outputs from {output_dir}')
+
+		dxpy.upload_local_file(
+			merged_file,
+			project=dxpy.PROJECT_CONTEXT_ID,
+			folder=output_dir,
+			name=glm_fname(pheno_name),
+			parents=True,
+			wait_on_close=True
+		)
+
+	summary = summarize_runtimes(shards, runtimes)
+	dxpy.upload_string(
+		json.dumps(summary, indent=4),
+		project=dxpy.PROJECT_CONTEXT_ID,
+		folder=output_dir,
+		name=RUNTIME_FNAME,
+		parents=True
+	)
+	print_runtimes(summary)
+	return summary
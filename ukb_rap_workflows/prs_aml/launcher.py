@@ -16,8 +16,8 @@ Optional args:
 
 * --wb: Flag to use just the white British subset of the UKB data.
 	False when not provided.
-* -l, --large-instance: Flag to use a larger instance type. False when not
-	provided.
+* -l, --large-instance: Flag to use LARGE_INSTANCE instead of the planned
+	instance type. False when not provided.
 * --pheno-dir: Directory containing the phenotype files. Default:
 	'/rdevito/nonlin_prs/data/pheno_data/pheno'
 * --pheno-metadata-file: File containing the phenotype metadata.
@@ -41,17 +41,34 @@ Optional args:
 		'/rdevito/nonlin_prs/automl_prs/output'.
 	Final output directory will be of the form: 
 		{output_dir}/{pheno-name}[_{wb}][_{data-version-desc}][_{model-config}]
+* --instance-type: Instance type to use. Default: the smallest adequate
+	instance for the data size, planned with rap_utils.resources, if its
+	coefficients are calibrated, otherwise DEFAULT_INSTANCE.
+* --time-budget: AutoML time budget in seconds, overriding the model
+	config's. Default: planned from the data size with
+	rap_utils.resources if its runtime coefficients are calibrated and
+	the instance type is planned too, otherwise the model config's.
+* --no-reuse: Flag to run the workflow even if an earlier analysis with
+	the same inputs, config and docker image is done. False when not
+	provided.
 """
 
 import argparse
 import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rap_utils import dx_resolve, resources, reuse
+from rap_utils.local_dx import get_dxpy
 
-import dxpy
+dxpy = get_dxpy()
 
 
 WORKFLOW_ID = 'workflow-Gj6yq88Jv7BBG3K4J3K5kv1Q'
 DEFAULT_INSTANCE = 'mem3_ssd1_v2_x64'
 LARGE_INSTANCE = 'mem3_ssd1_v2_x96'
+LAUNCHER_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
 def parse_args():
@@ -87,7 +104,8 @@ def parse_args():
 	parser.add_argument(
 		'-l', '--large-instance',
 		action='store_true',
-		help='Flag to use a larger instance type. False when not provided.'
+		help='Flag to use LARGE_INSTANCE instead of the planned instance '
+			'type. False when not provided.'
 	)
 	parser.add_argument(
 		'--pheno-dir',
@@ -139,22 +157,29 @@ def parse_args():
 		help='Directory in which a folder will be created to store the output '
 			'of the GWAS workflow. Default: \'/rdevito/nonlin_prs/automl_prs/output\'.'
 	)
+	parser.add_argument(
+		'--instance-type',
+		default=None,
+		help='Instance type to use. Default: planned from the data size if '
+			'calibrated, otherwise DEFAULT_INSTANCE.'
+	)
+	parser.add_argument(
+		'--time-budget',
+		type=int,
+		default=None,
+		help='AutoML time budget in seconds. Default: planned from the data '
+			'size if calibrated, otherwise the model config\'s.'
+	)
+	parser.add_argument(
+		'--no-reuse',
+		action='store_true',
+		help='Flag to run the workflow even if an earlier analysis with the '
+			'same inputs, config and docker image is done.'
+	)
 
 	return parser.parse_args()
 
 
-def get_dxlink_from_path(path_to_link):
-	"""Get dxlink from path."""
-	print(f'Finding data object for {path_to_link}', flush=True)
-	return dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=path_to_link.split('/')[-1],
-			folder='/'.join(path_to_link.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-
-
 def launch_automl_prs_workflow(
 	geno_parquet,
 	var_subset_json,
@@ -167,6 +192,8 @@ def launch_automl_prs_workflow(
 	output_dir,
 	job_name='fit_prs_automl',
 	instance_type=DEFAULT_INSTANCE,
+	time_budget=None,
+	reuse_outputs=True,
 ):
 	"""Launch AutoML-PRS fitting.
 
@@ -179,43 +206,68 @@ def launch_automl_prs_workflow(
 		val_samp_file: Path to the validation sample IDs file.
 		test_samp_file: Path to the test sample IDs file.
 		train_config_path: Path to the training configuration file.
+		output_dir: Path to the output directory.
+		job_name: Name of the job.
+		instance_type: Instance type to use for the workflow.
+		time_budget: AutoML time budget in seconds overriding the one in
+			the training configuration file, or None to use that one.
+		reuse_outputs: If True, reuse the outputs of an earlier analysis with
+			the same launch key instead of running. See rap_utils.reuse.
 	"""
 
 	# Get workflow
 	workflow = dxpy.dxworkflow.DXWorkflow(dxid=WORKFLOW_ID)
 
 	# Get data object IDs
-	geno_parquet_dxlink = get_dxlink_from_path(geno_parquet)
-	var_subset_json_dxlink = get_dxlink_from_path(var_subset_json)
-	pheno_file_dxlink = get_dxlink_from_path(pheno_file)
-	covar_file_dxlink = get_dxlink_from_path(covar_file)
-	train_samp_file_dxlink = get_dxlink_from_path(train_samp_file)
-	val_samp_file_dxlink = get_dxlink_from_path(val_samp_file)
-	test_samp_file_dxlink = get_dxlink_from_path(test_samp_file)
+	links = dx_resolve.get_dxlinks([
+		geno_parquet,
+		var_subset_json,
+		pheno_file,
+		covar_file,
+		train_samp_file,
+		val_samp_file,
+		test_samp_file
+	], refresh=[geno_parquet, var_subset_json])
 
 	# Set workflow input
 	prefix = 'stage-common.'
 	workflow_input = {
-		f'{prefix}geno_parquet': geno_parquet_dxlink,
-		f'{prefix}var_subset_json': var_subset_json_dxlink,
-		f'{prefix}pheno_file': pheno_file_dxlink,
-		f'{prefix}covar_file': covar_file_dxlink,
-		f'{prefix}train_ids': train_samp_file_dxlink,
-		f'{prefix}val_ids': val_samp_file_dxlink,
-		f'{prefix}test_ids': test_samp_file_dxlink,
+		f'{prefix}geno_parquet': links[geno_parquet],
+		f'{prefix}var_subset_json': links[var_subset_json],
+		f'{prefix}pheno_file': links[pheno_file],
+		f'{prefix}covar_file': links[covar_file],
+		f'{prefix}train_ids': links[train_samp_file],
+		f'{prefix}val_ids': links[val_samp_file],
+		f'{prefix}test_ids': links[test_samp_file],
 		f'{prefix}train_config_path': train_config_path
 	}
-
-	# Run workflow
-	analysis = workflow.run(
+	if time_budget is not None:
+		workflow_input[f'{prefix}time_budget'] = time_budget
+
+	# Run workflow unless its outputs can be reused. The model config
+	# is read from the docker image, so it is hashed from its local copy.
+	analysis = reuse.run_or_reuse(
+		dxpy,
+		workflow,
 		workflow_input,
 		folder=output_dir,
 		name=job_name,
+		config_files=[os.path.join(
+			LAUNCHER_DIR,
+			'docker',
+			'model_configs',
+			os.path.basename(train_config_path)
+		)],
+		image=reuse.image_digest(
+			os.path.join(LAUNCHER_DIR, 'prs_aml.wdl'),
+			os.path.join(LAUNCHER_DIR, 'docker'),
+			exclude=['model_configs']
+		),
+		reuse=reuse_outputs,
 		instance_type=instance_type,
 		priority='high',
 		ignore_reuse=True
 	)
-	print(f'Started analysis {analysis.get_id()} ({job_name})', flush=True)
 
 	return analysis
 
@@ -271,13 +323,37 @@ if __name__ == '__main__':
 
 	print(f'Output directory: {output_dir}')
 
-	# Set instance type
-	if args.large_instance:
+	# Set instance type, planned from data size if not given
+	resource_plan = None
+	if args.instance_type is not None:
+		instance_type = args.instance_type
+	elif args.large_instance:
 		instance_type = LARGE_INSTANCE
 	else:
-		instance_type = DEFAULT_INSTANCE
+		instance_type, resource_plan = resources.plan_instance(
+			'prs_aml',
+			n_samples=resources.count_lines(train_samp_fname),
+			n_variants=resources.count_variants(
+				vars_json=var_ss_json,
+				meta_json=f'{args.geno_dir}/{geno_subdir}/filtered_vars_meta.json'
+			),
+			default=DEFAULT_INSTANCE
+		)
 	print(f'Instance type: {instance_type}')
 
+	# Set time budget, which is only planned for the planned instance
+	if args.time_budget is not None:
+		time_budget = args.time_budget
+	elif resource_plan is not None and resource_plan['calibrated']:
+		time_budget = resource_plan['time_budget_seconds']
+	else:
+		# Default coefficients are too rough to change what a config trains
+		time_budget = None
+	if time_budget is not None:
+		print(f'Time budget: {time_budget} seconds')
+	else:
+		print('Time budget: from the model config')
+
 	# Launch workflow
 	job_name = f'prs_automl_{desc}'
 	print(f'Launching AutoML-PRS workflow with name: {job_name}')
@@ -293,7 +369,9 @@ if __name__ == '__main__':
 		train_config_path=f'{args.model_config_dir}/{args.model_config}.json',
 		output_dir=output_dir,
 		job_name=job_name,
-		instance_type=instance_type
+		instance_type=instance_type,
+		time_budget=time_budget,
+		reuse_outputs=not args.no_reuse
 	)
 
 	print()
\ No newline at end of file
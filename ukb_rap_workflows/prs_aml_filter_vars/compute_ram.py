@@ -21,4 +21,10 @@ xtx_memory_bytes = xtx_matrix_size * float_size_bytes
 # Convert bytes to gigabytes for easier interpretation
 xtx_memory_gb = xtx_memory_bytes / (1024 ** 3)
 
-print(f'Memory usage for X^T X matrix: {xtx_memory_gb:.2f} GB')
\ No newline at end of file
+print(f'Memory usage for X^T X matrix: {xtx_memory_gb:.2f} GB')
+# Estimate packed 2-bit genotype store (scripts/geno/geno_store.py) size,
+# for each of the variant-major and sample-major copies
+packed_memory_bytes = num_samples * ((num_features + 3) // 4)
+packed_memory_gb = packed_memory_bytes / (1024 ** 3)
+
+print(f'Packed 2-bit genotype store size per orientation: {packed_memory_gb:.2f} GB')
@@ -22,11 +22,24 @@ Optional args:
 	and the JSON file with information on what variants are includes
 	under which p-value and window thresholds. Default:
 	'/rdevito/nonlin_prs/automl_prs/prepro_data'.
+* --stream-convert: Flag to stream the plink2 dosage export through a
+	FIFO into an int8 parquet file with raw_to_parquet.py instead of
+	writing a .raw file. Missing calls are stored as nulls, which prs_aml
+	reads as NaN as it does without the flag. False when not provided.
+* --instance-type: Instance type to use. Default: the smallest adequate
+	instance for the data size, planned with rap_utils.resources, if its
+	coefficients are calibrated, otherwise DEFAULT_INSTANCE.
 """
 
 import argparse
+import os
+import sys
 
-import dxpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rap_utils import dx_resolve, resources
+from rap_utils.local_dx import get_dxpy
+
+dxpy = get_dxpy()
 
 
 WORKFLOW_ID = 'workflow-GjV2jkjJv7BPKQgvkZJVFjZ7'
@@ -77,26 +90,28 @@ def parse_args():
 			'under which p-value and window thresholds. Default: '
 			'\'/rdevito/nonlin_prs/automl_prs/prepro_data\'.'
 	)
+	parser.add_argument(
+		'--stream-convert',
+		action='store_true',
+		help='Flag to stream the plink2 dosage export into an int8 parquet '
+			'file without writing a .raw file. Missing calls are kept as nulls.'
+	)
+	parser.add_argument(
+		'--instance-type',
+		default=None,
+		help='Instance type to use. Default: planned from the data size if '
+			'calibrated, otherwise DEFAULT_INSTANCE.'
+	)
 
 	return parser.parse_args()
 
 
-def get_dxlink_from_path(path_to_link):
-	"""Get dxlink from path."""
-	print(f'Finding data object for {path_to_link}', flush=True)
-	return dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=path_to_link.split('/')[-1],
-			folder='/'.join(path_to_link.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-
-
 def launch_automl_prepro_workflow(
 	basil_incl_file,
 	pgen_path,
 	out_dir,
+	stream_convert=False,
+	instance_type=DEFAULT_INSTANCE,
 	name='prs_automl_prepro_basil'
 ):
 	"""Launch genotype preprocessing for autoML on UKB RAP.
@@ -106,6 +121,10 @@ def launch_automl_prepro_workflow(
 		pval_path (str): Path to the file containing the p-value threshold.
 		pgen_path (str): Path to the PGEN file without extension.
 		out_dir (str): Path to the output directory.
+		stream_convert (bool): Whether to stream the dosage export into
+			parquet with raw_to_parquet.py. Default: False.
+		instance_type (str): Instance type to use. Default:
+			DEFAULT_INSTANCE.
 		name (str): Name of the workflow. Default: 'prs_automl_prepro'.
 	"""
 
@@ -113,18 +132,21 @@ def launch_automl_prepro_workflow(
 	workflow = dxpy.dxworkflow.DXWorkflow(dxid=WORKFLOW_ID)
 
 	# Get data links for inputs
-	basil_link = get_dxlink_from_path(basil_incl_file)
-	geno_pgen_link = get_dxlink_from_path(f'{pgen_path}.pgen')
-	geno_psam_link = get_dxlink_from_path(f'{pgen_path}.psam')
-	geno_pvar_link = get_dxlink_from_path(f'{pgen_path}.pvar')
+	links = dx_resolve.get_dxlinks([
+		basil_incl_file,
+		f'{pgen_path}.pgen',
+		f'{pgen_path}.psam',
+		f'{pgen_path}.pvar'
+	], refresh=[basil_incl_file])
 
 	# Set workflow input
 	prefix = 'stage-common.'
 	workflow_input = {
-		f'{prefix}basil_incl_file': basil_link,
-		f'{prefix}geno_pgen_file': geno_pgen_link,
-		f'{prefix}geno_psam_file': geno_psam_link,
-		f'{prefix}geno_pvar_file': geno_pvar_link,
+		f'{prefix}basil_incl_file': links[basil_incl_file],
+		f'{prefix}geno_pgen_file': links[f'{pgen_path}.pgen'],
+		f'{prefix}geno_psam_file': links[f'{pgen_path}.psam'],
+		f'{prefix}geno_pvar_file': links[f'{pgen_path}.pvar'],
+		f'{prefix}stream_convert': stream_convert,
 	}
 
 	# Run workflow
@@ -132,7 +154,7 @@ def launch_automl_prepro_workflow(
 		workflow_input,
 		folder=out_dir,
 		name=name,
-		instance_type=DEFAULT_INSTANCE,
+		instance_type=instance_type,
 		priority='high',
 		ignore_reuse=True
 	)
@@ -171,10 +193,24 @@ if __name__ == '__main__':
 	# Set job name
 	job_name = f'prs_automl_prepro_{pheno_out_dir}_basil_{args.basil_desc}'
 
+	if args.instance_type is not None:
+		instance_type = args.instance_type
+	else:
+		# Plan instance type from data size
+		instance_type, _ = resources.plan_instance(
+			'prs_aml_filter_vars',
+			n_samples=resources.pgen_dims(pgen_path)[0],
+			n_variants=resources.count_lines(basil_incl_file) - 1,
+			default=DEFAULT_INSTANCE
+		)
+	print(f'Instance type: {instance_type}')
+
 	# Launch workflow
 	launch_automl_prepro_workflow(
 		basil_incl_file,
 		pgen_path,
 		out_dir,
+		stream_convert=args.stream_convert,
+		instance_type=instance_type,
 		name=job_name
 	)
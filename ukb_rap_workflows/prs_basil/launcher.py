@@ -39,27 +39,27 @@ Optional args:
 	'/rdevito/nonlin_prs/batch_iterative_prs/output/'. Final
 	output directory will be of the form: 
 	{output_dir}/{pheno_name}[_wb][_dev]_{model_type}
+* --instance-type: Instance type to use. Default: the smallest adequate
+	instance for the data size, planned with rap_utils.resources, if its
+	coefficients are calibrated, otherwise DEFAULT_INSTANCE.
+* --no-reuse: Flag to run the workflow even if an earlier analysis with
+	the same inputs and docker image is done. False when not provided.
 """
 
 import argparse
 import json
+import os
+import sys
 
-import dxpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rap_utils import dx_resolve, resources, reuse
+from rap_utils.local_dx import get_dxpy
+
+dxpy = get_dxpy()
 
 WORKFLOW_ID = 'workflow-GjQ6PZ0Jv7B6k3vbX1BjGXBz'
 DEFAULT_INSTANCE = 'mem3_ssd1_v2_x64'
-
-
-def get_dxlink_from_path(path_to_link):
-	"""Get dxlink from path."""
-	print(f'Finding data object for {path_to_link}', flush=True)
-	return dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=path_to_link.split('/')[-1],
-			folder='/'.join(path_to_link.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
+LAUNCHER_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
 def parse_args():
@@ -139,6 +139,18 @@ def parse_args():
 			'of the GWAS workflow. Final output directory will be of the form: '
 			'{output_dir}/{pheno_name}[_wb][_dev]_{model_type}'
 	)
+	parser.add_argument(
+		'--instance-type',
+		default=None,
+		help='Instance type to use. Default: planned from the data size if '
+			'calibrated, otherwise DEFAULT_INSTANCE.'
+	)
+	parser.add_argument(
+		'--no-reuse',
+		action='store_true',
+		help='Flag to run the workflow even if an earlier analysis with the '
+			'same inputs, config and docker image is done.'
+	)
 	
 	return parser.parse_args()
 
@@ -156,7 +168,8 @@ def launch_basil_workflow(
 	output_dir,
 	workflow_id=WORKFLOW_ID,
 	instance_type=DEFAULT_INSTANCE,
-	name='prs_basil'
+	name='prs_basil',
+	reuse_outputs=True
 ):
 	"""Launch BASIL PRS workflow on UKB RAP.
 	
@@ -175,47 +188,58 @@ def launch_basil_workflow(
 		instance_type (str): Instance type to use for the workflow. Default:
 			DEFAULT_INSTANCE.
 		name (str): Name of the workflow. Default: 'prs_basil'.
+		reuse_outputs (bool): If True, reuse the outputs of an earlier
+			analysis with the same launch key instead of running. See
+			rap_utils.reuse. Default: True.
 	"""
 
 	# Get workflow
 	workflow = dxpy.dxworkflow.DXWorkflow(dxid=workflow_id)
 
 	# Get data links for inputs
-	geno_pgen_link = get_dxlink_from_path(f'{geno_prefix}.pgen')
-	geno_psam_link = get_dxlink_from_path(f'{geno_prefix}.psam')
-	geno_pvar_link = get_dxlink_from_path(f'{geno_prefix}.pvar')
-	pheno_link = get_dxlink_from_path(pheno_file)
-	covar_link = get_dxlink_from_path(covar_file)
-	train_samp_link = get_dxlink_from_path(train_samp_file)
-	val_samp_link = get_dxlink_from_path(val_samp_file)
-	test_samp_link = get_dxlink_from_path(test_samp_file)
+	links = dx_resolve.get_dxlinks([
+		f'{geno_prefix}.pgen',
+		f'{geno_prefix}.psam',
+		f'{geno_prefix}.pvar',
+		pheno_file,
+		covar_file,
+		train_samp_file,
+		val_samp_file,
+		test_samp_file
+	])
 
 	# Set workflow input
 	prefix = 'stage-common.'
 	workflow_input = {
-		f'{prefix}geno_pgen': geno_pgen_link,
-		f'{prefix}geno_psam': geno_psam_link,
-		f'{prefix}geno_pvar': geno_pvar_link,
-		f'{prefix}pheno_file': pheno_link,
+		f'{prefix}geno_pgen': links[f'{geno_prefix}.pgen'],
+		f'{prefix}geno_psam': links[f'{geno_prefix}.psam'],
+		f'{prefix}geno_pvar': links[f'{geno_prefix}.pvar'],
+		f'{prefix}pheno_file': links[pheno_file],
 		f'{prefix}pheno_name': pheno_name,
-		f'{prefix}covar_file': covar_link,
-		f'{prefix}train_samples': train_samp_link,
-		f'{prefix}val_samples': val_samp_link,
-		f'{prefix}test_samples': test_samp_link,
+		f'{prefix}covar_file': links[covar_file],
+		f'{prefix}train_samples': links[train_samp_file],
+		f'{prefix}val_samples': links[val_samp_file],
+		f'{prefix}test_samples': links[test_samp_file],
 		f'{prefix}alpha': alpha,
 		f'{prefix}n_iter': n_iter,
 	}
 
-	# Run workflow
-	analysis = workflow.run(
+	# Run workflow unless its outputs can be reused
+	analysis = reuse.run_or_reuse(
+		dxpy,
+		workflow,
 		workflow_input,
 		folder=output_dir,
 		name=name,
+		image=reuse.image_digest(
+			os.path.join(LAUNCHER_DIR, 'prs_basil.wdl'),
+			os.path.join(LAUNCHER_DIR, 'docker')
+		),
+		reuse=reuse_outputs,
 		instance_type=instance_type,
 		priority='high',
 		ignore_reuse=True
 	)
-	print("Started analysis %s (%s)\n"%(analysis.get_id(), name))
 
 	return analysis
 	
@@ -304,6 +328,18 @@ if __name__ == '__main__':
 
 	# Launch the workflow
 	job_name = f'prs_basil_{desc}'
+	if args.instance_type is not None:
+		instance_type = args.instance_type
+	else:
+		# Plan instance type from data size
+		instance_type, _ = resources.plan_instance(
+			'prs_basil',
+			n_samples=resources.count_lines(train_samp_fname),
+			n_variants=resources.pgen_dims(geno_prefix)[1],
+			default=DEFAULT_INSTANCE
+		)
+	print(f'Instance type: {instance_type}')
+
 	print(f'Launching BASIL workflow with name: {job_name}')
 
 	launch_basil_workflow(
@@ -317,5 +353,7 @@ if __name__ == '__main__':
 		alpha=alpha,
 		n_iter=n_iter,
 		output_dir=output_dir,
-		name=job_name
+		instance_type=instance_type,
+		name=job_name,
+		reuse_outputs=not args.no_reuse
 	)
\ No newline at end of file
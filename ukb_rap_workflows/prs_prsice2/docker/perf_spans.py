@@ -0,0 +1,264 @@
+"""Named timing spans and opt-in profiling for the Python steps.
+
+A script calls start() when it begins and finish(out_dir) when it is
+done, and wraps its stages in span(name) blocks:
+
+	perf_spans.start('fit_wrapper')
+	with perf_spans.span('load'):
+		...
+	perf_spans.finish(args.out_dir)
+
+finish() writes perf_spans.json to out_dir with the run's wall time, CPU
+time and peak RSS, and for each span name its number of calls and total
+wall and CPU seconds, and the peak RSS reached inside it. Spans can be
+nested and entered many times, e.g. once per model. Span times are
+inclusive of nested spans.
+
+Peak RSS per span is measured by resetting the kernel's high water mark
+(VmHWM) through /proc/self/clear_refs when a span is entered. Where that
+is not possible (not Linux, or no permission), a span's peak is the
+process peak so far, from getrusage.
+
+Setting the NONLIN_PRS_PROFILE environment variable profiles the whole
+run between start() and finish():
+
+* 'cprofile': Deterministic profile with cProfile, saved as
+	{script}.prof (for pstats or snakeviz) and {script}.prof.txt, the
+	top functions by cumulative time.
+* 'sample': Sampling profile of the main thread, saved as
+	{script}.folded in collapsed stack format (one 'frame;frame;... count'
+	line per stack) for flamegraph.pl or speedscope. Samples are taken
+	every NONLIN_PRS_PROFILE_INTERVAL seconds (default: 0.005), with
+	little overhead for long runs.
+
+Profiles are saved to NONLIN_PRS_PROFILE_DIR if set, otherwise next to
+perf_spans.json.
+"""
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+PROFILE_ENV = 'NONLIN_PRS_PROFILE'
+PROFILE_DIR_ENV = 'NONLIN_PRS_PROFILE_DIR'
+PROFILE_INTERVAL_ENV = 'NONLIN_PRS_PROFILE_INTERVAL'
+DEFAULT_PROFILE_INTERVAL = 0.005
+
+SIDECAR_FNAME = 'perf_spans.json'
+
+# Functions listed in {script}.prof.txt
+N_PROFILE_FUNCTIONS = 50
+
+CLEAR_REFS_FILE = '/proc/self/clear_refs'
+STATUS_FILE = '/proc/self/status'
+
+
+def _status_kb(key):
+	"""A kB value of /proc/self/status, e.g. 'VmHWM', or None."""
+	try:
+		with open(STATUS_FILE) as f:
+			for line in f:
+				if line.startswith(f'{key}:'):
+					return int(line.split()[1])
+	except OSError:
+		pass
+	return None
+
+
+def _reset_peak_rss():
+	"""Reset VmHWM to the current RSS. Returns whether it was reset."""
+	try:
+		with open(CLEAR_REFS_FILE, 'w') as f:
+			f.write('5')
+		return True
+	except OSError:
+		return False
+
+
+def _peak_rss_kb():
+	"""Peak RSS since the last reset, or of the process, in kB."""
+	peak = _status_kb('VmHWM')
+	if peak is None:
+		# ru_maxrss is in kB on Linux and bytes on macOS
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		if sys.platform == 'darwin':
+			peak //= 1024
+	return peak
+
+
+class SamplingProfiler(threading.Thread):
+	"""Thread counting the main thread's stacks every interval seconds."""
+
+	def __init__(self, interval):
+		super().__init__(daemon=True)
+		self.interval = interval
+		self.stacks = Counter()
+		self._thread_id = threading.main_thread().ident
+		self._stop_event = threading.Event()
+
+	def run(self):
+		while not self._stop_event.wait(self.interval):
+			frame = sys._current_frames().get(self._thread_id)
+			stack = []
+			while frame is not None:
+				code = frame.f_code
+				stack.append(
+					f'{code.co_name} ({os.path.basename(code.co_filename)}'
+					f':{code.co_firstlineno})'
+				)
+				frame = frame.f_back
+			if stack:
+				self.stacks[';'.join(reversed(stack))] += 1
+
+	def stop(self):
+		self._stop_event.set()
+		self.join()
+
+	def save(self, folded_file):
+		with open(folded_file, 'w') as f:
+			for stack, count in self.stacks.most_common():
+				f.write(f'{stack} {count}\n')
+
+
+class PerfRecorder:
+	"""Accumulates span timings and runs the profiler for one script."""
+
+	def __init__(self):
+		self.script = None
+		self.spans = {}
+		self._open_peaks = []
+		self._start_wall = None
+		self._start_cpu = None
+		self._profile_mode = None
+		self._profiler = None
+
+	def start(self, script):
+		self.script = script
+		self._start_wall = time.perf_counter()
+		self._start_cpu = time.process_time()
+
+		self._profile_mode = os.environ.get(PROFILE_ENV) or None
+		if self._profile_mode == 'cprofile':
+			self._profiler = cProfile.Profile()
+			self._profiler.enable()
+		elif self._profile_mode == 'sample':
+			interval = float(
+				os.environ.get(PROFILE_INTERVAL_ENV, DEFAULT_PROFILE_INTERVAL)
+			)
+			self._profiler = SamplingProfiler(interval)
+			self._profiler.start()
+		elif self._profile_mode is not None:
+			raise ValueError(
+				f'{PROFILE_ENV} must be \'cprofile\' or \'sample\', '
+				f'not {self._profile_mode!r}'
+			)
+
+	@contextmanager
+	def span(self, name):
+		# Fold the peak so far into open spans before resetting it
+		peak = _peak_rss_kb()
+		self._open_peaks = [max(p, peak) for p in self._open_peaks]
+		_reset_peak_rss()
+		self._open_peaks.append(0)
+
+		start_wall = time.perf_counter()
+		start_cpu = time.process_time()
+		try:
+			yield
+		finally:
+			wall = time.perf_counter() - start_wall
+			cpu = time.process_time() - start_cpu
+			peak = _peak_rss_kb()
+			span_peak = max(self._open_peaks.pop(), peak)
+			self._open_peaks = [max(p, span_peak) for p in self._open_peaks]
+
+			record = self.spans.setdefault(name, {
+				'count': 0,
+				'wall_seconds': 0.0,
+				'cpu_seconds': 0.0,
+				'peak_rss_gb': 0.0,
+			})
+			record['count'] += 1
+			record['wall_seconds'] += wall
+			record['cpu_seconds'] += cpu
+			record['peak_rss_gb'] = max(record['peak_rss_gb'], span_peak / 1024**2)
+
+	def _stop_profiler(self, out_dir):
+		"""Stop the profiler, if any, and save its output to out_dir."""
+		if self._profiler is None:
+			return
+		profile_dir = os.environ.get(PROFILE_DIR_ENV) or out_dir
+		os.makedirs(profile_dir, exist_ok=True)
+		prefix = os.path.join(profile_dir, self.script)
+
+		if self._profile_mode == 'cprofile':
+			self._profiler.disable()
+			self._profiler.dump_stats(f'{prefix}.prof')
+			summary = io.StringIO()
+			stats = pstats.Stats(self._profiler, stream=summary)
+			stats.sort_stats('cumulative').print_stats(N_PROFILE_FUNCTIONS)
+			with open(f'{prefix}.prof.txt', 'w') as f:
+				f.write(summary.getvalue())
+		else:
+			self._profiler.stop()
+			self._profiler.save(f'{prefix}.folded')
+		self._profiler = None
+
+	def finish(self, out_dir):
+		"""Stop profiling and write perf_spans.json to out_dir.
+
+		Returns the path of perf_spans.json.
+		"""
+		self._stop_profiler(out_dir)
+
+		usage = resource.getrusage(resource.RUSAGE_SELF)
+		peak_kb = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+		perf = {
+			'script': self.script,
+			'argv': sys.argv,
+			'wall_seconds': round(time.perf_counter() - self._start_wall, 4),
+			'cpu_seconds': round(time.process_time() - self._start_cpu, 4),
+			'peak_rss_gb': round(peak_kb / 1024**2, 4),
+			'profile': self._profile_mode,
+			'spans': {
+				name: {
+					k: round(v, 4) if isinstance(v, float) else v
+					for k, v in record.items()
+				}
+				for name, record in self.spans.items()
+			},
+		}
+
+		os.makedirs(out_dir, exist_ok=True)
+		sidecar_file = os.path.join(out_dir, SIDECAR_FNAME)
+		with open(sidecar_file, 'w') as f:
+			json.dump(perf, f, indent=4)
+		return sidecar_file
+
+
+# Recorder used by the module level functions
+_recorder = PerfRecorder()
+
+
+def start(script):
+	"""Start timing (and profiling, if enabled) a script's run."""
+	_recorder.start(script)
+
+
+def span(name):
+	"""Context manager timing a named stage of the run."""
+	return _recorder.span(name)
+
+
+def finish(out_dir):
+	"""Stop profiling and write perf_spans.json to out_dir."""
+	return _recorder.finish(out_dir)
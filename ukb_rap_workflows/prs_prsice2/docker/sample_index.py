@@ -0,0 +1,249 @@
+"""Canonical sample index with splits stored as packed bitmasks.
+
+Every IID in the cohort is mapped once to a dense int32 code, its
+position in the sorted array of IIDs. Tables keyed by IID are joined by
+looking up their codes and gathering rows, instead of merging on
+strings. Sample splits are stored as packed bitmasks over the codes, so
+set algebra on splits (e.g. test & wb) is a bytewise operation.
+
+The index and its splits can be saved to and loaded from a .npz file.
+Run as a script to build one from a directory of split files, with one
+split per '.txt' file named by the file name without extension:
+
+	python sample_index.py --splits-dir splits -o sample_index.npz
+
+Args:
+
+* --splits-dir: Directory of split files, each a list of IIDs.
+* -o, --out-file: Path of the .npz file to save the index to.
+"""
+
+import argparse
+import glob
+import os
+
+import numpy as np
+
+from table_cache import read_table
+
+
+# Number of set bits in each byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument("--splits-dir", required=True)
+	parser.add_argument("-o", "--out-file", required=True)
+
+	return parser.parse_args()
+
+
+def load_split_file(split_file):
+	"""Load split file of sample IDs as an array of IID strings."""
+	return read_table(
+		split_file, sep='\s+', header=None, dtype=str
+	).values.flatten()
+
+
+class Bitmask:
+	"""Set of sample codes stored as packed bits.
+
+	Supports & (intersection), | (union), - (difference) and ~
+	(complement) with other Bitmasks over the same index.
+
+	Args:
+		bits: Packed uint8 array as from np.packbits.
+		n: Number of samples in the index.
+	"""
+
+	def __init__(self, bits, n):
+		self.bits = np.asarray(bits, dtype=np.uint8)
+		self.n = n
+
+	@classmethod
+	def from_bool(cls, mask):
+		"""Bitmask of the True entries of a boolean array."""
+		mask = np.asarray(mask, dtype=bool)
+		return cls(np.packbits(mask), len(mask))
+
+	@classmethod
+	def from_codes(cls, codes, n):
+		"""Bitmask of sample codes. Negative (missing) codes are ignored."""
+		mask = np.zeros(n, dtype=bool)
+		codes = np.asarray(codes)
+		mask[codes[codes >= 0]] = True
+		return cls.from_bool(mask)
+
+	def _check(self, other):
+		if self.n != other.n:
+			raise ValueError(
+				f'Bitmasks are over different indices ({self.n} vs {other.n})'
+			)
+
+	def __and__(self, other):
+		self._check(other)
+		return Bitmask(self.bits & other.bits, self.n)
+
+	def __or__(self, other):
+		self._check(other)
+		return Bitmask(self.bits | other.bits, self.n)
+
+	def __sub__(self, other):
+		self._check(other)
+		return Bitmask(self.bits & ~other.bits, self.n)
+
+	def __invert__(self):
+		bits = ~self.bits
+		# Clear padding bits past the last sample
+		if self.n % 8:
+			bits[-1] &= np.uint8(0xFF << (8 - self.n % 8) & 0xFF)
+		return Bitmask(bits, self.n)
+
+	def __eq__(self, other):
+		return self.n == other.n and np.array_equal(self.bits, other.bits)
+
+	def __len__(self):
+		return int(_POPCOUNT[self.bits].sum(dtype=np.int64))
+
+	def to_bool(self):
+		"""Unpack to a boolean array with one entry per sample."""
+		return np.unpackbits(self.bits, count=self.n).astype(bool)
+
+	def codes(self):
+		"""Sorted int32 codes of samples in the set."""
+		return np.flatnonzero(self.to_bool()).astype(np.int32)
+
+	def contains(self, codes):
+		"""Boolean array of whether each code is in the set.
+
+		Missing codes (-1) are never in the set.
+		"""
+		codes = np.asarray(codes, dtype=np.int64)
+		valid = codes >= 0
+		safe = np.where(valid, codes, 0)
+		in_set = (self.bits[safe >> 3] >> (7 - (safe & 7))) & 1
+		return valid & in_set.astype(bool)
+
+
+class SampleIndex:
+	"""Mapping from IID to dense int32 code, with named splits.
+
+	Args:
+		iids: Sorted array of unique IID strings. Code i is iids[i].
+		splits: Optional dict mapping split name to Bitmask.
+	"""
+
+	def __init__(self, iids, splits=None):
+		self.iids = np.asarray(iids, dtype=str)
+		self.splits = {} if splits is None else dict(splits)
+
+	def __len__(self):
+		return len(self.iids)
+
+	@classmethod
+	def from_iids(cls, iids):
+		"""Index of the unique IIDs in iids."""
+		return cls(np.unique(np.asarray(iids, dtype=str)))
+
+	@classmethod
+	def from_split_files(cls, split_files):
+		"""Index of every IID in a set of split files, with those splits.
+
+		Args:
+			split_files: Dict mapping split name to split file path.
+		"""
+		split_iids = {
+			name: load_split_file(split_file)
+			for name, split_file in split_files.items()
+		}
+		index = cls.from_iids(np.concatenate(list(split_iids.values())))
+		for name, iids in split_iids.items():
+			index.add_split(name, iids)
+		return index
+
+	@classmethod
+	def from_splits_dir(cls, splits_dir):
+		"""Index of every IID in the '.txt' split files in splits_dir."""
+		return cls.from_split_files({
+			os.path.splitext(os.path.basename(split_file))[0]: split_file
+			for split_file in sorted(glob.glob(os.path.join(splits_dir, '*.txt')))
+		})
+
+	def codes(self, iids):
+		"""int32 code of each IID, or -1 for IIDs not in the index."""
+		iids = np.asarray(iids, dtype=str)
+		if len(self.iids) == 0:
+			return np.full(len(iids), -1, dtype=np.int32)
+
+		codes = np.searchsorted(self.iids, iids)
+		codes[codes == len(self.iids)] = 0
+		found = self.iids[codes] == iids
+		return np.where(found, codes, -1).astype(np.int32)
+
+	def mask(self, iids):
+		"""Bitmask of the IIDs in iids that are in the index."""
+		return Bitmask.from_codes(self.codes(iids), len(self))
+
+	def add_split(self, name, iids):
+		"""Add a named split from an array of IIDs."""
+		self.splits[name] = self.mask(iids)
+
+	def split(self, name):
+		"""Bitmask of a named split."""
+		if name not in self.splits:
+			raise KeyError(
+				f'Unknown split {name}. Available: {sorted(self.splits)}'
+			)
+		return self.splits[name]
+
+	def gather(self, iids, values, fill=np.nan):
+		"""Align values keyed by IID to the index.
+
+		Returns float array with one row per sample in the index (same
+		trailing shape as values), with fill for samples not in iids.
+		IIDs not in the index are dropped.
+
+		Args:
+			iids: IID of each row of values.
+			values: Array of values, one row per IID.
+			fill: Value for samples with no row in values.
+		"""
+		values = np.asarray(values, dtype=float)
+		codes = self.codes(iids)
+		in_index = codes >= 0
+
+		aligned = np.full((len(self),) + values.shape[1:], fill)
+		aligned[codes[in_index]] = values[in_index]
+		return aligned
+
+	def save(self, out_file):
+		"""Save IIDs and packed splits to a .npz file."""
+		np.savez(
+			out_file,
+			iids=self.iids,
+			**{f'split_{name}': mask.bits for name, mask in self.splits.items()}
+		)
+
+	@classmethod
+	def load(cls, index_file):
+		"""Load an index saved by save."""
+		with np.load(index_file) as data:
+			iids = data['iids']
+			splits = {
+				key[len('split_'):]: Bitmask(data[key], len(iids))
+				for key in data.files if key.startswith('split_')
+			}
+		return cls(iids, splits)
+
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	index = SampleIndex.from_splits_dir(args.splits_dir)
+	index.save(args.out_file)
+
+	print(f'Indexed {len(index)} samples')
+	for name, mask in index.splits.items():
+		print(f'\t{name}: {len(mask)}')
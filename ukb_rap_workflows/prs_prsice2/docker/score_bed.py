@@ -0,0 +1,335 @@
+"""Score samples with weighted sums of genotypes, like plink2 --score.
+
+The genotype file is read once in variant blocks. Each block is decoded
+to allele counts, missing genotypes are mean-imputed, and the block is
+multiplied by a (variants x K) weight matrix holding every weight set
+being scored, so K scores (weight columns, p-value ranges) cost one
+pass. Blocks are decoded and multiplied in a thread pool. Decoded blocks
+in flight are bounded by --mem-mb, not by the number of threads, and
+with more than one thread BLAS is limited to one thread per worker (with
+threadpoolctl if installed; otherwise set OPENBLAS_NUM_THREADS=1) so
+workers do not oversubscribe the cores.
+
+Weights are for the weight file's A1 allele. Where that is the other
+allele of the genotype file's counted allele the weight is negated and
+2 * weight is added to every sample, which is the same as scoring
+2 - count. Variants whose alleles do not match are skipped.
+
+Output matches plink2 --score with default options: '#FID' (if known),
+'IID', 'ALLELE_CT' (2 x scored variants, as missing calls are imputed),
+'NAMED_ALLELE_DOSAGE_SUM' and one '{weight_col}_AVG' column per weight
+column, or 'SCORE1_AVG' with a single weight column. With
+--q-score-range, one {out}.{range_name}.sscore file is written per
+range, otherwise {out}.sscore.
+
+Args:
+
+* --bfile: Prefix of .bed/.bim/.fam genotype files.
+* --pfile: Prefix of .pgen/.pvar/.psam genotype files. Requires pgenlib.
+* --store: Directory of a packed genotype store from geno_store.py.
+	One of --bfile, --pfile and --store is required.
+* --score: Whitespace delimited weight file with a header line, e.g. a
+	plink2 .glm.linear file.
+* --out: Output prefix.
+* --id-col: Variant ID column of --score. Default: ID.
+* --allele-col: Allele column of --score the weights are for.
+	Default: A1.
+* --weight-cols: Weight columns of --score. Default: BETA.
+* --extract: File of variant IDs to score. If it has a header with an ID
+	column (e.g. a .clumps file) that column is used, otherwise the first
+	column.
+* --q-score-range: File with lines 'name lower upper'. A score is
+	computed for each range using variants with lower <= p <= upper.
+* --p-col: Column of --score with p-values for --q-score-range.
+	Default: P.
+* --threads: Number of threads. Default: number of CPUs.
+* --block-mb: Approximate memory per decoded block in MB, lowered so a
+	block per thread fits in --mem-mb. Default: 256.
+* --mem-mb: Approximate memory of all decoded blocks in flight in MB.
+	Default: 2048.
+"""
+
+import argparse
+import contextlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+try:
+	from threadpoolctl import threadpool_limits
+except ImportError:
+	threadpool_limits = None
+
+from bed_io import MISSING, open_genotypes
+from geno_store import GenoStore
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+
+	geno = parser.add_mutually_exclusive_group(required=True)
+	geno.add_argument("--bfile")
+	geno.add_argument("--pfile")
+	geno.add_argument("--store")
+	parser.add_argument("--score", required=True)
+	parser.add_argument("--out", required=True)
+	parser.add_argument("--id-col", default='ID')
+	parser.add_argument("--allele-col", default='A1')
+	parser.add_argument("--weight-cols", nargs='+', default=['BETA'])
+	parser.add_argument("--extract")
+	parser.add_argument("--q-score-range")
+	parser.add_argument("--p-col", default='P')
+	parser.add_argument("--threads", type=int, default=os.cpu_count())
+	parser.add_argument("--block-mb", type=float, default=256)
+	parser.add_argument("--mem-mb", type=float, default=2048)
+
+	return parser.parse_args()
+
+
+def read_id_list(id_file):
+	"""Variant IDs from an --extract file."""
+	with open(id_file) as f:
+		header = f.readline().split()
+	cols = [c.lstrip('#') for c in header]
+
+	if 'ID' in cols:
+		ids = pd.read_csv(id_file, sep='\s+', dtype=str)
+		return ids[header[cols.index('ID')]].values
+	return pd.read_csv(
+		id_file, sep='\s+', header=None, usecols=[0], dtype=str
+	)[0].values
+
+
+def read_q_score_ranges(range_file):
+	"""List of (name, lower, upper) from a --q-score-range file."""
+	ranges = pd.read_csv(
+		range_file,
+		sep='\s+',
+		header=None,
+		names=['name', 'lower', 'upper'],
+		dtype={'name': str}
+	)
+	return list(ranges.itertuples(index=False, name=None))
+
+
+def align_weights(variants, score_df, id_col, allele_col, weight_cols):
+	"""Match a weight table to genotype variants.
+
+	Returns (variant_idx, score_df, sign, n_mismatch). variant_idx are
+	the sorted indices of matched variants in variants, score_df the
+	matching rows of the weight table in the same order, sign is +1
+	where the weight allele is the counted allele and -1 where it is the
+	other allele, and n_mismatch is the number of variants skipped
+	because neither allele matched.
+
+	Args:
+		variants: Variant table from open_genotypes.
+		score_df: Weight table.
+		id_col: Variant ID column of score_df.
+		allele_col: Allele column of score_df.
+		weight_cols: Weight columns of score_df.
+	"""
+	var_pos = pd.Series(np.arange(len(variants)), index=variants['ID'].values)
+	var_pos = var_pos[~var_pos.index.duplicated(keep='first')]
+
+	rows = var_pos.reindex(score_df[id_col].values).values
+	in_geno = ~np.isnan(rows)
+	score_df = score_df[in_geno]
+	variant_idx = rows[in_geno].astype(np.int64)
+
+	allele = score_df[allele_col].values
+	is_a1 = allele == variants['A1'].values[variant_idx]
+	is_a2 = allele == variants['A2'].values[variant_idx]
+	matched = is_a1 | is_a2
+
+	variant_idx = variant_idx[matched]
+	sign = np.where(is_a1[matched], 1.0, -1.0)
+	score_df = score_df[matched]
+
+	order = np.argsort(variant_idx, kind='stable')
+	return (
+		variant_idx[order],
+		score_df.iloc[order],
+		sign[order],
+		int((~matched).sum())
+	)
+
+
+def impute_block(genos):
+	"""Mean-impute missing genotypes of a block as float64."""
+	missing = genos == MISSING
+	dosage = genos.astype(np.float64)
+	dosage[missing] = 0.0
+
+	n_called = genos.shape[1] - missing.sum(1)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		means = np.where(n_called > 0, dosage.sum(1) / n_called, 0.0)
+
+	rows, cols = np.nonzero(missing)
+	dosage[rows, cols] = means[rows]
+	return dosage
+
+
+def _score_block(reader, variant_idx, weights, start, stop):
+	"""Sum of weighted imputed genotypes over one block of variants."""
+	genos = reader.read_variants(variant_idx[start:stop])
+	return impute_block(genos).T @ weights[start:stop]
+
+
+def score_genotypes(
+	reader,
+	variant_idx,
+	weights,
+	n_threads=1,
+	block_variants=1000,
+	max_pending=None
+):
+	"""Weighted sums of mean-imputed genotypes for K weight sets.
+
+	Returns (n_samples, K) sums over variants of count * weight.
+
+	Args:
+		reader: BedReader, PgenReader or GenoStore.
+		variant_idx: Sorted indices of variants to score.
+		weights: (len(variant_idx), K) weights for the counted allele.
+		n_threads: Number of threads decoding and multiplying blocks.
+		block_variants: Variants per block.
+		max_pending: Most blocks submitted and not yet summed, which
+			bounds memory. Default: n_threads.
+	"""
+	sums = np.zeros((reader.n_samples, weights.shape[1]))
+	if len(variant_idx) == 0:
+		return sums
+
+	starts = range(0, len(variant_idx), block_variants)
+
+	if n_threads <= 1:
+		for start in starts:
+			sums += _score_block(
+				reader, variant_idx, weights, start, start + block_variants
+			)
+		return sums
+
+	if max_pending is None:
+		max_pending = n_threads
+	max_pending = max(1, max_pending)
+
+	# One BLAS thread per worker, as the workers already use the cores
+	if threadpool_limits is not None:
+		blas_limit = threadpool_limits(limits=1, user_api='blas')
+	else:
+		blas_limit = contextlib.nullcontext()
+
+	with blas_limit, ThreadPoolExecutor(
+		max_workers=min(n_threads, max_pending)
+	) as executor:
+		# Limit blocks in flight to bound memory
+		pending = []
+		for start in starts:
+			if len(pending) >= max_pending:
+				sums += pending.pop(0).result()
+			pending.append(executor.submit(
+				_score_block,
+				reader,
+				variant_idx,
+				weights,
+				start,
+				start + block_variants
+			))
+		for future in pending:
+			sums += future.result()
+
+	return sums
+
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	start_time = time.time()
+
+	if args.store is not None:
+		reader = GenoStore.open(args.store)
+		variants, samples = reader.variants, reader.samples
+	else:
+		reader, variants, samples = open_genotypes(args.bfile, args.pfile)
+
+	score_df = pd.read_csv(args.score, sep='\s+', dtype={args.id_col: str})
+	score_df = score_df.rename(columns=lambda c: c.lstrip('#'))
+	if args.extract is not None:
+		score_df = score_df[score_df[args.id_col].isin(read_id_list(args.extract))]
+
+	variant_idx, score_df, sign, n_mismatch = align_weights(
+		variants, score_df, args.id_col, args.allele_col, args.weight_cols
+	)
+	print(
+		f'{len(variant_idx)} variants matched, {n_mismatch} skipped for '
+		'allele mismatch',
+		flush=True
+	)
+
+	# Variants included in each output file
+	if args.q_score_range is not None:
+		p_vals = score_df[args.p_col].values.astype(float)
+		out_ranges = [
+			(f'{args.out}.{name}.sscore', (p_vals >= lower) & (p_vals <= upper))
+			for name, lower, upper in read_q_score_ranges(args.q_score_range)
+		]
+	else:
+		out_ranges = [
+			(f'{args.out}.sscore', np.ones(len(variant_idx), dtype=bool))
+		]
+
+	# One weight column per (range, weight column) and one per range for
+	# the named allele dosage sum. Flipped alleles are scored as 2 - count.
+	raw_weights = score_df[args.weight_cols].values.astype(float)
+	weight_blocks = []
+	for _, in_range in out_ranges:
+		block = np.column_stack([raw_weights, np.ones(len(raw_weights))])
+		weight_blocks.append(block * in_range[:, None])
+	weights = np.hstack(weight_blocks)
+	flip_offset = 2 * (weights * (sign < 0)[:, None]).sum(0)
+	weights = weights * sign[:, None]
+
+	# Size blocks by decoded float64 bytes, small enough for a block per
+	# thread within the memory budget
+	block_mb = min(args.block_mb, args.mem_mb / max(args.threads, 1))
+	block_variants = max(
+		1, int(block_mb * 2 ** 20 // (8 * reader.n_samples))
+	)
+	sums = score_genotypes(
+		reader,
+		variant_idx,
+		weights,
+		n_threads=args.threads,
+		block_variants=block_variants,
+		max_pending=int(args.mem_mb // block_mb)
+	) + flip_offset
+
+	# Write one sscore file per range
+	n_cols = len(args.weight_cols) + 1
+	if len(args.weight_cols) == 1:
+		avg_cols = ['SCORE1_AVG']
+	else:
+		avg_cols = [f'{c}_AVG' for c in args.weight_cols]
+
+	for r, (out_file, in_range) in enumerate(out_ranges):
+		range_sums = sums[:, r * n_cols:(r + 1) * n_cols]
+		allele_ct = 2 * int(in_range.sum())
+
+		sscore = pd.DataFrame({'IID': samples['IID'].values})
+		if 'FID' in samples:
+			sscore.insert(0, '#FID', samples['FID'].values)
+		else:
+			sscore = sscore.rename(columns={'IID': '#IID'})
+		sscore['ALLELE_CT'] = allele_ct
+		sscore['NAMED_ALLELE_DOSAGE_SUM'] = range_sums[:, -1]
+		for i, col in enumerate(avg_cols):
+			sscore[col] = range_sums[:, i] / allele_ct if allele_ct else np.nan
+
+		sscore.to_csv(out_file, sep='\t', index=False)
+		print(f'Wrote {out_file}', flush=True)
+
+	print(f'Scored in {time.time() - start_time:.1f} seconds', flush=True)
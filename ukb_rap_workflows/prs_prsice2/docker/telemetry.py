@@ -0,0 +1,274 @@
+"""Per-step resource telemetry for workflow task commands.
+
+Each step of a task's command is run under a sampler, which writes a
+JSON record of the step to a telemetry directory:
+
+	python3 /home/telemetry.py run -n prsice -d telemetry -- PRSice_linux ...
+	python3 /home/telemetry.py run -n clump -d telemetry -- plink2 --clump ...
+	python3 /home/telemetry.py summary -d telemetry -o runtime.json
+
+'run' exits with the step's exit code, so it can be used with
+'|| exit 1' like the command itself. While the step runs, its process
+tree is sampled from /proc every --interval seconds for resident
+memory, thread count and CPU time. When it exits, CPU time and disk
+I/O are taken from the step's resource usage (wait4), which covers
+every descendant it waited for. A step record has:
+
+* wall_seconds, user_cpu_seconds, system_cpu_seconds, cpu_seconds.
+* mean_cpus_busy: cpu_seconds / wall_seconds, and cpu_utilization, that
+	divided by the number of cores. A step using all cores has
+	cpu_utilization near 1.
+* max_cpus_busy: Largest CPU time per second between two samples.
+* peak_rss_gb: Peak resident memory of the process tree (the larger of
+	the sampled tree total and the largest single process).
+* mean_threads, max_threads: Threads in the process tree, sampled.
+* read_bytes, write_bytes: Bytes read from and written to block
+	devices (not the page cache).
+* returncode, start_time and command.
+
+'summary' combines the step records, in the order they started, into a
+runtime.json with
+
+* runtime_seconds: Total wall time of the steps.
+* cpu_seconds, peak_mem_gb (the largest step peak_rss_gb) and n_cores.
+* {name}_runtime_seconds: Wall time of each step.
+* steps: The step records.
+
+runtime_seconds keeps the meaning and key of earlier runtime.json files,
+so the score tables and resources.calibrate read them unchanged.
+
+Only the standard library is used, so the script runs in any image with
+python3. Without /proc (not Linux), only the wait4 figures are recorded.
+
+Args:
+
+* command: 'run' or 'summary'.
+* -d, --dir: Telemetry directory holding the step records.
+	Default: 'telemetry'.
+* -n, --name: Step name (run). Used as the record's file name and in
+	'{name}_runtime_seconds'.
+* --interval: Seconds between samples (run). Default: 1.
+* -o, --out: Output runtime JSON path (summary). Default: 'runtime.json'.
+* step command (run): The command to run, after '--'.
+"""
+
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+
+PROC_DIR = '/proc'
+
+# Bytes per block of ru_inblock and ru_oublock
+BLOCK_BYTES = 512
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument("command", choices=['run', 'summary'])
+	parser.add_argument("-d", "--dir", default='telemetry')
+	parser.add_argument("-n", "--name")
+	parser.add_argument("--interval", type=float, default=1.0)
+	parser.add_argument("-o", "--out", default='runtime.json')
+
+	# Split off the step command so its options are not parsed
+	argv = sys.argv[1:]
+	step_command = []
+	if '--' in argv:
+		step_command = argv[argv.index('--') + 1:]
+		argv = argv[:argv.index('--')]
+
+	args = parser.parse_args(argv)
+	args.step_command = step_command
+	if args.command == 'run' and (args.name is None or not step_command):
+		parser.error('run requires --name and a command after --')
+	return args
+
+
+def read_proc_stat(pid):
+	"""(ppid, cpu_seconds, n_threads, rss_bytes) of a process, or None.
+
+	Fields are read after the last ')' of /proc/{pid}/stat, as the
+	command name before it can contain spaces.
+	"""
+	try:
+		with open(f'{PROC_DIR}/{pid}/stat') as f:
+			fields = f.read().rsplit(')', 1)[1].split()
+	except (OSError, IndexError):
+		return None
+	ticks = os.sysconf('SC_CLK_TCK')
+	page_size = os.sysconf('SC_PAGE_SIZE')
+	return (
+		int(fields[1]),
+		(int(fields[11]) + int(fields[12])) / ticks,
+		int(fields[17]),
+		int(fields[21]) * page_size,
+	)
+
+
+def sample_tree(root_pid):
+	"""(cpu_seconds, n_threads, rss_bytes) summed over a process tree."""
+	stats = {}
+	for entry in os.listdir(PROC_DIR):
+		if entry.isdigit():
+			stat = read_proc_stat(int(entry))
+			if stat is not None:
+				stats[int(entry)] = stat
+
+	children = {}
+	for pid, stat in stats.items():
+		children.setdefault(stat[0], []).append(pid)
+
+	cpu_seconds, n_threads, rss_bytes = 0.0, 0, 0
+	stack = [root_pid]
+	while stack:
+		pid = stack.pop()
+		if pid in stats:
+			_, cpu, threads, rss = stats[pid]
+			cpu_seconds += cpu
+			n_threads += threads
+			rss_bytes += rss
+		stack.extend(children.get(pid, []))
+	return cpu_seconds, n_threads, rss_bytes
+
+
+class TreeSampler(threading.Thread):
+	"""Thread sampling a process tree until stop() is called."""
+
+	def __init__(self, root_pid, interval):
+		super().__init__(daemon=True)
+		self.root_pid = root_pid
+		self.interval = interval
+		self.n_samples = 0
+		self.peak_rss_bytes = 0
+		self.max_threads = 0
+		self.thread_sum = 0
+		self.max_cpus_busy = 0.0
+		self._stop_event = threading.Event()
+
+	def run(self):
+		if not os.path.isdir(PROC_DIR):
+			return
+		last_cpu, last_time = 0.0, time.perf_counter()
+		while not self._stop_event.wait(self.interval):
+			cpu_seconds, n_threads, rss_bytes = sample_tree(self.root_pid)
+			now = time.perf_counter()
+			if n_threads == 0:
+				continue
+
+			self.n_samples += 1
+			self.peak_rss_bytes = max(self.peak_rss_bytes, rss_bytes)
+			self.max_threads = max(self.max_threads, n_threads)
+			self.thread_sum += n_threads
+			# CPU time of exited children drops out of the tree total
+			if cpu_seconds >= last_cpu:
+				self.max_cpus_busy = max(
+					self.max_cpus_busy, (cpu_seconds - last_cpu) / (now - last_time)
+				)
+			last_cpu, last_time = cpu_seconds, now
+
+	def stop(self):
+		self._stop_event.set()
+		self.join()
+
+
+def run_step(name, command, telemetry_dir, interval=1.0):
+	"""Run a command under a TreeSampler and save its record.
+
+	Returns the command's exit code.
+
+	Args:
+		name: Step name. The record is saved to {telemetry_dir}/{name}.json.
+		command: Command as a list of arguments.
+		telemetry_dir: Directory for step records.
+		interval: Seconds between samples.
+	"""
+	os.makedirs(telemetry_dir, exist_ok=True)
+	n_cores = os.cpu_count()
+
+	start_time = time.time()
+	start = time.perf_counter()
+	proc = subprocess.Popen(command)
+	sampler = TreeSampler(proc.pid, interval)
+	sampler.start()
+	_, status, rusage = os.wait4(proc.pid, 0)
+	wall_seconds = time.perf_counter() - start
+	sampler.stop()
+	returncode = os.waitstatus_to_exitcode(status)
+	proc.returncode = returncode
+
+	cpu_seconds = rusage.ru_utime + rusage.ru_stime
+	mean_cpus_busy = cpu_seconds / wall_seconds if wall_seconds > 0 else 0.0
+	record = {
+		'name': name,
+		'command': shlex.join(command),
+		'start_time': start_time,
+		'returncode': returncode,
+		'wall_seconds': round(wall_seconds, 3),
+		'user_cpu_seconds': round(rusage.ru_utime, 3),
+		'system_cpu_seconds': round(rusage.ru_stime, 3),
+		'cpu_seconds': round(cpu_seconds, 3),
+		'mean_cpus_busy': round(mean_cpus_busy, 3),
+		'max_cpus_busy': round(max(sampler.max_cpus_busy, mean_cpus_busy), 3),
+		'cpu_utilization': round(mean_cpus_busy / n_cores, 3),
+		'peak_rss_gb': round(
+			max(sampler.peak_rss_bytes, rusage.ru_maxrss * 1024) / 1024**3, 3
+		),
+		'mean_threads': (
+			round(sampler.thread_sum / sampler.n_samples, 1)
+			if sampler.n_samples else None
+		),
+		'max_threads': sampler.max_threads or None,
+		'read_bytes': rusage.ru_inblock * BLOCK_BYTES,
+		'write_bytes': rusage.ru_oublock * BLOCK_BYTES,
+		'n_samples': sampler.n_samples,
+	}
+
+	record_file = os.path.join(telemetry_dir, f'{name}.json')
+	with open(record_file, 'w') as f:
+		json.dump(record, f, indent=4)
+
+	print(
+		f'[telemetry] {name}: {wall_seconds:.1f}s wall, {cpu_seconds:.1f}s CPU '
+		f'({mean_cpus_busy:.1f} of {n_cores} cores busy), '
+		f'{record["peak_rss_gb"]:.2f} GB peak RSS',
+		file=sys.stderr
+	)
+	return returncode
+
+
+def summarize(telemetry_dir):
+	"""Combine the step records in telemetry_dir into a runtime dict."""
+	steps = []
+	for fname in os.listdir(telemetry_dir):
+		if fname.endswith('.json'):
+			with open(os.path.join(telemetry_dir, fname)) as f:
+				steps.append(json.load(f))
+	steps.sort(key=lambda step: step['start_time'])
+
+	runtime = {
+		'runtime_seconds': round(sum(s['wall_seconds'] for s in steps), 3),
+		'cpu_seconds': round(sum(s['cpu_seconds'] for s in steps), 3),
+		'peak_mem_gb': max((s['peak_rss_gb'] for s in steps), default=0.0),
+		'n_cores': os.cpu_count(),
+	}
+	for step in steps:
+		runtime[f'{step["name"]}_runtime_seconds'] = step['wall_seconds']
+	runtime['steps'] = steps
+	return runtime
+
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	if args.command == 'run':
+		sys.exit(run_step(args.name, args.step_command, args.dir, args.interval))
+
+	with open(args.out, 'w') as f:
+		json.dump(summarize(args.dir), f, indent=4)
@@ -39,12 +39,25 @@ Optional args:
 	the output of the GWAS workflow. Default: 
 	'/rdevito/nonlin_prs/sum_stats_prs/PRSice2/prsice2_output'. Final
 	output directory will be of the form: {output_dir}/{pheno_name}[_wb][_dev]
+* --native-score: Flag to score all samples with the multi-threaded
+	score_bed.py instead of plink2 --score. False when not provided.
+* --profile: Profile fit_wrapper.py with perf_spans. One of "cprofile" or
+	"sample". The profiles are workflow outputs. Default: no profiling.
+* --instance-type: Instance type to use. Default: the smallest adequate
+	instance for the data size, planned with rap_utils.resources, if its
+	coefficients are calibrated, otherwise DEFAULT_INSTANCE.
 """
 
 import argparse
 import json
+import os
+import sys
 
-import dxpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rap_utils import dx_resolve, resources
+from rap_utils.local_dx import get_dxpy
+
+dxpy = get_dxpy()
 
 
 WORKFLOW_ID = 'workflow-GjQv0BjJv7B90q8GpqyKYzx9'
@@ -117,6 +130,23 @@ def parse_args():
 		help='Directory in which a folder will be created to store the output '
 		'of the GWAS workflow.'
 	)
+	parser.add_argument(
+		'--native-score',
+		action='store_true',
+		help='Flag to score all samples with score_bed.py instead of plink2.'
+	)
+	parser.add_argument(
+		'--profile',
+		default=None,
+		choices=['cprofile', 'sample'],
+		help='Profile fit_wrapper.py with perf_spans. Default: no profiling.'
+	)
+	parser.add_argument(
+		'--instance-type',
+		default=None,
+		help='Instance type to use. Default: planned from the data size if '
+			'calibrated, otherwise DEFAULT_INSTANCE.'
+	)
 	return parser.parse_args()
 
 
@@ -129,6 +159,8 @@ def launch_prsice2_workflow(
 	keep_file,
 	pred_file,
 	output_dir,
+	native_score=False,
+	profile=None,
 	workflow_id=WORKFLOW_ID,
 	instance_type=DEFAULT_INSTANCE,
 	name='prs_prsice2'
@@ -151,6 +183,10 @@ def launch_prsice2_workflow(
 		pred_file: Path to the pred file in UKB RAP storage. Samples in this
 			file will have scores predicted for them, but will not be fit on.
 		output_dir: Path to the output directory in UKB RAP storage.
+		native_score: If True, score all samples with score_bed.py instead
+			of plink2 --score.
+		profile: If set, profile fit_wrapper.py with perf_spans in this
+			mode ('cprofile' or 'sample').
 		workflow_id: ID of the PRSice2 C+T PRS workflow.
 		instance_type: Instance type to use for the workflow.
 		name: Name of the workflow.
@@ -160,99 +196,38 @@ def launch_prsice2_workflow(
 	workflow = dxpy.dxworkflow.DXWorkflow(dxid=workflow_id)
 
 	# Get data links for inputs
-	geno_bed_link_val = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=geno_prefix_val.split('/')[-1] + '.bed',
-			folder='/'.join(geno_prefix_val.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-	geno_bim_link_val = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=geno_prefix_val.split('/')[-1] + '.bim',
-			folder='/'.join(geno_prefix_val.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-	geno_fam_link_val = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=geno_prefix_val.split('/')[-1] + '.fam',
-			folder='/'.join(geno_prefix_val.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-	geno_bed_link_all = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=geno_prefix_all.split('/')[-1] + '.bed',
-			folder='/'.join(geno_prefix_all.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-	geno_bim_link_all = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=geno_prefix_all.split('/')[-1] + '.bim',
-			folder='/'.join(geno_prefix_all.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-	geno_fam_link_all = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=geno_prefix_all.split('/')[-1] + '.fam',
-			folder='/'.join(geno_prefix_all.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-	sum_stats_link = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=sum_stats_file.split('/')[-1],
-			folder='/'.join(sum_stats_file.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-	pheno_link = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=pheno_file.split('/')[-1],
-			folder='/'.join(pheno_file.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-	covar_link = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=covar_file.split('/')[-1],
-			folder='/'.join(covar_file.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-	keep_link = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=keep_file.split('/')[-1],
-			folder='/'.join(keep_file.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
-	pred_link = dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=pred_file.split('/')[-1],
-			folder='/'.join(pred_file.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
-	)
+	links = dx_resolve.get_dxlinks([
+		f'{geno_prefix_val}.bed',
+		f'{geno_prefix_val}.bim',
+		f'{geno_prefix_val}.fam',
+		f'{geno_prefix_all}.bed',
+		f'{geno_prefix_all}.bim',
+		f'{geno_prefix_all}.fam',
+		sum_stats_file,
+		pheno_file,
+		covar_file,
+		keep_file,
+		pred_file
+	], refresh=[sum_stats_file])
 
 	# Set up workflow input
 	prefix = 'stage-common.'
 	workflow_input = {
-		f'{prefix}geno_bed_file_val': geno_bed_link_val,
-		f'{prefix}geno_bim_file_val': geno_bim_link_val,
-		f'{prefix}geno_fam_file_val': geno_fam_link_val,
-		f'{prefix}geno_bed_file_all': geno_bed_link_all,
-		f'{prefix}geno_bim_file_all': geno_bim_link_all,
-		f'{prefix}geno_fam_file_all': geno_fam_link_all,
-		f'{prefix}sum_stats_file': sum_stats_link,
-		f'{prefix}pheno_file': pheno_link,
-		f'{prefix}covar_file': covar_link,
-		f'{prefix}keep_file': keep_link,
-		f'{prefix}pred_file': pred_link,
+		f'{prefix}geno_bed_file_val': links[f'{geno_prefix_val}.bed'],
+		f'{prefix}geno_bim_file_val': links[f'{geno_prefix_val}.bim'],
+		f'{prefix}geno_fam_file_val': links[f'{geno_prefix_val}.fam'],
+		f'{prefix}geno_bed_file_all': links[f'{geno_prefix_all}.bed'],
+		f'{prefix}geno_bim_file_all': links[f'{geno_prefix_all}.bim'],
+		f'{prefix}geno_fam_file_all': links[f'{geno_prefix_all}.fam'],
+		f'{prefix}sum_stats_file': links[sum_stats_file],
+		f'{prefix}pheno_file': links[pheno_file],
+		f'{prefix}covar_file': links[covar_file],
+		f'{prefix}keep_file': links[keep_file],
+		f'{prefix}pred_file': links[pred_file],
+		f'{prefix}native_score': native_score,
 	}
+	if profile is not None:
+		workflow_input[f'{prefix}profile'] = profile
 
 	# Run workflow
 	analysis = workflow.run(
@@ -356,6 +331,19 @@ if __name__ == '__main__':
 	if args.dev:
 		job_name += '_dev'
 
+	if args.instance_type is not None:
+		instance_type = args.instance_type
+	else:
+		# Plan instance type from data size of the scored genotypes
+		n_samples_all, n_variants_all = resources.bed_dims(geno_prefix_all)
+		instance_type, _ = resources.plan_instance(
+			'prs_prsice2',
+			n_samples=n_samples_all,
+			n_variants=n_variants_all,
+			default=DEFAULT_INSTANCE
+		)
+	print(f'Instance type: {instance_type}')
+
 	print(f'Launching PRSice2 workflow with name: {job_name}')
 	launch_prsice2_workflow(
 		geno_prefix_val=geno_prefix_val,
@@ -366,6 +354,9 @@ if __name__ == '__main__':
 		keep_file=keep_file,
 		pred_file=pred_file,
 		output_dir=output_dir,
+		native_score=args.native_score,
+		profile=args.profile,
+		instance_type=instance_type,
 		name=job_name,
 	)
 
@@ -0,0 +1,238 @@
+"""Bootstrap confidence intervals for PRS prediction scores.
+
+Each bootstrap replicate resamples samples with replacement. A replicate
+is stored as a row of multinomial weights (how many times each sample was
+drawn) instead of as resampled copies of the data, so that for a chunk of
+replicates:
+
+* sums needed for r2 and Pearson r are a single (replicates x samples)
+	by (samples x models) matrix product, and
+* Spearman r needs no sorting per replicate. Samples are sorted by value
+	once, and the average rank of a value in a replicate is the cumulative
+	weight of smaller values plus (its own weight + 1) / 2.
+
+Resample indices are drawn once per chunk and shared by every model
+being scored, so differences between models are paired. Replicates are
+processed in chunks sized to keep memory under max_chunk_bytes.
+"""
+
+import numpy as np
+
+
+BOOTSTRAP_METRICS = ['r2', 'pearson_r', 'spearman_r']
+DEFAULT_MAX_CHUNK_BYTES = 512 * 2 ** 20
+
+
+def draw_resample_weights(rng, n_samples, n_replicates):
+	"""Draw resample index matrix and return it as per-sample weights.
+
+	Returns (n_replicates, n_samples) int32 array where entry (r, i) is
+	the number of times sample i is drawn in replicate r.
+
+	Args:
+		rng: np.random.Generator.
+		n_samples: Number of samples to resample from.
+		n_replicates: Number of bootstrap replicates.
+	"""
+	idx = rng.integers(0, n_samples, size=(n_replicates, n_samples))
+	idx += np.arange(n_replicates)[:, None] * n_samples
+	return np.bincount(
+		idx.ravel(), minlength=n_replicates * n_samples
+	).reshape(n_replicates, n_samples).astype(np.int32)
+
+
+def _tie_groups(x):
+	"""Precompute sort order and tie groups used by _centered_ranks."""
+	order = np.argsort(x, kind='stable')
+	x_sorted = x[order]
+	new_group = np.r_[True, x_sorted[1:] != x_sorted[:-1]]
+
+	group_of_sample = np.empty(len(x), dtype=np.int64)
+	group_of_sample[order] = np.cumsum(new_group) - 1
+	group_ends = np.r_[np.flatnonzero(new_group)[1:], len(x)] - 1
+
+	return order, group_ends, group_of_sample
+
+
+def _centered_ranks(weights, ties):
+	"""Average ranks of each sample's value within each replicate.
+
+	Tied values get the mean of the ranks they span, as in
+	scipy.stats.rankdata. Ranks are centered by their weighted mean,
+	which is (n_samples + 1) / 2 in every replicate. Samples with zero
+	weight are given the rank their value would have, which does not
+	affect weighted statistics.
+
+	Args:
+		weights: (n_replicates, n_samples) resample weights.
+		ties: Output of _tie_groups for the values being ranked.
+	"""
+	order, group_ends, group_of_sample = ties
+
+	# Cumulative weight through the end of each tie group
+	group_w = np.take(weights, order, axis=1)
+	group_cum = np.cumsum(group_w, axis=1)
+	if len(group_ends) < len(order):
+		group_cum = np.take(group_cum, group_ends, axis=1)
+		group_w = np.diff(group_cum, axis=1, prepend=0)
+
+	group_rank = group_cum - (group_w - 1) / 2 - (len(order) + 1) / 2
+	return np.take(group_rank, group_of_sample, axis=1)
+
+
+def _weighted_sum_prod(weights, x, y):
+	"""Sum over samples of weights * x * y for each replicate."""
+	return np.einsum('ij,ij,ij->i', weights, x, y)
+
+
+def bootstrap_replicates(
+	y_true,
+	preds,
+	n_boot=1000,
+	seed=0,
+	metrics=BOOTSTRAP_METRICS,
+	max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES
+):
+	"""Compute bootstrap replicates of scores for several models.
+
+	All models are scored on the same resamples, so replicate r of one
+	model can be paired with replicate r of another.
+
+	Returns dict mapping each metric to an (n_boot, n_models) array.
+
+	Args:
+		y_true: (n_samples,) ground truth.
+		preds: (n_samples, n_models) predictions. Must have no NaNs.
+		n_boot: Number of bootstrap replicates.
+		seed: Seed for drawing resamples.
+		metrics: Metrics to compute. Any of BOOTSTRAP_METRICS.
+		max_chunk_bytes: Approximate memory limit for one chunk of
+			replicates.
+	"""
+	unknown = set(metrics) - set(BOOTSTRAP_METRICS)
+	if unknown:
+		raise ValueError(f'Unsupported bootstrap metrics: {sorted(unknown)}')
+
+	y_true = np.asarray(y_true, dtype=float)
+	preds = np.asarray(preds, dtype=float)
+	if preds.ndim == 1:
+		preds = preds[:, None]
+	n_samples, n_models = preds.shape
+
+	# Center by full sample means to limit cancellation in the moment sums
+	y_c = y_true - y_true.mean()
+	preds_c = preds - preds.mean(0)
+	sq_err = (y_true[:, None] - preds) ** 2
+
+	if 'spearman_r' in metrics:
+		y_ties = _tie_groups(y_true)
+		pred_ties = [_tie_groups(preds[:, j]) for j in range(n_models)]
+
+	# About five (replicates x samples) float arrays are live at once
+	chunk_size = max(1, int(max_chunk_bytes // (5 * 8 * n_samples)))
+	rng = np.random.default_rng(seed)
+
+	replicates = {m: np.empty((n_boot, n_models)) for m in metrics}
+
+	for start in range(0, n_boot, chunk_size):
+		stop = min(start + chunk_size, n_boot)
+		weights = draw_resample_weights(rng, n_samples, stop - start)
+		weights_f = weights.astype(float)
+
+		# (replicates,) and (replicates, models) weighted means
+		y_mean = weights_f @ y_c / n_samples
+		var_y = weights_f @ y_c ** 2 / n_samples - y_mean ** 2
+
+		if 'r2' in metrics:
+			mse = weights_f @ sq_err / n_samples
+			replicates['r2'][start:stop] = 1 - mse / var_y[:, None]
+
+		if 'pearson_r' in metrics:
+			p_mean = weights_f @ preds_c / n_samples
+			var_p = weights_f @ preds_c ** 2 / n_samples - p_mean ** 2
+			cov = weights_f @ (y_c[:, None] * preds_c) / n_samples \
+				- y_mean[:, None] * p_mean
+			replicates['pearson_r'][start:stop] = cov / np.sqrt(
+				var_y[:, None] * var_p
+			)
+
+		if 'spearman_r' in metrics:
+			y_ranks = _centered_ranks(weights, y_ties)
+			y_rank_ss = _weighted_sum_prod(weights_f, y_ranks, y_ranks)
+
+			for j in range(n_models):
+				pred_ranks = _centered_ranks(weights, pred_ties[j])
+				replicates['spearman_r'][start:stop, j] = _weighted_sum_prod(
+					weights_f, y_ranks, pred_ranks
+				) / np.sqrt(
+					y_rank_ss * _weighted_sum_prod(weights_f, pred_ranks, pred_ranks)
+				)
+
+	return replicates
+
+
+def percentile_ci(replicates, ci_level=0.95):
+	"""Percentile bootstrap confidence interval for each column.
+
+	Returns (low, high) arrays with one value per column of replicates.
+	"""
+	alpha = (1 - ci_level) / 2
+	return (
+		np.nanquantile(replicates, alpha, axis=0),
+		np.nanquantile(replicates, 1 - alpha, axis=0)
+	)
+
+
+def ci_scores(replicates, ci_level=0.95):
+	"""Confidence interval entries to add to each model's scores.
+
+	Returns list with one dict per model mapping '{metric}_ci_low' and
+	'{metric}_ci_high' to floats.
+
+	Args:
+		replicates: Output of bootstrap_replicates.
+		ci_level: Confidence level of the intervals.
+	"""
+	n_models = next(iter(replicates.values())).shape[1]
+	model_cis = [{} for _ in range(n_models)]
+
+	for metric, reps in replicates.items():
+		low, high = percentile_ci(reps, ci_level)
+		for j in range(n_models):
+			model_cis[j][f'{metric}_ci_low'] = float(low[j])
+			model_cis[j][f'{metric}_ci_high'] = float(high[j])
+
+	return model_cis
+
+
+def paired_differences(replicates, ref_col, ci_level=0.95):
+	"""Paired bootstrap comparison of each model with a reference model.
+
+	Returns list with one dict per model containing, for each metric,
+	'{metric}_diff' (mean replicate difference, model minus reference),
+	'{metric}_diff_ci_low', '{metric}_diff_ci_high' and
+	'{metric}_diff_p', a two-sided bootstrap p-value for no difference.
+
+	Args:
+		replicates: Output of bootstrap_replicates.
+		ref_col: Column of the reference model.
+		ci_level: Confidence level of the intervals.
+	"""
+	n_models = next(iter(replicates.values())).shape[1]
+	model_diffs = [{} for _ in range(n_models)]
+
+	for metric, reps in replicates.items():
+		diffs = reps - reps[:, [ref_col]]
+		low, high = percentile_ci(diffs, ci_level)
+		p_val = np.minimum(
+			1.0,
+			2 * np.minimum((diffs <= 0).mean(0), (diffs >= 0).mean(0))
+		)
+
+		for j in range(n_models):
+			model_diffs[j][f'{metric}_diff'] = float(np.nanmean(diffs[:, j]))
+			model_diffs[j][f'{metric}_diff_ci_low'] = float(low[j])
+			model_diffs[j][f'{metric}_diff_ci_high'] = float(high[j])
+			model_diffs[j][f'{metric}_diff_p'] = float(p_val[j])
+
+	return model_diffs
@@ -1,6 +1,8 @@
 """Score and plot PRS predictions.
 
-Outputs scores.json and plots.
+Outputs scores.json and plots, and perf_spans.json with the time and
+peak memory of each stage (see perf_spans.py) in --out-dir, or the
+working directory if there is none.
 
 Args:
 
@@ -9,40 +11,127 @@ Args:
 * -p, --pheno-file: Path to ground true phenotype file.
 * --wb: Split file for white British samples.
 * -o, --out-dir: Path to output directory.
+* --pred-dirs: Batch mode. Directories each containing a val_preds.csv
+	and test_preds.csv. Replaces -v/-t. The phenotype and white British
+	split are loaded once, all models are aligned to the phenotype
+	file's sample order and scored together. A scores.json (and plots
+	unless --no-plots) is written to each directory, and, if -o is given,
+	a batch_scores.json keyed by directory is written to --out-dir.
+* --no-plots: Skip the pred v true jointplots.
+* --plot-mode: 'scatter' (one marker per sample), 'hexbin' or 'hist2d'.
+	hexbin and hist2d bin (true, pred) pairs into a 2D histogram first and
+	draw the joint and marginal plots from the bin counts, so their cost
+	depends on --plot-bins and not on the number of samples.
+	Default: 'scatter'.
+* --plot-bins: Number of bins per axis for binned plot modes. Default: 200.
+* --plot-workers: Number of processes used to render plots. Plots are
+	rendered after scores.json is written. Default: 4.
+* --n-bootstrap: Number of bootstrap replicates used to add confidence
+	intervals for r2, pearson_r and spearman_r to scores.json as
+	'{metric}_ci_low' and '{metric}_ci_high'. Default: 0 (no intervals).
+* --ci-level: Confidence level of bootstrap intervals. Default: 0.95.
+* --seed: Seed for bootstrap resampling. Default: 0.
+* --reference: Batch mode only. One of --pred-dirs to compare every other
+	model against using paired bootstrap differences, which are written
+	to paired_comparisons.json in --out-dir.
+* --stream: Read prediction files in chunks and score them with running
+	sums and an external-sort Spearman r (see score_stream.py), so memory
+	does not grow with the number of predictions. Works in single and
+	batch mode. Not compatible with --n-bootstrap or scatter plots.
+* --chunk-size: Rows per chunk with --stream. Default: 1000000.
+* --pheno-index: Directory to save the phenotype index used by --stream
+	in, so later runs memory-map it instead of re-reading the phenotype
+	file. Rebuilt if the phenotype or white British split file changes.
 """
 
 import argparse
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
+from matplotlib.colors import LogNorm
 from scipy import stats
 from sklearn import metrics
 
+import perf_spans
+from perf_spans import span
+from sample_index import SampleIndex, load_split_file
+from score_bootstrap import bootstrap_replicates, ci_scores, paired_differences
+from score_stream import (
+	DEFAULT_CHUNK_SIZE, load_or_build_pheno_index, stream_pred_dir
+)
+from table_cache import read_table
+
+
+PLOT_MODES = ['scatter', 'hexbin', 'hist2d']
+
 
 def parse_args():
 	parser = argparse.ArgumentParser()
 
-	parser.add_argument("-v", "--val-preds", required=True)
-	parser.add_argument("-t", "--test-preds", required=True)
+	parser.add_argument("-v", "--val-preds")
+	parser.add_argument("-t", "--test-preds")
 	parser.add_argument("-p", "--pheno-file", required=True)
 	parser.add_argument("--wb", required=True)
-	parser.add_argument("-o", "--out-dir", required=True)
-
-	return parser.parse_args()
-
-
-def score_and_plot_preds(
-	y_true,
-	y_pred,
-	out_dir,
-	desc=None,
-	plot_prefix=''
-):
-	"""Score regression predictions and plot pred v true jointplot.
+	parser.add_argument("-o", "--out-dir")
+	parser.add_argument("--pred-dirs", nargs='+')
+	parser.add_argument("--no-plots", action='store_true')
+	parser.add_argument(
+		"--plot-mode",
+		choices=PLOT_MODES,
+		default='scatter'
+	)
+	parser.add_argument("--plot-bins", type=int, default=200)
+	parser.add_argument("--plot-workers", type=int, default=4)
+	parser.add_argument("--n-bootstrap", type=int, default=0)
+	parser.add_argument("--ci-level", type=float, default=0.95)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--reference")
+	parser.add_argument("--stream", action='store_true')
+	parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+	parser.add_argument("--pheno-index")
+
+	args = parser.parse_args()
+
+	if args.stream:
+		if args.n_bootstrap > 0:
+			parser.error('--stream does not support --n-bootstrap')
+		if not args.no_plots and args.plot_mode == 'scatter':
+			parser.error('--stream requires --no-plots or a binned --plot-mode')
+
+	if args.pred_dirs is None:
+		if args.val_preds is None or args.test_preds is None:
+			parser.error('-v/--val-preds and -t/--test-preds are required '
+				'unless --pred-dirs is given')
+		if args.out_dir is None:
+			parser.error('-o/--out-dir is required unless --pred-dirs is given')
+		if args.reference is not None:
+			parser.error('--reference requires --pred-dirs')
+	elif args.reference is not None:
+		if args.reference not in args.pred_dirs:
+			parser.error('--reference must be one of --pred-dirs')
+		if args.n_bootstrap < 1:
+			parser.error('--reference requires --n-bootstrap')
+		if args.out_dir is None:
+			parser.error('--reference requires -o/--out-dir')
+
+	return args
+
+
+# (description, plot prefix) for each key of scores.json
+SUBSETS = {
+	'val': ('Validation', 'val'),
+	'test': ('Test', 'test'),
+	'test_wb': ('Test White British', 'test_wb'),
+	'test_nwb': ('Test not White British', 'test_nwb'),
+}
+
+
+def score_preds(y_true, y_pred):
+	"""Score regression predictions.
 	
 	Returns dict with the following keys:
 		- mse: Mean squared error
@@ -55,31 +144,21 @@ def score_and_plot_preds(
 	Args:
 		y_true: Ground truth.
 		y_pred: Predictions.
-		desc: Description for plot title. If None, no title.
-		plot_prefix: Prefix for plot filename.
 	"""
+	return {
+		'mse': metrics.mean_squared_error(y_true, y_pred),
+		'r2': metrics.r2_score(y_true, y_pred),
+		'mae': metrics.mean_absolute_error(y_true, y_pred),
+		'mape': metrics.mean_absolute_percentage_error(y_true, y_pred),
+		'pearson_r': stats.pearsonr(y_true, y_pred).statistic,	# type: ignore
+		'spearman_r': stats.spearmanr(y_true, y_pred).statistic	# type: ignore
+	}
 
-	# Score predictions
-	mse = metrics.mean_squared_error(y_true, y_pred)
-	r2 = metrics.r2_score(y_true, y_pred)
-	mae = metrics.mean_absolute_error(y_true, y_pred)
-	mape = metrics.mean_absolute_percentage_error(y_true, y_pred)
-	pearson_r = stats.pearsonr(y_true, y_pred).statistic	# type: ignore
-	spearman_r = stats.spearmanr(y_true, y_pred).statistic	# type: ignore
 
-	# Plot predictions vs ground truth
-	g = sns.jointplot(
-		x=y_true,
-		y=y_pred, 
-		kind='scatter', 
-		joint_kws={'marker': '.', 'alpha': 0.3}
-	)
+def _finish_jointplot(g, min_val, max_val, out_dir, desc, plot_prefix):
+	"""Set limits, x=y line and labels of a jointplot, then save it."""
 	g.ax_joint.set_aspect('equal', adjustable='box')
 
-	# Get the overall min/max of the data
-	min_val = min(y_true.min(), y_pred.min())
-	max_val = max(y_true.max(), y_pred.max())
-
 	# Set the limits
 	g.ax_joint.set_xlim(min_val, max_val)
 	g.ax_joint.set_ylim(min_val, max_val)
@@ -104,82 +183,627 @@ def score_and_plot_preds(
 	)
 	plt.close()
 
-	return {
-		'mse': mse,
-		'r2': r2,
-		'mae': mae,
-		'mape': mape,
-		'pearson_r': pearson_r,
-		'spearman_r': spearman_r
-	}
 
+def plot_preds(
+	y_true,
+	y_pred,
+	out_dir,
+	desc=None,
+	plot_prefix=''
+):
+	"""Plot pred v true jointplot.
 
-if __name__ == '__main__':
+	Args:
+		y_true: Ground truth.
+		y_pred: Predictions.
+		out_dir: Directory the plot is saved to.
+		desc: Description for plot title. If None, no title.
+		plot_prefix: Prefix for plot filename.
+	"""
 
-	args = parse_args()
+	# Plot predictions vs ground truth
+	g = sns.jointplot(
+		x=y_true,
+		y=y_pred, 
+		kind='scatter', 
+		joint_kws={'marker': '.', 'alpha': 0.3}
+	)
 
-	# Load predictions
-	val_preds = pd.read_csv(args.val_preds)
-	test_preds = pd.read_csv(args.test_preds)
+	# Get the overall min/max of the data
+	min_val = min(y_true.min(), y_pred.min())
+	max_val = max(y_true.max(), y_pred.max())
 
-	# Load phenotype
-	pheno = pd.read_csv(args.pheno_file, sep='\s+')
-	pheno_col = pheno.columns.difference(['IID']).values[0]
-	pheno = pheno.rename(columns={pheno_col: 'true'})
-
-	# Join predictions with ground truth
-	val_preds = val_preds.merge(pheno, on='IID', how='inner')
-	test_preds = test_preds.merge(pheno, on='IID', how='inner')
-
-	# Load white British split
-	wb_iids = pd.read_csv(args.wb, sep='\s+', header=None).values.flatten()
-
-	# Get pred-true sets for WB and non-WB for test set
-	test_wb = test_preds[test_preds['IID'].isin(wb_iids)]
-	test_nwb = test_preds[~test_preds['IID'].isin(wb_iids)]
-
-	# Score and plot
-	val_scores = score_and_plot_preds(
-		val_preds['true'],
-		val_preds['pred'],
-		args.out_dir,
-		desc='Validation',
-		plot_prefix='val'
-	)
+	_finish_jointplot(g, min_val, max_val, out_dir, desc, plot_prefix)
+
+
+def bin_preds(y_true, y_pred, n_bins=200):
+	"""Bin (true, pred) pairs into a square 2D histogram.
+
+	Both axes share the same edges, spanning the overall min/max of the
+	data as in the scatter jointplot.
+
+	Returns (counts, edges) where counts is (n_bins, n_bins) with true
+	values along the first axis.
+
+	Args:
+		y_true: Ground truth.
+		y_pred: Predictions.
+		n_bins: Number of bins per axis.
+	"""
+	y_true = np.asarray(y_true, dtype=float)
+	y_pred = np.asarray(y_pred, dtype=float)
+
+	min_val = min(y_true.min(), y_pred.min())
+	max_val = max(y_true.max(), y_pred.max())
+	edges = np.linspace(min_val, max_val, n_bins + 1)
+
+	counts, _, _ = np.histogram2d(y_true, y_pred, bins=[edges, edges])
+	return counts, edges
+
+
+def plot_binned_preds(
+	counts,
+	edges,
+	out_dir,
+	desc=None,
+	plot_prefix='',
+	kind='hexbin'
+):
+	"""Plot pred v true jointplot from 2D histogram counts.
+
+	The joint plot is a hexbin or heatmap of the counts on a log color
+	scale and the marginals are histograms of the row and column sums.
+
+	Args:
+		counts: (n_bins, n_bins) counts from bin_preds.
+		edges: Bin edges from bin_preds.
+		out_dir: Directory the plot is saved to.
+		desc: Description for plot title. If None, no title.
+		plot_prefix: Prefix for plot filename.
+		kind: 'hexbin' or 'hist2d'.
+	"""
+	centers = (edges[:-1] + edges[1:]) / 2
+	widths = np.diff(edges)
+	min_val, max_val = edges[0], edges[-1]
+
+	g = sns.JointGrid()
+
+	if kind == 'hexbin':
+		true_c, pred_c = np.meshgrid(centers, centers, indexing='ij')
+		nonzero = counts > 0
+		g.ax_joint.hexbin(
+			true_c[nonzero],
+			pred_c[nonzero],
+			C=counts[nonzero],
+			reduce_C_function=np.sum,
+			gridsize=max(1, len(centers) // 4),
+			extent=(min_val, max_val, min_val, max_val),
+			bins='log',
+			mincnt=1,
+			cmap='viridis'
+		)
+	elif kind == 'hist2d':
+		g.ax_joint.pcolormesh(
+			edges,
+			edges,
+			np.ma.masked_equal(counts.T, 0),
+			norm=LogNorm(),
+			cmap='viridis'
+		)
+	else:
+		raise ValueError(f'Invalid binned plot kind: {kind}')
 
-	test_all_scores = score_and_plot_preds(
-		test_preds['true'],
-		test_preds['pred'],
-		args.out_dir,
-		desc='Test',
-		plot_prefix='test'
+	g.ax_marg_x.bar(centers, counts.sum(1), width=widths)
+	g.ax_marg_y.barh(centers, counts.sum(0), height=widths)
+
+	_finish_jointplot(g, min_val, max_val, out_dir, desc, plot_prefix)
+
+
+def make_plot_job(
+	y_true,
+	y_pred,
+	out_dir,
+	desc=None,
+	plot_prefix='',
+	plot_mode='scatter',
+	n_bins=200
+):
+	"""Return (function, args) that renders one jointplot.
+
+	For binned plot modes the data are binned here, so only the bin
+	counts are passed to the process that renders the plot.
+	"""
+	if plot_mode == 'scatter':
+		return plot_preds, (y_true, y_pred, out_dir, desc, plot_prefix)
+
+	counts, edges = bin_preds(y_true, y_pred, n_bins)
+	return plot_binned_preds, (
+		counts, edges, out_dir, desc, plot_prefix, plot_mode
 	)
 
-	test_wb_scores = score_and_plot_preds(
-		test_wb['true'],
-		test_wb['pred'],
-		args.out_dir,
-		desc='Test White British',
-		plot_prefix='test_wb'
+
+def run_plot_jobs(plot_jobs, n_workers=4):
+	"""Render plot jobs from make_plot_job in a process pool."""
+	if n_workers <= 1:
+		for func, func_args in plot_jobs:
+			func(*func_args)
+		return
+
+	with ProcessPoolExecutor(max_workers=n_workers) as executor:
+		futures = [
+			executor.submit(func, *func_args) for func, func_args in plot_jobs
+		]
+		for future in futures:
+			future.result()
+
+
+def score_and_plot_preds(
+	y_true,
+	y_pred,
+	out_dir,
+	desc=None,
+	plot_prefix='',
+	plot=True
+):
+	"""Score regression predictions and plot pred v true jointplot.
+	
+	Returns dict of scores from score_preds.
+
+	Args:
+		y_true: Ground truth.
+		y_pred: Predictions.
+		out_dir: Directory the plot is saved to.
+		desc: Description for plot title. If None, no title.
+		plot_prefix: Prefix for plot filename.
+		plot: If False, only score.
+	"""
+	scores = score_preds(y_true, y_pred)
+
+	if plot:
+		plot_preds(y_true, y_pred, out_dir, desc=desc, plot_prefix=plot_prefix)
+
+	return scores
+
+
+def load_pheno(pheno_file):
+	"""Load phenotype file as a Series of true values indexed by IID."""
+	pheno = read_table(pheno_file, sep='\s+', dtype={'IID': str})
+	pheno_col = pheno.columns.difference(['IID']).values[0]
+	return pheno.set_index('IID')[pheno_col].rename('true')
+
+
+def align_preds(pred_file, index):
+	"""Load a predictions CSV aligned to a SampleIndex.
+
+	Returns float array the length of index with the prediction for each
+	sample, or NaN where the file has no prediction for the sample.
+	Predictions for samples not in index are dropped, as with an inner
+	merge on IID.
+
+	Args:
+		pred_file: Path to CSV with 'IID' and 'pred' columns.
+		index: SampleIndex defining the shared sample order.
+	"""
+	with span('load'):
+		preds = read_table(pred_file, dtype={'IID': str})
+	with span('join'):
+		return index.gather(preds['IID'].values, preds['pred'].values)
+
+
+def _masked_pearson(x, y, valid, n):
+	"""Column-wise Pearson r of x and y over rows where valid."""
+	x_c = np.where(valid, x - np.where(valid, x, 0.0).sum(0) / n, 0.0)
+	y_c = np.where(valid, y - np.where(valid, y, 0.0).sum(0) / n, 0.0)
+	return (x_c * y_c).sum(0) / np.sqrt(
+		(x_c ** 2).sum(0) * (y_c ** 2).sum(0)
 	)
 
-	test_nwb_scores = score_and_plot_preds(
-		test_nwb['true'],
-		test_nwb['pred'],
-		args.out_dir,
-		desc='Test not White British',
-		plot_prefix='test_nwb'
+
+def score_pred_matrix(y_true, preds):
+	"""Score every column of a prediction matrix against shared truth.
+
+	Vectorized equivalent of calling score_preds once per column, where
+	each column is scored only over its non-NaN rows.
+
+	Returns dict with the same keys as score_preds, each mapping to an
+	array with one value per column of preds.
+
+	Args:
+		y_true: (n_samples,) ground truth. NaN rows are ignored.
+		preds: (n_samples, n_models) predictions, NaN where a model has
+			no prediction for a sample.
+	"""
+	y_true = np.asarray(y_true, dtype=float)[:, None]
+	preds = np.asarray(preds, dtype=float)
+
+	valid = ~np.isnan(preds) & ~np.isnan(y_true)
+	n = valid.sum(0)
+
+	err = np.where(valid, y_true - preds, 0.0)
+	abs_err = np.abs(err)
+	sq_err = (err ** 2).sum(0)
+
+	# Same epsilon as sklearn's mean_absolute_percentage_error
+	eps = np.finfo(np.float64).eps
+	ape = abs_err / np.maximum(np.abs(np.where(valid, y_true, 1.0)), eps)
+
+	y_c = np.where(valid, y_true - np.where(valid, y_true, 0.0).sum(0) / n, 0.0)
+	ss_tot = (y_c ** 2).sum(0)
+
+	# Spearman r is Pearson r of ranks within each column's valid rows
+	y_ranks = stats.rankdata(
+		np.where(valid, y_true, np.nan), axis=0, nan_policy='omit'
+	)
+	pred_ranks = stats.rankdata(
+		np.where(valid, preds, np.nan), axis=0, nan_policy='omit'
 	)
 
-	# Save scores
-	scores = {
-		'val': val_scores,
-		'test': test_all_scores,
-		'test_wb': test_wb_scores,
-		'test_nwb': test_nwb_scores
+	return {
+		'mse': sq_err / n,
+		'r2': 1 - sq_err / ss_tot,
+		'mae': abs_err.sum(0) / n,
+		'mape': ape.sum(0) / n,
+		'pearson_r': _masked_pearson(y_true, preds, valid, n),
+		'spearman_r': _masked_pearson(y_ranks, pred_ranks, valid, n),
 	}
 
-	with open(os.path.join(args.out_dir, 'scores.json'), 'w') as f:
-		json.dump(scores, f, indent=4)
 
+def _group_by_rows(valid):
+	"""Group columns of a boolean matrix that have identical values."""
+	groups = {}
+	for j in range(valid.shape[1]):
+		groups.setdefault(np.packbits(valid[:, j]).tobytes(), []).append(j)
+	return list(groups.values())
+
+
+def bootstrap_pred_matrix(
+	y_true,
+	preds,
+	n_boot,
+	seed=0,
+	ci_level=0.95,
+	ref_col=None
+):
+	"""Bootstrap confidence intervals for every column of preds.
+
+	Columns are grouped by which samples they have predictions for, and
+	each group is resampled once with the draws shared by all of its
+	columns. Paired differences against ref_col use the samples each
+	column has in common with ref_col, again sharing draws between
+	columns with the same samples in common.
+
+	Returns (cis, diffs) lists with one dict per column. cis entries are
+	from ci_scores. diffs entries are from paired_differences, or None if
+	ref_col is None or the column shares no samples with it.
 
+	Args:
+		y_true: (n_samples,) ground truth.
+		preds: (n_samples, n_models) predictions, NaN where a model has
+			no prediction for a sample.
+		n_boot: Number of bootstrap replicates.
+		seed: Seed for bootstrap resampling.
+		ci_level: Confidence level of the intervals.
+		ref_col: Column of the reference model for paired differences.
+	"""
+	valid = ~np.isnan(preds) & ~np.isnan(y_true)[:, None]
+
+	cis = [None] * preds.shape[1]
+	for cols in _group_by_rows(valid):
+		rows = valid[:, cols[0]]
+		replicates = bootstrap_replicates(
+			y_true[rows], preds[rows][:, cols], n_boot=n_boot, seed=seed
+		)
+		for j, col_cis in zip(cols, ci_scores(replicates, ci_level)):
+			cis[j] = col_cis
+
+	diffs = [None] * preds.shape[1]
+	if ref_col is not None:
+		shared = valid & valid[:, [ref_col]]
+		for cols in _group_by_rows(shared):
+			rows = shared[:, cols[0]]
+			if rows.sum() < 2:
+				continue
+
+			# Reference is the first column of each paired group
+			replicates = bootstrap_replicates(
+				y_true[rows],
+				preds[rows][:, [ref_col] + cols],
+				n_boot=n_boot,
+				seed=seed
+			)
+			col_diffs = paired_differences(replicates, 0, ci_level)
+			for j, d in zip(cols, col_diffs[1:]):
+				diffs[j] = d
+
+	return cis, diffs
+
+
+def load_batch(pred_files, pheno_file, wb_file):
+	"""Load predictions for many models aligned to a shared sample order.
+
+	The phenotype and white British split are loaded once into a
+	SampleIndex of the phenotype's samples, and each model's predictions
+	are gathered into index order.
+
+	Returns (y_true, subset_preds). y_true is the (n_samples,) phenotype.
+	subset_preds maps each subset in SUBSETS to an (n_samples, n_models)
+	matrix of predictions, with columns in the order of pred_files and
+	NaN for samples a model has no prediction for or that are not in the
+	subset.
+
+	Args:
+		pred_files: List of (val_preds, test_preds) CSV paths, one per
+			model.
+		pheno_file: Path to ground truth phenotype file.
+		wb_file: Split file for white British samples.
+	"""
+	with span('load'):
+		pheno = load_pheno(pheno_file)
+		wb_iids = load_split_file(wb_file)
+
+	with span('join'):
+		index = SampleIndex.from_iids(pheno.index)
+		index.add_split('wb', wb_iids)
+		y_true = index.gather(pheno.index, pheno.values)
+		is_wb = index.split('wb').to_bool()
+
+	val_preds = np.column_stack([
+		align_preds(val_file, index) for val_file, _ in pred_files
+	])
+	test_preds = np.column_stack([
+		align_preds(test_file, index) for _, test_file in pred_files
+	])
+
+	# Samples outside a subset are masked out by setting them to NaN
+	with span('join'):
+		subset_preds = {
+			'val': val_preds,
+			'test': test_preds,
+			'test_wb': np.where(is_wb[:, None], test_preds, np.nan),
+			'test_nwb': np.where(is_wb[:, None], np.nan, test_preds),
+		}
+
+	return y_true, subset_preds
+
+
+def pred_dir_files(pred_dir):
+	"""(val_preds, test_preds) CSV paths in a prediction directory."""
+	return (
+		os.path.join(pred_dir, 'val_preds.csv'),
+		os.path.join(pred_dir, 'test_preds.csv')
+	)
+
+
+def score_batch(
+	y_true,
+	subset_preds,
+	pred_dirs,
+	n_bootstrap=0,
+	seed=0,
+	ci_level=0.95,
+	reference=None
+):
+	"""Score val and test predictions for many models in one pass.
+
+	Every subset's (n_samples, n_models) matrix from load_batch is scored
+	column-wise.
+
+	Returns (batch_scores, paired_scores). batch_scores maps each directory
+	in pred_dirs to a dict of the same form as the scores.json written in
+	single model mode. paired_scores maps each directory compared with
+	reference to a dict of paired differences per subset, and is empty if
+	reference is None.
+
+	Args:
+		y_true: Ground truth from load_batch.
+		subset_preds: Prediction matrices from load_batch.
+		pred_dirs: Directories the columns of the matrices were loaded
+			from.
+		n_bootstrap: Number of bootstrap replicates for confidence
+			intervals. If 0, no intervals are added.
+		seed: Seed for bootstrap resampling.
+		ci_level: Confidence level of the intervals.
+		reference: Directory in pred_dirs to compare the other models to
+			with paired bootstrap differences.
+	"""
+	with span('metrics'):
+		subset_scores = {
+			subset: score_pred_matrix(y_true, preds)
+			for subset, preds in subset_preds.items()
+		}
+
+	batch_scores = {}
+	for i, pred_dir in enumerate(pred_dirs):
+		batch_scores[pred_dir] = {
+			subset: {
+				metric: float(vals[i]) for metric, vals in scores.items()
+			}
+			for subset, scores in subset_scores.items()
+		}
+
+	paired_scores = {}
+	if n_bootstrap > 0:
+		ref_col = None
+		if reference is not None:
+			ref_col = list(pred_dirs).index(reference)
+
+		for subset, preds in subset_preds.items():
+			with span('bootstrap'):
+				cis, diffs = bootstrap_pred_matrix(
+					y_true,
+					preds,
+					n_bootstrap,
+					seed=seed,
+					ci_level=ci_level,
+					ref_col=ref_col
+				)
+
+			for i, pred_dir in enumerate(pred_dirs):
+				batch_scores[pred_dir][subset].update(cis[i])
+				if diffs[i] is not None and i != ref_col:
+					paired_scores.setdefault(pred_dir, {})[subset] = diffs[i]
+
+	return batch_scores, paired_scores
+
+
+if __name__ == '__main__':
+
+	args = parse_args()
+	perf_spans.start('score_preds')
+
+	# (function, args) for each plot, rendered after scores are saved
+	plot_jobs = []
+
+	if args.stream:
+		# Streaming mode: score each model's files chunk by chunk
+		with span('load'):
+			index = load_or_build_pheno_index(
+				args.pheno_file,
+				args.wb,
+				index_dir=args.pheno_index,
+				chunk_size=args.chunk_size
+			)
+
+		if args.pred_dirs is not None:
+			pred_files = {
+				pred_dir: pred_dir_files(pred_dir) for pred_dir in args.pred_dirs
+			}
+		else:
+			pred_files = {args.out_dir: (args.val_preds, args.test_preds)}
+
+		batch_scores = {}
+		for out_dir, (val_file, test_file) in pred_files.items():
+			# Reading, joining and scoring are interleaved chunk by chunk
+			with span('stream'):
+				scores, binned = stream_pred_dir(
+					val_file,
+					test_file,
+					index,
+					chunk_size=args.chunk_size,
+					n_bins=None if args.no_plots else args.plot_bins
+				)
+			batch_scores[out_dir] = scores
+
+			with span('write'), open(os.path.join(out_dir, 'scores.json'), 'w') as f:
+				json.dump(scores, f, indent=4)
+
+			for subset, (desc, prefix) in SUBSETS.items():
+				if subset in binned:
+					counts, edges = binned[subset]
+					plot_jobs.append((plot_binned_preds, (
+						counts, edges, out_dir, desc, prefix, args.plot_mode
+					)))
+
+		if args.pred_dirs is not None and args.out_dir is not None:
+			with span('write'), open(
+				os.path.join(args.out_dir, 'batch_scores.json'), 'w'
+			) as f:
+				json.dump(batch_scores, f, indent=4)
+
+	elif args.pred_dirs is not None:
+		# Batch mode: score all models in one pass
+		y_true, subset_preds = load_batch(
+			[pred_dir_files(pred_dir) for pred_dir in args.pred_dirs],
+			args.pheno_file,
+			args.wb
+		)
+		batch_scores, paired_scores = score_batch(
+			y_true,
+			subset_preds,
+			args.pred_dirs,
+			n_bootstrap=args.n_bootstrap,
+			seed=args.seed,
+			ci_level=args.ci_level,
+			reference=args.reference
+		)
+
+		with span('write'):
+			for pred_dir, scores in batch_scores.items():
+				with open(os.path.join(pred_dir, 'scores.json'), 'w') as f:
+					json.dump(scores, f, indent=4)
+
+			if args.out_dir is not None:
+				with open(os.path.join(args.out_dir, 'batch_scores.json'), 'w') as f:
+					json.dump(batch_scores, f, indent=4)
+
+			if args.reference is not None:
+				paired_scores = {
+					'reference': args.reference,
+					'ci_level': args.ci_level,
+					'n_bootstrap': args.n_bootstrap,
+					'comparisons': paired_scores
+				}
+				with open(
+					os.path.join(args.out_dir, 'paired_comparisons.json'), 'w'
+				) as f:
+					json.dump(paired_scores, f, indent=4)
+
+		if not args.no_plots:
+			for i, pred_dir in enumerate(args.pred_dirs):
+				for subset, (desc, prefix) in SUBSETS.items():
+					preds = subset_preds[subset][:, i]
+					has_pred = ~np.isnan(preds) & ~np.isnan(y_true)
+					plot_jobs.append(make_plot_job(
+						y_true[has_pred],
+						preds[has_pred],
+						pred_dir,
+						desc=desc,
+						plot_prefix=prefix,
+						plot_mode=args.plot_mode,
+						n_bins=args.plot_bins
+					))
+
+	else:
+		# Load predictions aligned to the phenotype
+		y_true, subset_preds = load_batch(
+			[(args.val_preds, args.test_preds)],
+			args.pheno_file,
+			args.wb
+		)
+
+		# (true, pred) pairs for each subset
+		with span('join'):
+			subset_data = {}
+			for subset, preds in subset_preds.items():
+				has_pred = ~np.isnan(preds[:, 0]) & ~np.isnan(y_true)
+				subset_data[subset] = (y_true[has_pred], preds[has_pred, 0])
+
+		# Score
+		with span('metrics'):
+			scores = {
+				subset: score_preds(true, pred)
+				for subset, (true, pred) in subset_data.items()
+			}
+
+		# Add bootstrap confidence intervals
+		if args.n_bootstrap > 0:
+			with span('bootstrap'):
+				for subset, (true, pred) in subset_data.items():
+					replicates = bootstrap_replicates(
+						true,
+						pred,
+						n_boot=args.n_bootstrap,
+						seed=args.seed
+					)
+					scores[subset].update(ci_scores(replicates, args.ci_level)[0])
+
+		# Save scores
+		with span('write'), open(os.path.join(args.out_dir, 'scores.json'), 'w') as f:
+			json.dump(scores, f, indent=4)
+
+		if not args.no_plots:
+			for subset, (desc, prefix) in SUBSETS.items():
+				plot_jobs.append(make_plot_job(
+					*subset_data[subset],
+					args.out_dir,
+					desc=desc,
+					plot_prefix=prefix,
+					plot_mode=args.plot_mode,
+					n_bins=args.plot_bins
+				))
+
+	# Plot
+	with span('plot'):
+		run_plot_jobs(plot_jobs, n_workers=args.plot_workers)
+
+	perf_spans.finish(args.out_dir or '.')
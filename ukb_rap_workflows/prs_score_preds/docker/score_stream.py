@@ -0,0 +1,527 @@
+"""Streaming, constant-memory scoring of large prediction files.
+
+Predictions are read in chunks and joined to the phenotype through a
+pre-built index of sorted IIDs, so no prediction file is ever fully in
+memory:
+
+* mse, r2, mae, mape and pearson_r come from running sums updated once
+	per chunk. Means, sums of squares and the cross product are merged
+	with the pairwise update of Chan et al., which is as accurate as
+	Welford's one-at-a-time update.
+* spearman_r is the Pearson r of average ranks. Each chunk's values are
+	sorted and spilled to disk as a run, the runs are merged in blocks to
+	assign ranks (averaging ties as scipy.stats.rankdata does), and ranks
+	are written to memory-mapped files indexed by row. A final chunked
+	pass over the rank files gives the correlation.
+
+Peak memory is a few chunk-sized arrays plus the largest tie group. The
+phenotype index is built once from the .pheno and white British split
+files and can be saved to a directory and memory-mapped on later runs.
+Scores match score_preds.score_preds to floating-point tolerance, except
+that rows with a missing true value or prediction are skipped.
+"""
+
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_CHUNK_SIZE = 1_000_000
+
+# Rows kept for each subset of each prediction file. Values are the
+# required white British status, or None for all rows.
+VAL_SUBSETS = {'val': None}
+TEST_SUBSETS = {'test': None, 'test_wb': True, 'test_nwb': False}
+
+INDEX_FILES = ['iids.npy', 'true.npy', 'is_wb.npy']
+
+
+def _encode_iids(iids):
+	"""Convert IIDs to a fixed-width bytes array for searchsorted."""
+	return np.asarray(
+		pd.Series(iids, dtype=str).str.encode('utf-8').values, dtype='S'
+	)
+
+
+class PhenoIndex:
+	"""Phenotype values and white British status keyed by sorted IID.
+
+	Attributes:
+		iids: Sorted (n_samples,) bytes array of IIDs.
+		true: Phenotype value for each IID.
+		is_wb: Whether each IID is in the white British split.
+	"""
+
+	def __init__(self, iids, true, is_wb):
+		self.iids = iids
+		self.true = true
+		self.is_wb = is_wb
+
+	def lookup(self, iids):
+		"""Return (rows, found) locating encoded IIDs in the index."""
+		rows = np.searchsorted(self.iids, iids)
+		rows[rows == len(self.iids)] = 0
+		found = self.iids[rows] == iids
+		return rows, found
+
+	def save(self, index_dir, sources):
+		"""Save index arrays and the source file stats they came from."""
+		os.makedirs(index_dir, exist_ok=True)
+		np.save(os.path.join(index_dir, 'iids.npy'), self.iids)
+		np.save(os.path.join(index_dir, 'true.npy'), self.true)
+		np.save(os.path.join(index_dir, 'is_wb.npy'), self.is_wb)
+		with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+			json.dump(sources, f, indent=4)
+
+	@classmethod
+	def load(cls, index_dir):
+		"""Memory-map index arrays saved by save."""
+		return cls(*[
+			np.load(os.path.join(index_dir, fname), mmap_mode='r')
+			for fname in INDEX_FILES
+		])
+
+
+def _source_stats(*files):
+	"""Size and modification time of each file, to detect stale indices."""
+	stats = {}
+	for fname in files:
+		stat = os.stat(fname)
+		stats[os.path.abspath(fname)] = [stat.st_size, stat.st_mtime_ns]
+	return stats
+
+
+def build_pheno_index(pheno_file, wb_file, chunk_size=DEFAULT_CHUNK_SIZE):
+	"""Build a PhenoIndex from a .pheno file and white British split.
+
+	The phenotype file is read in chunks but the index itself holds one
+	IID and value per sample.
+
+	Args:
+		pheno_file: Whitespace delimited file with IID and one phenotype
+			column.
+		wb_file: Split file for white British samples.
+		chunk_size: Rows per chunk when reading pheno_file.
+	"""
+	iid_chunks = []
+	true_chunks = []
+	with pd.read_csv(
+		pheno_file, sep='\s+', dtype={'IID': str}, chunksize=chunk_size
+	) as reader:
+		for chunk in reader:
+			pheno_col = chunk.columns.difference(['IID']).values[0]
+			iid_chunks.append(_encode_iids(chunk['IID']))
+			true_chunks.append(chunk[pheno_col].values.astype(float))
+
+	iids = np.concatenate(iid_chunks)
+	order = np.argsort(iids, kind='stable')
+	iids = iids[order]
+	true = np.concatenate(true_chunks)[order]
+
+	if len(iids) > 1 and (iids[1:] == iids[:-1]).any():
+		raise ValueError(f'Duplicate IIDs in {pheno_file}')
+
+	index = PhenoIndex(iids, true, np.zeros(len(iids), dtype=bool))
+
+	wb_iids = _encode_iids(pd.read_csv(
+		wb_file, sep='\s+', header=None, dtype=str
+	).values.flatten())
+	rows, found = index.lookup(wb_iids)
+	index.is_wb[rows[found]] = True
+
+	return index
+
+
+def load_or_build_pheno_index(
+	pheno_file,
+	wb_file,
+	index_dir=None,
+	chunk_size=DEFAULT_CHUNK_SIZE
+):
+	"""Load a saved PhenoIndex, building and saving it if missing or stale.
+
+	Args:
+		pheno_file: Path to ground truth phenotype file.
+		wb_file: Split file for white British samples.
+		index_dir: Directory the index is saved to. If None, the index is
+			built in memory and not saved.
+		chunk_size: Rows per chunk when reading pheno_file.
+	"""
+	if index_dir is None:
+		return build_pheno_index(pheno_file, wb_file, chunk_size)
+
+	sources = _source_stats(pheno_file, wb_file)
+	meta_file = os.path.join(index_dir, 'meta.json')
+	if os.path.exists(meta_file):
+		with open(meta_file) as f:
+			if json.load(f) == sources:
+				return PhenoIndex.load(index_dir)
+
+	index = build_pheno_index(pheno_file, wb_file, chunk_size)
+	index.save(index_dir, sources)
+	return PhenoIndex.load(index_dir)
+
+
+class MomentAccumulator:
+	"""Running sums for mse, r2, mae, mape and pearson_r of (y, p) pairs."""
+
+	def __init__(self):
+		self.n = 0
+		self.mean_y = 0.0
+		self.mean_p = 0.0
+		self.m2_y = 0.0
+		self.m2_p = 0.0
+		self.c_yp = 0.0
+		self.sq_err = 0.0
+		self.abs_err = 0.0
+		self.abs_pct_err = 0.0
+		self.min_val = np.inf
+		self.max_val = -np.inf
+
+	def update(self, y, p):
+		"""Add a chunk of true values y and predictions p."""
+		n_b = len(y)
+		if n_b == 0:
+			return
+
+		mean_y_b = y.mean()
+		mean_p_b = p.mean()
+		y_c = y - mean_y_b
+		p_c = p - mean_p_b
+
+		# Merge chunk moments into running moments (Chan et al.)
+		n = self.n + n_b
+		delta_y = mean_y_b - self.mean_y
+		delta_p = mean_p_b - self.mean_p
+		scale = self.n * n_b / n
+
+		self.mean_y += delta_y * n_b / n
+		self.mean_p += delta_p * n_b / n
+		self.m2_y += y_c @ y_c + delta_y ** 2 * scale
+		self.m2_p += p_c @ p_c + delta_p ** 2 * scale
+		self.c_yp += y_c @ p_c + delta_y * delta_p * scale
+		self.n = n
+
+		err = np.abs(y - p)
+		self.sq_err += err @ err
+		self.abs_err += err.sum()
+
+		# Same epsilon as sklearn's mean_absolute_percentage_error
+		eps = np.finfo(np.float64).eps
+		self.abs_pct_err += (err / np.maximum(np.abs(y), eps)).sum()
+
+		self.min_val = min(self.min_val, y.min(), p.min())
+		self.max_val = max(self.max_val, y.max(), p.max())
+
+	def pearson_r(self):
+		"""Pearson r of the pairs added so far."""
+		return self.c_yp / np.sqrt(self.m2_y * self.m2_p)
+
+	def scores(self):
+		"""Scores with the same keys as score_preds, except spearman_r."""
+		return {
+			'mse': self.sq_err / self.n,
+			'r2': 1 - self.sq_err / self.m2_y,
+			'mae': self.abs_err / self.n,
+			'mape': self.abs_pct_err / self.n,
+			'pearson_r': self.pearson_r(),
+		}
+
+
+class RankSpill:
+	"""Values spilled to disk in sorted runs, ranked by an external merge.
+
+	Args:
+		spill_dir: Directory run files are written to.
+		name: Prefix for run file names.
+	"""
+
+	def __init__(self, spill_dir, name):
+		self.spill_dir = spill_dir
+		self.name = name
+		self.runs = []
+
+	def add(self, values, ids):
+		"""Sort a chunk of values with their row ids and write it as a run."""
+		order = np.argsort(values, kind='stable')
+		run_prefix = os.path.join(
+			self.spill_dir, f'{self.name}_run{len(self.runs)}'
+		)
+		np.save(f'{run_prefix}_values.npy', values[order])
+		np.save(f'{run_prefix}_ids.npy', ids[order])
+		self.runs.append(run_prefix)
+
+	def _merged_blocks(self, block_size):
+		"""Yield (values, ids) blocks of all runs in sorted order."""
+		run_vals = [
+			np.load(f'{run_prefix}_values.npy', mmap_mode='r')
+			for run_prefix in self.runs
+		]
+		run_ids = [
+			np.load(f'{run_prefix}_ids.npy', mmap_mode='r')
+			for run_prefix in self.runs
+		]
+		cursors = [0] * len(self.runs)
+		per_run = max(1, block_size // max(1, len(self.runs)))
+
+		while True:
+			active = [
+				i for i in range(len(self.runs))
+				if cursors[i] < len(run_vals[i])
+			]
+			if not active:
+				return
+
+			# Every value left in a run is at least its block's last value,
+			# so all block values up to the smallest of those are final.
+			threshold = np.inf
+			for i in active:
+				stop = cursors[i] + per_run
+				if stop < len(run_vals[i]):
+					threshold = min(threshold, run_vals[i][stop - 1])
+
+			vals = []
+			ids = []
+			for i in active:
+				block = run_vals[i][cursors[i]:cursors[i] + per_run]
+				n_take = np.searchsorted(block, threshold, side='right')
+				vals.append(block[:n_take])
+				ids.append(run_ids[i][cursors[i]:cursors[i] + n_take])
+				cursors[i] += n_take
+
+			vals = np.concatenate(vals)
+			ids = np.concatenate(ids)
+			order = np.argsort(vals, kind='stable')
+			yield vals[order], ids[order]
+
+	def ranks(self, n, rank_file, block_size=DEFAULT_CHUNK_SIZE):
+		"""Write the average rank of every row to a memory-mapped file.
+
+		Returns (n,) float memmap where entry i is the 1-based rank of the
+		value added with row id i, with ties given their mean rank.
+
+		Args:
+			n: Total number of values added.
+			rank_file: Path of the memory-mapped rank file.
+			block_size: Approximate number of values merged at once.
+		"""
+		ranks = np.lib.format.open_memmap(
+			rank_file, mode='w+', dtype=float, shape=(n,)
+		)
+		n_ranked = 0
+
+		# Values and ids of the last tie group seen, which may continue
+		# into the next block
+		open_val = None
+		open_ids = np.empty(0, dtype=np.int64)
+
+		for vals, ids in self._merged_blocks(block_size):
+			if open_val is not None and vals[0] == open_val:
+				n_cont = np.searchsorted(vals, open_val, side='right')
+				open_ids = np.concatenate([open_ids, ids[:n_cont]])
+				vals = vals[n_cont:]
+				ids = ids[n_cont:]
+				if len(vals) == 0:
+					continue
+
+			# The open group is complete
+			if len(open_ids) > 0:
+				ranks[open_ids] = n_ranked + (len(open_ids) + 1) / 2
+				n_ranked += len(open_ids)
+
+			new_group = np.r_[True, vals[1:] != vals[:-1]]
+			starts = np.flatnonzero(new_group)
+			sizes = np.diff(np.r_[starts, len(vals)])
+
+			# Hold back the last group of the block
+			n_closed = starts[-1]
+			group_rank = n_ranked + np.cumsum(sizes) - (sizes - 1) / 2
+			ranks[ids[:n_closed]] = np.repeat(group_rank[:-1], sizes[:-1])
+			n_ranked += n_closed
+
+			open_val = vals[-1]
+			open_ids = ids[n_closed:]
+
+		if len(open_ids) > 0:
+			ranks[open_ids] = n_ranked + (len(open_ids) + 1) / 2
+
+		ranks.flush()
+		return ranks
+
+
+class SubsetStream:
+	"""Streaming scores and spill files for one subset of samples.
+
+	Args:
+		spill_dir: Directory for spill and rank files.
+		name: Subset name, used to name files.
+		keep_values: If True, spill the (true, pred) pairs for
+			bin_counts. Default: False.
+	"""
+
+	def __init__(self, spill_dir, name, keep_values=False):
+		self.spill_dir = spill_dir
+		self.name = name
+		self.moments = MomentAccumulator()
+		self.y_spill = RankSpill(spill_dir, f'{name}_true')
+		self.p_spill = RankSpill(spill_dir, f'{name}_pred')
+		self.values_file = None
+		if keep_values:
+			self.values_file = os.path.join(spill_dir, f'{name}_values.bin')
+			open(self.values_file, 'wb').close()
+
+	def update(self, y, p):
+		"""Add a chunk of true values and predictions."""
+		ids = np.arange(self.moments.n, self.moments.n + len(y))
+		self.moments.update(y, p)
+		self.y_spill.add(y, ids)
+		self.p_spill.add(p, ids)
+
+		# Interleaved (true, pred) pairs, kept for binned plots
+		if self.values_file is not None:
+			with open(self.values_file, 'ab') as f:
+				f.write(np.column_stack([y, p]).astype(float).tobytes())
+
+	def spearman_r(self, chunk_size=DEFAULT_CHUNK_SIZE):
+		"""Pearson r of the ranks of true values and predictions."""
+		n = self.moments.n
+		y_ranks = self.y_spill.ranks(
+			n, os.path.join(self.spill_dir, f'{self.name}_true_ranks.npy'),
+			chunk_size
+		)
+		p_ranks = self.p_spill.ranks(
+			n, os.path.join(self.spill_dir, f'{self.name}_pred_ranks.npy'),
+			chunk_size
+		)
+
+		rank_moments = MomentAccumulator()
+		for start in range(0, n, chunk_size):
+			rank_moments.update(
+				np.asarray(y_ranks[start:start + chunk_size]),
+				np.asarray(p_ranks[start:start + chunk_size])
+			)
+		return rank_moments.pearson_r()
+
+	def bin_counts(self, n_bins, chunk_size=DEFAULT_CHUNK_SIZE):
+		"""2D histogram of (true, pred) pairs as returned by bin_preds."""
+		if self.values_file is None:
+			raise ValueError(f'{self.name} was streamed without keep_values')
+		edges = np.linspace(
+			self.moments.min_val, self.moments.max_val, n_bins + 1
+		)
+		counts = np.zeros((n_bins, n_bins))
+		if self.moments.n == 0:
+			return counts, edges
+
+		values = np.memmap(self.values_file, dtype=float, mode='r').reshape(
+			-1, 2
+		)
+		for start in range(0, len(values), chunk_size):
+			chunk = values[start:start + chunk_size]
+			counts += np.histogram2d(
+				chunk[:, 0], chunk[:, 1], bins=[edges, edges]
+			)[0]
+		return counts, edges
+
+	def scores(self, chunk_size=DEFAULT_CHUNK_SIZE):
+		"""Dict of scores with the same keys as score_preds."""
+		scores = self.moments.scores()
+		scores['spearman_r'] = self.spearman_r(chunk_size)
+		return {k: float(v) for k, v in scores.items()}
+
+
+def stream_scores(
+	pred_file,
+	index,
+	subsets,
+	chunk_size=DEFAULT_CHUNK_SIZE,
+	n_bins=None,
+	spill_dir=None
+):
+	"""Score a predictions CSV in chunks against a PhenoIndex.
+
+	Returns (scores, binned). scores maps each subset to a dict of the
+	same form as score_preds. binned maps each subset to (counts, edges)
+	from the same 2D histogram as bin_preds, or is empty if n_bins is
+	None.
+
+	Args:
+		pred_file: Path to CSV with 'IID' and 'pred' columns.
+		index: PhenoIndex for the ground truth phenotype.
+		subsets: Dict mapping subset name to required white British
+			status, or None to keep all rows. E.g. TEST_SUBSETS.
+		chunk_size: Rows per chunk.
+		n_bins: Number of bins per axis for binned plots.
+		spill_dir: Directory for temporary spill files. Default is the
+			system temporary directory.
+	"""
+	with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+		streams = {
+			subset: SubsetStream(tmp_dir, subset, keep_values=n_bins is not None)
+			for subset in subsets
+		}
+
+		with pd.read_csv(
+			pred_file,
+			usecols=['IID', 'pred'],
+			dtype={'IID': str},
+			chunksize=chunk_size
+		) as reader:
+			for chunk in reader:
+				rows, found = index.lookup(_encode_iids(chunk['IID']))
+				rows = rows[found]
+				y = np.asarray(index.true[rows], dtype=float)
+				p = chunk['pred'].values.astype(float)[found]
+				is_wb = np.asarray(index.is_wb[rows])
+
+				keep = ~np.isnan(y) & ~np.isnan(p)
+				for subset, wb in subsets.items():
+					in_subset = keep if wb is None else keep & (is_wb == wb)
+					streams[subset].update(y[in_subset], p[in_subset])
+
+		scores = {
+			subset: stream.scores(chunk_size)
+			for subset, stream in streams.items()
+		}
+		binned = {}
+		if n_bins is not None:
+			binned = {
+				subset: stream.bin_counts(n_bins, chunk_size)
+				for subset, stream in streams.items()
+			}
+
+	return scores, binned
+
+
+def stream_pred_dir(
+	val_file,
+	test_file,
+	index,
+	chunk_size=DEFAULT_CHUNK_SIZE,
+	n_bins=None,
+	spill_dir=None
+):
+	"""Stream-score one model's val and test prediction files.
+
+	Returns (scores, binned) as from stream_scores, with keys for every
+	subset of score_preds' scores.json.
+	"""
+	scores = {}
+	binned = {}
+	for pred_file, subsets in [
+		(val_file, VAL_SUBSETS), (test_file, TEST_SUBSETS)
+	]:
+		file_scores, file_binned = stream_scores(
+			pred_file,
+			index,
+			subsets,
+			chunk_size=chunk_size,
+			n_bins=n_bins,
+			spill_dir=spill_dir
+		)
+		scores.update(file_scores)
+		binned.update(file_binned)
+	return scores, binned
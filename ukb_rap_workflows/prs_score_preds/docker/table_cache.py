@@ -0,0 +1,188 @@
+"""Content-addressed binary cache for delimited input tables.
+
+read_table parses a .pheno, covariate .tsv, split .txt, .sscore or
+predictions .csv file with pd.read_csv once and stores a typed columnar
+copy as an uncompressed Feather (Arrow IPC) file. Later reads of a file
+with the same content and read options memory-map the Feather copy
+instead of parsing text.
+
+Cache entries are keyed by a BLAKE2b hash of the source file's bytes and
+the read_csv options. To avoid re-hashing unchanged files, the hash of
+each path is remembered along with its size and modification time.
+
+Integer columns are stored as int32 when their values fit. Float columns
+keep float64 so that scores computed from cached tables are identical to
+those from parsed ones.
+
+Caching is opt-in: the cache directory is the NONLIN_PRS_CACHE_DIR
+environment variable, and files are always parsed if it is unset or
+empty, or if pyarrow is not installed. WDL tasks leave it unset, as each
+run is a fresh container where the cache could never hit.
+
+The cache holds at most NONLIN_PRS_CACHE_MAX_GB (default: 10) GB of
+tables. When a new table takes it over that, the least recently used
+tables are deleted.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+try:
+	import pyarrow as pa
+	from pyarrow import feather
+except ImportError:
+	pa = None
+
+
+CACHE_DIR_ENV = 'NONLIN_PRS_CACHE_DIR'
+CACHE_MAX_GB_ENV = 'NONLIN_PRS_CACHE_MAX_GB'
+DEFAULT_CACHE_MAX_GB = 10
+
+_HASH_BLOCK_BYTES = 2 ** 20
+
+
+def get_cache_dir(cache_dir=None):
+	"""Cache directory to use, or None if caching is disabled."""
+	if pa is None:
+		return None
+	if cache_dir is None:
+		cache_dir = os.environ.get(CACHE_DIR_ENV, '')
+	if cache_dir == '':
+		return None
+	return os.path.expanduser(cache_dir)
+
+
+def _write_atomic(path, write_func):
+	"""Write a file via a temporary file so readers never see partial files."""
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+	os.close(fd)
+	try:
+		write_func(tmp_path)
+		os.replace(tmp_path, path)
+	except BaseException:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		raise
+
+
+def file_hash(path, cache_dir):
+	"""BLAKE2b hex digest of a file's contents.
+
+	The digest is remembered in cache_dir with the file's size and
+	modification time and reused while they are unchanged.
+	"""
+	abs_path = os.path.abspath(path)
+	stat = os.stat(abs_path)
+	stat_key = [stat.st_size, stat.st_mtime_ns]
+
+	memo_file = os.path.join(
+		cache_dir,
+		'hashes',
+		hashlib.blake2b(abs_path.encode(), digest_size=16).hexdigest() + '.json'
+	)
+	if os.path.exists(memo_file):
+		with open(memo_file) as f:
+			memo = json.load(f)
+		if memo['path'] == abs_path and memo['stat'] == stat_key:
+			return memo['hash']
+
+	hasher = hashlib.blake2b(digest_size=32)
+	with open(abs_path, 'rb') as f:
+		for block in iter(lambda: f.read(_HASH_BLOCK_BYTES), b''):
+			hasher.update(block)
+	digest = hasher.hexdigest()
+
+	os.makedirs(os.path.dirname(memo_file), exist_ok=True)
+
+	def write_memo(tmp_path):
+		with open(tmp_path, 'w') as f:
+			json.dump({'path': abs_path, 'stat': stat_key, 'hash': digest}, f)
+
+	_write_atomic(memo_file, write_memo)
+	return digest
+
+
+def prune(cache_dir, max_bytes):
+	"""Delete least recently used tables until they total max_bytes."""
+	entries = []
+	for entry in os.scandir(os.path.join(cache_dir, 'tables')):
+		if entry.name.endswith('.feather'):
+			stat = entry.stat()
+			entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+	total_bytes = sum(size for _, size, _ in entries)
+	for _, size, path in sorted(entries):
+		if total_bytes <= max_bytes:
+			break
+		try:
+			os.remove(path)
+		except FileNotFoundError:
+			# Pruned by another process
+			pass
+		total_bytes -= size
+
+
+def downcast_ints(df):
+	"""Store integer columns as int32 where all values fit."""
+	int32_info = np.iinfo(np.int32)
+	for col in df.columns:
+		if pd.api.types.is_integer_dtype(df[col]) and len(df[col]) > 0:
+			if df[col].min() >= int32_info.min \
+					and df[col].max() <= int32_info.max:
+				df[col] = df[col].astype(np.int32)
+	return df
+
+
+def read_table(path, cache_dir=None, **read_csv_kwargs):
+	"""pd.read_csv with a binary cache of the parsed table.
+
+	Returns the same DataFrame as pd.read_csv(path, **read_csv_kwargs),
+	except integer columns may be int32 and the index is always a
+	RangeIndex.
+
+	Args:
+		path: Path to the delimited text file.
+		cache_dir: Cache directory. Default is from get_cache_dir.
+		**read_csv_kwargs: Options passed to pd.read_csv. They must be
+			JSON serializable (e.g. dtype={'IID': str} is stored by
+			type name) since they are part of the cache key.
+	"""
+	cache_dir = get_cache_dir(cache_dir)
+	if cache_dir is None:
+		return downcast_ints(pd.read_csv(path, **read_csv_kwargs))
+
+	options = json.dumps(
+		read_csv_kwargs,
+		sort_keys=True,
+		default=lambda obj: getattr(obj, '__name__', str(obj))
+	)
+	key = hashlib.blake2b(
+		(file_hash(path, cache_dir) + options).encode(), digest_size=32
+	).hexdigest()
+	table_file = os.path.join(cache_dir, 'tables', f'{key}.feather')
+
+	if os.path.exists(table_file):
+		try:
+			# Modification time orders tables by last use for prune
+			os.utime(table_file)
+			return feather.read_table(table_file, memory_map=True).to_pandas()
+		except FileNotFoundError:
+			# Pruned by another process since the check
+			pass
+
+	df = downcast_ints(pd.read_csv(path, **read_csv_kwargs))
+	os.makedirs(os.path.dirname(table_file), exist_ok=True)
+	_write_atomic(
+		table_file,
+		lambda tmp_path: feather.write_feather(
+			df.reset_index(drop=True), tmp_path, compression='uncompressed'
+		)
+	)
+	max_gb = float(os.environ.get(CACHE_MAX_GB_ENV, DEFAULT_CACHE_MAX_GB))
+	prune(cache_dir, int(max_gb * 2 ** 30))
+	return df.reset_index(drop=True)
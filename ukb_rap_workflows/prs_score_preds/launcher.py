@@ -11,15 +11,33 @@ Required args:
 
 Optional args:
 * --wb: Flag for model fit on White British only
+* --n-bootstrap: Number of bootstrap replicates for confidence intervals
+	in scores.json. Default: 0 (no intervals).
+* --plot-mode: One of "scatter", "hexbin", or "hist2d". Binned modes are
+	faster to render for large test sets. Default: "scatter".
+* --profile: Profile score_preds.py with perf_spans. One of "cprofile" or
+	"sample". The profiles are workflow outputs. Default: no profiling.
+* --instance-type: Instance type to use. Default: the smallest adequate
+	instance for the data size, planned with rap_utils.resources, if its
+	coefficients are calibrated, otherwise DEFAULT_INSTANCE.
+* --no-reuse: Flag to run the workflow even if an earlier analysis with
+	the same inputs and docker image is done. False when not provided.
 """
 
 import argparse
+import os
+import sys
 
-import dxpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rap_utils import dx_resolve, resources, reuse
+from rap_utils.local_dx import get_dxpy
+
+dxpy = get_dxpy()
 
 
 WORKFLOW_ID = 'workflow-Ggx3J6QJv7BGzvQzq6xfz534'
 DEFAULT_INSTANCE = 'mem1_ssd1_v2_x2'
+LAUNCHER_DIR = os.path.dirname(os.path.abspath(__file__))
 
 PHENO_DIR = '/rdevito/nonlin_prs/data/pheno_data/pheno'
 SPLIT_DIR = '/rdevito/nonlin_prs/data/sample_data/splits'
@@ -43,57 +61,93 @@ def parse_args():
 		action='store_true',
 		help='Flag for model fit on White British only'
 	)
-	return parser.parse_args()
-
-
-def get_dxlink_from_path(path_to_link):
-	"""Get dxlink from path."""
-	print(f'Finding data object for {path_to_link}', flush=True)
-	return dxpy.dxlink(
-		list(dxpy.find_data_objects(
-			name=path_to_link.split('/')[-1],
-			folder='/'.join(path_to_link.split('/')[:-1]),
-			project=dxpy.PROJECT_CONTEXT_ID
-		))[0]['id']
+	parser.add_argument(
+		'--n-bootstrap',
+		type=int,
+		default=0,
+		help='Number of bootstrap replicates for confidence intervals in '
+			'scores.json. Default: 0 (no intervals).'
+	)
+	parser.add_argument(
+		'--plot-mode',
+		default='scatter',
+		choices=['scatter', 'hexbin', 'hist2d'],
+		help='Jointplot style. Default: scatter.'
+	)
+	parser.add_argument(
+		'--profile',
+		default=None,
+		choices=['cprofile', 'sample'],
+		help='Profile score_preds.py with perf_spans. Default: no profiling.'
+	)
+	parser.add_argument(
+		'--instance-type',
+		default=None,
+		help='Instance type to use. Default: planned from the data size if '
+			'calibrated, otherwise DEFAULT_INSTANCE.'
 	)
+	parser.add_argument(
+		'--no-reuse',
+		action='store_true',
+		help='Flag to run the workflow even if an earlier analysis with the '
+			'same inputs and docker image is done.'
+	)
+	return parser.parse_args()
 
 
 def launch_workflow(
 	model_dir,
 	pheno_file,
 	wb_split_file,
+	n_bootstrap=0,
+	plot_mode='scatter',
+	profile=None,
 	instance_type=DEFAULT_INSTANCE,
-	name='score_prs_preds'
+	name='score_prs_preds',
+	reuse_outputs=True
 ):
 	"""Launch PRS scoring and plotting workflow."""
 	
-	# Get links
-	val_pred_link = get_dxlink_from_path(f'{model_dir}/val_preds.csv')
-	test_pred_link = get_dxlink_from_path(f'{model_dir}/test_preds.csv')
-	pheno_link = get_dxlink_from_path(pheno_file)
-	wb_split_link = get_dxlink_from_path(wb_split_file)
+	# Get links. Predictions are replaced when a model is refit, so
+	# cached file IDs are not used.
+	links = dx_resolve.get_dxlinks([
+		f'{model_dir}/val_preds.csv',
+		f'{model_dir}/test_preds.csv',
+		pheno_file,
+		wb_split_file
+	], refresh=True)
 
 	# Set up workflow input
 	prefix = 'stage-common.'
 	workflow_input = {
-		f'{prefix}val_preds': val_pred_link,
-		f'{prefix}test_preds': test_pred_link,
-		f'{prefix}pheno_file': pheno_link,
-		f'{prefix}test_wb_samples': wb_split_link
+		f'{prefix}val_preds': links[f'{model_dir}/val_preds.csv'],
+		f'{prefix}test_preds': links[f'{model_dir}/test_preds.csv'],
+		f'{prefix}pheno_file': links[pheno_file],
+		f'{prefix}test_wb_samples': links[wb_split_file],
+		f'{prefix}n_bootstrap': n_bootstrap,
+		f'{prefix}plot_mode': plot_mode
 	}
+	if profile is not None:
+		workflow_input[f'{prefix}profile'] = profile
 
 	# Get workflow
 	workflow = dxpy.dxworkflow.DXWorkflow(dxid=WORKFLOW_ID)
 
-	# Run workflow
-	analysis = workflow.run(
+	# Run workflow unless its outputs can be reused
+	analysis = reuse.run_or_reuse(
+		dxpy,
+		workflow,
 		workflow_input,
 		folder=model_dir,
 		name=name,
+		image=reuse.image_digest(
+			os.path.join(LAUNCHER_DIR, 'prs_score_preds.wdl'),
+			os.path.join(LAUNCHER_DIR, 'docker')
+		),
+		reuse=reuse_outputs,
 		instance_type=instance_type,
 		ignore_reuse=True
 	)
-	print("Started analysis %s (%s)\n"%(analysis.get_id(), name))
 
 	return analysis
 
@@ -142,10 +196,26 @@ if __name__ == '__main__':
 	else:
 		name = f'score_prs_preds_{args.model_type}_{args.pheno_name}'
 
+	if args.instance_type is not None:
+		instance_type = args.instance_type
+	else:
+		# Plan instance type from data size
+		instance_type, _ = resources.plan_instance(
+			'prs_score_preds',
+			n_samples=resources.count_lines(pheno_file) - 1,
+			n_variants=0,
+			default=DEFAULT_INSTANCE
+		)
+	print(f'Instance type: {instance_type}')
+
 	launch_workflow(
 		model_dir,
 		pheno_file,
 		split_file,
-		instance_type=DEFAULT_INSTANCE,
-		name=name
+		n_bootstrap=args.n_bootstrap,
+		plot_mode=args.plot_mode,
+		profile=args.profile,
+		instance_type=instance_type,
+		name=name,
+		reuse_outputs=not args.no_reuse
 	)
@@ -0,0 +1,8 @@
+"""Shared helpers for the UKB RAP workflow launchers.
+
+Launchers add the ukb_rap_workflows directory to sys.path and import
+modules from this package, e.g.:
+
+	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	from rap_utils import resources
+"""
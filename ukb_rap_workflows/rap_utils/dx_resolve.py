@@ -0,0 +1,369 @@
+"""Resolve UKB RAP file paths to file IDs in batches, with a local cache.
+
+Finding each input with its own dxpy.find_data_objects query costs one
+platform round trip per file. resolve_paths() instead groups the paths
+by folder, lists each folder once, and lists the folders concurrently,
+so resolving every input of a launch, or of a sweep of launches, costs
+one round trip per distinct folder.
+
+Resolved path -> file ID mappings, including those of every other file
+in a listed folder, are kept in a JSON cache file for ttl seconds
+(default DEFAULT_TTL) so repeated launches make no queries at all. Set
+the NONLIN_PRS_DX_CACHE environment variable to change the cache file,
+pass refresh=True or --refresh to ignore cached entries, and use
+invalidate() or the 'invalidate' command after overwriting files.
+remove_paths() removes files before new versions are uploaded.
+
+The cache suits inputs that rarely change, such as genotype and
+phenotype files. Outputs of other workflows can be rerun, removed or
+duplicated at any time, so launchers pass them in refresh, a list of
+paths whose folders are listed again even if cached. A stale output
+then raises AmbiguousPathError or FileNotFoundError instead of
+resolving to an old file ID.
+
+A name matching more than one file in a folder raises AmbiguousPathError
+rather than picking one, and a missing file raises FileNotFoundError.
+Files missing from a folder holding a REUSE_POINTER_FILE written by
+reuse.py are resolved to the reused files it lists.
+
+Resolution uses local_dx.get_dxpy(), so it runs against a local project
+directory when NONLIN_PRS_LOCAL_PROJECT is set. Run as a script to
+resolve paths or clear cached entries:
+
+	python dx_resolve.py resolve /rdevito/nonlin_prs/a.tsv /rdevito/b.tsv
+	python dx_resolve.py invalidate --prefix /rdevito/nonlin_prs/gwas
+"""
+
+import argparse
+import json
+import os
+import posixpath
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+if __package__:
+	from .local_dx import get_dxpy
+else:
+	from local_dx import get_dxpy
+
+
+CACHE_ENV = 'NONLIN_PRS_DX_CACHE'
+DEFAULT_CACHE_FILE = os.path.join(
+	os.path.expanduser('~'), '.cache', 'nonlin_prs', 'dx_paths.json'
+)
+DEFAULT_TTL = 6 * 60 * 60
+DEFAULT_WORKERS = 8
+REUSE_POINTER_FILE = 'reused_outputs.json'
+
+
+class AmbiguousPathError(ValueError):
+	"""A path matches more than one file in the project."""
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+	subparsers = parser.add_subparsers(dest='command', required=True)
+
+	resolve_parser = subparsers.add_parser(
+		'resolve',
+		help='Print the file ID of each path.'
+	)
+	resolve_parser.add_argument('paths', nargs='+')
+	resolve_parser.add_argument(
+		'--refresh',
+		action='store_true',
+		help='Ignore and replace cached entries.'
+	)
+
+	invalidate_parser = subparsers.add_parser(
+		'invalidate',
+		help='Remove cached entries.'
+	)
+	invalidate_parser.add_argument(
+		'--prefix',
+		default=None,
+		help='Only remove entries of paths starting with this prefix. '
+			'Default: remove all entries.'
+	)
+
+	return parser.parse_args()
+
+
+def split_path(path):
+	"""(folder, name) of a project path."""
+	folder, name = posixpath.split(path)
+	return '/' + folder.strip('/'), name
+
+
+class PathResolver:
+	"""Resolve project paths to file IDs with batched, cached listings.
+
+	Args:
+		dx: dxpy module or stand-in. Default: local_dx.get_dxpy().
+		project: Project ID. Default: dx.PROJECT_CONTEXT_ID.
+		cache_file: JSON cache file, or None for no cache. Default:
+			NONLIN_PRS_DX_CACHE or DEFAULT_CACHE_FILE.
+		ttl: Seconds a cached entry is used for.
+		max_workers: Number of folders listed concurrently.
+	"""
+
+	def __init__(
+		self,
+		dx=None,
+		project=None,
+		cache_file='default',
+		ttl=DEFAULT_TTL,
+		max_workers=DEFAULT_WORKERS
+	):
+		self.dx = dx if dx is not None else get_dxpy()
+		self.project = project or self.dx.PROJECT_CONTEXT_ID
+		if cache_file == 'default':
+			cache_file = os.environ.get(CACHE_ENV, DEFAULT_CACHE_FILE)
+		self.cache_file = cache_file
+		self.ttl = ttl
+		self.max_workers = max_workers
+		self._lock = threading.Lock()
+		self._cache = self._load_cache()
+
+	def _load_cache(self):
+		"""{path: [file ID, time resolved]} of this project."""
+		if self.cache_file is None or not os.path.exists(self.cache_file):
+			return {}
+		try:
+			with open(self.cache_file) as f:
+				return json.load(f).get(self.project, {})
+		except (OSError, ValueError):
+			# A corrupt cache is rebuilt
+			return {}
+
+	def _save_cache(self, updates=None, removed=None):
+		"""Merge changes into the cache file, which other processes may share."""
+		if self.cache_file is None:
+			return
+		cache_dir = os.path.dirname(os.path.abspath(self.cache_file))
+		os.makedirs(cache_dir, exist_ok=True)
+
+		all_projects = {}
+		if os.path.exists(self.cache_file):
+			try:
+				with open(self.cache_file) as f:
+					all_projects = json.load(f)
+			except (OSError, ValueError):
+				all_projects = {}
+
+		entries = all_projects.setdefault(self.project, {})
+		entries.update(updates or {})
+		for path in removed or []:
+			entries.pop(path, None)
+
+		# Write to a temp file and rename so readers never see a partial file
+		fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+		with os.fdopen(fd, 'w') as f:
+			json.dump(all_projects, f)
+		os.replace(tmp_file, self.cache_file)
+
+	def _cached_id(self, path, now):
+		entry = self._cache.get(path)
+		if entry is not None and now - entry[1] < self.ttl:
+			return entry[0]
+		return None
+
+	def _list_folder(self, folder):
+		"""{name: [file IDs]} of the files directly in a folder."""
+		files = defaultdict(list)
+		for obj in self.dx.find_data_objects(
+			classname='file',
+			folder=folder,
+			recurse=False,
+			project=self.project,
+			describe={'fields': {'name': True}}
+		):
+			files[obj['describe']['name']].append(obj['id'])
+
+		# Outputs of a reused analysis are listed by a pointer file
+		if len(files.get(REUSE_POINTER_FILE, [])) == 1:
+			with self.dx.open_dxfile(files[REUSE_POINTER_FILE][0], mode='r') as f:
+				pointer = json.load(f)
+			for name, dxid in pointer['files'].items():
+				if name not in files:
+					files[name] = [dxid]
+
+		return files
+
+	def resolve(self, paths, refresh=False, missing_ok=False):
+		"""Dict of path -> file ID for each path.
+
+		Args:
+			paths: Iterable of project paths.
+			refresh: If True, list every folder again rather than use
+				cached entries. If a collection of paths, do so for
+				those paths only, e.g. outputs of earlier workflows.
+			missing_ok: If True, missing files map to None instead of
+				raising FileNotFoundError.
+		"""
+		paths = list(dict.fromkeys(paths))
+		now = time.time()
+		if isinstance(refresh, bool):
+			refresh_paths = set(paths) if refresh else set()
+		else:
+			refresh_paths = set(refresh)
+
+		resolved = {}
+		by_folder = defaultdict(list)
+		for path in paths:
+			dxid = None if path in refresh_paths else self._cached_id(path, now)
+			if dxid is not None:
+				resolved[path] = dxid
+			else:
+				folder, name = split_path(path)
+				by_folder[folder].append(path)
+
+		if by_folder:
+			folders = list(by_folder)
+			n_workers = max(1, min(self.max_workers, len(folders)))
+			with ThreadPoolExecutor(max_workers=n_workers) as executor:
+				listings = dict(zip(folders, executor.map(self._list_folder, folders)))
+
+			updates = {}
+			errors = []
+			for folder, files in listings.items():
+				# Cache every unambiguous file so sibling lookups are free
+				for name, ids in files.items():
+					if len(ids) == 1:
+						updates[posixpath.join(folder, name)] = [ids[0], now]
+
+				for path in by_folder[folder]:
+					ids = files.get(split_path(path)[1], [])
+					if len(ids) == 1:
+						resolved[path] = ids[0]
+					elif ids:
+						errors.append(AmbiguousPathError(
+							f'{path} matches {len(ids)} files: {", ".join(ids)}'
+						))
+					elif missing_ok:
+						resolved[path] = None
+					else:
+						errors.append(FileNotFoundError(
+							f'{path} not found in project {self.project}'
+						))
+
+			with self._lock:
+				# Drop entries of files no longer alone at their path
+				removed = [
+					p for p in self._cache
+					if split_path(p)[0] in listings and p not in updates
+				]
+				for path in removed:
+					del self._cache[path]
+				self._cache.update(updates)
+			self._save_cache(updates=updates, removed=removed)
+
+			if errors:
+				raise errors[0]
+
+		return {path: resolved[path] for path in paths}
+
+	def resolve_path(self, path, refresh=False):
+		"""File ID of one path."""
+		return self.resolve([path], refresh=refresh)[path]
+
+	def dxlinks(self, paths, refresh=False):
+		"""Dict of path -> dxlink for each path."""
+		return {
+			path: self.dx.dxlink(dxid)
+			for path, dxid in self.resolve(paths, refresh=refresh).items()
+		}
+
+	def remove(self, paths):
+		"""Remove every file at each path and return the number removed.
+
+		UKB RAP allows several files of one name in a folder, so a file
+		uploaded where one exists makes the path ambiguous. Remove the old
+		file first. Files a reuse pointer lists are not removed.
+		"""
+		paths = list(dict.fromkeys(paths))
+		dxids = []
+		for path in paths:
+			folder, name = split_path(path)
+			dxids += [
+				obj['id'] for obj in self.dx.find_data_objects(
+					classname='file',
+					name=name,
+					folder=folder,
+					recurse=False,
+					project=self.project
+				)
+			]
+		if dxids:
+			self.dx.DXProject(self.project).remove_objects(dxids)
+		self.invalidate(paths=paths)
+		return len(dxids)
+
+	def invalidate(self, paths=None, prefix=None):
+		"""Remove cached entries.
+
+		Args:
+			paths: Paths whose entries are removed.
+			prefix: Remove entries of paths starting with this prefix.
+			If neither is given, all entries of the project are removed.
+		"""
+		with self._lock:
+			if paths is None and prefix is None:
+				removed = list(self._cache)
+			else:
+				removed = [
+					p for p in self._cache
+					if (paths is not None and p in paths)
+					or (prefix is not None and p.startswith(prefix))
+				]
+			for path in removed:
+				del self._cache[path]
+		self._save_cache(removed=removed)
+		return removed
+
+
+_default_resolver = None
+
+
+def get_resolver():
+	"""Shared PathResolver with the default settings."""
+	global _default_resolver
+	dx = get_dxpy()
+	if _default_resolver is None or _default_resolver.dx is not dx:
+		_default_resolver = PathResolver(dx=dx)
+	return _default_resolver
+
+
+def resolve_paths(paths, refresh=False, missing_ok=False):
+	"""Dict of path -> file ID with the shared resolver."""
+	return get_resolver().resolve(paths, refresh=refresh, missing_ok=missing_ok)
+
+
+def remove_paths(paths):
+	"""Remove the files at paths with the shared resolver."""
+	return get_resolver().remove(paths)
+
+
+def get_dxlinks(paths, refresh=False):
+	"""Dict of path -> dxlink with the shared resolver."""
+	return get_resolver().dxlinks(paths, refresh=refresh)
+
+
+def get_dxlink_from_path(path_to_link):
+	"""dxlink of one path with the shared resolver."""
+	return get_dxlinks([path_to_link])[path_to_link]
+
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	resolver = get_resolver()
+	if args.command == 'resolve':
+		for path, dxid in resolver.resolve(args.paths, refresh=args.refresh).items():
+			print(f'{path}\t{dxid}')
+	else:
+		removed = resolver.invalidate(prefix=args.prefix)
+		print(f'Removed {len(removed)} cached entries')
@@ -0,0 +1,503 @@
+"""Filesystem-backed stand-in for the parts of dxpy the launchers use.
+
+A local directory plays the UKB RAP project: the project path
+'/rdevito/nonlin_prs/x.tsv' is the file {root}/rdevito/nonlin_prs/x.tsv.
+File IDs are derived from the path, size and modification time, so they
+are stable across runs and, as on the platform, a replaced file gets a
+new ID. Each API call can be given a fixed latency to imitate platform round
+trips when measuring how many calls a launcher makes.
+
+get_dxpy() returns this stand-in when the NONLIN_PRS_LOCAL_PROJECT
+environment variable is set to a project directory, and dxpy otherwise:
+
+	NONLIN_PRS_LOCAL_PROJECT=/tmp/rap python launcher.py ...
+
+NONLIN_PRS_LOCAL_LATENCY sets the per-call latency in seconds.
+
+Workflow runs are recorded as analyses under {root}/.local_dx/analyses.
+By default they are not executed: an analysis is 'in_progress' for
+NONLIN_PRS_LOCAL_RUN_SECONDS (default 0) seconds and then 'done'. With
+NONLIN_PRS_LOCAL_EXECUTE=1, the workflow's WDL task is run locally with
+local_wdl instead. NONLIN_PRS_LOCAL_FAIL_RATE is the fraction of API
+calls that fail with a transient LocalAPIError, so schedulers can be
+exercised offline.
+"""
+
+import fnmatch
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import threading
+import time
+
+
+LOCAL_PROJECT_ENV = 'NONLIN_PRS_LOCAL_PROJECT'
+LOCAL_LATENCY_ENV = 'NONLIN_PRS_LOCAL_LATENCY'
+LOCAL_RUN_SECONDS_ENV = 'NONLIN_PRS_LOCAL_RUN_SECONDS'
+LOCAL_FAIL_RATE_ENV = 'NONLIN_PRS_LOCAL_FAIL_RATE'
+LOCAL_EXECUTE_ENV = 'NONLIN_PRS_LOCAL_EXECUTE'
+LOCAL_PROJECT_ID = 'project-local'
+
+
+def file_id(path, local_path):
+	"""File ID of a project path, which changes when the file does."""
+	stat = os.stat(local_path)
+	return 'file-' + hashlib.sha1(
+		f'{path}:{stat.st_size}:{stat.st_mtime_ns}'.encode()
+	).hexdigest()[:24]
+
+
+class LocalAPIError(Exception):
+	"""Transient API failure of the local stand-in, like a dxpy 503."""
+
+
+class LocalJobFailureError(Exception):
+	"""A locally executed analysis failed, like dxpy's DXJobFailureError."""
+
+
+class LocalDXFile:
+	"""Local stand-in for dxpy.DXFile."""
+
+	def __init__(self, dx, dxid, project=None):
+		self._dx = dx
+		self._dxid = dxid
+		self._project = project or dx.PROJECT_CONTEXT_ID
+
+	def get_id(self):
+		return self._dxid
+
+	def describe(self, **kwargs):
+		self._dx._call()
+		return self._dx._describe(self._dxid)
+
+	def move(self, folder, **kwargs):
+		"""Move the file to folder, keeping its ID as on the platform."""
+		self._dx._call()
+		old_path = self._dx._project_path(self._dxid)
+		new_path = os.path.join('/' + folder.strip('/'), os.path.basename(old_path))
+		os.makedirs(os.path.dirname(self._dx.local_path(new_path)), exist_ok=True)
+		os.replace(self._dx.local_path(old_path), self._dx.local_path(new_path))
+		with self._dx._lock:
+			self._dx._paths[self._dxid] = new_path
+
+
+class LocalDXProject:
+	"""Local stand-in for dxpy.DXProject."""
+
+	def __init__(self, dx, dxid):
+		self._dx = dx
+		self._dxid = dxid
+
+	def get_id(self):
+		return self._dxid
+
+	def new_folder(self, folder, parents=False, **kwargs):
+		self._dx._call()
+		local_folder = self._dx.local_path(folder)
+		if not parents and not os.path.isdir(os.path.dirname(local_folder.rstrip('/'))):
+			raise FileNotFoundError(f'Parent folder of {folder} does not exist')
+		os.makedirs(local_folder, exist_ok=True)
+
+	def remove_objects(self, objects, **kwargs):
+		self._dx._call()
+		for dxid in objects:
+			os.remove(self._dx.local_path(self._dx._project_path(dxid)))
+			with self._dx._lock:
+				del self._dx._paths[dxid]
+
+
+class LocalDXAnalysis:
+	"""Local stand-in for dxpy.DXAnalysis."""
+
+	def __init__(self, dx, dxid):
+		self._dx = dx
+		self._dxid = dxid
+
+	def get_id(self):
+		return self._dxid
+
+	def describe(self, **kwargs):
+		self._dx._call()
+		with open(self._dx._analysis_file(self._dxid)) as f:
+			desc = json.load(f)
+		# Analyses that are only recorded finish after run_seconds
+		if desc['state'] == 'in_progress' and desc['run_seconds'] is not None:
+			if time.time() - desc['created'] >= desc['run_seconds']:
+				desc['state'] = 'done'
+		return desc
+
+	def wait_on_done(self, interval=1.0):
+		"""Wait until the analysis is done, raising if it fails."""
+		while True:
+			desc = self.describe()
+			if desc['state'] == 'done':
+				return
+			if desc['state'] == 'failed':
+				raise LocalJobFailureError(
+					f'{self._dxid} failed: {desc.get("failure_message")}'
+				)
+			time.sleep(interval)
+
+
+class LocalDXWorkflow:
+	"""Local stand-in for dxpy.DXWorkflow that records runs as analyses.
+
+	Runs are executed with local_wdl if wdl_file is given, or if the
+	stand-in executes runs and a launcher has this workflow's ID.
+	"""
+
+	def __init__(self, dx, dxid, wdl_file=None):
+		self._dx = dx
+		self._dxid = dxid
+		self._wdl_file = wdl_file
+
+	def get_id(self):
+		return self._dxid
+
+	def run(
+		self,
+		workflow_input,
+		folder=None,
+		name=None,
+		instance_type=None,
+		properties=None,
+		**kwargs
+	):
+		if __package__:
+			from . import local_wdl
+		else:
+			import local_wdl
+
+		self._dx._call()
+		wdl_file = self._wdl_file
+		if wdl_file is None and self._dx.execute:
+			wdl_file = local_wdl.find_workflow_wdl(self._dxid)
+			if wdl_file is None:
+				raise ValueError(f'No launcher has workflow ID {self._dxid}')
+
+		created = time.time()
+		dxid = 'analysis-' + hashlib.sha1(
+			f'{self._dxid}{name}{created}{random.random()}'.encode()
+		).hexdigest()[:24]
+
+		desc = {
+			'id': dxid,
+			'class': 'analysis',
+			'workflow': self._dxid,
+			'name': name,
+			'folder': folder,
+			'input': workflow_input,
+			'instance_type': instance_type,
+			'properties': properties or {},
+			'state': 'in_progress',
+			'created': created,
+			'run_seconds': None if wdl_file else self._dx.run_seconds,
+		}
+		os.makedirs(os.path.dirname(self._dx._analysis_file(dxid)), exist_ok=True)
+		self._dx._write_analysis(desc)
+
+		if wdl_file:
+			def on_done(result):
+				desc['output'] = {
+					name: (
+						[self._dx.dxlink(i) for i in ids] if isinstance(ids, list)
+						else self._dx.dxlink(ids)
+					)
+					for name, ids in result['outputs'].items()
+				}
+				desc['runtime_seconds'] = result['runtime_seconds']
+				desc['work_dir'] = result.get('work_dir')
+				if result['error'] is None:
+					desc['state'] = 'done'
+				else:
+					desc['state'] = 'failed'
+					desc['failure_message'] = result['error']
+				self._dx._write_analysis(desc)
+
+			local_wdl.submit(
+				self._dx, wdl_file, workflow_input, folder or '/', dxid, on_done
+			)
+
+		return LocalDXAnalysis(self._dx, dxid)
+
+
+class _LocalWorkflowModule:
+	"""Stand-in for the dxpy.dxworkflow module."""
+
+	def __init__(self, dx):
+		self._dx = dx
+
+	def DXWorkflow(self, dxid=None, project=None):
+		return LocalDXWorkflow(self._dx, dxid)
+
+
+class LocalDxpy:
+	"""Local stand-in for the dxpy module.
+
+	Supports find_data_objects (exact, glob and regexp names), dxlink,
+	DXFile (with move), DXProject (with new_folder and remove_objects),
+	open_dxfile, download_dxfile, upload_string, upload_local_file,
+	dxworkflow.DXWorkflow, DXAnalysis and find_analyses. The number of
+	API calls made is counted in n_calls.
+
+	Args:
+		root: Directory holding the project's files.
+		latency: Seconds each API call sleeps for.
+		project_id: Project ID reported as PROJECT_CONTEXT_ID.
+		run_seconds: Seconds an analysis stays in progress.
+		fail_rate: Fraction of API calls raising LocalAPIError.
+		execute: If True, workflow runs are executed with local_wdl.
+	"""
+
+	def __init__(
+		self,
+		root,
+		latency=0.0,
+		project_id=LOCAL_PROJECT_ID,
+		run_seconds=0.0,
+		fail_rate=0.0,
+		execute=False
+	):
+		self.root = os.path.abspath(root)
+		self.latency = latency
+		self.PROJECT_CONTEXT_ID = project_id
+		self.run_seconds = run_seconds
+		self.fail_rate = fail_rate
+		self.execute = execute
+		self.n_calls = 0
+		self.dxworkflow = _LocalWorkflowModule(self)
+		self._paths = {}
+		self._lock = threading.Lock()
+
+	def _call(self):
+		with self._lock:
+			self.n_calls += 1
+		if self.latency > 0:
+			time.sleep(self.latency)
+		if self.fail_rate > 0 and random.random() < self.fail_rate:
+			raise LocalAPIError('ServiceUnavailable: simulated transient failure')
+
+	def _analysis_file(self, dxid):
+		return os.path.join(self.root, '.local_dx', 'analyses', f'{dxid}.json')
+
+	def _write_analysis(self, desc):
+		# Written to a temp file and renamed, as other processes poll it
+		analysis_file = self._analysis_file(desc['id'])
+		with open(analysis_file + '.tmp', 'w') as f:
+			json.dump(desc, f, indent=4)
+		os.replace(analysis_file + '.tmp', analysis_file)
+
+	def local_path(self, path):
+		"""Local file of a project path."""
+		return os.path.join(self.root, path.lstrip('/'))
+
+	def _rel_folder(self, local_folder):
+		rel_folder = os.path.relpath(local_folder, self.root)
+		return '/' if rel_folder == '.' else '/' + rel_folder
+
+	def _register(self, path):
+		dxid = file_id(path, self.local_path(path))
+		with self._lock:
+			self._paths[dxid] = path
+		return dxid
+
+	def _project_path(self, dxid):
+		if dxid not in self._paths:
+			# IDs from an earlier process are found by walking the project
+			for folder, dir_names, names in os.walk(self.root):
+				if '.local_dx' in dir_names:
+					dir_names.remove('.local_dx')
+				for name in names:
+					self._register(os.path.join(self._rel_folder(folder), name))
+		if dxid not in self._paths:
+			raise FileNotFoundError(f'{dxid} not found in {self.root}')
+		return self._paths[dxid]
+
+	def _describe(self, dxid):
+		path = self._project_path(dxid)
+		folder, name = os.path.split(path)
+		return {
+			'id': dxid,
+			'class': 'file',
+			'project': self.PROJECT_CONTEXT_ID,
+			'name': name,
+			'folder': folder,
+			'state': 'closed',
+			'size': os.path.getsize(self.local_path(path)),
+		}
+
+	def find_data_objects(
+		self,
+		classname=None,
+		name=None,
+		name_mode='exact',
+		folder='/',
+		recurse=True,
+		project=None,
+		describe=False,
+		**kwargs
+	):
+		"""Yield {'id', 'project'[, 'describe']} for matching files."""
+		self._call()
+		folder = '/' + folder.strip('/')
+		local_folder = self.local_path(folder)
+		if not os.path.isdir(local_folder):
+			return
+
+		if recurse:
+			walk = os.walk(local_folder)
+		else:
+			walk = [(local_folder, None, os.listdir(local_folder))]
+
+		for dir_path, dir_names, names in walk:
+			if dir_names is not None and '.local_dx' in dir_names:
+				dir_names.remove('.local_dx')
+			rel_folder = self._rel_folder(dir_path)
+			for file_name in sorted(names):
+				if not os.path.isfile(os.path.join(dir_path, file_name)):
+					continue
+				if name is not None:
+					if name_mode == 'glob':
+						if not fnmatch.fnmatch(file_name, name):
+							continue
+					elif name_mode == 'regexp':
+						if not re.search(name, file_name):
+							continue
+					elif file_name != name:
+						continue
+
+				dxid = self._register(os.path.join(rel_folder, file_name))
+				result = {'id': dxid, 'project': self.PROJECT_CONTEXT_ID}
+				if describe:
+					result['describe'] = self._describe(dxid)
+				yield result
+
+	def dxlink(self, object_id, project_id=None):
+		if project_id is None:
+			return {'$dnanexus_link': object_id}
+		return {'$dnanexus_link': {'project': project_id, 'id': object_id}}
+
+	def DXFile(self, dxid, project=None):
+		return LocalDXFile(self, dxid, project)
+
+	def DXProject(self, dxid=None):
+		return LocalDXProject(self, dxid or self.PROJECT_CONTEXT_ID)
+
+	def DXAnalysis(self, dxid):
+		return LocalDXAnalysis(self, dxid)
+
+	def find_analyses(
+		self,
+		project=None,
+		properties=None,
+		state=None,
+		describe=False,
+		**kwargs
+	):
+		"""Yield {'id'[, 'describe']} of analyses matching all filters."""
+		self._call()
+		analyses_dir = os.path.dirname(self._analysis_file('x'))
+		if not os.path.isdir(analyses_dir):
+			return
+		for file_name in sorted(os.listdir(analyses_dir)):
+			if not file_name.endswith('.json'):
+				continue
+			dxid = file_name[:-len('.json')]
+			desc = LocalDXAnalysis(self, dxid).describe()
+			if state is not None and desc['state'] != state:
+				continue
+			if any(
+				desc.get('properties', {}).get(k) != v
+				for k, v in (properties or {}).items()
+			):
+				continue
+			result = {'id': dxid}
+			if describe:
+				result['describe'] = desc
+			yield result
+
+	def upload_string(
+		self,
+		to_upload,
+		project=None,
+		folder='/',
+		name=None,
+		parents=False,
+		**kwargs
+	):
+		"""Write a string to folder/name and return its LocalDXFile."""
+		self._call()
+		path = os.path.join('/' + folder.strip('/'), name)
+		self._make_folder(path, parents)
+		with open(self.local_path(path), 'w') as f:
+			f.write(to_upload)
+		return LocalDXFile(self, self._register(path), project)
+
+	def upload_local_file(
+		self,
+		filename=None,
+		project=None,
+		folder='/',
+		name=None,
+		parents=False,
+		**kwargs
+	):
+		"""Copy a local file to folder/name and return its LocalDXFile."""
+		self._call()
+		if name is None:
+			name = os.path.basename(filename)
+		path = os.path.join('/' + folder.strip('/'), name)
+		self._make_folder(path, parents)
+		shutil.copyfile(filename, self.local_path(path))
+		return LocalDXFile(self, self._register(path), project)
+
+	def _make_folder(self, path, parents):
+		"""Create the folder of path, which must exist unless parents."""
+		local_folder = os.path.dirname(self.local_path(path))
+		if not parents and not os.path.isdir(local_folder):
+			# As on the platform, uploads only create folders with parents=True
+			raise FileNotFoundError(f'Folder {os.path.dirname(path)} does not exist')
+		os.makedirs(local_folder, exist_ok=True)
+
+	def _link_id(self, dxid):
+		if isinstance(dxid, dict):
+			dxid = dxid['$dnanexus_link']
+			if isinstance(dxid, dict):
+				dxid = dxid['id']
+		return dxid
+
+	def open_dxfile(self, dxid, project=None, mode='r'):
+		self._call()
+		return open(self.local_path(self._project_path(self._link_id(dxid))), mode)
+
+	def download_dxfile(self, dxid, filename, **kwargs):
+		self._call()
+		shutil.copyfile(
+			self.local_path(self._project_path(self._link_id(dxid))), filename
+		)
+
+
+_local_dxpy = None
+
+
+def get_dxpy():
+	"""LocalDxpy if NONLIN_PRS_LOCAL_PROJECT is set, otherwise dxpy."""
+	global _local_dxpy
+
+	local_root = os.environ.get(LOCAL_PROJECT_ENV)
+	if local_root:
+		if _local_dxpy is None or _local_dxpy.root != os.path.abspath(local_root):
+			_local_dxpy = LocalDxpy(
+				local_root,
+				latency=float(os.environ.get(LOCAL_LATENCY_ENV, 0)),
+				run_seconds=float(os.environ.get(LOCAL_RUN_SECONDS_ENV, 0)),
+				fail_rate=float(os.environ.get(LOCAL_FAIL_RATE_ENV, 0)),
+				execute=os.environ.get(LOCAL_EXECUTE_ENV, '') not in ('', '0')
+			)
+		return _local_dxpy
+
+	import dxpy
+	return dxpy
@@ -0,0 +1,543 @@
+"""Run the workflows' WDL tasks locally against a local project.
+
+Each workflow in ukb_rap_workflows is a WDL 1.0 file with one task
+called once, with workflow inputs passed straight through to the task.
+run_workflow() parses that WDL, localizes File inputs from a LocalDxpy
+project directory into a per-analysis working directory, runs the task
+command in a process pool and copies the task outputs (file names and
+glob() patterns) into the output folder of the project. Only the WDL
+used by these workflows is supported: declarations with literal
+defaults, ~{name} placeholders and outputs that are file names, glob()
+patterns or task outputs.
+
+Launchers use it through the usual workflow.run interface. With
+NONLIN_PRS_LOCAL_PROJECT and NONLIN_PRS_LOCAL_EXECUTE=1 set, local_dx
+looks up the WDL of a workflow ID from the WORKFLOW_ID of each launcher
+and runs it here instead of only recording the analysis:
+
+	NONLIN_PRS_LOCAL_PROJECT=/tmp/rap NONLIN_PRS_LOCAL_EXECUTE=1 \\
+		python launcher.py -p standing_height_50
+
+The analysis is 'in_progress' while its task runs and then 'done' or
+'failed', with the output file links in its 'output' field. The launching
+process waits for its tasks to finish before exiting.
+
+Commands run on the host by default, so the tools the docker image
+provides (plink2, PRSice, R) must be installed locally. Paths under
+/home/, where the images keep the repo's scripts and configs, are
+mapped to the workflow's docker build directory, which holds copies of
+them. Set NONLIN_PRS_LOCAL_DOCKER=1 to run each command in the task's
+docker image instead, and NONLIN_PRS_LOCAL_WORKERS to the number of
+tasks run at once (default: the number of CPUs).
+
+Task working directories are kept as
+{root}/.local_dx/work/{analysis ID}, with localized inputs in 'inputs',
+the command's working directory in 'execution' and its output in
+'execution/stdout' and 'execution/stderr'.
+
+Run as a script to run a WDL with a JSON file of inputs, given with or
+without the 'stage-common.' prefix, project paths or file IDs:
+
+	python local_wdl.py ../prs_score_preds/prs_score_preds.wdl \\
+		-i inputs.json -f /rdevito/nonlin_prs/test_scores
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import shutil
+import subprocess
+import textwrap
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+if __package__:
+	from .local_dx import LocalDXWorkflow, get_dxpy
+else:
+	from local_dx import LocalDXWorkflow, get_dxpy
+
+
+WORKFLOWS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOCAL_DOCKER_ENV = 'NONLIN_PRS_LOCAL_DOCKER'
+LOCAL_WORKERS_ENV = 'NONLIN_PRS_LOCAL_WORKERS'
+INPUT_PREFIX = 'stage-common.'
+
+DECLARATION_RE = re.compile(
+	r'^(?P<type>[\w\[\]]+\??)\s+(?P<name>\w+)(?:\s*=\s*(?P<expr>.+?))?\s*$'
+)
+PLACEHOLDER_RE = re.compile(r'~\{\s*(\w+)\s*\}')
+HOME_PATH_RE = re.compile(r'(?<![\w/.])/home/')
+WORKFLOW_ID_RE = re.compile(r'^WORKFLOW_ID\s*=\s*[\'"]([\w-]+)[\'"]', re.MULTILINE)
+
+
+class WDLError(ValueError):
+	"""A WDL file or workflow input that the local runner cannot handle."""
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('wdl_file')
+	parser.add_argument(
+		'-i', '--inputs',
+		required=True,
+		help='JSON file of workflow inputs.'
+	)
+	parser.add_argument(
+		'-f', '--folder',
+		required=True,
+		help='Project folder the outputs are written to.'
+	)
+	parser.add_argument(
+		'-n', '--name',
+		default=None,
+		help='Analysis name. Default: the workflow name.'
+	)
+	return parser.parse_args()
+
+
+def _block(text, keyword):
+	"""Body of the first '{keyword} {...}' block in text, or None."""
+	match = re.search(r'\b' + keyword + r'\b[^{\n]*\{', text)
+	if match is None:
+		return None
+	depth = 1
+	i = match.end()
+	while depth > 0:
+		if i >= len(text):
+			raise WDLError(f'Unclosed {keyword} block')
+		if text[i] == '{':
+			depth += 1
+		elif text[i] == '}':
+			depth -= 1
+		i += 1
+	return text[match.end():i - 1]
+
+
+def _named_blocks(text, keyword):
+	"""Dict of name -> body of each '{keyword} name {...}' block."""
+	blocks = {}
+	for match in re.finditer(r'^\s*' + keyword + r'\s+(\w+)\s*\{', text, re.MULTILINE):
+		blocks[match.group(1)] = _block(text[match.start():], keyword)
+	return blocks
+
+
+def _strip_comments(line):
+	return re.sub(r'\s*#.*$', '', line).strip()
+
+
+def parse_literal(expr):
+	"""Value of a WDL literal: string, number or boolean."""
+	expr = expr.strip()
+	if expr in ('true', 'false'):
+		return expr == 'true'
+	if expr[:1] in ('"', "'") and expr[-1:] == expr[:1]:
+		return expr[1:-1]
+	try:
+		return int(expr)
+	except ValueError:
+		pass
+	try:
+		return float(expr)
+	except ValueError:
+		raise WDLError(f'Unsupported expression: {expr}')
+
+
+def _declarations(body):
+	"""List of {'type', 'name', 'expr'} of the declarations in a block."""
+	declarations = []
+	for line in (body or '').splitlines():
+		line = _strip_comments(line)
+		if not line:
+			continue
+		match = DECLARATION_RE.match(line)
+		if match is None:
+			raise WDLError(f'Unsupported declaration: {line}')
+		declarations.append(match.groupdict())
+	return declarations
+
+
+def _inputs(body):
+	"""Dict of name -> {'type', 'optional', 'default'} of an input block."""
+	inputs = {}
+	for decl in _declarations(body):
+		inputs[decl['name']] = {
+			'type': decl['type'].rstrip('?'),
+			'optional': decl['type'].endswith('?'),
+			'default': parse_literal(decl['expr']) if decl['expr'] else None,
+		}
+	return inputs
+
+
+def parse_wdl(wdl_text):
+	"""Parse a single-task WDL workflow.
+
+	Returns a dict with the workflow 'name', its 'inputs' (see _inputs),
+	'call' (the called 'task' and a dict of task input -> workflow input)
+	and 'outputs' (dict of workflow output -> task output), and the
+	called 'task' with its 'inputs', 'command', 'docker' image and
+	'outputs' (dict of name -> {'type', 'pattern', 'glob'}).
+	"""
+	# Commands are set aside so their braces and keywords are not parsed
+	commands = re.findall(r'\bcommand\s*<<<(.*?)>>>', wdl_text, re.DOTALL)
+	for i, command in enumerate(commands):
+		wdl_text = wdl_text.replace(f'<<<{command}>>>', f'<<<{i}>>>', 1)
+
+	workflows = _named_blocks(wdl_text, 'workflow')
+	if len(workflows) != 1:
+		raise WDLError(f'Expected one workflow, found {len(workflows)}')
+	wf_name, wf_body = next(iter(workflows.items()))
+
+	call_match = re.search(r'\bcall\s+(\w+)\s*\{', wf_body)
+	if call_match is None or len(re.findall(r'\bcall\s', wf_body)) != 1:
+		raise WDLError(f'Workflow {wf_name} must call exactly one task')
+	task_name = call_match.group(1)
+
+	call_inputs = {}
+	call_body = _block(wf_body[call_match.start():], 'call') or ''
+	for item in call_body.split('input:', 1)[-1].split(','):
+		item = _strip_comments(item)
+		if item:
+			task_input, wf_input = [s.strip() for s in item.split('=', 1)]
+			call_inputs[task_input] = wf_input
+
+	wf_outputs = {}
+	for decl in _declarations(_block(wf_body, 'output')):
+		called, _, task_output = decl['expr'].partition('.')
+		if called != task_name:
+			raise WDLError(f'Unsupported workflow output: {decl["expr"]}')
+		wf_outputs[decl['name']] = task_output
+
+	tasks = _named_blocks(wdl_text, 'task')
+	if task_name not in tasks:
+		raise WDLError(f'Task {task_name} not found')
+	task_body = tasks[task_name]
+
+	command_match = re.search(r'\bcommand\s*<<<(\d+)>>>', task_body)
+	if command_match is None:
+		raise WDLError(f'Task {task_name} has no command <<< >>> section')
+
+	docker_match = re.search(r'docker:\s*"([^"]+)"', _block(task_body, 'runtime') or '')
+
+	task_outputs = {}
+	for decl in _declarations(_block(task_body, 'output')):
+		glob_match = re.match(r'^glob\(\s*"([^"]+)"\s*\)$', decl['expr'])
+		task_outputs[decl['name']] = {
+			'type': decl['type'],
+			'pattern': glob_match.group(1) if glob_match else parse_literal(decl['expr']),
+			'glob': glob_match is not None,
+		}
+
+	return {
+		'name': wf_name,
+		'inputs': _inputs(_block(wf_body, 'input')),
+		'call': {'task': task_name, 'inputs': call_inputs},
+		'outputs': wf_outputs,
+		'task': {
+			'name': task_name,
+			'inputs': _inputs(_block(task_body, 'input')),
+			'command': textwrap.dedent(commands[int(command_match.group(1))]).strip('\n') + '\n',
+			'docker': docker_match.group(1) if docker_match else None,
+			'outputs': task_outputs,
+		},
+	}
+
+
+def load_wdl(wdl_file):
+	"""parse_wdl() of a WDL file."""
+	with open(wdl_file) as f:
+		return parse_wdl(f.read())
+
+
+def find_workflow_wdl(workflow_id, workflows_dir=WORKFLOWS_DIR):
+	"""WDL file of the launcher whose WORKFLOW_ID is workflow_id, or None."""
+	for entry in sorted(os.listdir(workflows_dir)):
+		launcher_file = os.path.join(workflows_dir, entry, 'launcher.py')
+		if not os.path.isfile(launcher_file):
+			continue
+		with open(launcher_file) as f:
+			match = WORKFLOW_ID_RE.search(f.read())
+		if match is None or match.group(1) != workflow_id:
+			continue
+		wdl_files = glob.glob(os.path.join(workflows_dir, entry, '*.wdl'))
+		if len(wdl_files) == 1:
+			return wdl_files[0]
+	return None
+
+
+def _link_id(value):
+	if isinstance(value, dict) and '$dnanexus_link' in value:
+		link = value['$dnanexus_link']
+		return link['id'] if isinstance(link, dict) else link
+	return value
+
+
+def task_inputs(wdl, workflow_input):
+	"""Dict of task input -> value, with File inputs as file IDs.
+
+	Args:
+		wdl: parse_wdl() output.
+		workflow_input: Workflow input dict as passed to workflow.run,
+			with or without the 'stage-common.' prefix.
+	"""
+	given = {
+		key[len(INPUT_PREFIX):] if key.startswith(INPUT_PREFIX) else key: value
+		for key, value in workflow_input.items()
+	}
+	unknown = set(given) - set(wdl['inputs'])
+	if unknown:
+		raise WDLError(f'Unknown inputs of {wdl["name"]}: {", ".join(sorted(unknown))}')
+
+	wf_values = {}
+	for name, spec in wdl['inputs'].items():
+		value = given.get(name, spec['default'])
+		if value is None and not spec['optional']:
+			raise WDLError(f'Missing required input {name} of {wdl["name"]}')
+		wf_values[name] = _link_id(value)
+
+	values = {}
+	for name, spec in wdl['task']['inputs'].items():
+		wf_name = wdl['call']['inputs'].get(name)
+		value = wf_values.get(wf_name) if wf_name is not None else None
+		values[name] = value if value is not None else spec['default']
+	return values
+
+
+def _format_value(value):
+	if value is None:
+		return ''
+	if isinstance(value, bool):
+		return 'true' if value else 'false'
+	return str(value)
+
+
+def run_task(
+	task,
+	values,
+	project_root,
+	input_paths,
+	folder,
+	work_dir,
+	use_docker=False,
+	home_dir=None
+):
+	"""Localize inputs, run a task command and copy its outputs to the project.
+
+	Runs in a process pool worker, so it only takes plain data. Returns a
+	dict of the task's 'outputs' (name -> project path or list of paths),
+	its 'returncode', 'runtime_seconds' and 'error' message, if any.
+
+	Args:
+		task: 'task' of parse_wdl() output.
+		values: Task input values, File inputs as file IDs.
+		project_root: Local project directory.
+		input_paths: Dict of file ID -> project path of the File inputs.
+		folder: Project folder the outputs are copied to.
+		work_dir: Working directory of the task.
+		use_docker: If True, run the command in the task's docker image.
+		home_dir: Directory /home/ paths are mapped to when not using
+			docker, or None to leave them.
+	"""
+	start = time.time()
+	inputs_dir = os.path.join(work_dir, 'inputs')
+	exec_dir = os.path.join(work_dir, 'execution')
+	os.makedirs(inputs_dir, exist_ok=True)
+	os.makedirs(exec_dir, exist_ok=True)
+
+	# Localize inputs into one directory, as tasks expect files of a
+	# fileset (e.g. .pgen, .psam, .pvar) to share a prefix
+	local = {}
+	for name, value in values.items():
+		if task['inputs'][name]['type'] != 'File' or value is None:
+			local[name] = _format_value(value)
+			continue
+		project_path = input_paths[value]
+		local_path = os.path.join(inputs_dir, os.path.basename(project_path))
+		if os.path.lexists(local_path):
+			local_path = os.path.join(inputs_dir, name, os.path.basename(project_path))
+			os.makedirs(os.path.dirname(local_path), exist_ok=True)
+		os.symlink(os.path.join(project_root, project_path.lstrip('/')), local_path)
+		local[name] = local_path
+
+	def substitute(match):
+		if match.group(1) not in local:
+			raise WDLError(f'Unknown placeholder ~{{{match.group(1)}}}')
+		return local[match.group(1)]
+
+	try:
+		command = PLACEHOLDER_RE.sub(substitute, task['command'])
+	except WDLError as e:
+		return {'outputs': {}, 'returncode': None, 'runtime_seconds': 0, 'error': str(e)}
+	if not use_docker and home_dir is not None:
+		command = HOME_PATH_RE.sub(home_dir.rstrip('/') + '/', command)
+	with open(os.path.join(work_dir, 'command.sh'), 'w') as f:
+		f.write(command)
+
+	if use_docker:
+		if task['docker'] is None:
+			raise WDLError(f'Task {task["name"]} has no docker image')
+		args = [
+			'docker', 'run', '--rm',
+			'-v', f'{project_root}:{project_root}:ro',
+			'-v', f'{work_dir}:{work_dir}',
+			'-w', exec_dir,
+			task['docker'],
+			'bash', os.path.join(work_dir, 'command.sh')
+		]
+	else:
+		args = ['bash', os.path.join(work_dir, 'command.sh')]
+
+	with open(os.path.join(exec_dir, 'stdout'), 'w') as stdout, \
+			open(os.path.join(exec_dir, 'stderr'), 'w') as stderr:
+		returncode = subprocess.run(args, cwd=exec_dir, stdout=stdout, stderr=stderr).returncode
+
+	result = {
+		'outputs': {},
+		'returncode': returncode,
+		'runtime_seconds': time.time() - start,
+		'error': None,
+	}
+	if returncode != 0:
+		result['error'] = f'Command exited with code {returncode}, see {exec_dir}/stderr'
+		return result
+
+	# Collect outputs and copy them into the output folder
+	out_dir = os.path.join(project_root, folder.strip('/'))
+	os.makedirs(out_dir, exist_ok=True)
+	for name, spec in task['outputs'].items():
+		if spec['glob']:
+			matches = sorted(glob.glob(os.path.join(exec_dir, spec['pattern'])))
+		else:
+			matches = [os.path.join(exec_dir, spec['pattern'])]
+			if not os.path.isfile(matches[0]):
+				result['error'] = f'Output {name} not found: {spec["pattern"]}'
+				return result
+
+		paths = []
+		for match in matches:
+			shutil.copyfile(match, os.path.join(out_dir, os.path.basename(match)))
+			paths.append('/' + folder.strip('/') + '/' + os.path.basename(match))
+		result['outputs'][name] = paths if spec['glob'] else paths[0]
+
+	result['runtime_seconds'] = time.time() - start
+	return result
+
+
+_executor = None
+
+
+def get_executor():
+	"""Shared process pool of NONLIN_PRS_LOCAL_WORKERS workers."""
+	global _executor
+	if _executor is None:
+		n_workers = int(os.environ.get(LOCAL_WORKERS_ENV, 0)) or os.cpu_count()
+		_executor = ProcessPoolExecutor(max_workers=n_workers)
+	return _executor
+
+
+def submit(dx, wdl_file, workflow_input, folder, analysis_id, on_done):
+	"""Run a workflow in the process pool and return its Future.
+
+	Args:
+		dx: LocalDxpy of the project.
+		wdl_file: WDL file of the workflow.
+		workflow_input: Workflow input dict as passed to workflow.run.
+		folder: Project folder the outputs are written to.
+		analysis_id: ID of the analysis, naming its working directory.
+		on_done: Called with the run_task() result dict, with 'outputs'
+			as workflow outputs of file IDs, when the task finishes.
+	"""
+	wdl = load_wdl(wdl_file)
+	values = task_inputs(wdl, workflow_input)
+	input_paths = {
+		value: dx._project_path(value)
+		for name, value in values.items()
+		if wdl['task']['inputs'][name]['type'] == 'File' and value is not None
+	}
+	work_dir = os.path.join(dx.root, '.local_dx', 'work', analysis_id)
+	home_dir = os.path.join(os.path.dirname(os.path.abspath(wdl_file)), 'docker')
+
+	future = get_executor().submit(
+		run_task,
+		wdl['task'],
+		values,
+		dx.root,
+		input_paths,
+		folder,
+		work_dir,
+		os.environ.get(LOCAL_DOCKER_ENV, '') not in ('', '0'),
+		home_dir if os.path.isdir(home_dir) else None
+	)
+
+	def callback(future):
+		try:
+			result = future.result()
+		except Exception as e:
+			result = {'outputs': {}, 'returncode': None, 'runtime_seconds': None, 'error': repr(e)}
+
+		# Workflow outputs as file IDs of the copied task outputs
+		outputs = {}
+		if result['error'] is None:
+			for wf_output, task_output in wdl['outputs'].items():
+				paths = result['outputs'][task_output]
+				if isinstance(paths, list):
+					outputs[wf_output] = [dx._register(p) for p in paths]
+				else:
+					outputs[wf_output] = dx._register(paths)
+		result['outputs'] = outputs
+		result['work_dir'] = work_dir
+		on_done(result)
+
+	future.add_done_callback(callback)
+	return future
+
+
+def run_workflow(wdl_file, workflow_input, folder, name=None, dx=None):
+	"""Run a workflow locally and wait for it. Returns its analysis.
+
+	Args:
+		wdl_file: WDL file of the workflow.
+		workflow_input: Dict of input name -> value, File inputs as
+			dxlinks, file IDs or project paths.
+		folder: Project folder the outputs are written to.
+		name: Analysis name. Default: the workflow name.
+		dx: LocalDxpy. Default: local_dx.get_dxpy().
+	"""
+	dx = dx if dx is not None else get_dxpy()
+	wdl = load_wdl(wdl_file)
+
+	# Project paths of File inputs are resolved to file IDs
+	workflow_input = dict(workflow_input)
+	for key, value in workflow_input.items():
+		input_name = key[len(INPUT_PREFIX):] if key.startswith(INPUT_PREFIX) else key
+		spec = wdl['inputs'].get(input_name)
+		if (
+			spec is not None and spec['type'] == 'File'
+			and isinstance(value, str) and value.startswith('/')
+		):
+			workflow_input[key] = dx._register(value)
+
+	workflow = LocalDXWorkflow(dx, f'workflow-local-{wdl["name"]}', wdl_file=wdl_file)
+	analysis = workflow.run(workflow_input, folder=folder, name=name or wdl['name'])
+	analysis.wait_on_done()
+	return analysis
+
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	with open(args.inputs) as f:
+		workflow_input = json.load(f)
+
+	analysis = run_workflow(
+		os.path.abspath(args.wdl_file),
+		workflow_input,
+		args.folder,
+		name=args.name
+	)
+	desc = analysis.describe()
+	print(json.dumps(
+		{k: desc[k] for k in ['id', 'state', 'folder', 'output', 'runtime_seconds']},
+		indent=4
+	))
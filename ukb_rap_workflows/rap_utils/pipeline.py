@@ -0,0 +1,546 @@
+"""Run the PRS workflows of each phenotype as one dependency graph.
+
+The stages of a phenotype and training population form a DAG:
+
+	gwas_plink2 -> prs_prsice2 -> prs_aml_filter_vars_clumps -> prs_aml
+	gwas_plink2 -> prs_aml_filter_vars (max{N}{desc} data versions) -> prs_aml
+	prs_basil -> prs_aml_filter_vars_basil -> prs_aml
+	prs_prsice2, prs_basil, prs_aml -> prs_score_preds
+
+Each stage is a run of its launcher, as in sweep.py, and is known to be
+complete when the files later stages read exist in its output folder.
+Stages whose outputs already exist are skipped, so an interrupted
+pipeline resumes where it stopped. A stage is launched as soon as the
+stages it depends on are done, so independent branches (BASIL alongside
+GWAS and PRSice, white British alongside all samples, every phenotype)
+run concurrently, up to --max-in-flight analyses at once. When more
+stages are ready than there are free slots, those heading the longest
+chains of dependent stages are launched first. When a stage fails, the
+stages depending on it are not launched and the rest of the graph
+carries on.
+
+After the run, a report of when each stage was ready, launched and done
+is printed and written to --report, with the critical path: the chain of
+stages, each waiting on the one before it, that ended last. The wall
+time of the pipeline is the length of that chain, plus any time its
+stages waited for a free in-flight slot.
+
+Output folders follow the launchers' defaults, which the pipeline's
+output roots must match.
+
+Example usage:
+```
+python pipeline.py --phenos standing_height_50 --populations all wb \\
+	--automl clumps:lgbm_v0h24_clumps basil_lasso:lgbm_v0h24_basil \\
+	--report pipeline_report.json
+```
+
+Args:
+
+* --phenos: Phenotypes to run, or 'all' for every phenotype in
+	--pheno-metadata-file. Default: 'all'.
+* --pheno-metadata-file: Phenotype metadata JSON. Default:
+	'../../data/pheno_metadata.json' relative to this module.
+* --populations: Populations to run, 'all' and/or 'wb'. Default: 'all'.
+* --basil-models: BASIL model types to fit. Default: 'lasso'.
+* --automl: AutoML models to fit as '{data version}:{model config}'.
+	The data version picks the variant filtering stage: 'clumps',
+	'basil_{model type}' or 'max{N}{desc}' (e.g. 'max30000_v2', which
+	runs prs_aml_filter_vars -m 30000 -d _v2). Default: none.
+* --no-score: Flag to leave out scoring with prs_score_preds.
+* --force: Flag to launch stages even if their outputs exist.
+* --max-submitting: Number of launches submitted at once. Default: 4.
+* --max-in-flight: Maximum number of running analyses. Default: 20.
+* --max-retries: Retries of a launch after transient errors. Default: 4.
+* --poll-seconds: Seconds between analysis state checks. Default: 60.
+* --report: JSON file the timing report is written to. Default: none.
+* --dry-run: Print the stages and their dependencies.
+"""
+
+import argparse
+import json
+import re
+import shlex
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+if __package__:
+	from .dx_resolve import PathResolver
+	from .local_dx import get_dxpy
+	from .sweep import (
+		DEFAULT_PHENO_METADATA, TERMINAL_STATES, LaunchError, launch_with_retry
+	)
+else:
+	from dx_resolve import PathResolver
+	from local_dx import get_dxpy
+	from sweep import (
+		DEFAULT_PHENO_METADATA, TERMINAL_STATES, LaunchError, launch_with_retry
+	)
+
+
+GWAS_DIR = '/rdevito/nonlin_prs/gwas/gwas_output'
+PRSICE_DIR = '/rdevito/nonlin_prs/sum_stats_prs/PRSice2/prsice2_output'
+BASIL_DIR = '/rdevito/nonlin_prs/batch_iterative_prs/output'
+PREPRO_DIR = '/rdevito/nonlin_prs/automl_prs/prepro_data'
+AUTOML_DIR = '/rdevito/nonlin_prs/automl_prs/output'
+
+PREDS_FILES = ['val_preds.csv', 'test_preds.csv']
+FILTERED_VARS_FILES = ['filtered_vars.parquet', 'filtered_vars.json']
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument('--phenos', nargs='+', default=['all'])
+	parser.add_argument('--pheno-metadata-file', default=DEFAULT_PHENO_METADATA)
+	parser.add_argument(
+		'--populations',
+		nargs='+',
+		choices=['all', 'wb'],
+		default=['all']
+	)
+	parser.add_argument('--basil-models', nargs='+', default=['lasso'])
+	parser.add_argument('--automl', nargs='+', default=[])
+	parser.add_argument('--no-score', action='store_true')
+	parser.add_argument('--force', action='store_true')
+	parser.add_argument('--max-submitting', type=int, default=4)
+	parser.add_argument('--max-in-flight', type=int, default=20)
+	parser.add_argument('--max-retries', type=int, default=4)
+	parser.add_argument('--poll-seconds', type=float, default=60)
+	parser.add_argument('--report', default=None)
+	parser.add_argument('--dry-run', action='store_true')
+
+	return parser.parse_args()
+
+
+def stage(name, workflow, args, output_dir, output_files, deps=()):
+	"""Dict describing one launch of the pipeline.
+
+	Args:
+		name: Unique stage name.
+		workflow: Launcher directory name.
+		args: Launcher arguments.
+		output_dir: Output folder of the launch.
+		output_files: Names of the files in output_dir that later stages
+			read, which exist once the stage is done.
+		deps: Names of the stages this stage depends on.
+	"""
+	return {
+		'name': name,
+		'workflow': workflow,
+		'args': list(args),
+		'key': name,
+		'outputs': [f'{output_dir}/{f}' for f in output_files],
+		'deps': list(deps),
+	}
+
+
+def build_stages(phenos, populations, basil_models=('lasso',), automl=(), score=True):
+	"""Dict of stage name -> stage() of the pipeline.
+
+	Args:
+		phenos: Phenotype names.
+		populations: 'all' and/or 'wb'.
+		basil_models: BASIL model types, e.g. 'lasso'.
+		automl: List of (data version, model config) of AutoML models.
+		score: If True, add a prs_score_preds stage for every model.
+	"""
+	stages = {}
+
+	def add(s):
+		stages[s['name']] = s
+		return s['name']
+
+	for pheno in phenos:
+		for population in populations:
+			wb = population == 'wb'
+			suffix = '_wb' if wb else ''
+			wb_flag = ['--wb'] if wb else []
+			desc = f'{pheno}{suffix}'
+			models = {}
+
+			gwas = add(stage(
+				f'gwas:{desc}', 'gwas_plink2', ['-p', pheno] + wb_flag,
+				f'{GWAS_DIR}/{pheno}_glm{suffix}',
+				[f'gwas_plink2.{pheno}.glm.linear']
+			))
+
+			prsice = add(stage(
+				f'prsice:{desc}', 'prs_prsice2', ['-p', pheno] + wb_flag,
+				f'{PRSICE_DIR}/{desc}',
+				PREDS_FILES + ['prs_prsice2_clump.clumps', 'prsice2_best_p_thresh.txt'],
+				deps=[gwas]
+			))
+			models['prsice'] = prsice
+
+			basil = {}
+			for model in basil_models:
+				basil[model] = add(stage(
+					f'basil_{model}:{desc}', 'prs_basil',
+					['-p', pheno, '-m', model] + wb_flag,
+					f'{BASIL_DIR}/{desc}_{model}',
+					PREDS_FILES + ['included_features.csv']
+				))
+				models[f'basil_{model}'] = basil[model]
+
+			filters = {}
+			for data_version, model_config in automl:
+				if data_version not in filters:
+					filters[data_version] = add(filter_stage(
+						pheno, wb, data_version, gwas, prsice, basil
+					))
+				models[f'automl_{data_version}_{model_config}'] = add(stage(
+					f'automl_{data_version}_{model_config}:{desc}', 'prs_aml',
+					['-p', pheno, '-d', data_version, '-m', model_config] + wb_flag,
+					f'{AUTOML_DIR}/{desc}_{data_version}_{model_config}',
+					PREDS_FILES,
+					deps=[filters[data_version]]
+				))
+
+			if score:
+				for model_type, model_stage in models.items():
+					output_dir = stages[model_stage]['outputs'][0].rsplit('/', 1)[0]
+					add(stage(
+						f'score_{model_type}:{desc}', 'prs_score_preds',
+						['-m', model_type, '-p', pheno] + wb_flag,
+						output_dir,
+						['scores.json'],
+						deps=[model_stage]
+					))
+
+	return stages
+
+
+def filter_stage(pheno, wb, data_version, gwas, prsice, basil):
+	"""Variant filtering stage() producing an AutoML data version."""
+	suffix = '_wb' if wb else ''
+	wb_flag = ['--wb'] if wb else []
+	desc = f'{pheno}{suffix}'
+	output_dir = f'{PREPRO_DIR}/{desc}_{data_version}'
+	name = f'filter_{data_version}:{desc}'
+
+	if data_version == 'clumps':
+		return stage(
+			name, 'prs_aml_filter_vars_clumps', ['-p', pheno] + wb_flag,
+			output_dir, FILTERED_VARS_FILES, deps=[prsice]
+		)
+
+	if data_version.startswith('basil_'):
+		model = data_version[len('basil_'):]
+		if model not in basil:
+			raise ValueError(
+				f'Data version {data_version} needs BASIL model {model} in '
+				'--basil-models'
+			)
+		return stage(
+			name, 'prs_aml_filter_vars_basil',
+			['-p', pheno, '--basil-desc', model] + wb_flag,
+			output_dir, FILTERED_VARS_FILES, deps=[basil[model]]
+		)
+
+	match = re.match(r'^max(\d+)(.*)$', data_version)
+	if match is None:
+		raise ValueError(f'Unknown data version: {data_version}')
+	max_variants, out_desc = match.groups()
+	launch_args = ['-p', pheno, '-m', max_variants] + wb_flag
+	if out_desc:
+		launch_args += ['-d', out_desc]
+	return stage(
+		name, 'prs_aml_filter_vars', launch_args,
+		output_dir, FILTERED_VARS_FILES, deps=[gwas]
+	)
+
+
+def topological_order(stages):
+	"""Stage names with every stage after the stages it depends on."""
+	order = []
+	visited = set()
+
+	def visit(name, path=()):
+		if name in path:
+			raise ValueError(f'Dependency cycle: {" -> ".join(path + (name,))}')
+		if name in visited:
+			return
+		for dep in stages[name]['deps']:
+			visit(dep, path + (name,))
+		visited.add(name)
+		order.append(name)
+
+	for name in stages:
+		visit(name)
+	return order
+
+
+def chain_lengths(stages):
+	"""Dict of stage name -> number of stages in its longest chain of dependents."""
+	dependents = {name: [] for name in stages}
+	for name, s in stages.items():
+		for dep in s['deps']:
+			dependents[dep].append(name)
+
+	lengths = {}
+	for name in reversed(topological_order(stages)):
+		lengths[name] = 1 + max((lengths[d] for d in dependents[name]), default=0)
+	return lengths
+
+
+def critical_path(stages, timings):
+	"""Stage names of the chain of this run's stages that ended last.
+
+	Each stage on the path is preceded by the dependency that finished
+	last, i.e. the one it waited for.
+	"""
+	finished = {
+		name: t for name, t in timings.items() if t.get('done') is not None
+	}
+	if not finished:
+		return []
+
+	path = [max(finished, key=lambda n: finished[n]['done'])]
+	while True:
+		deps = [d for d in stages[path[-1]]['deps'] if d in finished]
+		if not deps:
+			break
+		path.append(max(deps, key=lambda d: finished[d]['done']))
+	return path[::-1]
+
+
+def timing_report(stages, timings, start_time, end_time):
+	"""Dict of per-stage timings and the critical path of a run."""
+	rel = lambda t: None if t is None else round(t - start_time, 1)
+
+	report_stages = {}
+	for name, t in timings.items():
+		report_stages[name] = {
+			'state': t['state'],
+			'analysis_ids': t.get('analysis_ids'),
+			'ready_seconds': rel(t.get('ready')),
+			'launched_seconds': rel(t.get('launched')),
+			'done_seconds': rel(t.get('done')),
+			'run_seconds': (
+				round(t['done'] - t['launched'], 1)
+				if t.get('done') is not None and t.get('launched') is not None
+				else None
+			),
+			'queued_seconds': (
+				round(t['launched'] - t['ready'], 1)
+				if t.get('launched') is not None and t.get('ready') is not None
+				else None
+			),
+		}
+
+	path = critical_path(stages, timings)
+	return {
+		'wall_seconds': round(end_time - start_time, 1),
+		'critical_path': path,
+		'critical_path_run_seconds': round(
+			sum(report_stages[n]['run_seconds'] or 0 for n in path), 1
+		),
+		'critical_path_queued_seconds': round(
+			sum(report_stages[n]['queued_seconds'] or 0 for n in path), 1
+		),
+		'stages': report_stages,
+	}
+
+
+def print_report(report):
+	print('\nStage timings (seconds since start):')
+	print(f'{"stage":<60} {"state":<10} {"ready":>8} {"launched":>9} {"done":>8} {"run":>8}')
+	for name, s in sorted(
+		report['stages'].items(),
+		key=lambda item: (item[1]['done_seconds'] is None, item[1]['done_seconds'] or 0)
+	):
+		cols = [s['ready_seconds'], s['launched_seconds'], s['done_seconds'], s['run_seconds']]
+		cols = ['-' if c is None else c for c in cols]
+		print(f'{name:<60} {s["state"]:<10} {cols[0]:>8} {cols[1]:>9} {cols[2]:>8} {cols[3]:>8}')
+
+	print(f'\nWall time: {report["wall_seconds"]} seconds')
+	print(
+		f'Critical path ({report["critical_path_run_seconds"]} seconds running, '
+		f'{report["critical_path_queued_seconds"]} seconds queued):'
+	)
+	for name in report['critical_path']:
+		print(f'\t{name}')
+
+
+def run_pipeline(
+	stages,
+	dx,
+	max_submitting=4,
+	max_in_flight=20,
+	max_retries=4,
+	poll_seconds=60,
+	force=False,
+	launch=launch_with_retry
+):
+	"""Launch every stage once the stages it depends on are done.
+
+	Returns the timing_report() of the run.
+
+	Args:
+		stages: Dict of stage name -> stage().
+		dx: dxpy module or stand-in.
+		max_submitting: Number of launches submitted at once.
+		max_in_flight: Maximum number of launching stages plus running
+			analyses.
+		max_retries: Retries of a launch after transient errors.
+		poll_seconds: Seconds between analysis state checks.
+		force: If True, launch stages even if their outputs exist.
+		launch: Called with a stage and max_retries, returns (analysis
+			IDs, attempts). Default: sweep.launch_with_retry.
+	"""
+	# Stages heading the longest chains are launched first
+	lengths = chain_lengths(stages)
+	order = sorted(topological_order(stages), key=lambda n: -lengths[n])
+	resolver = PathResolver(dx=dx, cache_file=None)
+	start_time = time.time()
+	timings = {name: {'state': 'pending'} for name in order}
+
+	def outputs_exist(names):
+		paths = [p for n in names for p in stages[n]['outputs']]
+		found = resolver.resolve(paths, refresh=True, missing_ok=True)
+		return {
+			n: all(found[p] is not None for p in stages[n]['outputs'])
+			for n in names
+		}
+
+	# Stages whose outputs exist are already done
+	if not force:
+		for name, exists in outputs_exist(order).items():
+			if exists:
+				timings[name]['state'] = 'existing'
+	n_existing = sum(t['state'] == 'existing' for t in timings.values())
+	print(
+		f'{len(order)} stages, {n_existing} already done, '
+		f'{len(order) - n_existing} to run',
+		flush=True
+	)
+
+	def is_done(name):
+		return timings[name]['state'] in ('done', 'existing')
+
+	def block_dependents(failed):
+		for name in order:
+			t = timings[name]
+			if t['state'] == 'pending' and failed in stages[name]['deps']:
+				t['state'] = 'blocked'
+				print(f'Not launching {name}: {failed} did not complete', flush=True)
+				block_dependents(name)
+
+	launching = {}
+	running = {}
+
+	with ThreadPoolExecutor(max_workers=max_submitting) as executor:
+		while True:
+			now = time.time()
+
+			# Launch stages whose dependencies are done, longest chains first
+			for name in order:
+				t = timings[name]
+				if t['state'] != 'pending':
+					continue
+				if not all(is_done(d) for d in stages[name]['deps']):
+					continue
+				t.setdefault('ready', now)
+				n_in_flight = len(launching) + sum(len(ids) for ids in running.values())
+				if n_in_flight >= max_in_flight:
+					continue
+				t['state'] = 'launching'
+				t['launched'] = now
+				print(f'Launching {name}: {shlex.join(stages[name]["args"])}', flush=True)
+				launching[name] = executor.submit(launch, stages[name], max_retries)
+
+			# Collect finished launches
+			for name, future in list(launching.items()):
+				if not future.done():
+					continue
+				del launching[name]
+				try:
+					timings[name]['analysis_ids'], _ = future.result()
+					timings[name]['state'] = 'running'
+					running[name] = timings[name]['analysis_ids']
+				except LaunchError as e:
+					timings[name]['state'] = 'failed'
+					timings[name]['error'] = str(e)[-2000:]
+					print(f'Failed to launch {name}:\n{e}', flush=True)
+					block_dependents(name)
+
+			# Check running analyses
+			changed = False
+			for name, analysis_ids in list(running.items()):
+				# A stage that started several analyses ends with the last
+				states = [
+					dx.DXAnalysis(analysis_id).describe()['state']
+					for analysis_id in analysis_ids
+				]
+				if not all(s in TERMINAL_STATES for s in states):
+					continue
+				state = next((s for s in states if s != 'done'), 'done')
+				if state == 'done' and not outputs_exist([name])[name]:
+					state = 'missing_outputs'
+				del running[name]
+				changed = True
+				timings[name]['done'] = time.time()
+				if state == 'done':
+					timings[name]['state'] = 'done'
+					print(f'Done {name} ({", ".join(analysis_ids)})', flush=True)
+				else:
+					timings[name]['state'] = 'failed'
+					print(f'{name} ({", ".join(analysis_ids)}) ended as {state}', flush=True)
+					block_dependents(name)
+
+			if not launching and not running:
+				if not any(
+					t['state'] == 'pending'
+					and all(is_done(d) for d in stages[n]['deps'])
+					for n, t in timings.items()
+				):
+					break
+			if not changed:
+				time.sleep(poll_seconds if running and not launching else min(poll_seconds, 1))
+
+	return timing_report(stages, timings, start_time, time.time())
+
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	if args.phenos == ['all']:
+		with open(args.pheno_metadata_file) as f:
+			phenos = list(json.load(f))
+	else:
+		phenos = args.phenos
+
+	stages = build_stages(
+		phenos,
+		args.populations,
+		basil_models=args.basil_models,
+		automl=[tuple(a.split(':', 1)) for a in args.automl],
+		score=not args.no_score
+	)
+
+	if args.dry_run:
+		for name in topological_order(stages):
+			s = stages[name]
+			deps = ', '.join(s['deps']) or '-'
+			print(f'{name}\t{s["workflow"]} {shlex.join(s["args"])}\t<- {deps}')
+		sys.exit(0)
+
+	report = run_pipeline(
+		stages,
+		get_dxpy(),
+		max_submitting=args.max_submitting,
+		max_in_flight=args.max_in_flight,
+		max_retries=args.max_retries,
+		poll_seconds=args.poll_seconds,
+		force=args.force
+	)
+	print_report(report)
+
+	if args.report is not None:
+		with open(args.report, 'w') as f:
+			json.dump(report, f, indent=4)
+
+	if any(s['state'] in ('failed', 'blocked') for s in report['stages'].values()):
+		sys.exit(1)
@@ -0,0 +1,515 @@
+"""Size instances and time budgets for UKB RAP workflows from data size.
+
+Each workflow has a cost model in terms of its number of samples n and
+variants m:
+
+	peak memory (GB) = mem_base_gb
+		+ mem_bytes_per_cell * n * m / 2^30
+		+ mem_bytes_per_variant_pair * m^2 / 2^30
+	runtime (s) = time_base_s
+		+ time_per_cell_core_s * n * m / cores
+		+ time_per_cell_s * n * m
+
+e.g. prs_aml holds the dense genotype matrix (8 bytes per cell as
+float64, plus copies) and, for linear models, X'X (8 bytes per variant
+pair). plan() picks the smallest instance, by cores then memory, with
+at least the workflow's min_cores and enough memory, and predicts the
+runtime on it. For prs_aml the predicted runtime, rounded up to the
+hour and clipped to [min_budget_s, max_budget_s], is the planned AutoML
+time budget. Launchers only use it in place of a model config's budget
+when the runtime coefficients are calibrated, as the planned budget
+changes what a model trains. Likewise, plan_instance() only gives the
+planned instance type when they are calibrated, and the launcher's
+default instance type otherwise.
+
+The default coefficients are rough and should be recalibrated from past
+runs. calibrate() fits the runtime coefficients by non-negative least
+squares to runtime.json files ('runtime_seconds') of runs with known
+dimensions, and the memory coefficients too if the runtime.json files
+have a 'peak_mem_gb' key, as those written by telemetry.py do. Fitted
+coefficients are saved to resource_coeffs.json next to this module and
+used in place of the defaults.
+
+Dimensions are read from the same files the workflows use. Local paths
+are read directly and other paths are read from the UKB RAP project,
+found with dx_resolve.
+
+Run as a script to plan or calibrate:
+
+	python resources.py plan -w prs_aml --n-samples 330000 --n-variants 80000
+	python resources.py calibrate -w prs_aml --runs runs.csv
+
+where runs.csv has columns runtime_json, n_samples, n_variants and
+instance_type.
+
+Args:
+
+* command: 'plan' or 'calibrate'.
+* -w, --workflow: Workflow name, one of WORKFLOW_MODELS.
+* --n-samples: Number of samples (plan).
+* --n-variants: Number of variants (plan).
+* --runs: CSV file of past runs (calibrate).
+* --coeffs-file: Coefficients JSON file to read and, for calibrate,
+	update. Default: resource_coeffs.json next to this module.
+"""
+
+import argparse
+import copy
+import json
+import math
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+from scipy import optimize
+
+if __package__:
+	from . import dx_resolve
+else:
+	import dx_resolve
+
+
+# (cores, memory GB) of UKB RAP instance types
+INSTANCE_TYPES = {
+	'mem1_ssd1_v2_x2': (2, 4),
+	'mem1_ssd1_v2_x4': (4, 8),
+	'mem1_ssd1_v2_x8': (8, 16),
+	'mem1_ssd1_v2_x16': (16, 32),
+	'mem1_ssd1_v2_x36': (36, 72),
+	'mem1_ssd1_v2_x72': (72, 144),
+	'mem2_ssd1_v2_x2': (2, 8),
+	'mem2_ssd1_v2_x4': (4, 16),
+	'mem2_ssd1_v2_x8': (8, 32),
+	'mem2_ssd1_v2_x16': (16, 64),
+	'mem2_ssd1_v2_x32': (32, 128),
+	'mem2_ssd1_v2_x48': (48, 192),
+	'mem2_ssd1_v2_x64': (64, 256),
+	'mem2_ssd1_v2_x96': (96, 384),
+	'mem3_ssd1_v2_x2': (2, 16),
+	'mem3_ssd1_v2_x4': (4, 32),
+	'mem3_ssd1_v2_x8': (8, 64),
+	'mem3_ssd1_v2_x16': (16, 128),
+	'mem3_ssd1_v2_x32': (32, 256),
+	'mem3_ssd1_v2_x48': (48, 384),
+	'mem3_ssd1_v2_x64': (64, 512),
+	'mem3_ssd1_v2_x96': (96, 768),
+}
+
+# Fraction of an instance's memory a task can use
+MEM_HEADROOM = 0.9
+
+# Cost model coefficients of each workflow
+WORKFLOW_MODELS = {
+	'gwas_plink2': {
+		'min_cores': 64,
+		'mem_base_gb': 16,
+		'mem_bytes_per_cell': 0.25,
+		'mem_bytes_per_variant_pair': 0,
+		'time_base_s': 600,
+		'time_per_cell_core_s': 1.2e-6,
+		'time_per_cell_s': 0,
+	},
+	# One shard of a scattered gwas_plink2 run (see gwas_plink2/scatter.py).
+	# Shards are small enough for fewer cores, so only the core minimum
+	# differs; calibrate it from the shards' own runtime.json files.
+	'gwas_plink2_shard': {
+		'min_cores': 8,
+		'mem_base_gb': 16,
+		'mem_bytes_per_cell': 0.25,
+		'mem_bytes_per_variant_pair': 0,
+		'time_base_s': 600,
+		'time_per_cell_core_s': 1.2e-6,
+		'time_per_cell_s': 0,
+	},
+	'prs_prsice2': {
+		'min_cores': 32,
+		'mem_base_gb': 8,
+		'mem_bytes_per_cell': 0.5,
+		'mem_bytes_per_variant_pair': 0,
+		'time_base_s': 600,
+		'time_per_cell_core_s': 2e-6,
+		'time_per_cell_s': 0,
+	},
+	'prs_basil': {
+		'min_cores': 32,
+		'mem_base_gb': 16,
+		'mem_bytes_per_cell': 2,
+		'mem_bytes_per_variant_pair': 0,
+		'time_base_s': 1800,
+		'time_per_cell_core_s': 1e-5,
+		'time_per_cell_s': 0,
+	},
+	'prs_aml_filter_vars': {
+		'min_cores': 8,
+		'mem_base_gb': 8,
+		'mem_bytes_per_cell': 16,
+		'mem_bytes_per_variant_pair': 0,
+		'time_base_s': 600,
+		'time_per_cell_core_s': 0,
+		'time_per_cell_s': 1e-7,
+	},
+	'prs_aml': {
+		'min_cores': 32,
+		'mem_base_gb': 8,
+		'mem_bytes_per_cell': 12,
+		'mem_bytes_per_variant_pair': 8,
+		'time_base_s': 1800,
+		'time_per_cell_core_s': 2.1e-4,
+		'time_per_cell_s': 0,
+		'min_budget_s': 3600,
+		'max_budget_s': 86400,
+	},
+	'prs_score_preds': {
+		'min_cores': 2,
+		'mem_base_gb': 2,
+		'mem_bytes_per_cell': 64,
+		'mem_bytes_per_variant_pair': 0,
+		'time_base_s': 120,
+		'time_per_cell_core_s': 0,
+		'time_per_cell_s': 1e-5,
+	},
+}
+
+MEM_COEFS = ['mem_base_gb', 'mem_bytes_per_cell', 'mem_bytes_per_variant_pair']
+TIME_COEFS = ['time_base_s', 'time_per_cell_core_s', 'time_per_cell_s']
+
+DEFAULT_COEFFS_FILE = os.path.join(
+	os.path.dirname(os.path.abspath(__file__)), 'resource_coeffs.json'
+)
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument("command", choices=['plan', 'calibrate'])
+	parser.add_argument(
+		"-w", "--workflow", required=True, choices=list(WORKFLOW_MODELS)
+	)
+	parser.add_argument("--n-samples", type=int)
+	parser.add_argument("--n-variants", type=int, default=0)
+	parser.add_argument("--runs")
+	parser.add_argument("--coeffs-file", default=DEFAULT_COEFFS_FILE)
+
+	return parser.parse_args()
+
+
+def load_calibrated(coeffs_file=DEFAULT_COEFFS_FILE):
+	"""Dict of workflow -> calibrated coefficients, empty if there are none."""
+	if coeffs_file is None or not os.path.exists(coeffs_file):
+		return {}
+	with open(coeffs_file) as f:
+		return json.load(f)
+
+
+def load_models(coeffs_file=DEFAULT_COEFFS_FILE):
+	"""WORKFLOW_MODELS updated with calibrated coefficients, if any."""
+	models = copy.deepcopy(WORKFLOW_MODELS)
+	for workflow, coefs in load_calibrated(coeffs_file).items():
+		models.setdefault(workflow, {}).update(coefs)
+	return models
+
+
+def _features(n_samples, n_variants, n_cores):
+	"""Memory and runtime model features of runs."""
+	n_samples = np.asarray(n_samples, dtype=float)
+	n_variants = np.asarray(n_variants, dtype=float)
+	n_cores = np.asarray(n_cores, dtype=float)
+	# Workflows with no variant dimension scale with samples only
+	cells = n_samples * np.maximum(n_variants, 1)
+
+	mem_x = np.stack([
+		np.ones_like(cells), cells / 2 ** 30, n_variants ** 2 / 2 ** 30
+	], axis=-1)
+	time_x = np.stack([np.ones_like(cells), cells / n_cores, cells], axis=-1)
+	return mem_x, time_x
+
+
+def estimate(model, n_samples, n_variants, n_cores):
+	"""Predicted (peak memory GB, runtime seconds) of a run.
+
+	Args:
+		model: Cost model dict from WORKFLOW_MODELS.
+		n_samples: Number of samples.
+		n_variants: Number of variants, 0 if not applicable.
+		n_cores: Number of cores of the instance.
+	"""
+	mem_x, time_x = _features(n_samples, n_variants, n_cores)
+	mem_gb = mem_x @ np.array([model[c] for c in MEM_COEFS])
+	runtime_s = time_x @ np.array([model[c] for c in TIME_COEFS])
+	return float(mem_gb), float(runtime_s)
+
+
+def pick_instance(mem_gb, min_cores=1):
+	"""Smallest instance type, by cores then memory, that fits a run."""
+	candidates = sorted(
+		(cores, mem, name) for name, (cores, mem) in INSTANCE_TYPES.items()
+		if cores >= min_cores and mem * MEM_HEADROOM >= mem_gb
+	)
+	if not candidates:
+		raise ValueError(
+			f'No instance type has {mem_gb:.0f} GB usable memory and '
+			f'{min_cores} cores'
+		)
+	return candidates[0][2]
+
+
+def plan(workflow, n_samples, n_variants=0, coeffs_file=DEFAULT_COEFFS_FILE):
+	"""Instance type and predicted resources for a workflow run.
+
+	Returns a dict with 'instance_type', 'n_cores', 'mem_gb' (of the
+	instance), 'est_mem_gb', 'est_runtime_seconds', 'calibrated'
+	(whether the runtime coefficients were fit to past runs) and, for
+	workflows with budget bounds, 'time_budget_seconds'.
+
+	Args:
+		workflow: Workflow name, a key of WORKFLOW_MODELS.
+		n_samples: Number of samples.
+		n_variants: Number of variants, 0 if not applicable.
+		coeffs_file: Calibrated coefficients file, or None for defaults.
+	"""
+	model = load_models(coeffs_file)[workflow]
+	calibrated_coefs = load_calibrated(coeffs_file).get(workflow, {})
+
+	est_mem_gb, _ = estimate(model, n_samples, n_variants, 1)
+	instance_type = pick_instance(est_mem_gb, model['min_cores'])
+	n_cores, mem_gb = INSTANCE_TYPES[instance_type]
+	_, est_runtime_s = estimate(model, n_samples, n_variants, n_cores)
+
+	resource_plan = {
+		'workflow': workflow,
+		'n_samples': int(n_samples),
+		'n_variants': int(n_variants),
+		'instance_type': instance_type,
+		'n_cores': n_cores,
+		'mem_gb': mem_gb,
+		'est_mem_gb': round(est_mem_gb, 1),
+		'est_runtime_seconds': int(math.ceil(est_runtime_s)),
+		'calibrated': any(c in calibrated_coefs for c in TIME_COEFS),
+	}
+	if 'max_budget_s' in model:
+		budget = 3600 * math.ceil(est_runtime_s / 3600)
+		resource_plan['time_budget_seconds'] = int(min(
+			max(budget, model['min_budget_s']), model['max_budget_s']
+		))
+	return resource_plan
+
+
+def print_plan(resource_plan):
+	"""Print a plan from plan()."""
+	print(
+		f'Planned {resource_plan["instance_type"]} for '
+		f'{resource_plan["n_samples"]} samples x '
+		f'{resource_plan["n_variants"]} variants: '
+		f'~{resource_plan["est_mem_gb"]} GB peak memory, '
+		f'~{resource_plan["est_runtime_seconds"] / 3600:.1f} h runtime',
+		flush=True
+	)
+	if 'time_budget_seconds' in resource_plan:
+		print(
+			f'Planned time budget: {resource_plan["time_budget_seconds"]} seconds'
+			+ ('' if resource_plan['calibrated'] else ' (uncalibrated)'),
+			flush=True
+		)
+
+
+def plan_instance(
+	workflow,
+	n_samples,
+	n_variants=0,
+	default=None,
+	coeffs_file=DEFAULT_COEFFS_FILE,
+	verbose=True
+):
+	"""(instance type, plan) of a launch without an instance override.
+
+	The planned instance type is only used if the workflow's runtime
+	coefficients are calibrated, otherwise default is, as the default
+	coefficients are too rough to change the instance a workflow was
+	tuned on. If no instance type fits the estimate, default is used
+	and the plan is None.
+
+	Args:
+		workflow: Workflow name, a key of WORKFLOW_MODELS.
+		n_samples: Number of samples.
+		n_variants: Number of variants, 0 if not applicable.
+		default: Launcher's default instance type.
+		coeffs_file: Calibrated coefficients file, or None for defaults.
+		verbose: If True, print the plan and the instance type used.
+	"""
+	try:
+		resource_plan = plan(workflow, n_samples, n_variants, coeffs_file)
+	except ValueError as e:
+		print(f'{e}, using {default}', flush=True)
+		return default, None
+
+	if verbose:
+		print_plan(resource_plan)
+	if resource_plan['calibrated']:
+		return resource_plan['instance_type'], resource_plan
+	if verbose:
+		print(f'Uncalibrated plan, using {default}', flush=True)
+	return default, resource_plan
+
+
+def calibrate(runs, model):
+	"""Refit a workflow's cost model coefficients to past runs.
+
+	Returns the fitted coefficients as a dict. Runtime coefficients are
+	always fit, memory coefficients only if runs has a peak_mem_gb
+	column with at least as many non-null values as coefficients.
+
+	Args:
+		runs: DataFrame with n_samples, n_variants, n_cores and
+			runtime_seconds columns, and optionally peak_mem_gb.
+		model: Current cost model dict of the workflow.
+	"""
+	mem_x, time_x = _features(runs['n_samples'], runs['n_variants'], runs['n_cores'])
+	fitted = {}
+
+	time_coef, _ = optimize.nnls(time_x, runs['runtime_seconds'].values.astype(float))
+	fitted.update(zip(TIME_COEFS, time_coef.tolist()))
+
+	if 'peak_mem_gb' in runs and runs['peak_mem_gb'].notna().sum() >= len(MEM_COEFS):
+		has_mem = runs['peak_mem_gb'].notna().values
+		mem_coef, _ = optimize.nnls(
+			mem_x[has_mem], runs['peak_mem_gb'].values[has_mem].astype(float)
+		)
+		fitted.update(zip(MEM_COEFS, mem_coef.tolist()))
+
+	return {k: v for k, v in fitted.items() if k in model}
+
+
+def load_runs(runs_file):
+	"""Load past runs for calibrate from a CSV of runtime.json paths.
+
+	Args:
+		runs_file: CSV with runtime_json, n_samples, n_variants and
+			instance_type columns.
+	"""
+	runs = pd.read_csv(runs_file)
+	records = []
+	for run in runs.itertuples(index=False):
+		with open_text(run.runtime_json) as f:
+			runtime = json.load(f)
+		records.append({
+			'n_samples': run.n_samples,
+			'n_variants': run.n_variants,
+			'n_cores': INSTANCE_TYPES[run.instance_type][0],
+			'runtime_seconds': runtime['runtime_seconds'],
+			'peak_mem_gb': runtime.get('peak_mem_gb', np.nan),
+		})
+	return pd.DataFrame(records)
+
+
+def _dx_file(path):
+	"""DXFile of a path in the UKB RAP project."""
+	resolver = dx_resolve.get_resolver()
+	return resolver.dx.DXFile(
+		resolver.resolve_path(path), project=resolver.project
+	)
+
+
+def open_text(path):
+	"""Open a local file, or a UKB RAP file if there is no local one."""
+	if os.path.exists(path):
+		return open(path)
+	resolver = dx_resolve.get_resolver()
+	return resolver.dx.open_dxfile(resolver.resolve_path(path), mode='r')
+
+
+def count_lines(path):
+	"""Number of non-empty lines of a file, e.g. samples in a split file."""
+	with open_text(path) as f:
+		return sum(1 for line in f if line.strip())
+
+
+def read_head_bytes(path, n_bytes):
+	"""First n_bytes of a local or UKB RAP file."""
+	if os.path.exists(path):
+		with open(path, 'rb') as f:
+			return f.read(n_bytes)
+	resolver = dx_resolve.get_resolver()
+	with resolver.dx.open_dxfile(resolver.resolve_path(path), mode='rb') as f:
+		return f.read(n_bytes)
+
+
+def pgen_dims(pgen_prefix):
+	"""(n_samples, n_variants) from the header of a .pgen file."""
+	header = read_head_bytes(f'{pgen_prefix}.pgen', 11)
+	if header[:2] != b'\x6c\x1b':
+		raise ValueError(f'{pgen_prefix}.pgen is not a .pgen file')
+	n_variants, n_samples = struct.unpack('<II', header[3:11])
+	return n_samples, n_variants
+
+
+def bed_dims(bed_prefix):
+	"""(n_samples, n_variants) of a .bed file from its .fam and size."""
+	n_samples = count_lines(f'{bed_prefix}.fam')
+	bed_file = f'{bed_prefix}.bed'
+	if os.path.exists(bed_file):
+		size = os.path.getsize(bed_file)
+	else:
+		size = _dx_file(bed_file).describe()['size']
+	return n_samples, (size - 3) // ((n_samples + 3) // 4)
+
+
+def count_variants(vars_json=None, meta_json=None):
+	"""Number of variants in a filtered variant table.
+
+	Uses 'n_variants' of meta_json if it has one, otherwise the number of
+	distinct variant IDs in the lists of vars_json.
+
+	Args:
+		vars_json: Path to a filtered_vars.json file.
+		meta_json: Path to a filtered_vars_meta.json file.
+	"""
+	if meta_json is not None:
+		try:
+			with open_text(meta_json) as f:
+				meta = json.load(f)
+			if 'n_variants' in meta:
+				return int(meta['n_variants'])
+		except (FileNotFoundError, ImportError):
+			pass
+
+	with open_text(vars_json) as f:
+		var_sets = json.load(f)
+
+	ids = set()
+	stack = [var_sets]
+	while stack:
+		obj = stack.pop()
+		if isinstance(obj, dict):
+			stack.extend(obj.values())
+		elif isinstance(obj, list):
+			if all(isinstance(v, str) for v in obj):
+				ids.update(obj)
+			else:
+				stack.extend(obj)
+	return len(ids)
+
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	if args.command == 'plan':
+		print(json.dumps(
+			plan(args.workflow, args.n_samples, args.n_variants, args.coeffs_file),
+			indent=4
+		))
+	else:
+		models = load_models(args.coeffs_file)
+		runs = load_runs(args.runs)
+		fitted = calibrate(runs, models[args.workflow])
+
+		saved = {}
+		if os.path.exists(args.coeffs_file):
+			with open(args.coeffs_file) as f:
+				saved = json.load(f)
+		saved.setdefault(args.workflow, {}).update(fitted)
+		with open(args.coeffs_file, 'w') as f:
+			json.dump(saved, f, indent=4)
+
+		print(f'Calibrated {args.workflow} on {len(runs)} runs:')
+		print(json.dumps(fitted, indent=4))
@@ -0,0 +1,278 @@
+"""Reuse outputs of earlier analyses run with identical inputs.
+
+Launchers pass ignore_reuse=True, so the platform never reuses a job,
+and rerunning a launch refits a model from scratch. run_or_reuse() runs
+a workflow only if no earlier analysis has the same launch key, a hash
+of everything that determines the outputs:
+
+* the workflow ID,
+* the workflow input, with file links as file IDs (file IDs are
+	immutable, so a new or changed file has a new ID),
+* the contents of local config files the workflow reads from its
+	docker image, e.g. a prs_aml model config, and
+* the docker image, as the registry digest of the pushed image.
+
+The instance type and priority are not part of the key.
+
+A local copy of an image tagged :latest can be older than the pushed
+image, so the digest is read from the registry. If it cannot be, the key
+uses a digest of the docker build directory and the WDL file instead,
+but outputs are not reused: images such as prs_aml's clone code from
+GitHub at build time, so their build directory does not identify them.
+
+Analyses are tagged with their key in the 'launch_key' property. If a
+'done' analysis has the same key, no analysis is run. If its outputs are
+in a different folder, a REUSE_POINTER_FILE is written to the new folder
+mapping each output file name to its file ID, as a file can only be in
+one folder of a project. dx_resolve follows these pointers, so
+downstream launchers find reused outputs at the new paths.
+
+Pass reuse=False (launcher flag --no-reuse) to always run.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+
+if __package__:
+	from .dx_resolve import REUSE_POINTER_FILE
+else:
+	from dx_resolve import REUSE_POINTER_FILE
+
+
+KEY_PROPERTY = 'launch_key'
+
+# Prefix of image digests computed from the docker build directory
+SOURCE_PREFIX = 'source:'
+
+
+def file_digest(path):
+	"""SHA-256 of a local file."""
+	digest = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(2 ** 20), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+
+def config_digest(path):
+	"""SHA-256 of a JSON config, ignoring formatting and key order."""
+	with open(path) as f:
+		config = json.load(f)
+	return hashlib.sha256(
+		json.dumps(config, sort_keys=True).encode()
+	).hexdigest()
+
+
+def wdl_docker_image(wdl_file):
+	"""Docker image of the first task of a WDL file."""
+	with open(wdl_file) as f:
+		match = re.search(r'docker:\s*"([^"]+)"', f.read())
+	return match.group(1) if match else None
+
+
+def registry_digest(image):
+	"""Digest of an image as pushed to its registry, or None if unknown.
+
+	Args:
+		image: Image name with a tag, e.g. 'gcr.io/project/image:latest'.
+	"""
+	if shutil.which('docker') is None:
+		return None
+	result = subprocess.run(
+		[
+			'docker', 'buildx', 'imagetools', 'inspect',
+			'--format', '{{json .Manifest}}', image
+		],
+		capture_output=True,
+		text=True
+	)
+	if result.returncode != 0:
+		return None
+	try:
+		digest = json.loads(result.stdout)['digest']
+	except (ValueError, KeyError, TypeError):
+		return None
+
+	repository, _, tag = image.rpartition(':')
+	if not repository or '/' in tag:
+		# No tag, only a registry port
+		repository = image
+	return f'{repository}@{digest}'
+
+
+def image_digest(wdl_file, build_dir=None, exclude=()):
+	"""Digest identifying the docker image a workflow runs.
+
+	The registry digest of the WDL's image if it can be read, otherwise
+	'source:' and a digest of the WDL file and the files in build_dir,
+	with which run_or_reuse() does not reuse outputs.
+
+	Args:
+		wdl_file: WDL file of the workflow.
+		build_dir: Docker build directory.
+		exclude: Names of files or directories of build_dir to leave
+			out, e.g. configs hashed separately with config_files.
+	"""
+	image = wdl_docker_image(wdl_file)
+	if image is not None:
+		digest = registry_digest(image)
+		if digest is not None:
+			return digest
+
+	digest = hashlib.sha256()
+	digest.update(file_digest(wdl_file).encode())
+	if build_dir is not None:
+		for dir_path, dir_names, file_names in os.walk(build_dir):
+			dir_names[:] = sorted(d for d in dir_names if d not in exclude)
+			for file_name in sorted(f for f in file_names if f not in exclude):
+				path = os.path.join(dir_path, file_name)
+				digest.update(os.path.relpath(path, build_dir).encode())
+				digest.update(file_digest(path).encode())
+	return f'{SOURCE_PREFIX}{digest.hexdigest()}'
+
+
+def _link_ids(value):
+	"""Replace dxlinks nested in a workflow input with file IDs."""
+	if isinstance(value, dict):
+		if '$dnanexus_link' in value:
+			link = value['$dnanexus_link']
+			return link['id'] if isinstance(link, dict) else link
+		return {k: _link_ids(v) for k, v in value.items()}
+	if isinstance(value, list):
+		return [_link_ids(v) for v in value]
+	return value
+
+
+def launch_key(workflow_id, workflow_input, config_files=(), image=None):
+	"""SHA-256 launch key of a workflow run.
+
+	Args:
+		workflow_id: Workflow ID.
+		workflow_input: Workflow input dict.
+		config_files: Local copies of config files the workflow reads.
+		image: Docker image digest from image_digest().
+	"""
+	content = {
+		'workflow': workflow_id,
+		'input': _link_ids(workflow_input),
+		'configs': {
+			os.path.basename(p): config_digest(p) for p in config_files
+		},
+		'image': image,
+	}
+	return hashlib.sha256(
+		json.dumps(content, sort_keys=True).encode()
+	).hexdigest()
+
+
+def find_done_analysis(dx, key, project):
+	"""Describe dict of the latest 'done' analysis with a key, or None."""
+	found = list(dx.find_analyses(
+		project=project,
+		properties={KEY_PROPERTY: key},
+		state='done',
+		describe=True
+	))
+	if not found:
+		return None
+	return max(found, key=lambda a: a['describe']['created'])['describe']
+
+
+def link_outputs(dx, analysis_desc, folder, project):
+	"""Write a pointer to an earlier analysis's output files in folder."""
+	files = {
+		obj['describe']['name']: obj['id']
+		for obj in dx.find_data_objects(
+			classname='file',
+			folder=analysis_desc['folder'],
+			recurse=False,
+			project=project,
+			describe={'fields': {'name': True}}
+		)
+		if obj['describe']['name'] != REUSE_POINTER_FILE
+	}
+	pointer = {
+		'analysis_id': analysis_desc['id'],
+		'folder': analysis_desc['folder'],
+		'files': files,
+	}
+	dx.upload_string(
+		json.dumps(pointer, indent=4),
+		project=project,
+		folder=folder,
+		name=REUSE_POINTER_FILE,
+		parents=True,
+		wait_on_close=True
+	)
+	return files
+
+
+def run_or_reuse(
+	dx,
+	workflow,
+	workflow_input,
+	folder,
+	name,
+	config_files=(),
+	image=None,
+	reuse=True,
+	**run_kwargs
+):
+	"""Run a workflow unless an earlier analysis has the same launch key.
+
+	Returns the new or reused analysis.
+
+	Args:
+		dx: dxpy module or stand-in.
+		workflow: DXWorkflow to run.
+		workflow_input: Workflow input dict.
+		folder: Output folder.
+		name: Analysis name.
+		config_files: Local copies of config files the workflow reads.
+		image: Docker image digest from image_digest(). Outputs are only
+			reused if it is a registry digest.
+		reuse: If False, always run, though the key is still recorded.
+		**run_kwargs: Passed to workflow.run, e.g. instance_type.
+	"""
+	project = dx.PROJECT_CONTEXT_ID
+	key = launch_key(workflow.get_id(), workflow_input, config_files, image)
+	print(f'Launch key: {key}', flush=True)
+
+	if reuse and (image is None or image.startswith(SOURCE_PREFIX)):
+		print(
+			'Not reusing outputs: no registry digest of the docker image',
+			flush=True
+		)
+		reuse = False
+
+	if reuse:
+		prior = find_done_analysis(dx, key, project)
+		if prior is not None:
+			if prior['folder'].rstrip('/') != folder.rstrip('/'):
+				files = link_outputs(dx, prior, folder, project)
+				print(
+					f'Linked {len(files)} output files of {prior["folder"]} '
+					f'into {folder}',
+					flush=True
+				)
+			print(
+				"Reusing outputs of analysis %s (%s)\n" % (prior['id'], name),
+				flush=True
+			)
+			return dx.DXAnalysis(prior['id'])
+
+	properties = dict(run_kwargs.pop('properties', None) or {})
+	properties[KEY_PROPERTY] = key
+	analysis = workflow.run(
+		workflow_input,
+		folder=folder,
+		name=name,
+		properties=properties,
+		**run_kwargs
+	)
+	print("Started analysis %s (%s)\n" % (analysis.get_id(), name), flush=True)
+	return analysis
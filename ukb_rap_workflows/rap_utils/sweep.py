@@ -0,0 +1,456 @@
+"""Launch a grid of workflow runs with bounded concurrency and resume.
+
+A sweep runs one of the launchers (e.g. prs_aml/launcher.py) once per
+point of a grid of phenotypes x populations x launcher arguments, in
+place of looping over launch_script.sh edits. Each launch is a separate
+launcher process, so launches run exactly as they would by hand.
+
+Launches are submitted from a pool of --max-submitting threads, and no
+new launch starts while --max-in-flight analyses of the sweep (counting
+those of earlier runs of the same manifest) are still running, so a
+sweep stays within the project's job quota. Every analysis a launch
+starts is counted, e.g. each shard of a scattered GWAS. A launch whose
+traceback ends in a transient API error (HTTP 429/5xx, connection
+errors, timeouts) is retried up to --max-retries times with exponential
+backoff.
+
+The submitted analysis IDs of each launch are appended to a JSONL
+manifest, keyed by a hash of the launcher and its arguments. Rerunning a sweep with the same
+manifest skips launches already submitted, so an interrupted sweep
+resumes where it stopped. Launches that failed are tried again.
+
+With NONLIN_PRS_LOCAL_PROJECT set, launchers and the sweep use the local
+stand-in for the workflow API in local_dx.
+
+Example usage:
+```
+python sweep.py -w prs_aml --populations all wb \\
+	--grid m=lgbm_v0h24,elastic_net_v0h24 --grid d=max30000_v2 \\
+	--manifest aml_sweep.jsonl
+```
+
+Args:
+
+* -w, --workflow: Launcher to run, the name of its directory in
+	ukb_rap_workflows, e.g. 'prs_aml'.
+* --manifest: JSONL manifest of submitted launches.
+* --phenos: Phenotypes to launch, or 'all' for every phenotype in
+	--pheno-metadata-file. Default: 'all'.
+* --pheno-metadata-file: Phenotype metadata JSON. Default:
+	'../../data/pheno_metadata.json' relative to this module.
+* --populations: Populations to launch, 'all' and/or 'wb'.
+	Default: 'all'.
+* --grid: Launcher argument and comma separated values, e.g.
+	'm=lgbm_v0h24,elastic_net_v0h24' or 'model-type=lasso,ridge'. One
+	letter names are short flags. May be repeated.
+* --extra-args: Arguments passed to every launch, e.g. '--dev'.
+* --max-submitting: Number of launches submitted at once. Default: 4.
+* --max-in-flight: Maximum number of running analyses. Default: 20.
+* --max-retries: Retries of a launch after transient errors. Default: 4.
+* --poll-seconds: Seconds between analysis state checks while the
+	in-flight limit is reached. Default: 60.
+* --dry-run: Print the launches that would be submitted.
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+if __package__:
+	from .local_dx import get_dxpy
+else:
+	from local_dx import get_dxpy
+
+
+WORKFLOWS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_PHENO_METADATA = os.path.join(
+	WORKFLOWS_DIR, '..', 'data', 'pheno_metadata.json'
+)
+TERMINAL_STATES = {'done', 'failed', 'terminated', 'partially_failed'}
+ANALYSIS_ID_RE = re.compile(
+	r'(?:Started|Reusing outputs of) analysis (analysis-\w+)'
+)
+# Exception types of transient failures, matched against the exception
+# line that ends a launcher's traceback, with or without a module prefix
+TRANSIENT_EXCEPTION_RE = re.compile(
+	r'^(?:[\w.]+\.)?(ServiceUnavailable|RateLimitExceeded|TooManyRequests'
+	r'|DXRetryableException|ConnectionError|ConnectionResetError'
+	r'|ConnectTimeout|ReadTimeout|Timeout|TimeoutError|ChunkedEncodingError'
+	r'|ProtocolError|LocalAPIError)(?::|$)'
+)
+# HTTP status of a failed request in an exception message, as in dxpy's
+# 'InternalError: ..., code 500.' or requests' '503 Server Error: ...'
+TRANSIENT_STATUS_RE = re.compile(
+	r'\bcode (429|50[0234])\b|\b(429|50[0234]) (Client|Server) Error\b'
+)
+# Last line of a traceback, 'module.ExceptionType: message'
+EXCEPTION_LINE_RE = re.compile(r'^[A-Za-z_][\w.]*(?::|$)')
+
+
+class LaunchError(Exception):
+	"""A launch failed and should not be retried."""
+
+
+class TransientLaunchError(LaunchError):
+	"""A launch failed with an error worth retrying."""
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument('-w', '--workflow', required=True)
+	parser.add_argument('--manifest', required=True)
+	parser.add_argument('--phenos', nargs='+', default=['all'])
+	parser.add_argument('--pheno-metadata-file', default=DEFAULT_PHENO_METADATA)
+	parser.add_argument(
+		'--populations',
+		nargs='+',
+		choices=['all', 'wb'],
+		default=['all']
+	)
+	parser.add_argument('--grid', action='append', default=[])
+	parser.add_argument('--extra-args', default='')
+	parser.add_argument('--max-submitting', type=int, default=4)
+	parser.add_argument('--max-in-flight', type=int, default=20)
+	parser.add_argument('--max-retries', type=int, default=4)
+	parser.add_argument('--poll-seconds', type=float, default=60)
+	parser.add_argument('--dry-run', action='store_true')
+
+	return parser.parse_args()
+
+
+def parse_grid(grid_args):
+	"""List of (flag, [values]) from --grid 'name=v1,v2' arguments."""
+	grid = []
+	for grid_arg in grid_args:
+		name, _, values = grid_arg.partition('=')
+		if not values:
+			raise ValueError(f'--grid {grid_arg} has no values')
+		flag = f'-{name}' if len(name) == 1 else f'--{name}'
+		grid.append((flag, values.split(',')))
+	return grid
+
+
+def expand_grid(workflow, phenos, populations, grid, extra_args=()):
+	"""Launch specs for every point of the grid.
+
+	Each spec is a dict with the workflow, launcher arguments and a key
+	identifying the launch.
+
+	Args:
+		workflow: Launcher directory name.
+		phenos: Phenotype names.
+		populations: 'all' and/or 'wb'.
+		grid: List of (flag, [values]).
+		extra_args: Arguments added to every launch.
+	"""
+	flags = [flag for flag, _ in grid]
+	specs = []
+	for pheno, population in itertools.product(phenos, populations):
+		for values in itertools.product(*[v for _, v in grid]):
+			launch_args = ['-p', pheno]
+			if population == 'wb':
+				launch_args.append('--wb')
+			for flag, value in zip(flags, values):
+				launch_args += [flag, value]
+			launch_args += list(extra_args)
+
+			specs.append({
+				'workflow': workflow,
+				'args': launch_args,
+				'key': launch_key(workflow, launch_args),
+			})
+	return specs
+
+
+def launch_key(workflow, launch_args):
+	"""Key of a launch, the same however its arguments are ordered."""
+	pairs = []
+	i = 0
+	while i < len(launch_args):
+		if i + 1 < len(launch_args) and not launch_args[i + 1].startswith('-'):
+			pairs.append([launch_args[i], launch_args[i + 1]])
+			i += 2
+		else:
+			pairs.append([launch_args[i]])
+			i += 1
+	content = json.dumps([workflow, sorted(pairs)])
+	return hashlib.sha1(content.encode()).hexdigest()[:16]
+
+
+class Manifest:
+	"""Append-only JSONL record of launches.
+
+	The last record of each key is its current status.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.records = {}
+		self._lock = threading.Lock()
+		if os.path.exists(path):
+			with open(path) as f:
+				for line in f:
+					if line.strip():
+						record = json.loads(line)
+						self.records[record['key']] = record
+
+	def submitted(self):
+		"""Records of launches that were submitted."""
+		return {
+			k: r for k, r in self.records.items() if r['status'] == 'submitted'
+		}
+
+	def append(self, record):
+		with self._lock:
+			self.records[record['key']] = record
+			with open(self.path, 'a') as f:
+				f.write(json.dumps(record) + '\n')
+				f.flush()
+				os.fsync(f.fileno())
+
+
+def record_analysis_ids(record):
+	"""Analysis IDs of a submitted manifest record.
+
+	Records written before launches could start several analyses have
+	one 'analysis_id'.
+	"""
+	if 'analysis_ids' in record:
+		return record['analysis_ids']
+	return [record['analysis_id']]
+
+
+class InFlightLimiter:
+	"""Block new launches while max_in_flight analyses are running.
+
+	Launches being submitted count towards the limit until their
+	analysis is added or they fail.
+
+	Args:
+		dx: dxpy module or stand-in used to check analysis states.
+		max_in_flight: Maximum running analyses plus launches in progress.
+		poll_seconds: Seconds between state checks while at the limit.
+		analysis_ids: IDs of analyses already launched.
+	"""
+
+	def __init__(self, dx, max_in_flight, poll_seconds, analysis_ids=()):
+		self.dx = dx
+		self.max_in_flight = max_in_flight
+		self.poll_seconds = poll_seconds
+		self.running = set(analysis_ids)
+		self.n_launching = 0
+		self._lock = threading.Lock()
+		self.refresh()
+
+	def refresh(self):
+		"""Drop analyses that have finished."""
+		with self._lock:
+			running = list(self.running)
+		finished = set()
+		for analysis_id in running:
+			try:
+				state = self.dx.DXAnalysis(analysis_id).describe(
+					fields={'state': True}
+				)['state']
+			except Exception as e:
+				# Unknown states count as running until the next check
+				print(f'Could not check {analysis_id}: {e}', flush=True)
+				continue
+			if state in TERMINAL_STATES:
+				finished.add(analysis_id)
+		with self._lock:
+			self.running -= finished
+
+	def acquire(self):
+		"""Wait for a free slot and reserve it for a launch."""
+		while True:
+			with self._lock:
+				if len(self.running) + self.n_launching < self.max_in_flight:
+					self.n_launching += 1
+					return
+				n_busy = len(self.running) + self.n_launching
+			print(
+				f'{n_busy} analyses in flight, waiting {self.poll_seconds:g} '
+				'seconds',
+				flush=True
+			)
+			time.sleep(self.poll_seconds)
+			self.refresh()
+
+	def release(self, analysis_ids=()):
+		"""Release a reserved slot, adding the analyses the launch started."""
+		with self._lock:
+			self.n_launching -= 1
+			self.running.update(analysis_ids)
+
+
+def is_transient_error(stderr):
+	"""Whether a launcher's stderr ends in a transient API error.
+
+	Only the exception line of the final traceback is checked, so line
+	numbers and ordinary output are never taken for HTTP status codes.
+	"""
+	traceback = stderr.rpartition('Traceback (most recent call last):')[2]
+	for line in reversed(traceback.splitlines()):
+		if EXCEPTION_LINE_RE.match(line):
+			return bool(
+				TRANSIENT_EXCEPTION_RE.match(line) or TRANSIENT_STATUS_RE.search(line)
+			)
+	return False
+
+
+def run_launcher(spec, python=sys.executable):
+	"""Run a launcher once and return the IDs of the analyses it started.
+
+	A launcher can start several analyses, e.g. gwas_plink2 with
+	--scatter. Raises TransientLaunchError for failures worth retrying
+	and LaunchError otherwise.
+	"""
+	launcher_dir = os.path.join(WORKFLOWS_DIR, spec['workflow'])
+	result = subprocess.run(
+		[python, 'launcher.py'] + spec['args'],
+		cwd=launcher_dir,
+		capture_output=True,
+		text=True
+	)
+	analysis_ids = list(dict.fromkeys(ANALYSIS_ID_RE.findall(result.stdout)))
+
+	# Analyses that started are submitted whatever happened after
+	if analysis_ids:
+		return analysis_ids
+
+	output = result.stdout[-2000:] + result.stderr[-2000:]
+	if is_transient_error(result.stderr):
+		raise TransientLaunchError(output)
+	raise LaunchError(output)
+
+
+def launch_with_retry(spec, max_retries, base_delay=5.0, max_delay=300.0):
+	"""(analysis IDs, attempts) of a launch retried on transient errors."""
+	for attempt in range(max_retries + 1):
+		try:
+			return run_launcher(spec), attempt + 1
+		except TransientLaunchError as e:
+			if attempt == max_retries:
+				raise
+			# Full jitter keeps retries of concurrent launches apart
+			delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+			print(
+				f'Transient error launching {spec["key"]}, retrying in '
+				f'{delay:.1f} seconds: {str(e).strip().splitlines()[-1]}',
+				flush=True
+			)
+			time.sleep(delay)
+
+
+def run_sweep(
+	specs,
+	manifest,
+	dx,
+	max_submitting=4,
+	max_in_flight=20,
+	max_retries=4,
+	poll_seconds=60
+):
+	"""Launch specs not yet submitted according to the manifest.
+
+	Returns the number of (submitted, failed) launches.
+	"""
+	submitted = manifest.submitted()
+	pending = [s for s in specs if s['key'] not in submitted]
+	print(
+		f'{len(specs)} launches in grid, {len(specs) - len(pending)} already '
+		f'submitted, {len(pending)} to launch',
+		flush=True
+	)
+
+	limiter = InFlightLimiter(
+		dx,
+		max_in_flight,
+		poll_seconds,
+		analysis_ids=[i for r in submitted.values() for i in record_analysis_ids(r)]
+	)
+	counts = {'submitted': 0, 'failed': 0}
+
+	def launch(spec):
+		record = {
+			'key': spec['key'],
+			'workflow': spec['workflow'],
+			'args': spec['args'],
+		}
+		analysis_ids = []
+		try:
+			analysis_ids, attempts = launch_with_retry(spec, max_retries)
+			record.update(
+				status='submitted', analysis_ids=analysis_ids, attempts=attempts
+			)
+			print(
+				f'Submitted {shlex.join(spec["args"])}: {", ".join(analysis_ids)}',
+				flush=True
+			)
+		except LaunchError as e:
+			record.update(status='failed', error=str(e)[-2000:])
+			print(f'Failed {shlex.join(spec["args"])}:\n{e}', flush=True)
+		finally:
+			limiter.release(analysis_ids)
+
+		record['time'] = time.time()
+		manifest.append(record)
+		counts[record['status']] += 1
+
+	with ThreadPoolExecutor(max_workers=max_submitting) as executor:
+		futures = []
+		for spec in pending:
+			limiter.acquire()
+			futures.append(executor.submit(launch, spec))
+		for future in futures:
+			future.result()
+
+	return counts['submitted'], counts['failed']
+
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	if args.phenos == ['all']:
+		with open(args.pheno_metadata_file) as f:
+			phenos = list(json.load(f))
+	else:
+		phenos = args.phenos
+
+	specs = expand_grid(
+		args.workflow,
+		phenos,
+		args.populations,
+		parse_grid(args.grid),
+		extra_args=shlex.split(args.extra_args)
+	)
+
+	if args.dry_run:
+		for spec in specs:
+			print(f'{spec["key"]}\t{shlex.join(spec["args"])}')
+		sys.exit(0)
+
+	n_submitted, n_failed = run_sweep(
+		specs,
+		Manifest(args.manifest),
+		get_dxpy(),
+		max_submitting=args.max_submitting,
+		max_in_flight=args.max_in_flight,
+		max_retries=args.max_retries,
+		poll_seconds=args.poll_seconds
+	)
+	print(f'Submitted {n_submitted} launches, {n_failed} failed')
+	if n_failed:
+		sys.exit(1)